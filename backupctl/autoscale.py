@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import os
+
+from backupctl import trash, zfs
+
+logger = logging.getLogger(__name__)
+
+Policy = collections.namedtuple("Policy", ["threshold", "step", "percent", "max_quota"])
+
+Change = collections.namedtuple(
+    "Change", ["customer", "vault", "fs", "old", "new", "reason"]
+)
+
+DEFAULT_POLICY = Policy(threshold=0.9, step=None, percent=20, max_quota=None)
+
+
+def load_policy(cfg, customer=None):
+    """Read the autoscale policy from the [autoscale] section. The values of
+    an ``[autoscale <customer>]`` section overwrite it for one customer.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+    :param string customer:                 Customer name.
+
+    :returns: Policy of the customer.
+    :rtype: `autoscale.Policy`
+
+    :raises ValueError: If a value can't be interpreted.
+    """
+    values = {}
+    for section in ["autoscale", "autoscale {0}".format(customer)]:
+        if cfg.has_section(section):
+            values.update(cfg[section])
+    threshold = float(values.get("threshold", DEFAULT_POLICY.threshold))
+    if threshold > 1:
+        # given in percent
+        threshold /= 100.0
+    if not 0 < threshold <= 1:
+        raise ValueError("threshold must be between 0 and 1")
+    step = _size(values.get("step"))
+    percent = float(values.get("percent", DEFAULT_POLICY.percent) or 0)
+    if percent < 0 or (step is not None and step < 0):
+        raise ValueError("step and percent must not be negative")
+    if not percent and not step:
+        raise ValueError("step or percent must be greater than 0")
+    return Policy(
+        threshold=threshold,
+        step=step,
+        percent=percent,
+        max_quota=_size(values.get("max_quota")),
+    )
+
+
+def _size(value):
+    if value is None or not value.strip() or value.strip().lower() == "none":
+        return None
+    try:
+        return zfs.parse_size(value.strip())
+    except ValueError:
+        raise ValueError("invalid size {0!r}".format(value))
+
+
+def grow(quota, policy):
+    """Calculate the next quota with the step and percentage of a policy,
+    whichever is larger. Quotas are rounded up to full GiB, or MiB below one
+    GiB.
+
+    :param int quota:               Current quota in bytes.
+    :param autoscale.Policy policy: Policy.
+
+    :returns: New quota in bytes.
+    :rtype: int
+    """
+    new = quota
+    if policy.step:
+        new = max(new, quota + policy.step)
+    if policy.percent:
+        new = max(new, int(quota * (1 + policy.percent / 100.0)))
+    unit = 1 << 30 if new >= 1 << 30 else 1 << 20
+    return -(-new // unit) * unit
+
+
+def plan(inventory, policies, customer=None):
+    """Find the customers and vaults above their threshold and calculate
+    their new quotas. Customers are never grown above the max quota of their
+    policy, vaults never above the (new) quota of their customer.
+
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param policies:                Function returning the
+                                    `autoscale.Policy` of a customer.
+    :param string customer:         Only check this customer.
+
+    :returns: Changes to do, customers before their vaults.
+    :rtype: `list` of `autoscale.Change`
+    """
+    pool = inventory.pool
+    customers = collections.OrderedDict()
+    vaults = collections.defaultdict(list)
+    fs = os.path.join(pool, customer) if customer else pool
+    for dataset in inventory.datasets(fs):
+        if trash.is_trash(pool, dataset.name):
+            continue
+        parts = dataset.name.split("/")[1:]
+        if len(parts) == 1:
+            customers[parts[0]] = dataset
+        elif len(parts) == 2:
+            vaults[parts[0]].append(dataset)
+
+    changes = []
+    for name, dataset in customers.items():
+        policy = policies(name)
+        customer_quota = dataset.quota
+        change = _check(name, None, dataset, policy, policy.max_quota)
+        if change is not None:
+            changes.append(change)
+            customer_quota = change.new
+        for vault in vaults[name]:
+            change = _check(
+                name, vault.name.split("/")[2], vault, policy, customer_quota
+            )
+            if change is not None:
+                changes.append(change)
+    return changes
+
+
+def _check(customer, vault, dataset, policy, cap):
+    if not dataset.quota:
+        return None
+    ratio = dataset.used / float(dataset.quota)
+    if ratio < policy.threshold:
+        return None
+    new = grow(dataset.quota, policy)
+    if new <= dataset.quota:
+        return None
+    reason = "used {0:.0f}% of {1}, threshold {2:.0f}%".format(
+        ratio * 100, zfs.format_size(dataset.quota), policy.threshold * 100
+    )
+    if cap is not None and new > cap:
+        if cap <= dataset.quota:
+            logger.warning(
+                "{0} can't be grown above {1}: {2}".format(
+                    dataset.name, zfs.format_size(cap), reason
+                )
+            )
+            return None
+        new = cap
+        reason += ", capped at {0}".format(zfs.format_size(cap))
+    return Change(customer, vault, dataset.name, dataset.quota, new, reason)
+
+
+def apply(changes, hist, inventory):
+    """Set the new quotas of all changes in one batch and write them to the
+    history.
+
+    :param list changes:            Changes returned by `plan`.
+    :param history.History hist:    History database.
+    :param zfs.Inventory inventory: Inventory of the pool.
+
+    :returns: True if all quotas were set, else False.
+    :rtype: bool
+    """
+    if not changes:
+        return True
+    quotas = collections.OrderedDict(
+        (change.fs, "{0}B".format(change.new)) for change in changes
+    )
+    if not zfs.set_quotas(quotas, inventory=inventory):
+        return False
+    hist.add_many(
+        [
+            (
+                change.customer,
+                "autoscale",
+                change.vault,
+                zfs.format_size(change.new),
+                None,
+                change.reason,
+            )
+            for change in changes
+        ]
+    )
+    return True
+
+
+def format_change(change):
+    """Format a change for the output.
+
+    :param autoscale.Change change: Change.
+
+    :rtype: string
+    """
+    return "grow {0} from {1} to {2} ({3})".format(
+        change.fs,
+        zfs.format_size(change.old),
+        zfs.format_size(change.new),
+        change.reason,
+    )
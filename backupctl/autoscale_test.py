@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module autoscale"""
+
+import configparser
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+from backupctl import autoscale, history, simulator, zfs
+
+G = 1 << 30
+
+
+@pytest.fixture()
+def sim():
+    pool = simulator.SimulatedPool("backup", size=1 << 50)
+    pool._create("backup/customer1", quota=100 * G)
+    pool._create("backup/customer1/www.example.com", quota=10 * G)
+    pool._create("backup/customer1/mail.example.com", quota=10 * G)
+    pool._create("backup/customer2", quota=10 * G)
+    pool._create("backup/customer2/db.example.com", quota=9 * G)
+    pool._create("backup/backupctl-trash", quota=1 * G)
+    pool.write("backup/customer1/www.example.com", int(9.5 * G))
+    pool.write("backup/customer1/mail.example.com", 1 * G)
+    pool.write("backup/customer2/db.example.com", int(8.5 * G))
+    pool.write("backup/backupctl-trash", 1 * G)
+    previous = zfs.set_backend(pool)
+    yield pool
+    zfs.set_backend(previous)
+
+
+@pytest.fixture()
+def hist(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    return history.History(engine)
+
+
+def test_load_policy():
+    cfg = configparser.ConfigParser()
+    assert autoscale.load_policy(cfg) == autoscale.DEFAULT_POLICY
+    cfg.read_dict(
+        {
+            "autoscale": {"threshold": "80", "step": "5G", "max_quota": "1T"},
+            "autoscale customer1": {"percent": "0", "max_quota": "none"},
+        }
+    )
+    assert autoscale.load_policy(cfg, "customer2") == autoscale.Policy(
+        0.8, 5 * G, 20, 1 << 40
+    )
+    assert autoscale.load_policy(cfg, "customer1") == autoscale.Policy(
+        0.8, 5 * G, 0, None
+    )
+    cfg["autoscale"]["step"] = "5 apples"
+    with pytest.raises(ValueError, match="invalid size '5 apples'"):
+        autoscale.load_policy(cfg)
+    cfg["autoscale"]["step"] = "none"
+    with pytest.raises(ValueError, match="step or percent"):
+        autoscale.load_policy(cfg, "customer1")
+    cfg["autoscale"]["percent"] = "-10"
+    with pytest.raises(ValueError, match="must not be negative"):
+        autoscale.load_policy(cfg)
+
+
+@pytest.mark.parametrize(
+    "quota, policy, new",
+    [
+        (10 * G, autoscale.Policy(0.9, None, 20, None), 12 * G),
+        (10 * G, autoscale.Policy(0.9, 5 * G, 20, None), 15 * G),
+        (10 * G, autoscale.Policy(0.9, None, 1, None), 11 * G),
+        (100 << 20, autoscale.Policy(0.9, None, 10, None), 110 << 20),
+    ],
+)
+def test_grow(quota, policy, new):
+    assert autoscale.grow(quota, policy) == new
+
+
+def test_plan_and_apply(sim, hist):
+    policies = {
+        "customer1": autoscale.Policy(0.9, None, 20, None),
+        "customer2": autoscale.Policy(0.8, None, 50, 12 * G),
+    }
+    inventory = zfs.Inventory("backup")
+    changes = autoscale.plan(inventory, policies.get)
+    assert [(c.fs, c.old, c.new) for c in changes] == [
+        ("backup/customer1/www.example.com", 10 * G, 12 * G),
+        ("backup/customer2", 10 * G, 12 * G),
+        ("backup/customer2/db.example.com", 9 * G, 12 * G),
+    ]
+    assert changes[0].reason == "used 95% of 10.0G, threshold 90%"
+    assert changes[1].reason.endswith(", capped at 12.0G")
+    assert autoscale.plan(inventory, policies.get, "customer1") == changes[:1]
+    assert autoscale.apply(changes, hist, inventory)
+    assert zfs.Inventory("backup").quota("backup/customer2/db.example.com") == 12 * G
+    assert inventory.quota("backup/customer1/www.example.com") == 12 * G
+    session = sqlalchemy.orm.sessionmaker(bind=hist._engine)()
+    entries = session.query(history.HistoryEntry).order_by(history.HistoryEntry.id)
+    assert [(e.command, e.vault, e.size, e.reason) for e in entries][0] == (
+        "autoscale",
+        "www.example.com",
+        "12.0G",
+        "used 95% of 10.0G, threshold 90%",
+    )
+    assert autoscale.plan(zfs.Inventory("backup"), policies.get) == []
+
+
+def test_apply_sets_quotas_with_zfs_set(sim, hist):
+    # like zfs, the simulator refuses quotas in channel programs, they are
+    # only checked there and set with zfs set
+    inventory = zfs.Inventory("backup")
+    changes = autoscale.plan(
+        inventory, lambda customer: autoscale.Policy(0.9, None, 20, None)
+    )
+    calls = dict(sim.calls)
+    assert autoscale.apply(changes, hist, inventory)
+    assert sim.calls["program"] - calls.get("program", 0) == 1
+    assert sim.calls["set"] - calls.get("set", 0) == len(changes)
+    # capped at the quota of the customer
+    assert zfs.Inventory("backup").quota("backup/customer2/db.example.com") == 10 * G
+    # the check in the channel program still refuses a quota below the usage
+    too_small = [
+        autoscale.Change(
+            "customer1",
+            "www.example.com",
+            "backup/customer1/www.example.com",
+            12 * G,
+            5 * G,
+            "test",
+        )
+    ]
+    assert not autoscale.apply(too_small, hist, zfs.Inventory("backup"))
+    assert zfs.Inventory("backup").quota("backup/customer1/www.example.com") == 12 * G
+
+
+def test_plan_at_cap(sim):
+    sim._create("backup/customer3", quota=10 * G)
+    sim._create("backup/customer3/www.example.com", quota=10 * G)
+    sim.write("backup/customer3/www.example.com", int(9.5 * G))
+    policies = {
+        "customer1": autoscale.Policy(1, None, 20, None),
+        "customer2": autoscale.Policy(1, None, 20, None),
+        "customer3": autoscale.Policy(0.9, None, 20, 10 * G),
+    }
+    assert autoscale.plan(zfs.Inventory("backup"), policies.get) == []
+
+
+def test_plan_without_growth(sim):
+    # load_policy refuses such a policy, plan doesn't grow by nothing
+    policies = {
+        "customer1": autoscale.Policy(0.9, None, 0, None),
+        "customer2": autoscale.Policy(0.9, None, 0, None),
+    }
+    assert autoscale.grow(10 * G, policies["customer1"]) == 10 * G
+    assert autoscale.plan(zfs.Inventory("backup"), policies.get) == []
@@ -2,17 +2,37 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import configparser
+import atexit
+import collections
+import gzip
+import io
 import logging
 import os
+import signal
 import sys
+import threading
+import time
+from datetime import datetime
 
 import sqlalchemy
-from xdg import BaseDirectory
 
-from backupctl import zfs
-from backupctl.dirvish import Dirvish
-from backupctl.history import History
+from backupctl import autoscale as autoscaler
+from backupctl import churn
+from backupctl import compact as compaction
+from backupctl import database, du
+from backupctl import excludes as exclude_analysis
+from backupctl import export as exporter
+from backupctl import hook, manifest, migrations, protocol
+from backupctl import runner as backup_runner
+from backupctl import runs as backup_runs
+from backupctl import schedule as scheduler
+from backupctl import simulator, spool, walk, zfs
+from backupctl.daemon import EventDaemon
+from backupctl.dirvish import Dirvish, expired_images
+from backupctl.history import History, format_entry, snapshot_entry
+from backupctl.replicate import Replicator, format_result, lag
+from backupctl.settings import config
+from backupctl.trash import Trash, is_trash
 from backupctl.version import __version__
 
 LOG = logging.getLogger(__name__)
@@ -37,7 +57,32 @@ def main():
         All subcommands that modify zfs file system and dirvish configurations.
         See the manpage (man 8 backupctl) for more inforation.
         """,
-        choices=["new", "resize", "remove", "log"]
+        choices=[
+            "new",
+            "resize",
+            "remove",
+            "log",
+            "status",
+            "apply",
+            "reap",
+            "restore-from-trash",
+            "images",
+            "expire",
+            "autoscale",
+            "replicate",
+            "export",
+            "compact",
+            "ingest",
+            "daemon",
+            "daemon-status",
+            "runs",
+            "schedule",
+            "run",
+            "regen-configs",
+            "analyze-excludes",
+            "du",
+            "churn",
+        ],
     )
     parser.add_argument(
         "-v",
@@ -58,6 +103,16 @@ def main():
         Needed if different from option vault.
         """,
     )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=None,
+        help="""\
+        Exclude pattern added to the default excludes of a vault, can be
+        given several times. Stored for regen-configs, checked against the
+        newest image for analyze-excludes.
+        """,
+    )
     parser.add_argument(
         "-n",
         "--customer",
@@ -77,6 +132,189 @@ def main():
         MB, GB and so on.
         """,
     )
+    parser.add_argument(
+        "-f",
+        "--file",
+        required=False,
+        default=None,
+        help="""\
+        Manifest (.yaml or .csv) with the desired customers and vaults.
+        """,
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="""\
+        Remove customers and vaults which aren't in the manifest.
+        """,
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="""\
+        Only print what would be done.
+        """,
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="""\
+        Run the backups of all vaults.
+        """,
+    )
+    parser.add_argument(
+        "--now",
+        action="store_true",
+        help="""\
+        Destroy removed file systems immediately instead of moving them to the
+        trash.
+        """,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=None,
+        help="""\
+        Number of parallel zfs operations, threads or backups. Defaults to 8
+        for apply and to the configuration for reap, expire, replicate and
+        run.
+        """,
+    )
+    parser.add_argument(
+        "--loop",
+        action="store_true",
+        help="""\
+        Keep running and repeat the command after the configured interval.
+        """,
+    )
+    parser.add_argument(
+        "--keep",
+        required=False,
+        type=int,
+        default=None,
+        help="""\
+        Number of newest images to keep when expiring images.
+        """,
+    )
+    parser.add_argument(
+        "--older-than",
+        required=False,
+        type=int,
+        default=None,
+        help="""\
+        Expire images older than this number of days.
+        """,
+    )
+    parser.add_argument(
+        "--mount",
+        required=False,
+        default=None,
+        help="""\
+        Image to mount read-only.
+        """,
+    )
+    parser.add_argument(
+        "--umount",
+        required=False,
+        default=None,
+        help="""\
+        Image to unmount.
+        """,
+    )
+    parser.add_argument(
+        "--command",
+        dest="log_command",
+        required=False,
+        default=None,
+        help="""\
+        Only show log entries of this command, e.g. resize.
+        """,
+    )
+    parser.add_argument(
+        "--since",
+        required=False,
+        type=parse_datetime,
+        default=None,
+        help="""\
+        Only show log entries, runs or export rows at or after this time,
+        e.g. 2024-01-31 or "2024-01-31 12:00".
+        """,
+    )
+    parser.add_argument(
+        "--until",
+        required=False,
+        type=parse_datetime,
+        default=None,
+        help="""\
+        Only show log entries or runs before this time.
+        """,
+    )
+    parser.add_argument(
+        "--limit",
+        required=False,
+        type=int,
+        default=20,
+        help="""\
+        Number of log entries or exclude candidates to show. Defaults to 20.
+        """,
+    )
+    parser.add_argument(
+        "--before",
+        required=False,
+        type=parse_cursor,
+        default=None,
+        help="""\
+        Only show log entries older than this time and id, e.g.
+        2024-01-31T12:00:00.123456,42, as printed after a page of the log.
+        """,
+    )
+    parser.add_argument(
+        "--table",
+        required=False,
+        default="history",
+        choices=list(exporter.TABLES),
+        help="""\
+        Table to export. Defaults to history.
+        """,
+    )
+    parser.add_argument(
+        "--format",
+        required=False,
+        default="jsonl",
+        choices=exporter.FORMATS,
+        help="""\
+        Format of the export, JSON lines or CSV. Defaults to jsonl.
+        """,
+    )
+    parser.add_argument(
+        "--since-id",
+        required=False,
+        type=int,
+        default=None,
+        help="""\
+        Only export rows with a larger id, e.g. the last id of the previous
+        export.
+        """,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=False,
+        default=None,
+        help="""\
+        File to export to instead of the standard output. Files ending with .gz
+        are compressed.
+        """,
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="""\
+        Compress the export with gzip.
+        """,
+    )
     parser.add_argument(
         "--version",
         action="version",
@@ -88,157 +326,1145 @@ def main():
     args = parser.parse_args()
 
     cfg = config()
+    zfs_backend(cfg)
 
-    if not os.path.exists(os.path.dirname(cfg["database"].get("path"))):
-        os.makedirs(os.path.dirname(cfg["database"].get("path")))
+    engine = open_database(cfg)
 
-    try:
-        engine = sqlalchemy.create_engine(cfg["database"].get("fullpath"))
-        LOG.debug(
-            "Opened database {0} successfully".format(cfg["database"].get("fullpath"))
+    hist = History(engine)
+    dirvish = Dirvish(engine)
+    trash = Trash(engine)
+
+    spool_directory = hook.spool_directory(cfg)
+    if spool_directory is not None and args.command != "ingest":
+        # the commands see the backups of hooks which ran since the last one
+        try:
+            ingest(hist, dirvish, spool_directory)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            LOG.error("Couldn't ingest the spooled hook events: {0}".format(e))
+
+    if args.command == "new":
+        try:
+            with database.session_scope(engine):
+                new(
+                    hist,
+                    dirvish,
+                    cfg["zfs"]["pool"],
+                    cfg["zfs"]["root"],
+                    args.customer,
+                    args.vault,
+                    args.size,
+                    args.dirvish_client,
+                    inventory=zfs_inventory(cfg),
+                )
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool and ZFS Root must be specified in the "
+                "configuration file. Exit now."
+            )
+            sys.exit(1)
+    elif args.command == "resize":
+        try:
+            with database.session_scope(engine):
+                resize(
+                    hist,
+                    cfg["zfs"]["pool"],
+                    args.customer,
+                    args.vault,
+                    args.size,
+                    inventory=zfs_inventory(cfg),
+                )
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+    elif args.command == "remove":
+        try:
+            with database.session_scope(engine):
+                if args.now:
+                    remove(hist, cfg["zfs"]["pool"], args.customer, args.vault)
+                else:
+                    remove(
+                        hist,
+                        cfg["zfs"]["pool"],
+                        args.customer,
+                        args.vault,
+                        trash=trash,
+                        inventory=zfs_inventory(cfg),
+                    )
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+    elif args.command == "log":
+        history_show(
+            hist,
+            customer=args.customer,
+            vault=args.vault,
+            command=args.log_command,
+            since=args.since,
+            until=args.until,
+            limit=args.limit,
+            before=args.before,
         )
-    except sqlalchemy.exc.ArgumentError as e:
-        LOG.error(
-            "Couldn't open database {0}. Exit now.".format(
-                cfg["database"].get("fullpath")
+    elif args.command == "apply":
+        try:
+            apply(
+                hist,
+                dirvish,
+                zfs_inventory(cfg),
+                cfg["zfs"]["root"],
+                args.file,
+                prune=args.prune,
+                dry_run=args.dry_run,
+                jobs=args.jobs or 8,
+                trash=None if args.now else trash,
+            )
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool and ZFS Root must be specified in the "
+                "configuration file. Exit now."
+            )
+            sys.exit(1)
+    elif args.command == "status":
+        try:
+            status(zfs_inventory(cfg), args.customer)
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+    elif args.command == "reap":
+        try:
+            reap(
+                hist,
+                trash,
+                cfg["zfs"]["pool"],
+                jobs=args.jobs or cfg.getint("trash", "jobs", fallback=1),
+                rate=cfg.getfloat("trash", "rate", fallback=None),
+                max_freeing=trash_max_freeing(cfg),
+                interval=cfg.getfloat("trash", "interval", fallback=10),
+                dry_run=args.dry_run,
+                inventory=zfs_inventory(cfg),
+            )
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+        except ValueError as e:
+            LOG.error("Invalid trash configuration: {0}. Exit now.".format(e))
+            sys.exit(1)
+    elif args.command == "images":
+        try:
+            images(
+                hist,
+                cfg["zfs"]["pool"],
+                cfg["zfs"]["root"],
+                args.customer,
+                args.vault,
+                keep=args.keep,
+                older_than=args.older_than,
+                mount=args.mount,
+                umount=args.umount,
+                dry_run=args.dry_run,
+            )
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool and ZFS Root must be specified in the "
+                "configuration file. Exit now."
+            )
+            sys.exit(1)
+    elif args.command == "expire":
+        try:
+            expire(
+                hist,
+                cfg["zfs"]["root"],
+                args.customer,
+                args.vault,
+                jobs=args.jobs or cfg.getint("expire", "jobs", fallback=8),
+                rate=cfg.getfloat("expire", "rate", fallback=None),
+                interval=cfg.getfloat("expire", "interval", fallback=10),
+                dry_run=args.dry_run,
             )
+        except KeyError as e:
+            LOG.error("ZFS Root must be specified in the configuration file. Exit now.")
+            sys.exit(1)
+        except ValueError as e:
+            LOG.error("Invalid expire configuration: {0}. Exit now.".format(e))
+            sys.exit(1)
+    elif args.command == "autoscale":
+        try:
+            inventory = zfs_inventory(cfg)
+            autoscaler.load_policy(cfg)
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+        except ValueError as e:
+            LOG.error("Invalid autoscale configuration: {0}. Exit now.".format(e))
+            sys.exit(1)
+        autoscale(
+            hist,
+            inventory,
+            lambda customer: autoscaler.load_policy(cfg, customer),
+            args.customer,
+            dry_run=args.dry_run,
+            loop=args.loop,
+            interval=cfg.getfloat("autoscale", "interval", fallback=300),
+        )
+    elif args.command == "replicate":
+        try:
+            inventory = zfs_inventory(cfg)
+            replicator = zfs_replicator(cfg, engine, args.jobs)
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool and replication target must be specified in the "
+                "configuration file. Exit now."
+            )
+            sys.exit(1)
+        except ValueError as e:
+            LOG.error("Invalid replicate configuration: {0}. Exit now.".format(e))
+            sys.exit(1)
+        replicate(
+            hist,
+            replicator,
+            inventory,
+            args.customer,
+            args.vault,
+            dry_run=args.dry_run,
+        )
+    elif args.command == "export":
+        export(
+            engine,
+            args.table,
+            args.format,
+            output=args.output,
+            compress=args.gzip,
+            since=args.since,
+            since_id=args.since_id,
+        )
+    elif args.command == "compact":
+        try:
+            retention = compact_retention(cfg)
+        except ValueError as e:
+            LOG.error("Invalid compact configuration: {0}. Exit now.".format(e))
+            sys.exit(1)
+        compactor = compaction.Compactor(
+            engine,
+            cfg.get(
+                "compact",
+                "archive",
+                fallback=os.path.join(
+                    os.path.dirname(cfg["database"].get("path")), "archive"
+                ),
+            ),
+            rollups=cfg.getboolean("compact", "rollups", fallback=True),
+        )
+        compact(compactor, retention, dry_run=args.dry_run)
+    elif args.command == "ingest":
+        if spool_directory is None:
+            LOG.error("No spool directory configured in [hooks]. Exit now.")
+            sys.exit(1)
+        print("ingested {0} events".format(ingest(hist, dirvish, spool_directory)))
+    elif args.command == "daemon":
+        if hook.socket_path(cfg) is None:
+            LOG.error("No socket configured in [hooks]. Exit now.")
+            sys.exit(1)
+        daemon = EventDaemon(
+            dirvish,
+            hist,
+            hook.socket_path(cfg),
+            batch_size=cfg.getint("hooks", "batch_size", fallback=100),
+            interval=cfg.getfloat("hooks", "batch_ms", fallback=50) / 1000,
+        )
+        try:
+            run_daemon(daemon)
+        except OSError as e:
+            LOG.error("Couldn't run the daemon: {0}. Exit now.".format(e))
+            sys.exit(1)
+    elif args.command == "daemon-status":
+        if hook.socket_path(cfg) is None:
+            LOG.error("No socket configured in [hooks]. Exit now.")
+            sys.exit(1)
+        try:
+            daemon_status(hook.socket_path(cfg))
+        except (OSError, ValueError) as e:
+            LOG.error("The daemon doesn't answer: {0}. Exit now.".format(e))
+            sys.exit(1)
+    elif args.command == "runs":
+        show_runs(
+            backup_runs.report(
+                engine, client=args.vault, since=args.since, until=args.until
+            )
+        )
+    elif args.command == "schedule":
+        try:
+            inventory = zfs_inventory(cfg)
+            settings = schedule_settings(cfg)
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+        except ValueError as e:
+            LOG.error("Invalid schedule configuration: {0}. Exit now.".format(e))
+            sys.exit(1)
+        schedule(
+            engine,
+            dirvish,
+            inventory,
+            cfg.get("zfs", "root", fallback=None),
+            settings,
+            dry_run=args.dry_run,
+        )
+    elif args.command == "run":
+        if not args.all and not args.customer:
+            LOG.error("Customer or --all is needed")
+            sys.exit(1)
+        try:
+            inventory = zfs_inventory(cfg)
+            runner = zfs_runner(cfg, args.jobs)
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+        except ValueError as e:
+            LOG.error("Invalid run configuration: {0}. Exit now.".format(e))
+            sys.exit(1)
+        run_backups(
+            engine,
+            dirvish,
+            runner,
+            inventory,
+            cfg.get("zfs", "root", fallback=None),
+            customer=args.customer,
+            dry_run=args.dry_run,
+        )
+    elif args.command == "regen-configs":
+        try:
+            inventory = zfs_inventory(cfg)
+            root = cfg["zfs"]["root"]
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool and ZFS Root must be specified in the "
+                "configuration file. Exit now."
+            )
+            sys.exit(1)
+        regen_configs(
+            dirvish,
+            inventory,
+            root,
+            args.customer,
+            args.vault,
+            client=args.dirvish_client,
+            excludes=args.exclude,
+            jobs=args.jobs or 8,
+            dry_run=args.dry_run,
+        )
+    elif args.command == "analyze-excludes":
+        try:
+            root = cfg["zfs"]["root"]
+        except KeyError as e:
+            LOG.error("ZFS Root must be specified in the configuration file. Exit now.")
+            sys.exit(1)
+        analyze_excludes(
+            root,
+            args.customer,
+            args.vault,
+            patterns=args.exclude,
+            limit=args.limit,
+            jobs=args.jobs or 8,
+        )
+    elif args.command == "du":
+        try:
+            root = cfg["zfs"]["root"]
+        except KeyError as e:
+            LOG.error("ZFS Root must be specified in the configuration file. Exit now.")
+            sys.exit(1)
+        cache = cfg.get(
+            "du",
+            "cache",
+            fallback=os.path.join(
+                os.path.dirname(cfg["database"].get("path")), "du-cache"
+            ),
+        )
+        disk_usage(
+            root,
+            args.customer,
+            args.vault,
+            cache=du.Cache(cache) if cache else None,
+            jobs=args.jobs or 4,
+        )
+    elif args.command == "churn":
+        try:
+            root = cfg["zfs"]["root"]
+        except KeyError as e:
+            LOG.error("ZFS Root must be specified in the configuration file. Exit now.")
+            sys.exit(1)
+        show_churn(
+            engine,
+            root,
+            args.customer,
+            args.vault,
+            window=cfg.getint("churn", "window", fallback=7),
+            jobs=args.jobs or 4,
+            pool=cfg.get("zfs", "pool", fallback=None),
         )
+    elif args.command == "restore-from-trash":
+        try:
+            with database.session_scope(engine):
+                restore_from_trash(
+                    hist, trash, zfs_inventory(cfg), args.customer, args.vault
+                )
+        except KeyError as e:
+            LOG.error(
+                "ZFS Pool must be specified in the configuration file. Exit now."
+            )
+            sys.exit(1)
+    else:
         sys.exit(1)
-    except sqlalchemy.exc.OperationalError as e:
+    sys.exit(0)
+
+
+def backup_start():
+    """Add an entry to the database when a dirvish backup is started.
+
+    This function should be triggered by dirvish pre-server.
+    """
+    cfg = config()
+    engine = open_database(cfg)
+    dirvish = Dirvish(engine)
+    with database.session_scope(engine):
+        dirvish.backup_start()
+
+
+def backup_stop():
+    """Add an entry to the database when a dirvish backup is stopped.
+
+    This function should be triggered by dirvish post-server.
+    """
+    cfg = config()
+    engine = open_database(cfg)
+    zfs_backend(cfg)
+    pool = None
+    if cfg.getboolean("zfs", "snapshots", fallback=False):
+        pool = cfg.get("zfs", "pool", fallback=None)
+    dirvish = Dirvish(engine)
+    hist = History(engine)
+    with database.session_scope(engine):
+        entry = dirvish.backup_stop(pool, cfg.get("zfs", "root", fallback=None))
+        if entry.snapshot is not None:
+            hist.add_many([snapshot_entry(entry.snapshot)])
+
+
+def add_events(records):
+    """Add events of the dirvish hooks to the database directly, when the
+    daemon doesn't run. Events which the daemon committed are skipped.
+
+    :param list records:    Events as created by `spool.event`.
+    """
+    cfg = config()
+    engine = open_database(cfg)
+    Dirvish(engine).ingest(records, hist=History(engine))
+
+
+def run_daemon(daemon):
+    """Run the daemon until SIGTERM or SIGINT, then write the queued events.
+
+    :param daemon.EventDaemon daemon:   Daemon.
+
+    :raises OSError: If the socket can't be created.
+    """
+
+    def stop(signum, frame):
+        # shutdown waits for serve, which runs in this thread
+        threading.Thread(target=daemon.stop).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    daemon.serve()
+
+
+def daemon_status(path):
+    """Show the queue depth, the number of events and the commit latency of
+    the daemon.
+
+    :param string path: Unix socket of the daemon.
+
+    :raises OSError: If the daemon doesn't run.
+    :raises ValueError: If the answer is invalid.
+    """
+    stats = protocol.request(path, {"type": "stats"})
+    print("queue: {0}".format(stats["queue"]))
+    print(
+        "events: {0} committed, {1} duplicated".format(
+            stats["events"], stats["duplicates"]
+        )
+    )
+    print("batches: {0}, {1} failed".format(stats["batches"], stats["failures"]))
+    print(
+        "commit latency: {0:.1f} ms last, {1:.1f} ms average, {2:.1f} ms max".format(
+            stats["commit_last_ms"], stats["commit_avg_ms"], stats["commit_max_ms"]
+        )
+    )
+
+
+def ingest(hist, dirvish, directory):
+    """Add the events the dirvish hooks wrote to the spool directory to the
+    database in one transaction, then remove them from the spool.
+
+    :param history.History hist:    History object.
+    :param dirvish.Dirvish dirvish: Dirvish object.
+    :param string directory:        Spool directory.
+
+    :returns: Number of added events, without the duplicated ones.
+    :rtype: int
+
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+    events = spool.read(directory)
+    if not events:
+        return 0
+    entries = dirvish.ingest([event.record for event in events], hist=hist)
+    # events stay in the spool if the transaction fails, the next ingest skips
+    # the ones added if the spool can't be cleaned up
+    spool.remove(events)
+    return len(entries)
+
+
+def open_database(cfg):
+    """Open the configured database and upgrade its schema, exit if that's
+    not possible.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :rtype: `sqlalchemy.engine.base.Engine`
+    """
+    try:
+        engine = database.engine_from_config(cfg)
+    except (sqlalchemy.exc.ArgumentError, OSError) as e:
         LOG.error(
-            "Couldn't open database {0}. Exit now.".format(
-                cfg["database"].get("fullpath")
+            "Couldn't open database {0}: {1}. Exit now.".format(
+                cfg["database"].get("fullpath"), e
+            )
+        )
+        sys.exit(1)
+    try:
+        migrations.upgrade(engine)
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        LOG.error("Couldn't upgrade the database schema: {0}. Exit now.".format(e))
+        sys.exit(1)
+    return engine
+
+
+def zfs_backend(cfg):
+    """Set up the zfs storage backend, either the real zfs command line tools
+    ("cli", the default) or the in-memory simulator ("simulator").
+
+    The simulated pool is loaded from the state file of the [simulator]
+    section and saved back on exit. If there is no state file yet, a pool with
+    the configured number of customers and vaults is created.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :returns: The backend in use.
+    :rtype: `zfs.Backend`
+    """
+    if cfg.get("zfs", "backend", fallback="cli") != "simulator":
+        return zfs.get_backend()
+    pool = cfg.get("zfs", "pool", fallback="backup")
+    state = cfg.get("simulator", "state", fallback=None)
+    latency = cfg.getfloat("simulator", "latency", fallback=0)
+    if state and os.path.exists(state):
+        backend = simulator.SimulatedPool.load(state, latency=latency)
+    else:
+        backend = simulator.SimulatedPool.synthetic(
+            pool,
+            cfg.getint("simulator", "customers", fallback=0),
+            cfg.getint("simulator", "vaults", fallback=0),
+            root=cfg.get("zfs", "root", fallback=os.path.join(os.sep, "srv", "backup")),
+            latency=latency,
+        )
+    if state:
+        atexit.register(backend.save, state)
+    zfs.set_backend(backend)
+    return backend
+
+
+def zfs_inventory(cfg):
+    """Create the zfs inventory of the configured pool.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :returns: Inventory of the pool.
+    :rtype: `zfs.Inventory`
+
+    :raises KeyError: If no pool is configured.
+    """
+    return zfs.Inventory(
+        cfg["zfs"]["pool"], ttl=cfg["zfs"].getfloat("cache_ttl", fallback=30)
+    )
+
+
+def trash_max_freeing(cfg):
+    """Read the freeing limit of the [trash] section.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :returns: Number of bytes or None if there is no limit.
+    :rtype: int
+
+    :raises ValueError: If the size can't be interpreted.
+    """
+    max_freeing = cfg.get("trash", "max_freeing", fallback=None)
+    if not max_freeing:
+        return None
+    return zfs.parse_size(max_freeing)
+
+
+def zfs_replicator(cfg, engine, jobs=None):
+    """Create the replicator of the [replicate] section.
+
+    :param configparser.ConfigParser cfg:       Configuration object.
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param int jobs:                            Number of parallel transfers,
+                                                defaults to the configuration.
+
+    :rtype: `replicate.Replicator`
+
+    :raises KeyError: If no target is configured.
+    :raises ValueError: If the bandwidth can't be interpreted.
+    """
+    section = cfg["replicate"]
+    bandwidth = section.get("bandwidth", None)
+    if bandwidth:
+        try:
+            bandwidth = zfs.parse_size(bandwidth)
+        except ValueError:
+            raise ValueError("invalid bandwidth {0!r}".format(section["bandwidth"]))
+    return Replicator(
+        engine,
+        section["target"],
+        ssh=section.get("ssh", None) or None,
+        jobs=jobs or section.getint("jobs", fallback=2),
+        bandwidth=bandwidth or None,
+    )
+
+
+def zfs_runner(cfg, jobs=None):
+    """Create the backup runner of the [run] section. The jobs option of a
+    ``[run <customer>]`` section caps the backups of one customer.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+    :param int jobs:                        Number of parallel backups,
+                                            defaults to the configuration.
+
+    :rtype: `runner.Runner`
+
+    :raises KeyError: If no pool is configured.
+    :raises ValueError: If an option can't be interpreted.
+    """
+    customer_jobs = {None: cfg.getint("run", "customer_jobs", fallback=1)}
+    for section in cfg.sections():
+        if section.startswith("run "):
+            customer_jobs[section[4:].strip()] = cfg.getint(
+                section, "jobs", fallback=customer_jobs[None]
+            )
+    hours = cfg.getfloat("run", "hours", fallback=8)
+    return backup_runner.Runner(
+        jobs=jobs or cfg.getint("run", "jobs", fallback=4),
+        customer_jobs=customer_jobs,
+        retries=cfg.getint("run", "retries", fallback=2),
+        backoff=cfg.getfloat("run", "backoff", fallback=300),
+        window=hours * 3600 if hours else None,
+        command=cfg.get("run", "command", fallback="dirvish").split(),
+        pool=cfg["zfs"]["pool"],
+    )
+
+
+def compact_retention(cfg):
+    """Read the retention of the tables from the [compact] section.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :returns: Days to keep by table name, only for tables with a retention.
+    :rtype: `collections.OrderedDict`
+
+    :raises ValueError: If a retention isn't a positive number.
+    """
+    retention = collections.OrderedDict()
+    for table in compaction.TABLES:
+        days = cfg.getfloat("compact", "{0}_days".format(table), fallback=None)
+        if days is None:
+            continue
+        if days <= 0:
+            raise ValueError("{0}_days must be positive".format(table))
+        retention[table] = days
+    return retention
+
+
+def schedule_settings(cfg):
+    """Read the backup window and its limits from the [schedule] section.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :returns: Settings by option name.
+    :rtype: dict
+
+    :raises ValueError: If an option can't be interpreted.
+    """
+    section = cfg["schedule"] if cfg.has_section("schedule") else {}
+    settings = {
+        "start": scheduler.parse_time(section.get("start", "22:00")),
+        "hours": float(section.get("hours", 8)),
+        "concurrency": int(section.get("concurrency", 4)),
+        "io": None,
+        "throughput": None,
+        "default_duration": float(section.get("default_duration", 3600)),
+        "days": float(section.get("days", 30)),
+        "path": section.get("path", os.path.join(os.sep, "etc", "cron.d", "backupctl")),
+        "user": section.get("user", "root"),
+    }
+    for option in ["io", "throughput"]:
+        if section.get(option):
+            try:
+                settings[option] = zfs.parse_size(section.get(option))
+            except ValueError:
+                raise ValueError("invalid {0} {1!r}".format(option, section[option]))
+    if settings["concurrency"] < 1:
+        raise ValueError("concurrency must be at least 1")
+    return settings
+
+
+def schedule(engine, dirvish, inventory, root, settings, dry_run=False):
+    """Assign start times to the backups of all vaults within the backup
+    window and write them to a cron file.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param dirvish.Dirvish dirvish:             Dirvish object.
+    :param zfs.Inventory inventory:             Inventory of the pool.
+    :param string root:                         Backup root path.
+    :param dict settings:                       Settings, see
+                                                `schedule_settings`.
+    :param bool dry_run:                        Print the cron file instead
+                                                of writing it.
+    """
+    clients = {}
+    for dataset in inventory.datasets():
+        parts = dataset.name.split("/")
+        if len(parts) == 3 and root:
+            clients["/".join(parts[1:])] = dirvish.config_client(
+                root, parts[1], parts[2]
+            )
+    jobs = scheduler.jobs(
+        inventory,
+        clients,
+        scheduler.durations(engine, settings["days"]),
+        default_seconds=settings["default_duration"],
+        throughput=settings["throughput"],
+    )
+    slots = scheduler.plan(jobs, settings["concurrency"], settings["io"])
+    window = int(settings["hours"] * 60)
+    makespan = scheduler.makespan(slots)
+    report = [
+        "{0} vaults, {1} with measured durations".format(
+            len(slots), sum(1 for slot in slots if slot.job.measured)
+        ),
+        "peak concurrency {0} of {1}".format(
+            scheduler.peak(slots), settings["concurrency"]
+        ),
+        "makespan {0} of a {1} window".format(
+            backup_runs.format_duration(makespan * 60),
+            backup_runs.format_duration(window * 60),
+        ),
+    ]
+    content = scheduler.crontab(
+        slots,
+        settings["start"],
+        user=settings["user"],
+        header=["written by backupctl schedule, changes are overwritten"] + report,
+    )
+    if dry_run:
+        print(content, end="")
+    else:
+        try:
+            scheduler.write(settings["path"], content)
+        except OSError as e:
+            LOG.error("Couldn't write {0}: {1}".format(settings["path"], e))
+            sys.exit(1)
+        print("wrote {0}".format(settings["path"]))
+    for line in report:
+        print(line)
+    if makespan > window:
+        LOG.warning(
+            "The backups need {0} minutes more than the window.".format(
+                makespan - window
             )
         )
-        sys.exit(1)
 
-    hist = History(engine)
-    dirvish = Dirvish(engine)
 
-    if args.command == "new":
-        try:
-            new(
-                hist,
-                dirvish,
-                cfg["zfs"]["pool"],
-                cfg["zfs"]["root"],
-                args.customer,
-                args.vault,
-                args.size,
-                args.dirvish_client,
+def run_backups(engine, dirvish, runner, inventory, root, customer=None, dry_run=False):
+    """Run the backups of all vaults or of the vaults of one customer, the
+    vault with the oldest successful backup first, and print every finished
+    backup with the queue depth and the throughput.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param dirvish.Dirvish dirvish:             Dirvish object.
+    :param runner.Runner runner:                Backup runner.
+    :param zfs.Inventory inventory:             Inventory of the pool.
+    :param string root:                         Backup root path.
+    :param string customer:                     Only vaults of this customer.
+    :param bool dry_run:                        Only print the order of the
+                                                backups.
+    """
+    if not inventory.refresh():
+        sys.exit(1)
+    clients = {}
+    for dataset in inventory.datasets():
+        parts = dataset.name.split("/")
+        if len(parts) == 3 and root:
+            clients["/".join(parts[1:])] = dirvish.config_client(
+                root, parts[1], parts[2]
             )
-        except KeyError as e:
-            LOG.error(
-                "ZFS Pool and ZFS Root must be specified in the "
-                "configuration file. Exit now."
+    tasks = backup_runner.tasks(
+        inventory, clients, backup_runner.last_success(engine), customer
+    )
+    if not tasks:
+        print("Nothing to do")
+        return
+    if dry_run:
+        for task in tasks:
+            print(
+                "{0}: last success {1}, at most {2} of {3} at once".format(
+                    task.vault,
+                    task.last_success or "never",
+                    runner.limit(task.customer),
+                    task.customer,
+                )
             )
-            sys.exit(1)
-    elif args.command == "resize":
-        try:
-            resize(hist, cfg["zfs"]["pool"], args.customer, args.vault, args.size)
-        except KeyError as e:
-            LOG.error(
-                "ZFS Pool must be specified in the configuration file. Exit now."
+        return
+
+    def progress(result):
+        stats = runner.stats()
+        if result.error is None:
+            outcome = "ok in {0}, {1} written".format(
+                backup_runs.format_duration(result.seconds),
+                zfs.format_size(result.written),
             )
-            sys.exit(1)
-    elif args.command == "remove":
-        try:
-            remove(hist, cfg["zfs"]["pool"], args.customer, args.vault)
-        except KeyError as e:
-            LOG.error(
-                "ZFS Pool must be specified in the configuration file. Exit now."
+        else:
+            outcome = "failed after attempt {0}: {1}".format(
+                result.attempts, result.error
             )
-            sys.exit(1)
-    elif args.command == "log":
-        history_show(hist)
-    else:
+        print(
+            "{0} {1} | queued {2}, running {3}, {4}/s".format(
+                result.vault,
+                outcome,
+                stats["queued"],
+                stats["running"],
+                zfs.format_size(stats["throughput"]),
+            )
+        )
+
+    runner.run(tasks, callback=progress)
+    stats = runner.stats()
+    print(
+        "{0} ok, {1} failed, {2} retries, {3} not started in the window, "
+        "{4} written in {5}".format(
+            stats["succeeded"],
+            stats["failed"],
+            stats["retries"],
+            stats["skipped"],
+            zfs.format_size(stats["written"]),
+            backup_runs.format_duration(stats["elapsed"]),
+        )
+    )
+    if stats["failed"] or stats["skipped"]:
         sys.exit(1)
-    sys.exit(0)
 
 
-def backup_start():
-    """Add an entry to the database when a dirvish backup is started.
+def regen_configs(
+    dirvish,
+    inventory,
+    root,
+    customer=None,
+    vault=None,
+    client=None,
+    excludes=None,
+    jobs=8,
+    dry_run=False,
+):
+    """Regenerate the dirvish configurations of all vaults, of the vaults of
+    a customer or of one vault and print the number of changed, unchanged
+    and failed configurations. A client or excludes given for one vault are
+    stored as its settings first.
 
-    This function should be triggered by dirvish pre-server.
+    :param dirvish.Dirvish dirvish:     Dirvish object.
+    :param zfs.Inventory inventory:     Inventory of the pool.
+    :param string root:                 Backup root path.
+    :param string customer:             Only vaults of this customer.
+    :param string vault:                Only this vault.
+    :param string client:               Client of the vault.
+    :param list excludes:               Exclude patterns of the vault added
+                                        to the default excludes.
+    :param int jobs:                    Number of parallel renderings.
+    :param bool dry_run:                Only print the configurations which
+                                        would change.
     """
-    cfg = config()
-    if not os.path.exists(os.path.dirname(cfg["database"].get("path"))):
-        os.makedirs(os.path.dirname(cfg["database"].get("path")))
-    try:
-        engine = sqlalchemy.create_engine(cfg["database"].get("fullpath"))
-        LOG.debug(
-            "Opened database {0} successfully".format(cfg["database"].get("fullpath"))
-        )
-    except (sqlalchemy.exc.ArgumentError, sqlalchemy.exc.OperationalError) as e:
-        LOG.error(
-            "Couldn't open database {0}. Exit now.".format(
-                cfg["database"].get("fullpath")
+    if vault and not customer:
+        LOG.error("Customer is needed")
+        sys.exit(1)
+    if (client or excludes) and not vault:
+        LOG.error("Customer and vault are needed to store a client or excludes")
+        sys.exit(1)
+    if not inventory.refresh():
+        sys.exit(1)
+    fs = inventory.pool
+    if customer:
+        fs = os.path.join(fs, customer)
+        if vault:
+            fs = os.path.join(fs, vault)
+    vaults = [
+        tuple(dataset.name.split("/")[1:])
+        for dataset in inventory.datasets(fs)
+        if len(dataset.name.split("/")) == 3
+        and not is_trash(inventory.pool, dataset.name)
+    ]
+    if not vaults:
+        print("Nothing to do")
+        return
+    if (client or excludes) and not dry_run:
+        dirvish.set_vault_config(customer, vault, client, excludes)
+    results = dirvish.regenerate_configs(root, vaults, jobs=jobs, dry_run=dry_run)
+    counts = collections.Counter(result.status for result in results)
+    for result in results:
+        if result.status == "changed":
+            print(
+                "{0}/{1}: {2}".format(
+                    result.customer,
+                    result.vault,
+                    "would change" if dry_run else "changed",
+                )
+            )
+        elif result.status == "failed":
+            print(
+                "{0}/{1}: failed: {2}".format(
+                    result.customer, result.vault, result.error
+                )
             )
+    print(
+        "{0} changed, {1} unchanged, {2} failed".format(
+            counts["changed"], counts["unchanged"], counts["failed"]
         )
+    )
+    if counts["failed"]:
         sys.exit(1)
-    dirvish = Dirvish(engine)
-    dirvish.backup_start()
 
 
-def backup_stop():
-    """Add an entry to the database when a dirvish backup is stopped.
+def analyze_excludes(root, customer, vault, patterns=None, limit=20, jobs=8):
+    """Scan the newest image of a vault and print the exclude patterns which
+    would save the most bytes per night, or the saving of proposed
+    patterns.
 
-    This function should be triggered by dirvish post-server.
+    :param string root:     Backup root path.
+    :param string customer: Customer name.
+    :param string vault:    Vault name or server hostname.
+    :param list patterns:   Proposed exclude patterns to check.
+    :param int limit:       Number of candidates.
+    :param int jobs:        Number of threads of the scan.
     """
-    cfg = config()
-    if not os.path.exists(os.path.dirname(cfg["database"].get("path"))):
-        os.makedirs(os.path.dirname(cfg["database"].get("path")))
-    try:
-        engine = sqlalchemy.create_engine(cfg["database"].get("fullpath"))
-        LOG.debug(
-            "Opened database {0} successfully".format(cfg["database"].get("fullpath"))
+    if not customer or not vault:
+        LOG.error("Customer and vault are needed")
+        sys.exit(1)
+    tree = exclude_analysis.latest_tree(os.path.join(root, customer, vault))
+    if tree is None:
+        LOG.error("No image of {0}/{1} found".format(customer, vault))
+        sys.exit(1)
+    result = exclude_analysis.scan(tree, patterns, jobs=jobs)
+    total = result.tree.root.usage()
+    if patterns:
+        candidates = [
+            exclude_analysis.Candidate(pattern, usage)
+            for pattern, usage in result.excluded.items()
+        ]
+        saved = exclude_analysis.Usage(
+            *(sum(column) for column in zip(*result.excluded.values()))
         )
-    except sqlalchemy.exc.ArgumentError as e:
-        LOG.error(
-            "Couldn't open database {0}. Exit now.".format(
-                cfg["database"].get("fullpath")
-            )
+        candidates.append(exclude_analysis.Candidate("total", saved))
+        # the excluded files are part of the image
+        total = exclude_analysis.Usage(*(a + b for a, b in zip(total, saved)))
+    else:
+        candidates = exclude_analysis.candidates(result, limit=limit)
+    print(
+        "{0}: {1} in {2} files, {3} in {4} files written by the last "
+        "backup".format(
+            tree,
+            zfs.format_size(total.bytes),
+            total.files,
+            zfs.format_size(total.churn),
+            total.churn_files,
         )
-        sys.exit(1)
-    except sqlalchemy.exc.OperationalError as e:
-        LOG.error(
-            "Couldn't open database {0}. Exit now.".format(
-                cfg["database"].get("fullpath")
-            )
+    )
+    if not candidates:
+        print("No candidates")
+        return
+    rows = [["PATTERN", "SIZE", "FILES", "CHURN", "CHANGED", "SHARE"]]
+    for candidate in candidates:
+        usage = candidate.usage
+        rows.append(
+            [
+                candidate.pattern,
+                zfs.format_size(usage.bytes),
+                str(usage.files),
+                zfs.format_size(usage.churn),
+                str(usage.churn_files),
+                "{0:.1%}".format(usage.churn / total.churn if total.churn else 0),
+            ]
         )
-        sys.exit(1)
-    dirvish = Dirvish(engine)
-    dirvish.backup_stop()
+    print_table(rows)
 
 
-def config():
-    """Read the configuration files. If no configuration exists, write the
-    default configuration to the directory ~/.config.
+def disk_usage(root, customer, vault=None, cache=None, jobs=4):
+    """Print the bytes each image of a vault holds alone and shares with the
+    other images, or the usage of each vault of a customer.
 
-    :returns: Configuration object.
-    :rtype: `configparser.ConfigParser`
+    :param string root:     Backup root path.
+    :param string customer: Customer name.
+    :param string vault:    Vault name or server hostname.
+    :param du.Cache cache:  Cache of the scanned images.
+    :param int jobs:        Number of images scanned in parallel.
     """
-    cfg = configparser.ConfigParser()
-    cfg.read(os.path.join(os.sep, "etc", "backupctl.ini"))
-    cfg.read(os.path.join(BaseDirectory.xdg_config_home, "backupctl.ini"))
-    cfg.read("backupctl.ini")
+    if not customer:
+        LOG.error("Customer is needed")
+        sys.exit(1)
+    if vault:
+        vaults = [vault]
+    else:
+        try:
+            vaults = sorted(
+                entry.name
+                for entry in os.scandir(os.path.join(root, customer))
+                if entry.is_dir(follow_symlinks=False)
+            )
+        except OSError as e:
+            LOG.error("Couldn't read customer {0}: {1}".format(customer, e))
+            sys.exit(1)
+    rows = []
+    cached = scanned = 0
+    for name in vaults:
+        total, images = du.vault_usage(root, customer, name, cache=cache, jobs=jobs)
+        cached += total.cached
+        scanned += total.scanned
+        if vault:
+            rows.append(["IMAGE", "FILES", "SIZE", "UNIQUE", "SHARED"])
+            for image in images:
+                rows.append(
+                    [
+                        image.image,
+                        str(image.files),
+                        zfs.format_size(image.bytes),
+                        zfs.format_size(image.unique),
+                        zfs.format_size(image.shared),
+                    ]
+                )
+            rows.append(
+                ["total", str(total.files), zfs.format_size(total.bytes), "", ""]
+            )
+        else:
+            if not rows:
+                rows.append(["VAULT", "IMAGES", "FILES", "SIZE"])
+            rows.append(
+                [
+                    name,
+                    str(total.images),
+                    str(total.files),
+                    zfs.format_size(total.bytes),
+                ]
+            )
+    if rows:
+        print_table(rows)
+    print("{0} images scanned, {1} cached".format(scanned, cached))
 
-    if not cfg.has_section("database"):
-        cfg.add_section("database")
-    if not cfg.has_option("database", "type"):
-        cfg["database"]["type"] = "sqlite"
-    if not cfg.has_option("database", "path"):
-        cfg["database"]["path"] = os.path.join(
-            os.sep, "var", "lib", "backupctl", "backupctl.db"
-        )
-    if not cfg.has_option("database", "fullpath"):
-        cfg["database"]["fullpath"] = "{0}:///{1}".format(
-            cfg["database"].get("type"), cfg["database"].get("path")
+
+def show_churn(engine, root, customer=None, vault=None, window=7, jobs=4, pool=None):
+    """Measure the images which are new since the last call and print the
+    bytes and files each vault writes per day, averaged over the last images,
+    and the sum of each customer.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param string root:     Backup root path.
+    :param string customer: Customer name, None for all customers.
+    :param string vault:    Vault name or server hostname.
+    :param int window:      Number of images of the rolling average.
+    :param int jobs:        Number of vaults measured in parallel.
+    :param string pool:     zfs pool name, to skip its trash.
+    """
+    if vault and not customer:
+        LOG.error("Customer is needed")
+        sys.exit(1)
+    customers = [customer] if customer else sorted(_subdirectories(root))
+    vaults = []
+    for name in customers:
+        if pool and is_trash(pool, os.path.join(pool, name)):
+            continue
+        for vault_name in (
+            [vault] if vault else sorted(_subdirectories(os.path.join(root, name)))
+        ):
+            vaults.append((name, vault_name))
+    measured = churn.ChurnTracker(engine).update(root, vaults, jobs=jobs)
+    try:
+        results = churn.report(engine, customer, vault, window=window)
+    except ValueError as e:
+        LOG.error("Invalid churn window: {0}".format(e))
+        sys.exit(1)
+    if not results:
+        print("No vault has two measured images")
+        return
+    rows = [["VAULT", "IMAGE", "NEW", "NEW FILES", "IMAGES", "PER DAY", "FILES/DAY"]]
+    for result in results:
+        rows.append(
+            [
+                "{0}/{1}".format(result.customer, result.vault),
+                result.image,
+                zfs.format_size(result.new_bytes),
+                str(result.new_files),
+                str(result.images),
+                zfs.format_size(int(result.bytes_per_day)),
+                "{0:.0f}".format(result.files_per_day),
+            ]
         )
-    return cfg
+    if not vault:
+        rows.append(["", "", "", "", "", "", ""])
+        for name, (bytes_per_day, files_per_day) in churn.customers(results).items():
+            rows.append(
+                [
+                    name,
+                    "",
+                    "",
+                    "",
+                    "",
+                    zfs.format_size(int(bytes_per_day)),
+                    "{0:.0f}".format(files_per_day),
+                ]
+            )
+    print_table(rows, left=(0, 1))
+    print("{0} images measured".format(measured))
 
 
-def new(hist, dirvish, pool, root, customer, vault=None, size=None, client=None):
+def new(
+    hist,
+    dirvish,
+    pool,
+    root,
+    customer,
+    vault=None,
+    size=None,
+    client=None,
+    inventory=None,
+):
     """Create a new customer or a new vault/server.
 
     :param history.History hist:    History database.
@@ -248,6 +1474,8 @@ def new(hist, dirvish, pool, root, customer, vault=None, size=None, client=None)
     :param string customer:         Customer name.
     :param string vault:            Vault name or server hostname.
     :param string size:             Quota for this customer or vault.
+    :param zfs.Inventory inventory: Inventory to check for existing file
+                                    systems.
     """
     if not customer:
         LOG.error("Customer is needed")
@@ -261,7 +1489,7 @@ def new(hist, dirvish, pool, root, customer, vault=None, size=None, client=None)
     else:
         fs = os.path.join(pool, customer)
         path = None
-    fs_status = zfs.new_filesystem(fs, path, size)
+    fs_status = zfs.new_filesystem(fs, path, size, inventory=inventory)
     if fs_status:
         hist.add(customer, "create", vault, size)
         if vault is not None:
@@ -271,7 +1499,7 @@ def new(hist, dirvish, pool, root, customer, vault=None, size=None, client=None)
             hist.add(customer, "config", vault)
 
 
-def resize(hist, pool, customer, vault=None, size=None):
+def resize(hist, pool, customer, vault=None, size=None, inventory=None):
     """Resize an existing customer or vault.
 
     :param history.History hist:    History database.
@@ -279,6 +1507,7 @@ def resize(hist, pool, customer, vault=None, size=None):
     :param string customer:         Customer name.
     :param string vault:            Vault name or server hostname.
     :param string size:             Quota for this customer or vault.
+    :param zfs.Inventory inventory: Inventory to look up the used size.
     """
     if not customer:
         LOG.error("Customer is needed")
@@ -290,21 +1519,35 @@ def resize(hist, pool, customer, vault=None, size=None):
         fs = os.path.join(pool, customer, vault)
     else:
         fs = os.path.join(pool, customer)
-    zfs.resize_filesystem(fs, size)
+    zfs.resize_filesystem(fs, size, inventory=inventory)
     hist.add(customer, "resize", vault, size)
 
 
-def remove(hist, pool, customer, vault=None):
-    """Remove a customer or vault.
+def remove(hist, pool, customer, vault=None, trash=None, inventory=None):
+    """Remove a customer or vault. With a trash the file system is only moved
+    to the trash and destroyed later by `reap`, else it's destroyed
+    immediately.
 
     :param history.History hist:    History database.
     :param string pool:             ZFS pool name.
     :param string customer:         Customer name.
     :param string vault:            Vault name or server hostname.
+    :param trash.Trash trash:       Trash to move the file system to.
+    :param zfs.Inventory inventory: Inventory of the pool, needed with a
+                                    trash.
     """
     if not customer:
         LOG.error("Customer is needed")
         sys.exit(1)
+    if trash is not None:
+        entry = trash.move(inventory, customer, vault)
+        if entry is None:
+            sys.exit(1)
+        hist.add(customer, "trash", vault)
+        print(
+            'moved "{0}" to trash, undo with restore-from-trash'.format(entry.dataset)
+        )
+        return
     if vault:
         fs = os.path.join(pool, customer, vault)
     else:
@@ -315,13 +1558,722 @@ def remove(hist, pool, customer, vault=None):
     hist.add(customer, "remove", vault)
 
 
-def history_show(history):
+def reap(
+    hist,
+    trash,
+    pool,
+    jobs=1,
+    rate=None,
+    max_freeing=None,
+    interval=10,
+    dry_run=False,
+    inventory=None,
+):
+    """Destroy the file systems in the trash and wait until the pool has freed
+    their space. File systems in the trash without a trash entry are only
+    reported.
+
+    :param history.History hist:    History database.
+    :param trash.Trash trash:       Trash.
+    :param string pool:             ZFS pool name.
+    :param int jobs:                Number of parallel destroys.
+    :param float rate:              Maximum number of destroys per second.
+    :param int max_freeing:         Don't start a destroy while the pool has
+                                    more bytes than this left to free.
+    :param float interval:          Seconds between checks of the pool.
+    :param bool dry_run:            Only print what would be destroyed.
+    :param zfs.Inventory inventory: Inventory of the pool.
+    """
+    for orphan in trash.orphans(inventory or zfs.Inventory(pool)):
+        LOG.warning(
+            '"{0}" has no trash entry, destroy or rename it manually'.format(orphan)
+        )
+    entries = trash.entries()
+    for entry in entries:
+        print(
+            '{0} - {1} removed from "{2}"'.format(
+                entry.datetime, entry.trash_dataset, entry.dataset
+            )
+        )
+    if not entries:
+        print("Nothing to do")
+    if dry_run or not entries:
+        return
+
+    def reaped(entry, ok):
+        if ok:
+            hist.add(entry.customer, "reap", entry.vault)
+        else:
+            LOG.error('failed: destroy "{0}"'.format(entry.trash_dataset))
+
+    started = time.monotonic()
+    done, failed = trash.reap(
+        pool,
+        jobs=jobs,
+        rate=rate,
+        max_freeing=max_freeing,
+        interval=interval,
+        callback=reaped,
+    )
+    freeing = wait_freeing(trash, pool, interval)
+    print(
+        "{0} ok, {1} failed, {2}".format(
+            done,
+            failed,
+            manifest.format_throughput(done + failed, time.monotonic() - started),
+        )
+    )
+    if failed or freeing is None:
+        sys.exit(1)
+
+
+def wait_freeing(trash, pool, interval=10):
+    """Print the progress of the pool freeing the space of destroyed file
+    systems until it's done.
+
+    :param trash.Trash trash:   Trash.
+    :param string pool:         ZFS pool name.
+    :param float interval:      Seconds between checks.
+
+    :returns: Bytes left to free or None if the pool couldn't be checked.
+    :rtype: int
+    """
+
+    def progress(freeing):
+        if freeing:
+            print("{0} left to free".format(zfs.format_size(freeing)))
+
+    return trash.wait_freeing(pool, interval=interval, callback=progress)
+
+
+def restore_from_trash(hist, trash, inventory, customer, vault=None):
+    """Restore the most recently removed file system of a customer or vault
+    from the trash.
+
+    :param history.History hist:    History database.
+    :param trash.Trash trash:       Trash.
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param string customer:         Customer name.
+    :param string vault:            Vault name or server hostname.
+    """
+    if not customer:
+        LOG.error("Customer is needed")
+        sys.exit(1)
+    entry = trash.restore(inventory, customer, vault)
+    if entry is None:
+        sys.exit(1)
+    hist.add(customer, "restore", vault)
+    print('restored "{0}"'.format(entry.dataset))
+
+
+def images(
+    hist,
+    pool,
+    root,
+    customer,
+    vault,
+    keep=None,
+    older_than=None,
+    mount=None,
+    umount=None,
+    dry_run=False,
+):
+    """List, expire, mount or unmount the images of a vault kept as zfs
+    snapshots.
+
+    Expiring destroys the snapshots with one ``zfs destroy``, which doesn't
+    depend on the number of files in the images. Mounted images are found
+    below ``<root>/.images/<customer>/<vault>/<image>``.
+
+    :param history.History hist:    History database.
+    :param string pool:             ZFS pool name.
+    :param string root:             Backup root path.
+    :param string customer:         Customer name.
+    :param string vault:            Vault name or server hostname.
+    :param int keep:                Expire all but the newest images.
+    :param int older_than:          Expire images older than this number of
+                                    days.
+    :param string mount:            Image to mount.
+    :param string umount:           Image to unmount.
+    :param bool dry_run:            Only print the images to expire.
+    """
+    if not customer or not vault:
+        LOG.error("Customer and vault are needed")
+        sys.exit(1)
+    fs = os.path.join(pool, customer, vault)
+    if mount or umount:
+        path = os.path.join(root, ".images", customer, vault, mount or umount)
+        if mount:
+            ok = zfs.mount_snapshot("{0}@{1}".format(fs, mount), path)
+        else:
+            ok = zfs.umount_snapshot(path)
+        if not ok:
+            sys.exit(1)
+        if mount:
+            print(path)
+        return
+    snapshots = zfs.list_snapshots(fs)
+    if keep is None and older_than is None:
+        rows = [["IMAGE", "USED", "REFER", "CREATION"]]
+        for snapshot in snapshots:
+            rows.append(
+                [
+                    snapshot.name.split("@", 1)[1],
+                    zfs.format_size(snapshot.used),
+                    zfs.format_size(snapshot.refer),
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(snapshot.creation)),
+                ]
+            )
+        print_table(rows, left=(0, 3))
+        return
+    expired = snapshots
+    if keep is not None:
+        expired = expired[: max(len(expired) - keep, 0)]
+    if older_than is not None:
+        cutoff = time.time() - older_than * 86400
+        expired = [snapshot for snapshot in expired if snapshot.creation < cutoff]
+    names = [snapshot.name.split("@", 1)[1] for snapshot in expired]
+    for name in names:
+        print('expire image "{0}"'.format(name))
+    if not names:
+        print("Nothing to do")
+    if dry_run or not names:
+        return
+    if not zfs.destroy_snapshots(fs, names):
+        sys.exit(1)
+    hist.add_many(
+        [(customer, "expire", vault, None, snapshot.name) for snapshot in expired]
+    )
+
+
+def expire(
+    hist,
+    root,
+    customer=None,
+    vault=None,
+    jobs=8,
+    rate=None,
+    interval=10,
+    dry_run=False,
+):
+    """Remove the expired dirvish images of all vaults, of a customer or of a
+    vault.
+
+    The summary of each expired image is removed first, so dirvish doesn't
+    use a half removed image as reference. The image trees of a vault are then
+    removed in parallel by a `walk.Remover`.
+
+    :param history.History hist:    History database.
+    :param string root:             Backup root path.
+    :param string customer:         Customer name.
+    :param string vault:            Vault name or server hostname.
+    :param int jobs:                Number of threads.
+    :param float rate:              Maximum number of unlinks per second.
+    :param float interval:          Seconds between progress reports.
+    :param bool dry_run:            Only print the expired images.
+    """
+    if vault and not customer:
+        LOG.error("Customer is needed")
+        sys.exit(1)
+    vaults = []
+    for name in [customer] if customer else sorted(_subdirectories(root)):
+        if name.startswith("."):
+            continue
+        if vault:
+            vault_names = [vault]
+        else:
+            vault_names = sorted(_subdirectories(os.path.join(root, name)))
+        vaults.extend((name, vault_name) for vault_name in vault_names)
+
+    expired = []
+    for name, vault_name in vaults:
+        images = expired_images(os.path.join(root, name, vault_name))
+        for image in images:
+            print('expire image "{0}" of {1}/{2}'.format(image.name, name, vault_name))
+        if images:
+            expired.append((name, vault_name, images))
+    if not expired:
+        print("Nothing to do")
+    if dry_run or not expired:
+        return
+
+    def report(stats):
+        print(
+            "{0} files, {1} directories, {2} freed, {3:.0f} unlinks/s".format(
+                stats.files,
+                stats.directories,
+                zfs.format_size(stats.freed),
+                stats.files / stats.seconds if stats.seconds > 0 else 0,
+            )
+        )
+
+    remover = walk.Remover(jobs, rate, interval)
+    errors = 0
+    for name, vault_name, images in expired:
+        for image in images:
+            try:
+                os.unlink(os.path.join(image.path, "summary"))
+            except FileNotFoundError:
+                pass
+        stats = remover.remove([image.path for image in images], progress=report)
+        print(
+            "{0}/{1}: {2} images, {3} files, {4} freed in {5:.1f}s".format(
+                name,
+                vault_name,
+                len(images),
+                stats.files,
+                zfs.format_size(stats.freed),
+                stats.seconds,
+            )
+        )
+        errors += stats.errors
+        hist.add(name, "expire", vault_name)
+    if errors:
+        LOG.error("{0} files or directories couldn't be removed".format(errors))
+        sys.exit(1)
+
+
+def _subdirectories(path):
+    try:
+        return [
+            entry.name
+            for entry in os.scandir(path)
+            if entry.is_dir(follow_symlinks=False)
+        ]
+    except OSError as e:
+        LOG.error("couldn't read {0}: {1}".format(path, e))
+        return []
+
+
+def autoscale(
+    hist,
+    inventory,
+    policies,
+    customer=None,
+    dry_run=False,
+    loop=False,
+    interval=300,
+):
+    """Grow the quotas of customers and vaults which are above the usage
+    threshold of their policy. All new quotas are set in one batch.
+
+    :param history.History hist:    History database.
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param policies:                Function returning the
+                                    `autoscale.Policy` of a customer.
+    :param string customer:         Only check this customer.
+    :param bool dry_run:            Only print the changes.
+    :param bool loop:               Repeat every interval until interrupted.
+    :param float interval:          Seconds between two runs.
+    """
+    while True:
+        ok = inventory.refresh()
+        if ok:
+            try:
+                changes = autoscaler.plan(inventory, policies, customer)
+            except ValueError as e:
+                LOG.error("Invalid autoscale configuration: {0}".format(e))
+                sys.exit(1)
+            for change in changes:
+                print(autoscaler.format_change(change))
+            if not dry_run:
+                ok = autoscaler.apply(changes, hist, inventory)
+        if not loop:
+            break
+        time.sleep(interval)
+    if not ok:
+        sys.exit(1)
+
+
+def replicate(hist, replicator, inventory, customer=None, vault=None, dry_run=False):
+    """Send the changes of the vaults since their last replication to the
+    target, incremental if possible, and print the throughput and lag per
+    vault.
+
+    :param history.History hist:            History database.
+    :param replicate.Replicator replicator: Replicator.
+    :param zfs.Inventory inventory:         Inventory of the pool.
+    :param string customer:                 Only vaults of this customer.
+    :param string vault:                    Only this vault.
+    :param bool dry_run:                    Only print what would be sent.
+    """
+    if vault and not customer:
+        LOG.error("Customer is needed")
+        sys.exit(1)
+    if not inventory.refresh():
+        sys.exit(1)
+    datasets = replicator.datasets(inventory, customer, vault)
+    if not datasets:
+        print("Nothing to do")
+        return
+    state = replicator.state(datasets)
+    if dry_run:
+        for fs in datasets:
+            entry = state.get(fs)
+            if entry is None or not entry.snapshot:
+                mode = "full"
+            else:
+                mode = "incremental from {0}".format(entry.snapshot)
+            if entry is not None and entry.pending:
+                mode = "resume {0} or {1}".format(entry.pending, mode)
+            print(
+                "{0} -> {1}: {2}, lag {3}".format(
+                    fs, replicator.target_fs(fs), mode, _format_lag(lag(entry))
+                )
+            )
+        return
+
+    started = time.monotonic()
+    results = replicator.replicate(
+        datasets, callback=lambda result: print(format_result(result))
+    )
+    state = replicator.state(datasets)
+    failed = 0
+    entries = []
+    for result in results:
+        customer_name, vault_name = result.dataset.split("/")[1:3]
+        if result.error is None:
+            reason = "{0} {1} in {2:.1f}s".format(
+                result.mode, zfs.format_size(result.transferred), result.seconds
+            )
+        else:
+            failed += 1
+            reason = "failed: {0}".format(result.error)
+        entries.append(
+            (
+                customer_name,
+                "replicate",
+                vault_name,
+                None,
+                result.snapshot or result.pending,
+                reason,
+            )
+        )
+    hist.add_many(entries)
+    for fs in datasets:
+        print("{0}: lag {1}".format(fs, _format_lag(lag(state.get(fs)))))
+    print(
+        "{0} ok, {1} failed, {2}".format(
+            len(results) - failed,
+            failed,
+            manifest.format_throughput(len(results), time.monotonic() - started),
+        )
+    )
+    if failed:
+        sys.exit(1)
+
+
+def _format_lag(seconds):
+    if seconds is None:
+        return "never replicated"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
+
+
+def apply(
+    hist,
+    dirvish,
+    inventory,
+    root,
+    path,
+    prune=False,
+    dry_run=False,
+    jobs=8,
+    trash=None,
+):
+    """Reconcile the customers and vaults of a manifest with the pool.
+
+    :param history.History hist:    History database.
+    :param dirvish.Dirvish dirvish: Dirvish object.
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param string root:             Backup root path.
+    :param string path:             Path to the manifest.
+    :param bool prune:              Remove customers and vaults which aren't
+                                    in the manifest.
+    :param bool dry_run:            Only print the plan.
+    :param int jobs:                Number of parallel workers.
+    :param trash.Trash trash:       Trash to move pruned file systems to,
+                                    None to destroy them immediately.
+    """
+    if not path:
+        LOG.error("A manifest is required")
+        sys.exit(1)
+    try:
+        desired = manifest.load_manifest(path)
+    except (OSError, ValueError) as e:
+        LOG.error("Couldn't read manifest {0}: {1}".format(path, e))
+        sys.exit(1)
+    if not inventory.refresh():
+        sys.exit(1)
+    actions = manifest.plan(desired, inventory, dirvish, root, prune=prune)
+    for action in actions:
+        print(manifest.format_action(action))
+    if not actions:
+        print("Nothing to do")
+    if dry_run or not actions:
+        return
+    started = time.monotonic()
+    results = manifest.execute(
+        actions, hist, dirvish, inventory, root, jobs=jobs, trash=trash
+    )
+    failed = [action for action, ok in results if not ok]
+    for action in failed:
+        LOG.error("failed: {0}".format(manifest.format_action(action)))
+    print(
+        "{0} ok, {1} failed, {2}".format(
+            len(results) - len(failed),
+            len(failed),
+            manifest.format_throughput(len(results), time.monotonic() - started),
+        )
+    )
+    if failed:
+        sys.exit(1)
+
+
+def status(inventory, customer=None):
+    """Print the usage and quotas of all file systems or of one customer.
+
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param string customer:         Customer name.
+    """
+    fs = None
+    if customer:
+        fs = os.path.join(inventory.pool, customer)
+    rows = [["NAME", "USED", "AVAIL", "QUOTA", "REFER", "RATIO", "MOUNTPOINT"]]
+    for dataset in inventory.datasets(fs):
+        rows.append(
+            [
+                dataset.name,
+                zfs.format_size(dataset.used),
+                zfs.format_size(dataset.avail),
+                zfs.format_size(dataset.quota),
+                zfs.format_size(dataset.refer),
+                "{0:.2f}x".format(dataset.compressratio),
+                dataset.mountpoint or "-",
+            ]
+        )
+    print_table(rows, left=(0, 6))
+
+
+def print_table(rows, left=(0,)):
+    """Print rows as a table with aligned columns.
+
+    :param list rows:   Rows of strings, the first one is the header.
+    :param tuple left:  Indexes of the columns aligned to the left, the
+                        others are aligned to the right.
+    """
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print(
+            "  ".join(
+                column.ljust(width) if i in left else column.rjust(width)
+                for i, (column, width) in enumerate(zip(row, widths))
+            ).rstrip()
+        )
+
+
+def show_runs(machines):
+    """Print the durations, the failure rate and the trend of the backup
+    runs of each machine.
+
+    :param list machines:   Statistics as returned by `runs.report`.
+    """
+    if not machines:
+        print("No finished runs")
+        return
+    rows = [["MACHINE", "SERVER", "RUNS", "FAILED", "P50", "P95", "MAX", "TREND"]]
+    for machine in machines:
+        trend = backup_runs.trend(machine)
+        rows.append(
+            [
+                str(machine.client),
+                str(machine.server),
+                str(machine.runs),
+                "{0:.1%}".format(backup_runs.failure_rate(machine)),
+                backup_runs.format_duration(machine.p50),
+                backup_runs.format_duration(machine.p95),
+                backup_runs.format_duration(machine.max),
+                "-" if trend is None else "{0:+.0%}".format(trend),
+            ]
+        )
+    print_table(rows, left=(0, 1))
+
+
+def compact(compactor, retention, dry_run=False):
+    """Archive the rows older than their retention, then vacuum the
+    database.
+
+    :param compact.Compactor compactor: Compactor.
+    :param dict retention:              Days to keep by table name.
+    :param bool dry_run:                Only print the number of old rows.
+    """
+    if not retention:
+        print("No retention configured")
+        return
+    failed = False
+    for table, days in retention.items():
+        if dry_run:
+            print(
+                "{0}: {1} rows older than {2:g} days".format(
+                    table, compactor.count(table, days), days
+                )
+            )
+            continue
+        try:
+            stats = compactor.compact(table, days)
+        except OSError as e:
+            LOG.error("Couldn't archive {0}: {1}".format(table, e))
+            failed = True
+            continue
+        print(
+            "{0}: archived {1} rows to {2} files".format(
+                table, stats.archived, len(stats.files)
+            )
+        )
+    if not dry_run:
+        compactor.vacuum()
+    if failed:
+        sys.exit(1)
+
+
+def export(
+    engine,
+    table,
+    fmt="jsonl",
+    output=None,
+    compress=False,
+    since=None,
+    since_id=None,
+):
+    """Export a table as JSON lines or CSV, row by row. The number of rows and
+    the last id, to continue with --since-id next time, are printed to the
+    standard error.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param string table:                        Table name.
+    :param string fmt:                          "jsonl" or "csv".
+    :param string output:                       File to write to, None for
+                                                the standard output.
+    :param bool compress:                       Compress with gzip, implied by
+                                                an output ending with .gz.
+    :param datetime since:                      Only rows at or after this
+                                                time.
+    :param int since_id:                        Only rows with a larger id.
+    """
+    compress = compress or (output is not None and output.endswith(".gz"))
+    newline = "" if fmt == "csv" else None
+    try:
+        if output is None:
+            raw = sys.stdout.buffer
+        else:
+            raw = open(output, "wb")
+    except OSError as e:
+        LOG.error("Couldn't open {0}: {1}".format(output, e))
+        sys.exit(1)
+    try:
+        stream = gzip.GzipFile(fileobj=raw, mode="wb") if compress else raw
+        out = io.TextIOWrapper(stream, encoding="utf8", newline=newline)
+        try:
+            count, last_id = exporter.export(
+                engine, table, out, fmt=fmt, since=since, since_id=since_id
+            )
+        finally:
+            out.flush()
+            out.detach()
+            if compress:
+                stream.close()
+    except ValueError as e:
+        LOG.error("Couldn't export {0}: {1}".format(table, e))
+        sys.exit(1)
+    finally:
+        if output is not None:
+            raw.close()
+    print(
+        "exported {0} rows of {1}, last id {2}".format(
+            count, table, last_id if last_id is not None else since_id
+        ),
+        file=sys.stderr,
+    )
+
+
+def history_show(
+    history,
+    customer=None,
+    vault=None,
+    command=None,
+    since=None,
+    until=None,
+    limit=20,
+    before=None,
+):
     """Manage the command log.
 
+    Shows the newest ``limit`` matching entries. If there may be older ones,
+    the option to show the next page is printed after them.
+
     :param history.History history: History database.
+    :param string customer:         Only entries of this customer.
+    :param string vault:            Only entries of this vault.
+    :param string command:          Only entries of this command.
+    :param datetime since:          Only entries at or after this time.
+    :param datetime until:          Only entries before this time.
+    :param int limit:               Number of entries to show.
+    :param tuple before:            Only entries older than this time and
+                                    id.
+    """
+    entries = history.entries(
+        limit,
+        customer=customer,
+        vault=vault,
+        command=command,
+        since=since,
+        until=until,
+        before=before,
+    )
+    for entry in entries:
+        print(format_entry(entry))
+    if entries and len(entries) == limit:
+        print(
+            "-- older entries: --before {0},{1}".format(
+                entries[0].datetime.isoformat(), entries[0].id
+            )
+        )
+
+
+def parse_datetime(value):
+    """Parse a date or a date and time given on the command line.
+
+    :param string value:    Time as YYYY-MM-DD, optionally followed by HH:MM
+                            or HH:MM:SS.
+
+    :rtype: datetime
+
+    :raises argparse.ArgumentTypeError: If the time can't be interpreted.
     """
-    for row in history.show():
-        print(row)
+    for fmt in ["%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"]:
+        try:
+            return datetime.strptime(value.replace("T", " "), fmt)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("invalid time {0!r}".format(value))
+
+
+def parse_cursor(value):
+    """Parse the position in the log printed after a page of entries.
+
+    :param string value:    Time in ISO format and id, separated by a comma.
+
+    :returns: Time and id.
+    :rtype: `tuple` (datetime, int)
+
+    :raises argparse.ArgumentTypeError: If the position can't be interpreted.
+    """
+    try:
+        when, id_ = value.rsplit(",", 1)
+        return (datetime.fromisoformat(when), int(id_))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid position {0!r}".format(value))
 
 
 if __name__ == "__main__":
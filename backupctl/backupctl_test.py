@@ -3,12 +3,18 @@
 
 """Test for class backupctl"""
 
+import argparse
+import configparser
+import gzip
+import json
 import os
+from datetime import datetime
 
 import pytest
 import sqlalchemy
 
-from backupctl import backupctl, dirvish, history
+from backupctl import (backupctl, dirvish, history, replicate, runs, simulator,
+                       spool)
 
 BACKUPCTL_DB = os.path.join(os.sep, "tmp", "backupctl", "backupctl.db")
 
@@ -37,6 +43,16 @@ mock_data = {
     "zfs-destroy": (0, "", ""),
     "zfs-get": (0, "0", ""),
     "zfs-set": (0, "", ""),
+    "zfs-rename": (0, "", ""),
+    "zpool-get": (0, "0\n", ""),
+    "zfs-list": (
+        0,
+        "backup\t3072\t1048576\t0\t1024\t/backup\t1.00x\n"
+        "backup/customer1\t2048\t1048576\t10485760\t1024\tnone\t1.50x\n"
+        "backup/customer1/www.example.com\t1024\t1048576\t0\t1024\t"
+        "/srv/backup/customer1/www.example.com\t1.00x\n",
+        "",
+    ),
 }
 
 
@@ -49,6 +65,9 @@ def mock_zfs(mocker):
         return mock_data["-".join(cmd[:2])]
 
     mocker.patch("backupctl.zfs.execute_cmd", mocked)
+    mocker.patch(
+        "backupctl.zfs.stream_cmd", lambda cmd: backupctl.zfs.Stream(*mocked(cmd))
+    )
     yield commands
 
 
@@ -69,7 +88,52 @@ def mock_zfs(mocker):
         (["remove"], 1),
         (["remove", "-n", "customer1"], 0),
         (["remove", "-n", "customer1", "-v", "www.example.com"], 0),
+        (["remove", "-n", "customer1", "-v", "www.example.com", "--now"], 0),
+        (["remove", "-n", "customer1", "--now"], 0),
+        (["reap", "--dry-run"], 0),
+        (["reap", "-j", "2"], 0),
+        (["restore-from-trash"], 1),
+        (["restore-from-trash", "-n", "customer1"], 1),
+        (["images", "-n", "customer1"], 1),
+        (["expire", "-v", "www.example.com"], 1),
+        (["expire", "--dry-run"], 0),
+        (["autoscale", "--dry-run"], 0),
+        (["autoscale", "-n", "customer1"], 0),
+        (["replicate"], 1),
+        (["replicate", "--dry-run"], 1),
+        (["export"], 0),
+        (["export", "--table", "dirvish", "--format", "csv", "--since-id", "1"], 0),
+        (["export", "--table", "machines", "--since", "2024-01-31"], 1),
+        (["export", "--table", "unknown"], 2),
+        (["compact"], 0),
+        (["compact", "--dry-run"], 0),
+        (["ingest"], 1),
+        (["daemon"], 1),
+        (["daemon-status"], 1),
+        (["runs"], 0),
+        (["runs", "-v", "www.example.com", "--since", "2024-01-31"], 0),
+        (["schedule", "--dry-run"], 0),
+        (["run"], 1),
+        (["run", "--all", "--dry-run"], 0),
+        (["regen-configs"], 0),
+        (["regen-configs", "-v", "www.example.com"], 1),
+        (["regen-configs", "-n", "customer1", "--exclude", "/srv/*"], 1),
+        (["analyze-excludes", "-n", "customer1"], 1),
+        (["analyze-excludes", "-n", "customer1", "-v", "www.example.com"], 1),
+        (["du"], 1),
+        (["churn", "-v", "www.example.com"], 1),
+        (["churn", "-n", "customer9"], 0),
         (["log"], 0),
+        (["log", "-n", "customer1", "--command", "new", "--limit", "5"], 0),
+        (["log", "--since", "2024-01-31", "--until", "2024-02-01 12:00"], 0),
+        (["log", "--before", "2024-01-31T12:00:00.123456,10"], 0),
+        (["log", "--before", "10"], 2),
+        (["log", "--since", "yesterday"], 2),
+        (["apply"], 1),
+        (["apply", "-f", "/nonexistent/manifest.csv"], 1),
+        (["apply", "--prune", "--now", "-f", "/nonexistent/manifest.csv"], 1),
+        (["status"], 0),
+        (["status", "-n", "customer1"], 0),
         (["test"], 2),
     ],
 )
@@ -98,7 +162,12 @@ def test_main(parameters, exit_code, mocker, mock_zfs):
     assert pytest_wrapped_e.value.code == exit_code
 
 
-def test_config():
+def test_config(tmp_path, monkeypatch):
+    # config() reads backupctl.ini of the working directory
+    (tmp_path / "backupctl.ini").write_text(
+        "[zfs]\npool = backup\nroot = /srv/backup\n"
+    )
+    monkeypatch.chdir(tmp_path)
     cfg = backupctl.config()
     import configparser
 
@@ -255,6 +324,432 @@ def test_vault(mock_zfs, ohistory, odirvish):
     ]
 
 
+def test_inventory_checks(mock_zfs, ohistory, odirvish):
+    inventory = backupctl.zfs.Inventory("backup")
+    backupctl.new(
+        ohistory,
+        odirvish,
+        pool="backup",
+        root=None,
+        customer="customer1",
+        size="1G",
+        inventory=inventory,
+    )
+    backupctl.resize(
+        ohistory, pool="backup", customer="customer1", size="2G", inventory=inventory
+    )
+    assert [cmd[:2] for cmd in mock_zfs] == [["zfs", "list"], ["zfs", "set"]]
+
+
+def test_apply(mock_zfs, ohistory, odirvish, tmp_path, capsys):
+    path = tmp_path / "manifest.csv"
+    path.write_text(
+        "customer,vault,size,client\n"
+        "customer1,,10M,\n"
+        "customer1,mail.example.com,500M,\n"
+    )
+    backupctl.apply(
+        ohistory,
+        odirvish,
+        backupctl.zfs.Inventory("backup"),
+        str(tmp_path),
+        str(path),
+    )
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == (
+        'create customer "customer1" vault "mail.example.com" with size 500M'
+    )
+    assert out[-1].startswith("1 ok, 0 failed, 1 operations in ")
+    assert [cmd[:2] for cmd in mock_zfs] == [["zfs", "list"], ["zfs", "create"]]
+
+
+def test_status(mock_zfs, capsys):
+    backupctl.status(backupctl.zfs.Inventory("backup"), "customer1")
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == [
+        "NAME",
+        "USED",
+        "AVAIL",
+        "QUOTA",
+        "REFER",
+        "RATIO",
+        "MOUNTPOINT",
+    ]
+    assert lines[1].split() == [
+        "backup/customer1",
+        "2.0K",
+        "1.0M",
+        "10.0M",
+        "1.0K",
+        "1.50x",
+        "-",
+    ]
+    assert lines[2].split()[0] == "backup/customer1/www.example.com"
+    assert len(lines) == 3
+
+
+def test_print_table(capsys):
+    rows = [["NAME", "SIZE", "PATH"], ["a", "10G", "/srv/a"]]
+    backupctl.print_table(rows, left=(0, 2))
+    assert capsys.readouterr().out.splitlines() == [
+        "NAME  SIZE  PATH",
+        "a      10G  /srv/a",
+    ]
+
+
+def test_images(ohistory, tmp_path, capsys):
+    sim = simulator.SimulatedPool("backup")
+    sim._create("backup/customer1")
+    sim._create("backup/customer1/www.example.com")
+    previous = backupctl.zfs.set_backend(sim)
+    try:
+        fs = "backup/customer1/www.example.com"
+        for image in ["2024-01-01", "2024-01-02", "2024-01-03"]:
+            backupctl.zfs.new_snapshot(fs, image)
+        backupctl.images(
+            ohistory, "backup", str(tmp_path), "customer1", "www.example.com"
+        )
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0].split() == ["IMAGE", "USED", "REFER", "CREATION"]
+        assert [line.split()[0] for line in lines[1:]] == [
+            "2024-01-01",
+            "2024-01-02",
+            "2024-01-03",
+        ]
+        backupctl.images(
+            ohistory, "backup", str(tmp_path), "customer1", "www.example.com", keep=1
+        )
+        assert capsys.readouterr().out.splitlines() == [
+            'expire image "2024-01-01"',
+            'expire image "2024-01-02"',
+        ]
+        assert [s.name for s in backupctl.zfs.list_snapshots(fs)] == [
+            fs + "@2024-01-03"
+        ]
+        backupctl.images(
+            ohistory,
+            "backup",
+            str(tmp_path),
+            "customer1",
+            "www.example.com",
+            older_than=1,
+        )
+        assert capsys.readouterr().out.splitlines() == ["Nothing to do"]
+    finally:
+        backupctl.zfs.set_backend(previous)
+
+
+def test_expire(ohistory, tmp_path, capsys):
+    for image, expire in [("2024-01-01", "2024-01-16"), ("2024-01-02", "never")]:
+        path = tmp_path / "customer1" / "www.example.com" / image
+        (path / "tree" / "etc").mkdir(parents=True)
+        (path / "tree" / "etc" / "hosts").write_text("127.0.0.1 localhost\n")
+        (path / "summary").write_text(
+            "Image-now: {0} 00:00:00\nExpire: +15 days == {1} 00:00:00\n"
+            "Status: success\n".format(image, expire)
+        )
+    (tmp_path / "customer1" / "www.example.com" / "dirvish").mkdir()
+    (tmp_path / ".images").mkdir()
+    backupctl.expire(ohistory, str(tmp_path), dry_run=True)
+    assert capsys.readouterr().out.splitlines() == [
+        'expire image "2024-01-01" of customer1/www.example.com'
+    ]
+    backupctl.expire(ohistory, str(tmp_path), "customer1", jobs=2)
+    out = capsys.readouterr().out.splitlines()
+    assert out[-1].startswith("customer1/www.example.com: 1 images, 1 files, ")
+    assert sorted(os.listdir(str(tmp_path / "customer1" / "www.example.com"))) == [
+        "2024-01-02",
+        "dirvish",
+    ]
+    backupctl.expire(ohistory, str(tmp_path), "customer1", "www.example.com")
+    assert capsys.readouterr().out.splitlines() == ["Nothing to do"]
+
+
+def test_replicate_dry_run(tmp_path, capsys):
+    sim = simulator.SimulatedPool("backup")
+    sim._create("backup/customer1")
+    sim._create("backup/customer1/www.example.com")
+    sim._create("backup/customer1/mail.example.com")
+    previous = backupctl.zfs.set_backend(sim)
+    try:
+        engine = sqlalchemy.create_engine(
+            "sqlite:///{0}".format(tmp_path / "backupctl.db")
+        )
+        hist = history.History(engine)
+        replicator = replicate.Replicator(engine, "backup2")
+        inventory = backupctl.zfs.Inventory("backup")
+        backupctl.replicate(
+            hist, replicator, inventory, "customer1", "www.example.com", dry_run=True
+        )
+        assert capsys.readouterr().out.splitlines() == [
+            "backup/customer1/www.example.com -> backup2/customer1/www.example.com: "
+            "full, lag never replicated"
+        ]
+        with pytest.raises(SystemExit):
+            backupctl.replicate(hist, replicator, inventory, vault="www.example.com")
+        backupctl.replicate(hist, replicator, inventory, "customer2", dry_run=True)
+        assert capsys.readouterr().out.splitlines() == ["Nothing to do"]
+    finally:
+        backupctl.zfs.set_backend(previous)
+
+
+def test_export(tmp_path, capsys):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "export.db"))
+    hist = history.History(engine)
+    hist.add("customer1", "create", size="10G")
+    hist.add("customer2", "create", size="20G")
+    output = str(tmp_path / "history.jsonl.gz")
+    backupctl.export(engine, "history", output=output)
+    assert capsys.readouterr().err == "exported 2 rows of history, last id 2\n"
+    with gzip.open(output, "rt") as f:
+        assert [json.loads(line)["customer"] for line in f] == [
+            "customer1",
+            "customer2",
+        ]
+    backupctl.export(engine, "history", fmt="csv", since_id=2)
+    captured = capsys.readouterr()
+    assert captured.out.splitlines()[0].startswith("id,datetime,command")
+    assert len(captured.out.splitlines()) == 1
+    assert captured.err == "exported 0 rows of history, last id 2\n"
+
+
+def test_compact_retention():
+    cfg = configparser.ConfigParser()
+    assert backupctl.compact_retention(cfg) == {}
+    cfg["compact"] = {"dirvish_days": "90", "history_days": "365"}
+    assert list(backupctl.compact_retention(cfg).items()) == [
+        ("history", 365),
+        ("dirvish", 90),
+    ]
+    cfg["compact"]["history_days"] = "0"
+    with pytest.raises(ValueError):
+        backupctl.compact_retention(cfg)
+
+
+def test_parse_datetime():
+    assert backupctl.parse_datetime("2024-01-31") == datetime(2024, 1, 31)
+    assert backupctl.parse_datetime("2024-01-31T12:30") == datetime(2024, 1, 31, 12, 30)
+    with pytest.raises(argparse.ArgumentTypeError):
+        backupctl.parse_datetime("31.01.2024")
+
+
+def test_ingest(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "ingest.db"))
+    hist = history.History(engine)
+    odirvish = dirvish.Dirvish(engine)
+    directory = str(tmp_path / "spool")
+    env = {
+        "DIRVISH_SERVER": "backup.example.com",
+        "DIRVISH_CLIENT": "www.example.com",
+        "DIRVISH_IMAGE": "www.example.com:default:2024-01-01",
+        "DIRVISH_STATUS": "success",
+    }
+    spool.write(directory, "start", env)
+    spool.write(directory, "end", env, "backup/customer1/www.example.com@2024-01-01")
+    # the hook was retried
+    spool.write(directory, "end", env, "backup/customer1/www.example.com@2024-01-01")
+    assert backupctl.ingest(hist, odirvish, directory) == 2
+    assert spool.read(directory) == []
+    assert [
+        (entry.command, entry.vault, entry.snapshot) for entry in hist.entries()
+    ] == [
+        ("snapshot", "www.example.com", "backup/customer1/www.example.com@2024-01-01")
+    ]
+
+    # events which were added before but not removed from the spool
+    spool.write(directory, "end", env)
+    env["DIRVISH_IMAGE"] = "www.example.com:default:2024-01-02"
+    spool.write(directory, "start", env)
+    assert backupctl.ingest(hist, odirvish, directory) == 1
+    assert backupctl.ingest(hist, odirvish, directory) == 0
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            "SELECT trigger, machine FROM dirvish ORDER BY id"
+        ).fetchall() == [("start", 1), ("end", 1), ("start", 1)]
+
+
+def test_show_runs(capsys):
+    backupctl.show_runs([])
+    assert capsys.readouterr().out == "No finished runs\n"
+    backupctl.show_runs(
+        [
+            runs.MachineRuns("www", "backup", 20, 1, 1000, 1900, 2000, 1000, 1100),
+            runs.MachineRuns("db", "backup", 1, 1, None, None, None, None, None),
+        ]
+    )
+    assert capsys.readouterr().out.splitlines() == [
+        "MACHINE  SERVER  RUNS  FAILED      P50      P95      MAX  TREND",
+        "www      backup    20    5.0%  0:16:40  0:31:40  0:33:20   +10%",
+        "db       backup     1  100.0%        -        -        -      -",
+    ]
+
+
+def test_schedule_settings():
+    import configparser
+
+    cfg = configparser.ConfigParser()
+    settings = backupctl.schedule_settings(cfg)
+    assert settings["start"] == 22 * 60
+    assert settings["concurrency"] == 4
+    assert settings["io"] is None
+    assert settings["path"] == "/etc/cron.d/backupctl"
+    cfg["schedule"] = {"start": "1:30", "io": "200M", "throughput": "50M"}
+    settings = backupctl.schedule_settings(cfg)
+    assert settings["start"] == 90
+    assert settings["io"] == 200 * 1024**2
+    assert settings["throughput"] == 50 * 1024**2
+    for option, value in [("io", "fast"), ("concurrency", "0"), ("start", "8am")]:
+        cfg["schedule"] = {option: value}
+        with pytest.raises(ValueError):
+            backupctl.schedule_settings(cfg)
+    cfg["schedule"] = {"throughput": "50X"}
+    with pytest.raises(ValueError, match="invalid throughput '50X'"):
+        backupctl.schedule_settings(cfg)
+
+
+def test_zfs_runner():
+    import configparser
+
+    cfg = configparser.ConfigParser()
+    cfg["zfs"] = {"pool": "backup"}
+    cfg["run"] = {"jobs": "6", "customer_jobs": "2", "hours": "0"}
+    cfg["run customer1"] = {"jobs": "4"}
+    cfg["run customer2"] = {}
+    runner = backupctl.zfs_runner(cfg)
+    assert runner.jobs == 6
+    assert runner.window is None
+    assert runner.command == ["dirvish"]
+    assert [runner.limit(c) for c in ["customer1", "customer2", "other"]] == [4, 2, 2]
+    assert backupctl.zfs_runner(cfg, jobs=2).jobs == 2
+    cfg["run customer2"] = {"jobs": "0"}
+    with pytest.raises(ValueError):
+        backupctl.zfs_runner(cfg)
+
+
+def test_regen_configs(tmp_path, capsys):
+    pool = simulator.SimulatedPool("backup", size=1 << 40)
+    for fs in ["customer1", "customer1/www", "customer1/db", "customer2"]:
+        pool._create("backup/" + fs)
+    previous = backupctl.zfs.set_backend(pool)
+    try:
+        root = str(tmp_path)
+        odirvish = dirvish.Dirvish(sqlalchemy.create_engine("sqlite://"))
+        odirvish.create_config(root, "customer1", "www", "192.0.2.1", verbose=False)
+        inventory = backupctl.zfs.Inventory("backup")
+        with pytest.raises(SystemExit):
+            backupctl.regen_configs(odirvish, inventory, root)
+        assert capsys.readouterr().out.splitlines() == [
+            "customer1/db: failed: no client",
+            "0 changed, 1 unchanged, 1 failed",
+        ]
+        backupctl.regen_configs(
+            odirvish, inventory, root, "customer1", "www", excludes=["/srv/*"]
+        )
+        assert capsys.readouterr().out.splitlines() == [
+            "customer1/www: changed",
+            "1 changed, 0 unchanged, 0 failed",
+        ]
+        assert odirvish.vault_configs()[("customer1", "www")].excludes == "/srv/*"
+    finally:
+        backupctl.zfs.set_backend(previous)
+
+
+def test_analyze_excludes(tmp_path, capsys):
+    tree = tmp_path / "customer1" / "www" / "2024-01-01" / "tree"
+    os.makedirs(str(tree / "var" / "cache"))
+    (tree / "var" / "cache" / "big").write_bytes(b"x" * 3000)
+    (tree / "notes.txt").write_bytes(b"x" * 1000)
+    (tree / ".." / "summary").write_text("Status: success\n")
+    backupctl.analyze_excludes(str(tmp_path), "customer1", "www", limit=1)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].endswith(
+        ": 3.9K in 2 files, 3.9K in 2 files written by the last backup"
+    )
+    assert lines[1].split() == ["PATTERN", "SIZE", "FILES", "CHURN", "CHANGED", "SHARE"]
+    assert lines[2].split() == ["/var/cache/*", "2.9K", "1", "2.9K", "1", "75.0%"]
+    assert len(lines) == 3
+    backupctl.analyze_excludes(
+        str(tmp_path), "customer1", "www", patterns=["*.txt", "/tmp/*"]
+    )
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in lines[2:]] == ["*.txt", "/tmp/*", "total"]
+    assert lines[4].split()[-1] == "25.0%"
+    with pytest.raises(SystemExit):
+        backupctl.analyze_excludes(str(tmp_path), "customer1", "mail")
+
+
+def test_disk_usage(tmp_path, capsys):
+    for vault in ["www", "mail"]:
+        image = tmp_path / "customer1" / vault / "2024-01-01"
+        os.makedirs(str(image / "tree"))
+        (image / "tree" / "file").write_bytes(os.urandom(8192))
+        (image / "summary").write_text("Status: success\n")
+    cache = backupctl.du.Cache(str(tmp_path / "cache"))
+    backupctl.disk_usage(str(tmp_path), "customer1", "www", cache=cache)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["IMAGE", "FILES", "SIZE", "UNIQUE", "SHARED"]
+    assert lines[1].split()[:2] == ["2024-01-01", "1"]
+    assert lines[2].split()[:2] == ["total", "1"]
+    assert lines[3] == "1 images scanned, 0 cached"
+    backupctl.disk_usage(str(tmp_path), "customer1", cache=cache)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["VAULT", "IMAGES", "FILES", "SIZE"]
+    assert [line.split()[:3] for line in lines[1:3]] == [
+        ["mail", "1", "1"],
+        ["www", "1", "1"],
+    ]
+    assert lines[3] == "1 images scanned, 1 cached"
+    with pytest.raises(SystemExit):
+        backupctl.disk_usage(str(tmp_path), "customer2")
+
+
+def test_show_churn(tmp_path, capsys):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    root = tmp_path / "backup"
+    for name in ["2024-01-01", "2024-01-02"]:
+        image = root / "customer1" / "www" / name
+        os.makedirs(str(image / "tree"))
+        (image / "tree" / "file").write_bytes(os.urandom(8192))
+        (image / "summary").write_text(
+            "Image-now: {0} 22:00:00\nStatus: success\n".format(name)
+        )
+    backupctl.show_churn(engine, str(root))
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == [
+        "VAULT",
+        "IMAGE",
+        "NEW",
+        "NEW",
+        "FILES",
+        "IMAGES",
+        "PER",
+        "DAY",
+        "FILES/DAY",
+    ]
+    assert lines[1].split()[:2] == ["customer1/www", "2024-01-02"]
+    assert lines[1].split()[3:5] == ["1", "1"]
+    assert lines[3].split()[0] == "customer1"
+    assert lines[4] == "2 images measured"
+    backupctl.show_churn(engine, str(root), "customer1", "www")
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 3
+    assert lines[2] == "0 images measured"
+    with pytest.raises(SystemExit):
+        backupctl.show_churn(engine, str(root), vault="www")
+
+
+def test_zfs_replicator(tmp_path):
+    import configparser
+
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    cfg = configparser.ConfigParser()
+    cfg["replicate"] = {"target": "backup2", "bandwidth": "10M"}
+    assert backupctl.zfs_replicator(cfg, engine).bandwidth == 10 * 1024**2
+    cfg["replicate"]["bandwidth"] = "fast"
+    with pytest.raises(ValueError, match="invalid bandwidth 'fast'"):
+        backupctl.zfs_replicator(cfg, engine)
+
+
 @pytest.mark.xfail
 def test_new_no_customer(ohistory, odirvish):
     backupctl.new(ohistory, odirvish, customer=None, vault=None, size=None, client=None)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Change rate of vaults between successive dirvish images.
+
+Dirvish links every unchanged file of an image to the file of the previous
+image, so a file whose inode differs from the file at the same path in the
+previous image was written by the backup. Both trees are read with
+`os.scandir` in the order of their paths and merged like a sorted join, only
+one directory listing per level of each tree is held in memory, however many
+files the trees have.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import stat
+from datetime import datetime
+
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Float, Index, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from backupctl import database
+from backupctl.dirvish import vault_images
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+# Files are the files of the image, new files have no inode of the previous
+# image at the same path, removed files are only in the previous image. Bytes
+# are allocated bytes.
+Change = collections.namedtuple(
+    "Change",
+    [
+        "files",
+        "bytes",
+        "new_files",
+        "new_bytes",
+        "removed_files",
+        "removed_bytes",
+    ],
+)
+
+VaultChurn = collections.namedtuple(
+    "VaultChurn",
+    [
+        "customer",
+        "vault",
+        "image",
+        "new_bytes",
+        "new_files",
+        "images",
+        "bytes_per_day",
+        "files_per_day",
+    ],
+)
+
+# The rolling average of the newest image of each vault is the sum of the
+# new bytes of the last images over the days they cover.
+REPORT = """
+WITH rolling AS (
+    SELECT customer, vault, image, new_bytes, new_files,
+        COUNT(*) OVER w AS images,
+        SUM(new_bytes) OVER w AS window_bytes,
+        SUM(new_files) OVER w AS window_files,
+        SUM(days) OVER w AS window_days,
+        ROW_NUMBER() OVER (
+            PARTITION BY customer, vault ORDER BY created DESC, id DESC
+        ) AS age
+    FROM churn
+    WHERE previous IS NOT NULL
+        AND (:customer IS NULL OR customer = :customer)
+        AND (:vault IS NULL OR vault = :vault)
+    WINDOW w AS (
+        PARTITION BY customer, vault ORDER BY created, id
+        ROWS BETWEEN {preceding:d} PRECEDING AND CURRENT ROW
+    )
+)
+SELECT customer, vault, image, new_bytes, new_files, images,
+    CASE WHEN window_days > 0 THEN window_bytes / window_days
+        ELSE 1.0 * window_bytes / images END,
+    CASE WHEN window_days > 0 THEN window_files / window_days
+        ELSE 1.0 * window_files / images END
+FROM rolling
+WHERE age = 1
+ORDER BY customer, vault
+"""
+
+
+class ChurnEntry(Base):
+    __tablename__ = "churn"
+
+    id = Column(Integer, primary_key=True)
+    customer = Column(String)
+    vault = Column(String)
+    image = Column(String)
+    previous = Column(String)
+    created = Column(DateTime)
+    days = Column(Float)
+    files = Column(Integer)
+    bytes = Column(Integer)
+    new_files = Column(Integer)
+    new_bytes = Column(Integer)
+    removed_files = Column(Integer)
+    removed_bytes = Column(Integer)
+    measured = Column(DateTime)
+
+    __table_args__ = (
+        Index(
+            "ix_churn_customer_vault_image", "customer", "vault", "image", unique=True
+        ),
+    )
+
+    def __repr__(self):
+        return "<Entry(id='{0}')>".format(self.id)
+
+
+def walk_sorted(path):
+    """Yield the files of a tree in the order of their paths.
+
+    :param string path: Root of the tree.
+
+    :returns: Generator of tuples of the path as a tuple of names, the inode
+              and the allocated bytes.
+    :rtype: generator
+    """
+    stack = [((), _listdir(path))]
+    while stack:
+        key, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError as e:
+            logger.error("couldn't read {0}: {1}".format(entry.path, e))
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            # a file and a directory never have the same name, so the files
+            # below a directory come right after it in the order of the paths
+            stack.append((key + (entry.name,), _listdir(entry.path)))
+        else:
+            yield key + (entry.name,), st.st_ino, st.st_blocks * 512
+
+
+def _listdir(path):
+    try:
+        return iter(sorted(os.scandir(path), key=lambda entry: entry.name))
+    except OSError as e:
+        logger.error("couldn't read {0}: {1}".format(path, e))
+        return iter([])
+
+
+def compare(previous, tree):
+    """Count the files of a tree which aren't the same inode as the file at
+    the same path of the previous tree.
+
+    :param string previous: Tree of the previous image, None to count all
+                            files as new.
+    :param string tree:     Tree of the image.
+
+    :rtype: `churn.Change`
+    """
+    counts = [0] * 6
+    old = walk_sorted(previous) if previous is not None else iter([])
+    new = walk_sorted(tree)
+    before = next(old, None)
+    after = next(new, None)
+    while after is not None:
+        if before is not None and before[0] < after[0]:
+            counts[4] += 1
+            counts[5] += before[2]
+            before = next(old, None)
+            continue
+        counts[0] += 1
+        counts[1] += after[2]
+        if before is not None and before[0] == after[0]:
+            if before[1] != after[1]:
+                counts[2] += 1
+                counts[3] += after[2]
+            before = next(old, None)
+        else:
+            counts[2] += 1
+            counts[3] += after[2]
+        after = next(new, None)
+    while before is not None:
+        counts[4] += 1
+        counts[5] += before[2]
+        before = next(old, None)
+    return Change(*counts)
+
+
+class ChurnTracker:
+    """Measure and store the churn of every image of the vaults.
+
+    :ivar sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        Base.metadata.create_all(engine)
+
+    def measured(self, customer, vault):
+        """Get the images of a vault whose churn is stored.
+
+        :param string customer: Customer name.
+        :param string vault:    Vault name.
+
+        :rtype: `set` of `string`
+        """
+        with database.session_scope(self._engine) as session:
+            query = session.query(ChurnEntry.image).filter(
+                ChurnEntry.customer == customer, ChurnEntry.vault == vault
+            )
+            return set(image for (image,) in query)
+
+    def update(self, root, vaults, jobs=4, callback=None):
+        """Compare the images of vaults which aren't measured yet with their
+        previous image, in parallel per vault, and store their churn.
+
+        Only successful images are compared, the first image of a vault is
+        stored without a previous image.
+
+        :param string root:     Backup root path.
+        :param list vaults:     Tuples of customer and vault.
+        :param int jobs:        Number of vaults compared in parallel.
+        :param callback:        Called with each new `churn.ChurnEntry`.
+
+        :returns: Number of measured images.
+        :rtype: int
+        """
+        count = 0
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(jobs, 1)
+        ) as executor:
+            futures = [
+                executor.submit(self._update_vault, root, customer, vault, callback)
+                for customer, vault in vaults
+            ]
+            for future in futures:
+                count += future.result()
+        return count
+
+    def _update_vault(self, root, customer, vault, callback):
+        measured = self.measured(customer, vault)
+        images = [
+            image
+            for image in vault_images(os.path.join(root, customer, vault))
+            if image.status == "success"
+        ]
+        count = 0
+        for previous, image in zip([None] + images, images):
+            if image.name in measured:
+                continue
+            change = compare(
+                os.path.join(previous.path, "tree") if previous else None,
+                os.path.join(image.path, "tree"),
+            )
+            days = None
+            if previous and previous.created and image.created:
+                days = (image.created - previous.created).total_seconds() / 86400
+            entry = ChurnEntry(
+                customer=customer,
+                vault=vault,
+                image=image.name,
+                previous=previous.name if previous else None,
+                created=image.created,
+                days=days,
+                measured=datetime.now(),
+                **change._asdict()
+            )
+            with database.session_scope(self._engine, immediate=True) as session:
+                session.add(entry)
+                session.flush()
+                session.expunge(entry)
+            count += 1
+            if callback is not None:
+                callback(entry)
+        return count
+
+
+def report(engine, customer=None, vault=None, window=7):
+    """Get the churn of the newest image of each vault and the rolling
+    average per day of the last images.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param string customer: Only vaults of this customer.
+    :param string vault:    Only this vault.
+    :param int window:      Number of images of the rolling average.
+
+    :rtype: `list` of `churn.VaultChurn`
+
+    :raises ValueError: If the window is less than 1.
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+    if window < 1:
+        raise ValueError("window must be at least 1")
+    query = sqlalchemy.text(REPORT.format(preceding=int(window) - 1))
+    with engine.connect() as connection:
+        rows = connection.execute(query, {"customer": customer, "vault": vault})
+        return [VaultChurn(*row) for row in rows]
+
+
+def customers(vaults):
+    """Sum up the churn of the vaults of each customer.
+
+    :param list vaults: `churn.VaultChurn` as returned by `report`.
+
+    :returns: Bytes and files per day by customer.
+    :rtype: `collections.OrderedDict`
+    """
+    totals = collections.OrderedDict()
+    for churn in vaults:
+        total = totals.setdefault(churn.customer, [0.0, 0.0])
+        total[0] += churn.bytes_per_day or 0
+        total[1] += churn.files_per_day or 0
+    return collections.OrderedDict(
+        (customer, tuple(total)) for customer, total in totals.items()
+    )
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module churn"""
+
+import os
+from datetime import datetime
+
+import pytest
+import sqlalchemy
+
+from backupctl import churn
+
+
+def write_image(vault, name, files, previous=None, removed=()):
+    """Write an image, the files of ``previous`` which aren't in ``files``
+    or ``removed`` are hardlinked like dirvish does."""
+    tree = os.path.join(vault, name, "tree")
+    os.makedirs(os.path.join(tree, "etc"))
+    for path, size in files.items():
+        with open(os.path.join(tree, path), "wb") as f:
+            f.write(os.urandom(size))
+    for path in previous or []:
+        if path not in files and path not in removed:
+            os.link(
+                os.path.join(vault, previous[path], "tree", path),
+                os.path.join(tree, path),
+            )
+    with open(os.path.join(vault, name, "summary"), "w") as summary:
+        summary.write("Image-now: {0} 22:00:00\nStatus: success\n".format(name))
+    images = {path: image for path, image in (previous or {}).items()}
+    for path in removed:
+        images.pop(path)
+    images.update({path: name for path in files})
+    return images
+
+
+def allocated(vault, image, path):
+    return os.lstat(os.path.join(vault, image, "tree", path)).st_blocks * 512
+
+
+@pytest.fixture()
+def root(tmp_path):
+    root = str(tmp_path / "backup")
+    vault = os.path.join(root, "customer1", "www")
+    first = write_image(
+        vault, "2024-01-01", {"etc/hosts": 8192, "etc/passwd": 4096, "big": 65536}
+    )
+    second = write_image(vault, "2024-01-02", {"etc/hosts": 12288}, first)
+    write_image(vault, "2024-01-04", {"new": 4096}, second, removed=["big"])
+    return root
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    return sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+
+
+def test_walk_sorted(tmp_path):
+    for path in ["b", "a/z", "a/b/c", "a-b", "c/d"]:
+        os.makedirs(os.path.dirname(str(tmp_path / path)), exist_ok=True)
+        (tmp_path / path).write_text("x")
+    os.symlink("a", str(tmp_path / "link"))
+    keys = [key for key, inode, size in churn.walk_sorted(str(tmp_path))]
+    assert keys == [
+        ("a", "b", "c"),
+        ("a", "z"),
+        ("a-b",),
+        ("b",),
+        ("c", "d"),
+        ("link",),
+    ]
+    assert keys == sorted(keys)
+
+
+def test_compare(root):
+    vault = os.path.join(root, "customer1", "www")
+    trees = [os.path.join(vault, name, "tree") for name in sorted(os.listdir(vault))]
+    hosts = allocated(vault, "2024-01-02", "etc/hosts")
+    new = allocated(vault, "2024-01-04", "new")
+    big = allocated(vault, "2024-01-01", "big")
+
+    change = churn.compare(trees[0], trees[1])
+    assert change == churn.Change(3, change.bytes, 1, hosts, 0, 0)
+    change = churn.compare(trees[1], trees[2])
+    assert change == churn.Change(3, change.bytes, 1, new, 1, big)
+    first = churn.compare(None, trees[0])
+    assert first.files == first.new_files == 3
+    assert first.bytes == first.new_bytes
+
+
+def test_update_and_report(root, engine):
+    tracker = churn.ChurnTracker(engine)
+    entries = []
+    assert tracker.update(root, [("customer1", "www")], callback=entries.append) == 3
+    assert [(entry.image, entry.previous, entry.days) for entry in entries] == [
+        ("2024-01-01", None, None),
+        ("2024-01-02", "2024-01-01", 1.0),
+        ("2024-01-04", "2024-01-02", 2.0),
+    ]
+    assert entries[2].created == datetime(2024, 1, 4, 22)
+    # measured images aren't compared again
+    assert tracker.update(root, [("customer1", "www")]) == 0
+    assert tracker.measured("customer1", "www") == {
+        "2024-01-01",
+        "2024-01-02",
+        "2024-01-04",
+    }
+
+    vault = os.path.join(root, "customer1", "www")
+    hosts = allocated(vault, "2024-01-02", "etc/hosts")
+    new = allocated(vault, "2024-01-04", "new")
+    (result,) = churn.report(engine)
+    assert result == churn.VaultChurn(
+        "customer1",
+        "www",
+        "2024-01-04",
+        new,
+        1,
+        2,
+        pytest.approx((hosts + new) / 3),
+        pytest.approx(2 / 3),
+    )
+    (result,) = churn.report(engine, customer="customer1", vault="www", window=1)
+    assert result.images == 1
+    assert result.bytes_per_day == pytest.approx(new / 2)
+    assert churn.report(engine, customer="customer2") == []
+    with pytest.raises(ValueError):
+        churn.report(engine, window=0)
+
+
+def test_customers():
+    vaults = [
+        churn.VaultChurn("customer1", "db", "2024-01-02", 10, 1, 2, 100.0, 2.0),
+        churn.VaultChurn("customer1", "www", "2024-01-02", 10, 1, 2, 50.0, 1.0),
+        churn.VaultChurn("customer2", "www", "2024-01-02", 10, 1, 2, 20.0, 0.5),
+    ]
+    assert list(churn.customers(vaults).items()) == [
+        ("customer1", (150.0, 3.0)),
+        ("customer2", (20.0, 0.5)),
+    ]
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from backupctl import database, export
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+# Tables which can be compacted, the others only hold current state.
+TABLES = ["history", "dirvish"]
+
+CompactStats = collections.namedtuple(
+    "CompactStats", ["table", "archived", "last_id", "files"]
+)
+
+
+class DirvishDailyEntry(Base):
+    __tablename__ = "dirvish_daily"
+
+    id = Column(Integer, primary_key=True)
+    day = Column(String)
+    machine = Column(Integer)
+    starts = Column(Integer)
+    ends = Column(Integer)
+    successes = Column(Integer)
+    failures = Column(Integer)
+
+    def __repr__(self):
+        return "<Entry(id='{0}')>".format(self.id)
+
+
+def archive_path(archive, table, when):
+    """Get the archive file of the rows of a table in one month.
+
+    :param string archive:  Archive directory.
+    :param string table:    Table name.
+    :param datetime when:   Time of the row.
+
+    :rtype: string
+    """
+    return os.path.join(
+        archive, table, "{0}-{1}.jsonl.gz".format(table, when.strftime("%Y-%m"))
+    )
+
+
+def read_archive(path):
+    """Read the rows of an archive file.
+
+    :param string path: Archive file.
+
+    :returns: Generator of the rows as `dict`.
+    """
+    with gzip.open(path, "rt", encoding="utf8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class Compactor:
+    """Move old rows of the event tables to compressed monthly archive files
+    and keep the live database small.
+
+    The archive files are JSON lines, one gzip member per run, so a month can
+    be extended by later runs. Rows are deleted only after their archive file
+    is written; an interrupted run may archive rows twice, but never loses
+    them.
+
+    :ivar sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :ivar string archive:   Archive directory.
+    :ivar bool rollups:     Keep the number of backups per day and machine of
+                            removed dirvish events in the dirvish_daily table.
+
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+
+    def __init__(self, engine, archive, rollups=True):
+        self._engine = engine
+        self.archive = archive
+        self.rollups = rollups
+        Base.metadata.create_all(engine)
+
+    def _session(self):
+        return database.session_factory(self._engine)()
+
+    def count(self, table, days, now=None):
+        """Count the rows of a table older than a number of days.
+
+        :param string table:    Table name, one of `TABLES`.
+        :param float days:      Retention in days.
+        :param datetime now:    Current time.
+
+        :rtype: int
+        """
+        model, time_column = export.TABLES[table]
+        cutoff = (now or datetime.now()) - timedelta(days=days)
+        session = self._session()
+        try:
+            query = session.query(model).filter(getattr(model, time_column) < cutoff)
+            return query.count()
+        finally:
+            session.close()
+
+    def compact(self, table, days, now=None):
+        """Archive and delete the rows of a table older than a number of days.
+
+        :param string table:    Table name, one of `TABLES`.
+        :param float days:      Retention in days.
+        :param datetime now:    Current time.
+
+        :returns: Statistics of the compaction.
+        :rtype: `compact.CompactStats`
+
+        :raises OSError: If an archive file can't be written, nothing is
+                         deleted then.
+        """
+        if table not in TABLES:
+            raise KeyError(table)
+        model, time_column = export.TABLES[table]
+        cutoff = (now or datetime.now()) - timedelta(days=days)
+        files = collections.OrderedDict()
+        daily = collections.defaultdict(lambda: [0, 0, 0, 0])
+        archived = 0
+        last_id = None
+        try:
+            for record in export.rows(self._engine, table, until=cutoff):
+                path = archive_path(self.archive, table, record[time_column])
+                if path not in files:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    files[path] = gzip.open(path, "at", encoding="utf8")
+                files[path].write(export.to_json(record))
+                files[path].write("\n")
+                if table == "dirvish" and self.rollups:
+                    _count(daily, record)
+                archived += 1
+                last_id = record["id"]
+        finally:
+            for f in files.values():
+                f.close()
+        if last_id is None:
+            return CompactStats(table, 0, None, [])
+
+        session = self._session()
+        session.query(model).filter(
+            getattr(model, time_column) < cutoff, model.id <= last_id
+        ).delete(synchronize_session=False)
+        if daily:
+            self._add_daily(session, daily)
+        session.commit()
+        session.close()
+        logger.info(
+            "archived {0} rows of {1} to {2} files".format(archived, table, len(files))
+        )
+        return CompactStats(table, archived, last_id, list(files))
+
+    def _add_daily(self, session, daily):
+        for (day, machine), counts in sorted(daily.items()):
+            entry = (
+                session.query(DirvishDailyEntry)
+                .filter(
+                    DirvishDailyEntry.day == day, DirvishDailyEntry.machine == machine
+                )
+                .first()
+            )
+            if entry is None:
+                entry = DirvishDailyEntry(
+                    day=day, machine=machine, starts=0, ends=0, successes=0, failures=0
+                )
+                session.add(entry)
+            entry.starts += counts[0]
+            entry.ends += counts[1]
+            entry.successes += counts[2]
+            entry.failures += counts[3]
+
+    def vacuum(self):
+        """Give the space of deleted rows back and update the statistics of
+        the query planner. Only SQLite databases are vacuumed.
+
+        :raises sqlalchemy.exc.OperationalError: Wraps a DB-API
+                                                 OperationalError.
+        """
+        if self._engine.dialect.name != "sqlite":
+            return
+        with self._engine.connect() as connection:
+            connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            connection.execute(sqlalchemy.text("VACUUM"))
+            connection.execute(sqlalchemy.text("ANALYZE"))
+
+
+def _count(daily, record):
+    key = (record["datetime"].strftime("%Y-%m-%d"), record["machine"])
+    if record["trigger"] == "start":
+        daily[key][0] += 1
+    else:
+        daily[key][1] += 1
+        if str(record["status"]) == "success":
+            daily[key][2] += 1
+        else:
+            daily[key][3] += 1
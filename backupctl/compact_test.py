@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module compact"""
+
+import os
+from datetime import datetime
+
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from backupctl import compact, dirvish, history
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "live.db"))
+    history.History(engine)
+    dirvish.Dirvish(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all(
+        [
+            history.HistoryEntry(
+                datetime=datetime(2024, 1, day), command="create", customer="c1"
+            )
+            for day in (1, 2, 31)
+        ]
+        + [history.HistoryEntry(datetime=datetime(2024, 2, 1), command="resize")]
+        + [history.HistoryEntry(datetime=datetime(2024, 6, 1), command="resize")]
+    )
+    events = [
+        (datetime(2024, 1, 1, 1), 1, "start", None),
+        (datetime(2024, 1, 1, 2), 1, "end", "success"),
+        (datetime(2024, 1, 1, 3), 2, "start", None),
+        (datetime(2024, 1, 1, 4), 2, "end", "error"),
+        (datetime(2024, 1, 2, 1), 1, "start", None),
+        (datetime(2024, 6, 1, 1), 1, "start", None),
+    ]
+    session.add_all(
+        [
+            dirvish.DirvishEntry(
+                datetime=when, machine=machine, trigger=trigger, status=status
+            )
+            for when, machine, trigger, status in events
+        ]
+    )
+    session.commit()
+    return engine
+
+
+NOW = datetime(2024, 6, 15)
+
+
+def test_compact_history(engine, tmp_path):
+    compactor = compact.Compactor(engine, str(tmp_path / "archive"))
+    assert compactor.count("history", 30, now=NOW) == 4
+    stats = compactor.compact("history", 30, now=NOW)
+    assert stats.archived == 4
+    assert stats.last_id == 4
+    assert [os.path.basename(path) for path in stats.files] == [
+        "history-2024-01.jsonl.gz",
+        "history-2024-02.jsonl.gz",
+    ]
+    assert [row["id"] for row in compact.read_archive(stats.files[0])] == [1, 2, 3]
+    assert compactor.count("history", 0, now=NOW) == 1
+
+    # a second run appends to the month
+    session = sessionmaker(bind=engine)()
+    session.add(history.HistoryEntry(datetime=datetime(2024, 1, 5)))
+    session.commit()
+    stats = compactor.compact("history", 30, now=NOW)
+    assert stats.archived == 1
+    assert [row["id"] for row in compact.read_archive(stats.files[0])] == [
+        1,
+        2,
+        3,
+        6,
+    ]
+    assert compactor.compact("history", 30, now=NOW).archived == 0
+    compactor.vacuum()
+
+
+def test_compact_dirvish_rollups(engine, tmp_path):
+    compactor = compact.Compactor(engine, str(tmp_path / "archive"))
+    stats = compactor.compact("dirvish", 30, now=NOW)
+    assert stats.archived == 5
+    session = sessionmaker(bind=engine)()
+    daily = [
+        (e.day, e.machine, e.starts, e.ends, e.successes, e.failures)
+        for e in session.query(compact.DirvishDailyEntry).order_by(
+            compact.DirvishDailyEntry.day, compact.DirvishDailyEntry.machine
+        )
+    ]
+    assert daily == [
+        ("2024-01-01", 1, 1, 1, 1, 0),
+        ("2024-01-01", 2, 1, 1, 0, 1),
+        ("2024-01-02", 1, 1, 0, 0, 0),
+    ]
+    assert session.query(dirvish.DirvishEntry).count() == 1
+
+
+def test_compact_without_rollups(engine, tmp_path):
+    compactor = compact.Compactor(engine, str(tmp_path / "archive"), rollups=False)
+    compactor.compact("dirvish", 30, now=NOW)
+    session = sessionmaker(bind=engine)()
+    assert session.query(compact.DirvishDailyEntry).count() == 0
+
+
+def test_compact_archive_error(engine, tmp_path):
+    (tmp_path / "archive").write_text("not a directory")
+    compactor = compact.Compactor(engine, str(tmp_path / "archive"))
+    with pytest.raises(OSError):
+        compactor.compact("history", 30, now=NOW)
+    assert compactor.count("history", 30, now=NOW) == 4
+    with pytest.raises(KeyError):
+        compactor.compact("machines", 30)
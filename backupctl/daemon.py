@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import sqlalchemy
+
+from backupctl import protocol
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    def __init__(self, record):
+        self.record = record
+        self.done = threading.Event()
+        self.ok = False
+
+
+def _invalid(record):
+    """Check an event before it's queued, a malformed event would fail the
+    whole batch.
+
+    :param record:  Event as created by `spool.event`.
+
+    :returns: The error or None if the event is valid.
+    :rtype: string
+    """
+    if not isinstance(record, dict):
+        return "not an object"
+    if record.get("trigger") not in ("start", "end"):
+        return "unknown trigger {0!r}".format(record.get("trigger"))
+    env = record.get("env")
+    if not isinstance(env, dict):
+        return "missing env"
+    if not all(value is None or isinstance(value, str) for value in env.values()):
+        return "env values must be strings"
+    if not isinstance(record.get("id"), str) or not record["id"]:
+        return "missing id"
+    when = record.get("time")
+    if isinstance(when, bool) or not isinstance(when, (int, float)):
+        return "missing time"
+    if record.get("snapshot") is not None and not isinstance(record["snapshot"], str):
+        return "snapshot must be a string"
+    return None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        daemon = self.server.event_daemon
+        while True:
+            try:
+                message = protocol.read_frame(self.request)
+            except (OSError, ValueError) as e:
+                logger.warning("invalid request: {0}".format(e))
+                return
+            if message is None:
+                return
+            try:
+                protocol.write_frame(self.request, daemon.answer(message))
+            except OSError:
+                return
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # connections of hooks starting at the same time, connect fails with
+    # EAGAIN when the backlog is full
+    request_queue_size = 128
+
+
+class EventDaemon:
+    """Accept the events of the dirvish hooks on a Unix socket and add them
+    to the database in batches.
+
+    Events are queued and written by one thread, which commits up to
+    ``batch_size`` events or all events arriving within ``interval`` seconds
+    after the first one in a single transaction. A hook gets its answer when
+    its event is committed. The ids of the machines are kept in memory, so a
+    batch only reads the database to skip duplicated events.
+
+    :ivar dirvish.Dirvish dirvish:  Dirvish object.
+    :ivar history.History hist:     History the snapshots are added to.
+    :ivar string path:              Path of the Unix socket.
+    :ivar int batch_size:           Maximum number of events per transaction.
+    :ivar float interval:           Seconds to wait for more events.
+    :ivar float timeout:            Seconds a hook waits for its commit.
+    """
+
+    def __init__(self, dirvish, hist, path, batch_size=100, interval=0.05, timeout=10):
+        self.dirvish = dirvish
+        self.hist = hist
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._machines = {}
+        self._server = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "events": 0,
+            "duplicates": 0,
+            "batches": 0,
+            "failures": 0,
+            "commit_last_ms": 0.0,
+            "commit_max_ms": 0.0,
+            "commit_total_ms": 0.0,
+        }
+
+    def answer(self, message):
+        """Answer a request of a client.
+
+        :param dict message:    Request, an event ``{"type": "event",
+                                "record": ...}`` or ``{"type": "stats"}``.
+
+        :returns: The answer, ``ok`` tells whether the request succeeded.
+        :rtype: dict
+        """
+        if not isinstance(message, dict):
+            return {"ok": False, "error": "unknown request"}
+        if message.get("type") == "stats":
+            return dict(self.stats(), ok=True)
+        if message.get("type") != "event" or "record" not in message:
+            return {"ok": False, "error": "unknown request"}
+        error = _invalid(message["record"])
+        if error is not None:
+            logger.warning("rejected event: {0}".format(error))
+            return {"ok": False, "error": "invalid event: {0}".format(error)}
+        pending = self.submit(message["record"])
+        if not pending.done.wait(self.timeout):
+            return {"ok": False, "error": "timeout"}
+        if not pending.ok:
+            return {"ok": False, "error": "commit failed"}
+        return {"ok": True}
+
+    def submit(self, record):
+        """Queue an event for the next batch.
+
+        :param dict record: Event as created by `spool.event`.
+
+        :returns: Object whose ``done`` event is set after the commit, with
+                  the result in ``ok``.
+        """
+        pending = _Pending(record)
+        self._queue.put(pending)
+        return pending
+
+    def stats(self):
+        """Get the queue depth and the commit latency.
+
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        total = stats.pop("commit_total_ms")
+        stats["queue"] = self._queue.qsize()
+        stats["commit_avg_ms"] = total / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+    def write(self):
+        """Write the queued events until `stop` is called."""
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    pending = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stop = True
+                    break
+                batch.append(pending)
+            try:
+                self._commit(batch)
+            except Exception:
+                # keep writing, the hooks of later batches would time out
+                logger.exception("couldn't write {0} events".format(len(batch)))
+            if stop:
+                return
+
+    def _commit(self, batch):
+        start = time.monotonic()
+        ok = False
+        added = []
+        try:
+            added = self.dirvish.ingest(
+                [pending.record for pending in batch], self._machines, self.hist
+            )
+            ok = True
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.error("couldn't commit {0} events: {1}".format(len(batch), e))
+        finally:
+            if not ok:
+                # machines added in the failed transaction don't exist
+                self._machines.clear()
+            latency = (time.monotonic() - start) * 1000
+            with self._lock:
+                self._stats["batches"] += 1
+                if ok:
+                    self._stats["events"] += len(added)
+                    self._stats["duplicates"] += len(batch) - len(added)
+                else:
+                    self._stats["failures"] += 1
+                self._stats["commit_last_ms"] = latency
+                self._stats["commit_max_ms"] = max(
+                    self._stats["commit_max_ms"], latency
+                )
+                self._stats["commit_total_ms"] += latency
+            for pending in batch:
+                pending.ok = ok
+                pending.done.set()
+
+    def serve(self):
+        """Listen on the socket until `stop` is called, then write the queued
+        events.
+
+        :raises OSError: If the socket can't be created or another daemon
+                         listens on it.
+        """
+        self._remove_stale_socket()
+        self._server = _Server(self.path, _Handler)
+        self._server.event_daemon = self
+        writer = threading.Thread(target=self.write, name="writer")
+        writer.start()
+        logger.info("listening on {0}".format(self.path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.remove(self.path)
+            self._queue.put(None)
+            writer.join()
+
+    def stop(self):
+        """Stop `serve`, must be called from another thread."""
+        if self._server is not None:
+            self._server.shutdown()
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.path)
+            except OSError:
+                # left behind by a daemon which was killed
+                os.remove(self.path)
+                return
+        raise OSError("another daemon listens on {0}".format(self.path))
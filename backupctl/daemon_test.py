@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module daemon"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import sqlalchemy
+
+from backupctl import dirvish, history, hook, protocol, spool
+from backupctl.daemon import EventDaemon
+
+EVENTS = 40
+
+
+@pytest.fixture()
+def daemon(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    daemon = EventDaemon(
+        dirvish.Dirvish(engine),
+        history.History(engine),
+        str(tmp_path / "backupctl.sock"),
+        batch_size=10,
+        interval=0.05,
+    )
+    server = threading.Thread(target=daemon.serve)
+    server.start()
+    while not os.path.exists(daemon.path):
+        time.sleep(0.01)
+    yield daemon
+    daemon.stop()
+    server.join()
+
+
+def _event(i):
+    env = {
+        "DIRVISH_SERVER": "backup.example.com",
+        "DIRVISH_CLIENT": "client{0}.example.com".format(i % 4),
+        "DIRVISH_IMAGE": "default:2024-01-01_{0:02d}".format(i // 2),
+        "DIRVISH_STATUS": "success",
+    }
+    return spool.event("start" if i % 2 == 0 else "end", env)
+
+
+def test_group_commit(daemon):
+    with ThreadPoolExecutor(EVENTS) as pool:
+        sent = list(
+            pool.map(lambda i: hook.send(daemon.path, _event(i)), range(EVENTS))
+        )
+    assert sent == [True] * EVENTS
+    # a retried hook
+    assert hook.send(daemon.path, _event(1))
+
+    stats = protocol.request(daemon.path, {"type": "stats"})
+    assert stats["ok"]
+    assert stats["queue"] == 0
+    assert stats["events"] == EVENTS
+    assert stats["duplicates"] == 1
+    assert stats["failures"] == 0
+    assert stats["batches"] < EVENTS
+    assert stats["commit_max_ms"] >= stats["commit_avg_ms"] > 0
+
+    with daemon.dirvish._engine.connect() as connection:
+        query = connection.exec_driver_sql
+        assert query("SELECT COUNT(*) FROM dirvish").scalar() == EVENTS
+        assert query("SELECT COUNT(*) FROM machines").scalar() == 4
+    assert len(daemon._machines) == 4
+
+
+def test_unknown_request(daemon):
+    assert protocol.request(daemon.path, {"type": "unknown"}) == {
+        "ok": False,
+        "error": "unknown request",
+    }
+
+
+def test_malformed_event(daemon):
+    record = _event(0)
+    del record["env"]
+    answer = protocol.request(daemon.path, {"type": "event", "record": record})
+    assert not answer["ok"]
+    assert answer["error"].startswith("invalid event")
+    assert not protocol.request(daemon.path, {"type": "event", "record": []})["ok"]
+    # an event the checks let through fails its batch only
+    record = _event(2)
+    record["time"] = 1e20
+    assert not protocol.request(daemon.path, {"type": "event", "record": record})["ok"]
+
+    assert hook.send(daemon.path, _event(0))
+    stats = protocol.request(daemon.path, {"type": "stats"})
+    assert stats["events"] == 1
+    assert stats["failures"] == 1
+
+
+@pytest.mark.parametrize("message", [[], ["event"], "stats", 1])
+def test_malformed_request(daemon, message):
+    assert protocol.request(daemon.path, message) == {
+        "ok": False,
+        "error": "unknown request",
+    }
+    # the connection handler is still alive
+    assert protocol.request(daemon.path, {"type": "stats"})["ok"]
+
+
+def test_stale_socket(tmp_path):
+    path = str(tmp_path / "stale.sock")
+    with open(path, "w"):
+        pass
+    daemon = EventDaemon(None, None, path)
+    server = threading.Thread(target=daemon.serve)
+    server.start()
+    while daemon._server is None:
+        time.sleep(0.01)
+    with pytest.raises(OSError):
+        EventDaemon(None, None, path).serve()
+    daemon.stop()
+    server.join()
+    assert not os.path.exists(path)
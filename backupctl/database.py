@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextlib
+import logging
+import os
+import threading
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger(__name__)
+
+_engines = {}
+_factories = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def open_engine(url, busy_timeout=30):
+    """Open a SQLite database. Engines are cached by URL, so all objects of a
+    process share one connection pool.
+
+    The database is switched to write-ahead logging, which lets readers
+    and one writer work at the same time, and wait up to ``busy_timeout``
+    seconds for the lock of another writer instead of failing with "database
+    is locked".
+
+    :param string url:          SQLAlchemy database URL.
+    :param float busy_timeout:  Seconds to wait for a locked SQLite database.
+
+    :rtype: `sqlalchemy.engine.base.Engine`
+
+    :raises sqlalchemy.exc.ArgumentError: Raised when an invalid or conflicting
+                                          function argument is supplied or the
+                                          URL isn't a SQLite URL.
+    """
+    with _lock:
+        engine = _engines.get(url)
+        if engine is not None:
+            return engine
+        if not url.startswith("sqlite"):
+            # the migrations and the maintenance are written for SQLite
+            raise sqlalchemy.exc.ArgumentError(
+                "unsupported database {0}, only SQLite is supported".format(url)
+            )
+        engine = sqlalchemy.create_engine(url, connect_args={"timeout": busy_timeout})
+        _configure_sqlite(engine, busy_timeout)
+        _engines[url] = engine
+        logger.debug("Opened database {0} successfully".format(url))
+        return engine
+
+
+def _configure_sqlite(engine, busy_timeout):
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA busy_timeout = {0:d}".format(int(busy_timeout * 1000)))
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
+
+
+def engine_from_config(cfg):
+    """Open the database of the [database] section, creating its directory
+    if needed.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :rtype: `sqlalchemy.engine.base.Engine`
+
+    :raises sqlalchemy.exc.ArgumentError: Raised when an invalid or conflicting
+                                          function argument is supplied.
+    :raises OSError: If the directory of the database can't be created.
+    """
+    path = cfg["database"].get("path")
+    if path and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return open_engine(
+        cfg["database"].get("fullpath"),
+        busy_timeout=cfg.getfloat("database", "busy_timeout", fallback=30),
+    )
+
+
+def session_factory(engine):
+    """Get the session factory of an engine. Sessions don't expire their
+    objects on commit, so they can still be used after the session is closed.
+
+    :param sqlalchemy.engine.base.Engine engine:    SQLAlchemy engine.
+
+    :rtype: `sqlalchemy.orm.sessionmaker`
+    """
+    with _lock:
+        factory = _factories.get(engine)
+        if factory is None:
+            factory = sessionmaker(bind=engine, expire_on_commit=False)
+            _factories[engine] = factory
+        return factory
+
+
+@contextlib.contextmanager
+def session_scope(engine, immediate=False, separate=False):
+    """Run a unit of work in one transaction.
+
+    The session is committed when the block ends and rolled back if it
+    raises. A scope opened while another scope of the same engine is active
+    in the thread joins the outer one, so a whole command or hook with all the
+    objects it calls is written in exactly one transaction. Changes are only
+    sent to the database when they are needed, call ``session.flush()`` to get
+    the id of a new object.
+
+    :param sqlalchemy.engine.base.Engine engine:    SQLAlchemy engine.
+    :param bool immediate:                          Take the write lock of a
+                                                    SQLite database now, for
+                                                    units of work which read
+                                                    before they write, e.g.
+                                                    to insert a row only if
+                                                    it doesn't exist yet.
+    :param bool separate:                           Commit this scope on its
+                                                    own even if another scope
+                                                    is active, e.g. to record
+                                                    a state before a slow
+                                                    action. The outer scope
+                                                    must not have written yet,
+                                                    else this one waits for
+                                                    its lock.
+
+    :returns: Context manager yielding the session.
+    """
+    scopes = getattr(_local, "scopes", None)
+    if scopes is None:
+        scopes = _local.scopes = {}
+    outer = scopes.get(engine)
+    if outer is not None and not separate:
+        if immediate:
+            _begin_immediate(outer)
+        yield outer
+        return
+    session = session_factory(engine)()
+    scopes[engine] = session
+    try:
+        if immediate:
+            _begin_immediate(session)
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        if outer is not None:
+            scopes[engine] = outer
+        else:
+            del scopes[engine]
+        session.close()
+
+
+def _begin_immediate(session):
+    connection = session.connection()
+    if connection.dialect.name != "sqlite":
+        return
+    # the sqlite3 module only starts a transaction before the first write
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
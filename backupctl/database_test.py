@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module database"""
+
+import configparser
+import multiprocessing
+import os
+
+import pytest
+import sqlalchemy
+
+from backupctl import backupctl, database, dirvish, history, migrations
+
+CLIENTS = 10
+HOOKS = 200
+
+
+@pytest.fixture()
+def cfg(tmp_path):
+    cfg = configparser.ConfigParser()
+    cfg["database"] = {
+        "type": "sqlite",
+        "path": str(tmp_path / "db" / "backupctl.db"),
+        "fullpath": "sqlite:///{0}".format(tmp_path / "db" / "backupctl.db"),
+        "busy_timeout": "60",
+    }
+    cfg["zfs"] = {"pool": "backup", "root": str(tmp_path / "backup")}
+    return cfg
+
+
+def test_engine_from_config(cfg):
+    engine = database.engine_from_config(cfg)
+    assert database.engine_from_config(cfg) is engine
+    assert os.path.isdir(os.path.dirname(cfg["database"]["path"]))
+    with engine.connect() as connection:
+        pragma = connection.exec_driver_sql
+        assert pragma("PRAGMA journal_mode").scalar() == "wal"
+        assert pragma("PRAGMA busy_timeout").scalar() == 60000
+        # NORMAL
+        assert pragma("PRAGMA synchronous").scalar() == 1
+
+
+def test_open_engine_sqlite_only():
+    with pytest.raises(sqlalchemy.exc.ArgumentError):
+        database.open_engine("postgresql://backup@localhost/backupctl")
+
+
+def test_session_scope(cfg):
+    engine = database.engine_from_config(cfg)
+    hist = history.History(engine)
+    commits = []
+    sqlalchemy.event.listen(engine, "commit", lambda connection: commits.append(1))
+
+    with database.session_scope(engine) as outer:
+        hist.add("customer1", "create", size="1G")
+        with database.session_scope(engine) as inner:
+            assert inner is outer
+        hist.add("customer1", "config", "www.example.com")
+        assert commits == []
+    assert len(commits) == 1
+    assert len(hist.entries()) == 2
+
+    with pytest.raises(RuntimeError):
+        with database.session_scope(engine):
+            hist.add("customer2", "create", size="1G")
+            raise RuntimeError()
+    assert len(hist.entries()) == 2
+
+
+def test_session_scope_separate(cfg):
+    engine = database.engine_from_config(cfg)
+    hist = history.History(engine)
+    with pytest.raises(RuntimeError):
+        with database.session_scope(engine) as outer:
+            with database.session_scope(engine, separate=True) as inner:
+                assert inner is not outer
+                hist.add("customer1", "trash", "www.example.com")
+            with database.session_scope(engine) as joined:
+                assert joined is outer
+            hist.add("customer1", "remove", "www.example.com")
+            raise RuntimeError()
+    assert [entry.command for entry in hist.entries()] == ["trash"]
+
+
+def test_hook_is_one_transaction(cfg, mocker, monkeypatch):
+    mocker.patch("backupctl.backupctl.config", lambda: cfg)
+    engine = database.engine_from_config(cfg)
+    migrations.upgrade(engine)
+    odirvish = dirvish.Dirvish(engine)
+    mocker.patch("backupctl.backupctl.Dirvish", lambda engine: odirvish)
+    commits = []
+    sqlalchemy.event.listen(engine, "commit", lambda connection: commits.append(1))
+    monkeypatch.setenv("DIRVISH_SERVER", "backup.example.com")
+    monkeypatch.setenv("DIRVISH_CLIENT", "www.example.com")
+    backupctl.backup_start()
+    assert len(commits) == 1
+
+
+def _hook(i):
+    os.environ["DIRVISH_SERVER"] = "backup.example.com"
+    os.environ["DIRVISH_CLIENT"] = "client{0}.example.com".format(i % CLIENTS)
+    os.environ["DIRVISH_STATUS"] = "success"
+    if i % 2:
+        backupctl.backup_stop()
+    else:
+        backupctl.backup_start()
+    return i
+
+
+def test_parallel_hooks(cfg, mocker):
+    mocker.patch("backupctl.backupctl.config", lambda: cfg)
+    # the tables exist before the hooks run, as in production
+    os.makedirs(os.path.dirname(cfg["database"]["path"]))
+    engine = sqlalchemy.create_engine(cfg["database"]["fullpath"])
+    migrations.upgrade(engine)
+    engine.dispose()
+
+    context = multiprocessing.get_context("fork")
+    with context.Pool(32) as pool:
+        assert sorted(pool.map(_hook, range(HOOKS))) == list(range(HOOKS))
+
+    engine = sqlalchemy.create_engine(cfg["database"]["fullpath"])
+    with engine.connect() as connection:
+        query = connection.exec_driver_sql
+        assert query("SELECT COUNT(*) FROM dirvish").scalar() == HOOKS
+        assert query("SELECT COUNT(*) FROM machines").scalar() == CLIENTS
+        assert (
+            query("SELECT COUNT(*) FROM dirvish WHERE trigger = 'start'").scalar()
+            == HOOKS // 2
+        )
+    engine.dispose()
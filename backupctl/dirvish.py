@@ -1,18 +1,40 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import collections
+import concurrent.futures
+import hashlib
 import logging
 import os
+import tempfile
+import threading
 from datetime import datetime
 
 import jinja2
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (Boolean, Column, DateTime, Float, ForeignKey, Index,
+                        Integer, String, Text)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+
+from backupctl import database, spool, zfs
+from backupctl.history import snapshot_entry
 
 logger = logging.getLogger(__name__)
 Base = declarative_base()
 
+Image = collections.namedtuple("Image", ["name", "path", "created", "expire", "status"])
+
+# Outcome of the regeneration of a configuration, status is "changed",
+# "unchanged" or "failed".
+ConfigResult = collections.namedtuple(
+    "ConfigResult", ["customer", "vault", "status", "error"]
+)
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dirvish.conf.j2")
+
+_environment = jinja2.Environment()
+_templates = {}
+_templates_lock = threading.Lock()
+
 
 class MachineEntry(Base):
     __tablename__ = "machines"
@@ -22,6 +44,12 @@ class MachineEntry(Base):
     dirvish_server = Column(String)
     enabled = Column(Boolean)
 
+    __table_args__ = (
+        Index(
+            "ix_machines_client_server", "dirvish_client", "dirvish_server", unique=True
+        ),
+    )
+
     def __repr__(self):
         return "<Entry(id='{0}')>".format(self.id)
 
@@ -34,11 +62,116 @@ class DirvishEntry(Base):
     machine = Column(Integer, ForeignKey(MachineEntry.id))
     trigger = Column(String)
     status = Column(Integer)
+    snapshot = Column(String)
+    event = Column(String)
+
+    __table_args__ = (
+        Index("ix_dirvish_machine_datetime", "machine", "datetime"),
+        Index("ix_dirvish_event", "event", unique=True),
+    )
+
+    def __repr__(self):
+        return "<Entry(id='{0}')>".format(self.id)
+
+
+class RunEntry(Base):
+    """One backup of a machine, the start and the end event of dirvish.
+
+    The status is None while the backup runs, the status of the end event
+    when it ended and "missing" if the machine started again without an end.
+    A run without a start has no start time.
+    """
+
+    __tablename__ = "runs"
+
+    id = Column(Integer, primary_key=True)
+    machine = Column(Integer, ForeignKey(MachineEntry.id))
+    start_id = Column(Integer)
+    end_id = Column(Integer)
+    started = Column(DateTime)
+    ended = Column(DateTime)
+    seconds = Column(Float)
+    status = Column(String)
+
+    __table_args__ = (Index("ix_runs_machine_started", "machine", "started"),)
 
     def __repr__(self):
         return "<Entry(id='{0}')>".format(self.id)
 
 
+class VaultConfigEntry(Base):
+    """Settings of the dirvish configuration of a vault which differ from the
+    defaults. A client of None keeps the client of the existing
+    configuration, the excludes are added to the default excludes, one
+    pattern per line.
+    """
+
+    __tablename__ = "vault_configs"
+
+    id = Column(Integer, primary_key=True)
+    customer = Column(String)
+    vault = Column(String)
+    client = Column(String)
+    excludes = Column(Text)
+    updated = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_vault_configs_customer_vault", "customer", "vault", unique=True),
+    )
+
+    def __repr__(self):
+        return "<Entry(id='{0}')>".format(self.id)
+
+
+def compile_template(path=TEMPLATE):
+    """Get a compiled template. Templates are compiled once per process by
+    one shared environment.
+
+    :param string path: Path of the template.
+
+    :rtype: `jinja2.Template`
+
+    :raises FileNotFoundError: If the template file is missing.
+    """
+    with _templates_lock:
+        template = _templates.get(path)
+        if template is None:
+            with open(path, "r") as conf_jinja:
+                template = _environment.from_string(conf_jinja.read())
+            _templates[path] = template
+        return template
+
+
+def write_if_changed(path, content):
+    """Replace a file atomically if its content differs.
+
+    :param string path:     File path.
+    :param string content:  New content.
+
+    :returns: True if the file was written, False if it was up to date.
+    :rtype: bool
+
+    :raises OSError: If the file can't be read or written.
+    """
+    data = content.encode("utf8")
+    try:
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                return False
+    except FileNotFoundError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".default.conf-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return True
+
+
 class Dirvish:
     """Create dirvish configuration and handle dirvish server triggers.
 
@@ -79,52 +212,183 @@ class Dirvish:
             "/var/lib/docker/trust/*"
         ]
         self._engine = engine
+        self._template = None
         Base.metadata.create_all(engine)
 
-    def create_config(self, root, customer, vault, client, excludes=None):
+    def template(self):
+        """Get the compiled dirvish configuration template, see
+        `compile_template`.
+
+        :returns: Compiled template.
+        :rtype: `jinja2.Template`
+
+        :raises FileNotFoundError: If the template file is missing.
+        """
+        if self._template is None:
+            self._template = compile_template()
+        return self._template
+
+    def render_config(self, client, excludes=None):
+        """Render a dirvish configuration.
+
+        :param string client:   Client fqdn or IP address.
+        :param list excludes:   Exclude patterns, defaults to the default
+                                excludes.
+
+        :rtype: string
+
+        :raises FileNotFoundError: If the template file is missing.
+        """
+        if excludes is None:
+            excludes = self._excludes_default
+        return self.template().render(client=client, excludes=excludes)
+
+    def create_config(self, root, customer, vault, client, excludes=None, verbose=True):
         """Create default dirvish configuration.
 
         :param string root:     Backup root path.
         :param string customer: Customer name.
         :param string vault:    Dirvish vault.
         :param string client:   Client fqdn or IP address.
+        :param bool verbose:    Print the next steps for the operator.
 
         :returns: True if the dirvish configuration was written, else False.
         :rtype: bool
         """
-        root_dir = os.path.dirname(os.path.abspath(__file__))
-        config_path_j2 = os.path.join(root_dir, "dirvish.conf.j2")
         config_root = os.path.join(root, customer, vault, "dirvish")
         config_path = os.path.join(config_root, "default.conf")
-        if excludes is None:
-            excludes = self._excludes_default
         try:
-            with open(config_path_j2, "r") as conf_jinja:
-                os.makedirs(config_root, mode=0o755, exist_ok=True)
-                with open(config_path, "w") as conf:
-                    content = conf_jinja.read()
-                    content_rendered = (
-                        jinja2.Environment()
-                        .from_string(content)
-                        .render(client=client, excludes=excludes)
-                    )
-                    conf.write(content_rendered)
+            content = self.render_config(client, excludes)
+            os.makedirs(config_root, mode=0o755, exist_ok=True)
+            write_if_changed(config_path, content)
         except FileNotFoundError as e:
             logger.error(
                 "couldn't open configuration file {0}: {1}".format(config_path, e)
             )
+        if not verbose:
+            return True
         print(
             "You should now edit the dirvish configuration and run an "
             "initial backup.\n"
             "$EDITOR {0}/{1}/{2}/dirvish/default.conf\n"
             "dirvish --vault {1}/{2} --init\n\n"
-            "Please add the backup Job to /etc/crontab:\n"
-            "XX YY   *  *  *    root    dirvish --vault {1}/{2}\n".format(
-                root, customer, vault
-            )
+            "Then add the backup job to cron with a start time which fits the\n"
+            "other backups:\n"
+            "backupctl schedule\n".format(root, customer, vault)
         )
         return True
 
+    def config_client(self, root, customer, vault):
+        """Read the client of an existing dirvish configuration.
+
+        :param string root:     Backup root path.
+        :param string customer: Customer name.
+        :param string vault:    Dirvish vault.
+
+        :returns: Client fqdn or IP address, None if there is no configuration.
+        :rtype: string
+        """
+        config_path = os.path.join(root, customer, vault, "dirvish", "default.conf")
+        try:
+            with open(config_path, "r") as conf:
+                for line in conf:
+                    if line.startswith("client:"):
+                        return line.split(":", 1)[1].strip()
+        except OSError:
+            pass
+        return None
+
+    def set_vault_config(self, customer, vault, client=None, excludes=None):
+        """Store the settings of a vault which differ from the defaults.
+
+        :param string customer: Customer name.
+        :param string vault:    Dirvish vault.
+        :param string client:   Client fqdn or IP address, None to keep the
+                                client of the existing configuration.
+        :param list excludes:   Exclude patterns added to the default
+                                excludes.
+        """
+        with database.session_scope(self._engine, immediate=True) as session:
+            entry = (
+                session.query(VaultConfigEntry)
+                .filter_by(customer=customer, vault=vault)
+                .first()
+            )
+            if entry is None:
+                entry = VaultConfigEntry(customer=customer, vault=vault)
+                session.add(entry)
+            entry.client = client
+            entry.excludes = "\n".join(excludes) if excludes else None
+            entry.updated = datetime.now()
+
+    def vault_configs(self):
+        """Get the stored settings of all vaults.
+
+        :returns: Settings by customer and vault.
+        :rtype: `dict` of `dirvish.VaultConfigEntry`
+        """
+        with database.session_scope(self._engine) as session:
+            entries = session.query(VaultConfigEntry).all()
+            session.expunge_all()
+        return {(entry.customer, entry.vault): entry for entry in entries}
+
+    def regenerate_configs(self, root, vaults, jobs=8, dry_run=False):
+        """Render the dirvish configuration of vaults with the current
+        template, default excludes and their stored settings, and replace
+        the configurations whose content changed.
+
+        :param string root:     Backup root path.
+        :param list vaults:     Tuples of customer and vault.
+        :param int jobs:        Number of configurations rendered in parallel.
+        :param bool dry_run:    Only compare the configurations.
+
+        :returns: Results in the order of the vaults.
+        :rtype: `list` of `dirvish.ConfigResult`
+        """
+        overrides = self.vault_configs()
+        # compile before the threads start
+        self.template()
+
+        def regenerate(customer, vault):
+            entry = overrides.get((customer, vault))
+            client = entry.client if entry is not None else None
+            client = client or self.config_client(root, customer, vault)
+            if not client:
+                return ConfigResult(customer, vault, "failed", "no client")
+            excludes = list(self._excludes_default)
+            if entry is not None and entry.excludes:
+                excludes += entry.excludes.splitlines()
+            path = os.path.join(root, customer, vault, "dirvish", "default.conf")
+            content = self.render_config(client, excludes)
+            if dry_run:
+                try:
+                    with open(path, "r") as conf:
+                        changed = conf.read() != content
+                except FileNotFoundError:
+                    changed = True
+            else:
+                changed = write_if_changed(path, content)
+            return ConfigResult(
+                customer, vault, "changed" if changed else "unchanged", None
+            )
+
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(regenerate, customer, vault)
+                for customer, vault in vaults
+            ]
+            for (customer, vault), future in zip(vaults, futures):
+                try:
+                    results.append(future.result())
+                except (OSError, jinja2.TemplateError) as e:
+                    logger.error(
+                        "couldn't regenerate the configuration of {0}/{1}: "
+                        "{2}".format(customer, vault, e)
+                    )
+                    results.append(ConfigResult(customer, vault, "failed", str(e)))
+        return results
+
     def create_machine(self, dirvish_server, dirvish_client):
         """Add a machine in the machines table if it doesn't exist.
 
@@ -134,22 +398,21 @@ class Dirvish:
         :returns:   A server object.
         :rtype:     `dirvish.ServerEntry`
         """
-        db_session = sessionmaker(bind=self._engine)
-        session = db_session()
-
-        machine = (
-            session.query(MachineEntry)
-            .filter_by(dirvish_client=dirvish_client, dirvish_server=dirvish_server)
-            .first()
-        )
-        if not machine:
-            machine = MachineEntry(
-                dirvish_client=dirvish_client,
-                dirvish_server=dirvish_server,
-                enabled=True,
+        with database.session_scope(self._engine) as session:
+            machine = (
+                session.query(MachineEntry)
+                .filter_by(dirvish_client=dirvish_client, dirvish_server=dirvish_server)
+                .order_by(MachineEntry.id)
+                .first()
             )
-            session.add(machine)
-            session.commit()
+            if not machine:
+                machine = MachineEntry(
+                    dirvish_client=dirvish_client,
+                    dirvish_server=dirvish_server,
+                    enabled=True,
+                )
+                session.add(machine)
+                session.flush()
         return machine
 
     def backup_start(self):
@@ -161,37 +424,293 @@ class Dirvish:
         dirvish_client = os.environ.get("DIRVISH_CLIENT", None)
         # dirvish_image  = os.environ.get('DIRVISH_IMAGE', None)
 
-        machine = self.create_machine(dirvish_server, dirvish_client)
+        self.add_event("start", dirvish_server, dirvish_client)
 
-        new_entry = DirvishEntry(
-            datetime=datetime.now(), machine=machine.id, trigger="start"
-        )
+    def backup_stop(self, pool=None, root=None):
+        """Add an entry to the database when a dirvish backup is stopped.
 
-        db_session = sessionmaker(bind=self._engine)
-        session = db_session()
-        session.add(new_entry)
-        session.commit()
+        This function should be triggered by dirvish post-server. If a pool
+        and the backup root are given, a successful image is kept as a zfs
+        snapshot ``<pool>/<customer>/<vault>@<image>`` of the vault.
 
-    def backup_stop(self):
-        """Add an entry to the database when a dirvish backup is stopped.
+        :param string pool: zfs pool name, None to take no snapshot.
+        :param string root: Backup root path.
 
-        This function should be triggered by dirvish post-server.
+        :returns: The new entry.
+        :rtype: `dirvish.DirvishEntry`
         """
         dirvish_server = os.environ.get("DIRVISH_SERVER", None)
         dirvish_client = os.environ.get("DIRVISH_CLIENT", None)
         # dirvish_image  = os.environ.get('DIRVISH_IMAGE', None)
         dirvish_status = os.environ.get("DIRVISH_STATUS", None)
 
-        machine = self.create_machine(dirvish_server, dirvish_client)
+        # take the snapshot before writing, the database isn't locked for it
+        snapshot = None
+        if pool is not None and dirvish_status == "success":
+            snapshot = snapshot_image(pool, root, os.environ.get("DIRVISH_DEST", ""))
+
+        return self.add_event(
+            "end", dirvish_server, dirvish_client, dirvish_status, snapshot
+        )
+
+    def add_event(
+        self,
+        trigger,
+        dirvish_server,
+        dirvish_client,
+        status=None,
+        snapshot=None,
+        when=None,
+        event=None,
+        machines=None,
+    ):
+        """Add the start or end of a backup of a machine.
+
+        :param string trigger:          "start" or "end".
+        :param string dirvish_server:   Backup server (dirvish server).
+        :param string dirvish_client:   Backup client (machine to backup).
+        :param string status:           Status of an ended backup.
+        :param string snapshot:         zfs snapshot of the image.
+        :param datetime when:           Time of the event, defaults to now.
+        :param string event:            Key of a spooled event, see
+                                        `spool.event_key`.
+        :param dict machines:           Ids of the machines by server and
+                                        client, which are looked up and
+                                        added to it only if they are missing.
+                                        The caller has to clear it if the
+                                        transaction fails.
+
+        :returns: The new entry.
+        :rtype: `dirvish.DirvishEntry`
+        """
+        with database.session_scope(self._engine, immediate=True) as session:
+            machine = None
+            if machines is not None:
+                machine = machines.get((dirvish_server, dirvish_client))
+            if machine is None:
+                machine = self.create_machine(dirvish_server, dirvish_client).id
+                if machines is not None:
+                    machines[(dirvish_server, dirvish_client)] = machine
+            new_entry = DirvishEntry(
+                datetime=when or datetime.now(),
+                machine=machine,
+                trigger=trigger,
+                status=status,
+                snapshot=snapshot,
+                event=event,
+            )
+            session.add(new_entry)
+            session.flush()
+            self._track_run(session, new_entry)
+        return new_entry
+
+    def _track_run(self, session, entry):
+        run = (
+            session.query(RunEntry)
+            .filter(RunEntry.machine == entry.machine)
+            .order_by(RunEntry.started.desc(), RunEntry.id.desc())
+            .first()
+        )
+        if run is not None and run.status is not None:
+            run = None
+        if entry.trigger == "start":
+            if run is not None:
+                run.status = "missing"
+            session.add(
+                RunEntry(
+                    machine=entry.machine, start_id=entry.id, started=entry.datetime
+                )
+            )
+            return
+        if run is None:
+            run = RunEntry(machine=entry.machine)
+            session.add(run)
+        run.end_id = entry.id
+        run.ended = entry.datetime
+        run.status = str(entry.status or "unknown")
+        if run.started is not None:
+            run.seconds = (run.ended - run.started).total_seconds()
+
+    def ingest(self, records, machines=None, hist=None):
+        """Add spooled hook events in one transaction. Events which are
+        already in the database, e.g. of a retried hook or of an ingest which
+        couldn't clean up the spool, are skipped.
+
+        :param list records:            Events as created by `spool.event`.
+        :param dict machines:           Cache of machine ids, see
+                                        `add_event`.
+        :param history.History hist:    History the snapshots of the new
+                                        events are added to.
+
+        :returns: The new entries.
+        :rtype: `list` of `dirvish.DirvishEntry`
+        """
+        keys = [spool.event_key(record) for record in records]
+        added = []
+        with database.session_scope(self._engine, immediate=True) as session:
+            seen = set()
+            # stay below the limit of SQL variables
+            for start in range(0, len(keys), 500):
+                query = session.query(DirvishEntry.event).filter(
+                    DirvishEntry.event.in_(keys[start : start + 500])
+                )
+                seen.update(key for (key,) in query)
+            for record, key in zip(records, keys):
+                if key in seen:
+                    logger.info("skipped duplicated event {0}".format(key))
+                    continue
+                seen.add(key)
+                env = record["env"]
+                added.append(
+                    self.add_event(
+                        record["trigger"],
+                        env.get("DIRVISH_SERVER"),
+                        env.get("DIRVISH_CLIENT"),
+                        env.get("DIRVISH_STATUS"),
+                        record.get("snapshot"),
+                        datetime.fromtimestamp(record["time"]),
+                        key,
+                        machines,
+                    )
+                )
+            if hist is not None:
+                hist.add_many(
+                    [
+                        snapshot_entry(entry.snapshot)
+                        for entry in added
+                        if entry.snapshot is not None
+                    ]
+                )
+        return added
+
+
+def image_location(root, dest):
+    """Find the customer, vault and image of a dirvish image tree.
+
+    :param string root: Backup root path.
+    :param string dest: Tree of the image, e.g.
+                        ``<root>/<customer>/<vault>/<image>/tree``.
+
+    :returns: Customer, vault and image or None if the tree isn't below root.
+    :rtype: `tuple` (string, string, string)
+    """
+    if not root or not dest:
+        return None
+    parts = os.path.relpath(os.path.normpath(dest), os.path.normpath(root)).split(
+        os.sep
+    )
+    if parts[-1] == "tree":
+        parts = parts[:-1]
+    if len(parts) != 3 or ".." in parts:
+        return None
+    return tuple(parts)
+
+
+def snapshot_image(pool, root, dest):
+    """Take a zfs snapshot of the vault a dirvish image was written to.
+
+    :param string pool: zfs pool name.
+    :param string root: Backup root path.
+    :param string dest: Tree of the image (DIRVISH_DEST), e.g.
+                        ``<root>/<customer>/<vault>/<image>/tree``.
+
+    :returns: The snapshot name or None if no snapshot was taken.
+    :rtype: string
+    """
+    location = image_location(root, dest)
+    if location is None:
+        logger.error(
+            "image {0} isn't a vault image below {1}, no snapshot taken".format(
+                dest, root
+            )
+        )
+        return None
+    customer, vault, image = location
+    return zfs.new_snapshot(os.path.join(pool, customer, vault), image)
+
 
-        new_entry = DirvishEntry(
-            datetime=datetime.now(),
-            machine=machine.id,
-            trigger="end",
-            status=dirvish_status,
+def read_summary(path):
+    """Read the summary file dirvish writes into every image.
+
+    :param string path: Image directory.
+
+    :returns: Fields of the summary or None if there is no summary.
+    :rtype: dict
+    """
+    summary = {}
+    try:
+        with open(os.path.join(path, "summary"), "r", errors="replace") as f:
+            for line in f:
+                if ": " in line and not line.startswith((" ", "\t")):
+                    key, value = line.split(": ", 1)
+                    summary.setdefault(key.strip(), value.strip())
+    except OSError:
+        return None
+    return summary
+
+
+def _summary_time(value):
+    if value is None:
+        return None
+    # e.g. "+15 days == 2024-01-16 00:00:01"
+    value = value.rsplit("==", 1)[-1].strip()
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def vault_images(path):
+    """List the images of a dirvish vault.
+
+    :param string path: Vault directory.
+
+    :returns: Images, oldest first.
+    :rtype: `list` of `dirvish.Image`
+    """
+    images = []
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        logger.error("couldn't read vault {0}: {1}".format(path, e))
+        return images
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False) or entry.name == "dirvish":
+            continue
+        summary = read_summary(entry.path)
+        if summary is None:
+            continue
+        images.append(
+            Image(
+                name=entry.name,
+                path=entry.path,
+                created=_summary_time(summary.get("Image-now")),
+                expire=_summary_time(summary.get("Expire")),
+                status=summary.get("Status"),
+            )
         )
+    return sorted(images, key=lambda image: (image.created or datetime.min, image.name))
+
 
-        db_session = sessionmaker(bind=self._engine)
-        session = db_session()
-        session.add(new_entry)
-        session.commit()
+def expired_images(path, now=None):
+    """List the expired images of a dirvish vault. Like dirvish-expire, the
+    newest successful image is always kept.
+
+    :param string path:     Vault directory.
+    :param datetime now:    Point in time to check against, defaults to now.
+
+    :returns: Expired images, oldest first.
+    :rtype: `list` of `dirvish.Image`
+    """
+    if now is None:
+        now = datetime.now()
+    images = vault_images(path)
+    successful = [image for image in images if image.status == "success"]
+    keep = successful[-1] if successful else None
+    return [
+        image
+        for image in images
+        if image.expire is not None and image.expire <= now and image is not keep
+    ]
@@ -5,8 +5,11 @@
 
 import os
 
+import pytest
 import sqlalchemy
 
+from backupctl import dirvish as dirvish_module
+from backupctl import simulator, zfs
 from backupctl.dirvish import Dirvish
 
 BACKUPCTL_DB = os.path.join(os.sep, "tmp", "backupctl", "backupctl.db")
@@ -25,6 +28,19 @@ def test_dirvish_config():
     )
 
 
+def test_dirvish_config_client():
+    if not os.path.exists(os.path.dirname(BACKUPCTL_DB)):
+        os.makedirs(os.path.dirname(BACKUPCTL_DB))
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(BACKUPCTL_DB))
+    dirvish = Dirvish(engine)
+    root = os.path.join(os.sep, "tmp", "backupctl", "dirvish")
+    assert dirvish.create_config(
+        root, "example", "mail.example.com", "192.0.2.1", verbose=False
+    )
+    assert dirvish.config_client(root, "example", "mail.example.com") == "192.0.2.1"
+    assert dirvish.config_client(root, "example", "missing.example.com") is None
+
+
 def test_create_machine():
     if not os.path.exists(os.path.dirname(BACKUPCTL_DB)):
         os.makedirs(os.path.dirname(BACKUPCTL_DB))
@@ -60,3 +76,175 @@ def test_dirvish_stop():
     os.environ["DIRVISH_CLIENT"] = "client.example.com"
     os.environ["DIRVISH_SERVER"] = "backup.example.com"
     dirvish.backup_stop()
+
+
+@pytest.mark.parametrize(
+    "dest, location",
+    [
+        (
+            "/srv/backup/customer1/www.example.com/2024-01-01_00:00/tree",
+            ("customer1", "www.example.com", "2024-01-01_00:00"),
+        ),
+        (
+            "/srv/backup/customer1/www.example.com/2024-01-01_00:00",
+            ("customer1", "www.example.com", "2024-01-01_00:00"),
+        ),
+        ("/srv/backup/customer1/www.example.com/tree", None),
+        ("/srv/other/customer1/www.example.com/2024-01-01_00:00/tree", None),
+        ("", None),
+    ],
+)
+def test_image_location(dest, location):
+    assert dirvish_module.image_location("/srv/backup", dest) == location
+
+
+def test_dirvish_stop_snapshot(tmp_path, monkeypatch):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    dirvish = Dirvish(engine)
+    sim = simulator.SimulatedPool("backup")
+    sim._create("backup/customer1")
+    sim._create("backup/customer1/www.example.com")
+    previous = zfs.set_backend(sim)
+    try:
+        monkeypatch.setenv("DIRVISH_CLIENT", "www.example.com")
+        monkeypatch.setenv("DIRVISH_SERVER", "backup.example.com")
+        monkeypatch.setenv(
+            "DIRVISH_DEST", "/srv/backup/customer1/www.example.com/2024-01-01/tree"
+        )
+        monkeypatch.setenv("DIRVISH_STATUS", "success")
+        entry = dirvish.backup_stop("backup", "/srv/backup")
+        assert entry.snapshot == "backup/customer1/www.example.com@2024-01-01"
+        monkeypatch.setenv("DIRVISH_STATUS", "fail")
+        assert dirvish.backup_stop("backup", "/srv/backup").snapshot is None
+        monkeypatch.setenv("DIRVISH_STATUS", "success")
+        assert dirvish.backup_stop().snapshot is None
+        assert [
+            s.name for s in zfs.list_snapshots("backup/customer1/www.example.com")
+        ] == ["backup/customer1/www.example.com@2024-01-01"]
+    finally:
+        zfs.set_backend(previous)
+
+
+def write_image(vault, name, created, expire, status="success"):
+    path = os.path.join(vault, name, "tree")
+    os.makedirs(path)
+    with open(os.path.join(vault, name, "summary"), "w") as summary:
+        summary.write(
+            "client: www.example.com\n"
+            "Image: {0}\n"
+            "Image-now: {1}\n"
+            "Expire: +15 days == {2}\n"
+            "exclude:\n"
+            "        Status: ignored\n"
+            "Status: {3}\n".format(name, created, expire, status)
+        )
+
+
+def test_expired_images(tmp_path):
+    from datetime import datetime
+
+    vault = str(tmp_path)
+    os.makedirs(os.path.join(vault, "dirvish"))
+    os.makedirs(os.path.join(vault, "unfinished"))
+    write_image(vault, "2024-01-01", "2024-01-01 00:00:00", "2024-01-16 00:00:00")
+    write_image(vault, "2024-01-02", "2024-01-02 00:00:00", "2024-01-17 00:00:00")
+    write_image(
+        vault, "2024-01-03", "2024-01-03 00:00:00", "2024-01-18 00:00:00", "fail"
+    )
+    write_image(vault, "2024-01-04", "2024-01-04 00:00:00", "never")
+    images = dirvish_module.vault_images(vault)
+    assert [image.name for image in images] == [
+        "2024-01-01",
+        "2024-01-02",
+        "2024-01-03",
+        "2024-01-04",
+    ]
+    assert images[2].status == "fail"
+    assert images[3].expire is None
+    now = datetime(2024, 2, 1)
+    assert [i.name for i in dirvish_module.expired_images(vault, now)] == [
+        "2024-01-01",
+        "2024-01-02",
+        "2024-01-03",
+    ]
+
+
+def test_expired_images_keeps_newest_success(tmp_path):
+    from datetime import datetime
+
+    vault = str(tmp_path)
+    write_image(vault, "2024-01-01", "2024-01-01 00:00:00", "2024-01-16 00:00:00")
+    write_image(
+        vault, "2024-01-02", "2024-01-02 00:00:00", "2024-01-17 00:00:00", "fail"
+    )
+    assert [
+        i.name for i in dirvish_module.expired_images(vault, datetime(2024, 2, 1))
+    ] == ["2024-01-02"]
+
+
+def test_compile_template():
+    engine = sqlalchemy.create_engine("sqlite://")
+    template = Dirvish(engine).template()
+    assert Dirvish(engine).template() is template
+    assert dirvish_module.compile_template() is template
+
+
+def test_write_if_changed(tmp_path):
+    path = str(tmp_path / "default.conf")
+    assert dirvish_module.write_if_changed(path, "client: a\n")
+    inode = os.stat(path).st_ino
+    assert not dirvish_module.write_if_changed(path, "client: a\n")
+    assert os.stat(path).st_ino == inode
+    assert dirvish_module.write_if_changed(path, "client: b\n")
+    assert open(path).read() == "client: b\n"
+    assert oct(os.stat(path).st_mode & 0o777) == "0o644"
+    assert os.listdir(str(tmp_path)) == ["default.conf"]
+
+
+def test_regenerate_configs(tmp_path):
+    root = str(tmp_path)
+    dirvish = Dirvish(sqlalchemy.create_engine("sqlite://"))
+    for vault, client in [("www", "192.0.2.1"), ("mail", "192.0.2.2")]:
+        dirvish.create_config(root, "customer1", vault, client, verbose=False)
+    os.makedirs(os.path.join(root, "customer1", "db", "dirvish"))
+    dirvish.set_vault_config("customer1", "db", "192.0.2.3")
+    dirvish.set_vault_config("customer1", "www", excludes=["/srv/cache/*"])
+    vaults = [("customer1", "www"), ("customer1", "mail"), ("customer1", "db")]
+
+    results = dirvish.regenerate_configs(root, vaults, jobs=2, dry_run=True)
+    assert [r.status for r in results] == ["changed", "unchanged", "changed"]
+    assert (
+        "/srv/cache/*"
+        not in open(
+            os.path.join(root, "customer1", "www", "dirvish", "default.conf")
+        ).read()
+    )
+
+    results = dirvish.regenerate_configs(root, vaults + [("customer1", "new")])
+    assert [(r.vault, r.status, r.error) for r in results] == [
+        ("www", "changed", None),
+        ("mail", "unchanged", None),
+        ("db", "changed", None),
+        ("new", "failed", "no client"),
+    ]
+    www = open(os.path.join(root, "customer1", "www", "dirvish", "default.conf"))
+    assert "client: 192.0.2.1\n" in www.read()
+    assert dirvish.config_client(root, "customer1", "db") == "192.0.2.3"
+    assert (
+        "    /srv/cache/*"
+        in open(
+            os.path.join(root, "customer1", "www", "dirvish", "default.conf")
+        ).read()
+    )
+    assert [r.status for r in dirvish.regenerate_configs(root, vaults)] == [
+        "unchanged"
+    ] * 3
+
+    # stored settings are replaced
+    dirvish.set_vault_config("customer1", "www")
+    assert dirvish.vault_configs()[("customer1", "www")].excludes is None
+    assert [r.status for r in dirvish.regenerate_configs(root, vaults)] == [
+        "changed",
+        "unchanged",
+        "unchanged",
+    ]
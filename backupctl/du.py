@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Disk usage of dirvish images which share their files by hardlinks.
+
+The files of an image which are hardlinks to other images don't take any
+space of their own, only the files which are in no other image are freed
+when the image expires. Every image is walked once, the files with a single
+link are summed up right away and the inode numbers and sizes of the others
+are kept in an `InodeSet`, two sorted arrays of 8 byte integers. The sets of
+all images are merged to find the files which only one image holds.
+
+All images of a vault are on one file system, so the inode number alone
+identifies a file. The device number isn't kept, zfs doesn't keep it across
+reboots. The scan of an image is cached in a file until the modification
+time of the image changes, so only new images are walked again.
+"""
+
+import array
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import json
+import logging
+import os
+import stat
+import tempfile
+import zlib
+
+from backupctl.dirvish import vault_images
+
+logger = logging.getLogger(__name__)
+
+# Sizes are the allocated bytes of the files, unique bytes are only in this
+# image and are freed when it's removed.
+ImageUsage = collections.namedtuple(
+    "ImageUsage", ["image", "files", "bytes", "unique", "shared", "cached"]
+)
+
+# Usage of a vault, bytes are the allocated bytes of its distinct files.
+VaultUsage = collections.namedtuple(
+    "VaultUsage", ["images", "files", "bytes", "cached", "scanned"]
+)
+
+VERSION = 1
+
+# Files sorted at once while building an `InodeSet`.
+RUN = 1 << 16
+
+
+class InodeSet:
+    """Sorted inode numbers with the size of each file.
+
+    :ivar array.array inodes:   Inode numbers, ascending and distinct.
+    :ivar array.array sizes:    Allocated bytes of the files.
+    """
+
+    __slots__ = ("inodes", "sizes")
+
+    def __init__(self, inodes=None, sizes=None):
+        self.inodes = inodes if inodes is not None else array.array("Q")
+        self.sizes = sizes if sizes is not None else array.array("Q")
+
+    @classmethod
+    def build(cls, inodes, sizes):
+        """Create a set from unsorted inodes, links to the same inode are
+        kept once.
+
+        Only `RUN` files at a time are sorted as Python objects, the sorted
+        runs are kept as arrays and merged, so building the set takes little
+        more memory than the arrays.
+
+        :param array.array inodes:  Inode numbers.
+        :param array.array sizes:   Allocated bytes of the files.
+
+        :rtype: `du.InodeSet`
+        """
+        runs = []
+        for start in range(0, len(inodes), RUN):
+            pairs = sorted(zip(inodes[start : start + RUN], sizes[start : start + RUN]))
+            runs.append(
+                (
+                    array.array("Q", [inode for inode, size in pairs]),
+                    array.array("Q", [size for inode, size in pairs]),
+                )
+            )
+        result = cls()
+        last = None
+        for inode, size in heapq.merge(*[zip(*run) for run in runs]):
+            if inode == last:
+                continue
+            last = inode
+            result.inodes.append(inode)
+            result.sizes.append(size)
+        return result
+
+    def __len__(self):
+        return len(self.inodes)
+
+    def total(self):
+        """Get the allocated bytes of all files.
+
+        :rtype: int
+        """
+        return sum(self.sizes)
+
+    def dumps(self):
+        """Serialize the set.
+
+        :rtype: bytes
+        """
+        return zlib.compress(self.inodes.tobytes() + self.sizes.tobytes())
+
+    @classmethod
+    def loads(cls, data):
+        """Read a set serialized with `dumps`.
+
+        :param bytes data:  Serialized set.
+
+        :rtype: `du.InodeSet`
+
+        :raises ValueError: If the data is corrupt.
+        """
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        values = array.array("Q")
+        if len(data) % (2 * values.itemsize):
+            raise ValueError("invalid inode set")
+        values.frombytes(data)
+        half = len(values) // 2
+        return cls(values[:half], values[half:])
+
+
+# Scan of one image: its files, their allocated bytes, the bytes of the
+# files with a single link and the set of the other files.
+ImageScan = collections.namedtuple(
+    "ImageScan", ["mtime", "files", "bytes", "single", "linked"]
+)
+
+
+def scan_image(path):
+    """Walk the tree of an image.
+
+    :param string path: Image directory.
+
+    :rtype: `du.ImageScan`
+    """
+    mtime = os.stat(path).st_mtime_ns
+    files = 0
+    single = 0
+    inodes = array.array("Q")
+    sizes = array.array("Q")
+    stack = [os.path.join(path, "tree")]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.error("couldn't read {0}: {1}".format(directory, e))
+            continue
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                logger.error("couldn't read {0}: {1}".format(entry.path, e))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(entry.path)
+                continue
+            files += 1
+            if st.st_nlink == 1:
+                single += st.st_blocks * 512
+            else:
+                inodes.append(st.st_ino)
+                sizes.append(st.st_blocks * 512)
+    linked = InodeSet.build(inodes, sizes)
+    return ImageScan(mtime, files, single + linked.total(), single, linked)
+
+
+class Cache:
+    """Scans of images stored as files below a directory, one file per
+    image, valid as long as the modification time of the image is the same.
+
+    :ivar string directory: Cache directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, customer, vault, image):
+        """Get the cache file of an image.
+
+        :param string customer: Customer name.
+        :param string vault:    Vault name.
+        :param string image:    Image name.
+
+        :rtype: string
+        """
+        return os.path.join(self.directory, customer, vault, image + ".du")
+
+    def load(self, customer, vault, image, mtime):
+        """Read the scan of an image.
+
+        :param string customer: Customer name.
+        :param string vault:    Vault name.
+        :param string image:    Image name.
+        :param int mtime:       Current modification time of the image in
+                                nanoseconds.
+
+        :returns: The scan or None if it isn't cached or outdated.
+        :rtype: `du.ImageScan`
+        """
+        try:
+            with open(self.path(customer, vault, image), "rb") as f:
+                header = json.loads(f.readline().decode("utf8"))
+                if header.get("version") != VERSION or header.get("mtime") != mtime:
+                    return None
+                linked = InodeSet.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "ignored the cached usage of {0}/{1}/{2}: {3}".format(
+                    customer, vault, image, e
+                )
+            )
+            return None
+        return ImageScan(
+            mtime, header["files"], header["bytes"], header["single"], linked
+        )
+
+    def save(self, customer, vault, image, scan):
+        """Write the scan of an image atomically.
+
+        :param string customer:     Customer name.
+        :param string vault:        Vault name.
+        :param string image:        Image name.
+        :param du.ImageScan scan:   Scan of the image.
+
+        :raises OSError: If the file can't be written.
+        """
+        path = self.path(customer, vault, image)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        header = {
+            "version": VERSION,
+            "mtime": scan.mtime,
+            "files": scan.files,
+            "bytes": scan.bytes,
+            "single": scan.single,
+        }
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".du-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json.dumps(header).encode("utf8") + b"\n")
+                f.write(scan.linked.dumps())
+            os.rename(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def prune(self, customer, vault, images):
+        """Remove the cache files of images which don't exist anymore.
+
+        :param string customer: Customer name.
+        :param string vault:    Vault name.
+        :param list images:     Names of the existing images.
+        """
+        directory = os.path.join(self.directory, customer, vault)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith(".du") and name[:-3] not in images:
+                os.remove(os.path.join(directory, name))
+
+
+def vault_usage(root, customer, vault, cache=None, jobs=4):
+    """Get the usage of every image of a vault, walking the images which
+    aren't cached in parallel.
+
+    :param string root:     Backup root path.
+    :param string customer: Customer name.
+    :param string vault:    Vault name.
+    :param du.Cache cache:  Cache of the scans, None to walk all images.
+    :param int jobs:        Number of images walked at the same time.
+
+    :returns: The usage of the vault and of its images, oldest first.
+    :rtype: tuple (`du.VaultUsage`, `list` of `du.ImageUsage`)
+    """
+    images = vault_images(os.path.join(root, customer, vault))
+    scans = {}
+    missing = []
+    for image in images:
+        scan = None
+        if cache is not None:
+            scan = cache.load(
+                customer, vault, image.name, os.stat(image.path).st_mtime_ns
+            )
+        if scan is None:
+            missing.append(image)
+        else:
+            scans[image.name] = scan
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        paths = [image.path for image in missing]
+        for image, scan in zip(missing, executor.map(scan_image, paths)):
+            scans[image.name] = scan
+            if cache is not None:
+                try:
+                    cache.save(customer, vault, image.name, scan)
+                except OSError as e:
+                    logger.warning(
+                        "couldn't cache the usage of {0}: {1}".format(image.path, e)
+                    )
+    if cache is not None:
+        cache.prune(customer, vault, [image.name for image in images])
+
+    ordered = [scans[image.name] for image in images]
+    unique, distinct = _shared(ordered)
+    result = []
+    scanned = set(image.name for image in missing)
+    for image, scan, linked_unique in zip(images, ordered, unique):
+        own = scan.single + linked_unique
+        result.append(
+            ImageUsage(
+                image.name,
+                scan.files,
+                scan.bytes,
+                own,
+                scan.bytes - own,
+                image.name not in scanned,
+            )
+        )
+    return (
+        VaultUsage(
+            len(images),
+            sum(scan.files for scan in ordered),
+            sum(scan.single for scan in ordered) + distinct,
+            len(images) - len(missing),
+            len(missing),
+        ),
+        result,
+    )
+
+
+def _shared(scans):
+    # merge the sorted inodes of all images, an inode found once belongs to
+    # one image alone
+    unique = [0] * len(scans)
+    distinct = 0
+    merged = heapq.merge(
+        *[
+            zip(scan.linked.inodes, scan.linked.sizes, itertools.repeat(i))
+            for i, scan in enumerate(scans)
+        ]
+    )
+    last = None
+    owner = None
+    size = 0
+    for inode, inode_size, index in merged:
+        if inode == last:
+            owner = None
+            continue
+        if owner is not None:
+            unique[owner] += size
+        last, owner, size = inode, index, inode_size
+        distinct += inode_size
+    if owner is not None:
+        unique[owner] += size
+    return unique, distinct
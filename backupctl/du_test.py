@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module du"""
+
+import array
+import os
+
+import pytest
+
+from backupctl import du
+
+
+def write_image(vault, name, files, previous=None):
+    """Write an image, the files of ``previous`` which aren't in ``files``
+    are hardlinked like dirvish does."""
+    tree = os.path.join(vault, name, "tree")
+    os.makedirs(os.path.join(tree, "etc"))
+    for path, size in files.items():
+        with open(os.path.join(tree, path), "wb") as f:
+            f.write(os.urandom(size))
+    for path in previous or []:
+        if path not in files:
+            os.link(
+                os.path.join(vault, previous[path], "tree", path),
+                os.path.join(tree, path),
+            )
+    with open(os.path.join(vault, name, "summary"), "w") as summary:
+        summary.write("Image-now: {0} 22:00:00\nStatus: success\n".format(name))
+    return {path: name for path in files}
+
+
+def allocated(vault, image, path):
+    return os.lstat(os.path.join(vault, image, "tree", path)).st_blocks * 512
+
+
+@pytest.fixture()
+def vault(tmp_path):
+    vault = str(tmp_path / "backup" / "customer1" / "www")
+    first = write_image(
+        vault, "2024-01-01", {"etc/hosts": 8192, "etc/passwd": 4096, "big": 65536}
+    )
+    second = dict(first)
+    second.update(write_image(vault, "2024-01-02", {"etc/hosts": 12288}, first))
+    write_image(vault, "2024-01-03", {"new": 4096}, second)
+    return vault
+
+
+def test_inode_set_runs(monkeypatch):
+    # links to the same inode in different runs are kept once
+    monkeypatch.setattr(du, "RUN", 2)
+    inodes = du.InodeSet.build(
+        array.array("Q", [30, 10, 20, 10, 30, 5, 20]),
+        array.array("Q", [3, 1, 2, 1, 3, 9, 2]),
+    )
+    assert list(inodes.inodes) == [5, 10, 20, 30]
+    assert list(inodes.sizes) == [9, 1, 2, 3]
+    assert du.InodeSet.build(array.array("Q"), array.array("Q")).total() == 0
+
+
+def test_inode_set():
+    inodes = du.InodeSet.build(
+        array.array("Q", [30, 10, 20, 10]), array.array("Q", [3, 1, 2, 1])
+    )
+    assert list(inodes.inodes) == [10, 20, 30]
+    assert list(inodes.sizes) == [1, 2, 3]
+    assert len(inodes) == 3
+    assert inodes.total() == 6
+    loaded = du.InodeSet.loads(inodes.dumps())
+    assert (loaded.inodes, loaded.sizes) == (inodes.inodes, inodes.sizes)
+    with pytest.raises(ValueError):
+        du.InodeSet.loads(b"invalid")
+
+
+def test_vault_usage(vault, tmp_path):
+    root = str(tmp_path / "backup")
+    hosts1 = allocated(vault, "2024-01-01", "etc/hosts")
+    hosts2 = allocated(vault, "2024-01-02", "etc/hosts")
+    passwd = allocated(vault, "2024-01-01", "etc/passwd")
+    big = allocated(vault, "2024-01-01", "big")
+    new = allocated(vault, "2024-01-03", "new")
+    total, images = du.vault_usage(root, "customer1", "www", jobs=2)
+    assert images == [
+        du.ImageUsage(
+            "2024-01-01", 3, hosts1 + passwd + big, hosts1, passwd + big, False
+        ),
+        du.ImageUsage(
+            "2024-01-02", 3, hosts2 + passwd + big, 0, hosts2 + passwd + big, False
+        ),
+        du.ImageUsage(
+            "2024-01-03",
+            4,
+            hosts2 + passwd + big + new,
+            new,
+            hosts2 + passwd + big,
+            False,
+        ),
+    ]
+    assert total == du.VaultUsage(3, 10, hosts1 + hosts2 + passwd + big + new, 0, 3)
+
+
+def test_vault_usage_cache(vault, tmp_path):
+    root = str(tmp_path / "backup")
+    cache = du.Cache(str(tmp_path / "cache"))
+    total, images = du.vault_usage(root, "customer1", "www", cache=cache)
+    assert (total.cached, total.scanned) == (0, 3)
+    assert sorted(os.listdir(str(tmp_path / "cache" / "customer1" / "www"))) == [
+        "2024-01-01.du",
+        "2024-01-02.du",
+        "2024-01-03.du",
+    ]
+    cached_total, cached_images = du.vault_usage(root, "customer1", "www", cache=cache)
+    assert (cached_total.cached, cached_total.scanned) == (3, 0)
+    assert cached_total.bytes == total.bytes
+    assert [image._replace(cached=False) for image in cached_images] == images
+    assert all(image.cached for image in cached_images)
+
+    # a changed image or a corrupt cache is scanned again, the cache of a
+    # removed image is removed
+    os.utime(os.path.join(vault, "2024-01-02"), (0, 0))
+    with open(cache.path("customer1", "www", "2024-01-01"), "r+b") as f:
+        f.seek(-4, os.SEEK_END)
+        f.write(b"xxxx")
+    for name in ["summary", "tree/new"]:
+        os.remove(os.path.join(vault, "2024-01-03", name))
+    total, images = du.vault_usage(root, "customer1", "www", cache=cache)
+    assert (total.cached, total.scanned) == (0, 2)
+    assert not os.path.exists(cache.path("customer1", "www", "2024-01-03"))
+    assert cache.load("customer1", "www", "2024-01-02", 0).files == 3
+    assert cache.load("customer1", "www", "2024-01-02", 1) is None
+    total, images = du.vault_usage(root, "customer1", "www", cache=cache)
+    assert (total.cached, total.scanned) == (2, 0)
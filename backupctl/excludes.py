@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Find the parts of a dirvish image which are worth excluding.
+
+Every unchanged file of an image is a hardlink to the previous image, so a
+file of the newest image with a single link was written by the last backup.
+The size and the number of files of every directory and this nightly churn
+are summed up in a trie of the directories of the image, which keeps one node
+per directory and nothing per file. The trie is built from a parallel scan
+with `os.scandir`.
+
+Exclude patterns are matched like rsync does: a pattern starting with a slash
+is anchored at the root of the tree, a pattern with a trailing slash only
+matches directories, a pattern without any other slash matches the name of a
+file or directory at any depth, ``*`` doesn't match a slash and ``**`` does.
+"""
+
+import collections
+import logging
+import os
+import queue
+import re
+import threading
+
+from backupctl.dirvish import vault_images
+
+logger = logging.getLogger(__name__)
+
+Usage = collections.namedtuple("Usage", ["bytes", "files", "churn", "churn_files"])
+
+# A pattern and the usage of the files it matches.
+Candidate = collections.namedtuple("Candidate", ["pattern", "usage"])
+
+Rule = collections.namedtuple("Rule", ["pattern", "regex", "directories", "name"])
+
+# Result of a scan: the trie of the files which aren't excluded, their usage
+# by file suffix, and the usage of the excluded files by pattern.
+Scan = collections.namedtuple("Scan", ["tree", "suffixes", "excluded"])
+
+# Directory names aren't a candidate unless they are this often in the tree.
+MIN_OCCURRENCES = 2
+
+
+class Node:
+    """Directory of a `excludes.Tree` with the usage of its subtree."""
+
+    __slots__ = ("children", "bytes", "files", "churn", "churn_files")
+
+    def __init__(self):
+        self.children = None
+        self.bytes = 0
+        self.files = 0
+        self.churn = 0
+        self.churn_files = 0
+
+    def child(self, name):
+        """Get a subdirectory, add it if it's missing.
+
+        :param string name: Name of the subdirectory.
+
+        :rtype: `excludes.Node`
+        """
+        if self.children is None:
+            self.children = {}
+        node = self.children.get(name)
+        if node is None:
+            node = self.children[name] = Node()
+        return node
+
+    def usage(self):
+        """Get the usage of the subtree.
+
+        :rtype: `excludes.Usage`
+        """
+        return Usage(self.bytes, self.files, self.churn, self.churn_files)
+
+
+class Tree:
+    """Trie of the directories of an image.
+
+    :ivar excludes.Node root:   Root directory of the image.
+    """
+
+    def __init__(self):
+        self.root = Node()
+
+    def add(self, path, usage):
+        """Add the files directly in a directory.
+
+        :param string path:             Directory, relative to the root of
+                                        the image with a leading slash, the
+                                        empty string for the root.
+        :param excludes.Usage usage:    Usage of the files.
+        """
+        node = self.root
+        _add(node, usage)
+        for name in path.split("/")[1:]:
+            node = node.child(name)
+            _add(node, usage)
+
+    def get(self, path):
+        """Get a directory.
+
+        :param string path: Directory, see `add`.
+
+        :returns: The directory or None if it has no files.
+        :rtype: `excludes.Node`
+        """
+        node = self.root
+        for name in path.split("/")[1:]:
+            node = (node.children or {}).get(name)
+            if node is None:
+                return None
+        return node
+
+    def directories(self):
+        """Walk all directories, parents before their children.
+
+        :returns: Generator of tuples of the path and the `excludes.Node`.
+        :rtype: generator
+        """
+        stack = [("", self.root)]
+        while stack:
+            path, node = stack.pop()
+            yield path, node
+            for name, child in sorted((node.children or {}).items(), reverse=True):
+                stack.append((path + "/" + name, child))
+
+
+def _add(node, usage):
+    node.bytes += usage.bytes
+    node.files += usage.files
+    node.churn += usage.churn
+    node.churn_files += usage.churn_files
+
+
+def compile_pattern(pattern):
+    """Compile an exclude pattern of dirvish (rsync).
+
+    :param string pattern:  Pattern, e.g. "/var/cache/*" or "*.bak".
+
+    :rtype: `excludes.Rule`
+    """
+    directories = pattern.endswith("/")
+    body = pattern.rstrip("/")
+    regex = _translate(body.lstrip("/"))
+    if body.startswith("/"):
+        return Rule(pattern, re.compile("^/" + regex + "$"), directories, False)
+    if "/" in body:
+        return Rule(pattern, re.compile("(^|/)" + regex + "$"), directories, False)
+    return Rule(pattern, re.compile("^" + regex + "$"), directories, True)
+
+
+def _translate(glob):
+    regex = []
+    i = 0
+    while i < len(glob):
+        char = glob[i]
+        if glob.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[" and "]" in glob[i + 2 :]:
+            end = glob.index("]", i + 2)
+            regex.append("[" + glob[i + 1 : end].replace("\\", "\\\\") + "]")
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return "".join(regex)
+
+
+def match(rules, path, name, directory):
+    """Find the first rule which excludes a file or directory.
+
+    :param list rules:      `excludes.Rule` to check.
+    :param string path:     Path relative to the root of the image with a
+                            leading slash.
+    :param string name:     Name of the file or directory.
+    :param bool directory:  Whether it is a directory.
+
+    :returns: Position of the rule or None if no rule matches.
+    :rtype: int
+    """
+    for i, rule in enumerate(rules):
+        if rule.directories and not directory:
+            continue
+        if rule.regex.search(name if rule.name else path):
+            return i
+    return None
+
+
+def scan(path, patterns=None, jobs=8):
+    """Scan the tree of an image in parallel.
+
+    The files matched by a pattern, or below a directory matched by one,
+    aren't added to the trie but counted for the first matching pattern.
+
+    :param string path:     Tree of the image.
+    :param list patterns:   Exclude patterns.
+    :param int jobs:        Number of threads.
+
+    :returns: The trie and the usage by suffix and excluded pattern.
+    :rtype: `excludes.Scan`
+    """
+    rules = [compile_pattern(pattern) for pattern in patterns or []]
+    directories = queue.Queue()
+    directories.put((path, "", None))
+    results = []
+    threads = []
+    for i in range(max(int(jobs), 1)):
+        result = ({}, {}, [[0, 0, 0, 0] for rule in rules])
+        results.append(result)
+        thread = threading.Thread(
+            target=_worker, args=(directories, rules, result), daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    directories.join()
+    for thread in threads:
+        directories.put(None)
+    for thread in threads:
+        thread.join()
+
+    tree = Tree()
+    suffixes = {}
+    excluded = [[0, 0, 0, 0] for rule in rules]
+    for files, by_suffix, by_rule in results:
+        for directory, counts in files.items():
+            tree.add(directory, Usage(*counts))
+        for suffix, counts in by_suffix.items():
+            _merge(suffixes.setdefault(suffix, [0, 0, 0, 0]), counts)
+        for total, counts in zip(excluded, by_rule):
+            _merge(total, counts)
+    return Scan(
+        tree,
+        {suffix: Usage(*counts) for suffix, counts in suffixes.items()},
+        collections.OrderedDict(
+            (rule.pattern, Usage(*counts)) for rule, counts in zip(rules, excluded)
+        ),
+    )
+
+
+def _merge(total, counts):
+    for i, count in enumerate(counts):
+        total[i] += count
+
+
+def _worker(directories, rules, result):
+    files, suffixes, excluded = result
+    while True:
+        item = directories.get()
+        if item is None:
+            return
+        try:
+            _scan_directory(directories, rules, item, files, suffixes, excluded)
+        finally:
+            directories.task_done()
+
+
+def _scan_directory(directories, rules, item, files, suffixes, excluded):
+    path, relative, rule = item
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        logger.error("couldn't read {0}: {1}".format(path, e))
+        return
+    for entry in entries:
+        entry_path = relative + "/" + entry.name
+        try:
+            directory = entry.is_dir(follow_symlinks=False)
+            matched = rule
+            if matched is None:
+                matched = match(rules, entry_path, entry.name, directory)
+            if directory:
+                directories.put((entry.path, entry_path, matched))
+                continue
+            st = entry.stat(follow_symlinks=False)
+        except OSError as e:
+            logger.error("couldn't read {0}: {1}".format(entry.path, e))
+            continue
+        churned = 1 if st.st_nlink == 1 else 0
+        counts = (st.st_size, 1, st.st_size * churned, churned)
+        if matched is not None:
+            _merge(excluded[matched], counts)
+            continue
+        _merge(files.setdefault(relative, [0, 0, 0, 0]), counts)
+        suffix = os.path.splitext(entry.name)[1]
+        if suffix and suffix != entry.name:
+            _merge(suffixes.setdefault(suffix, [0, 0, 0, 0]), counts)
+
+
+def names(tree):
+    """Sum up the subtrees of the directories with the same name. A
+    directory below another one of the same name is counted once.
+
+    :param excludes.Tree tree:  Trie of the image.
+
+    :returns: Usage and number of directories by name.
+    :rtype: `dict` of tuples (`excludes.Usage`, int)
+    """
+    totals = {}
+    stack = [(tree.root, frozenset())]
+    while stack:
+        node, above = stack.pop()
+        for name, child in (node.children or {}).items():
+            if name not in above:
+                usage, count = totals.get(name, (Usage(0, 0, 0, 0), 0))
+                totals[name] = (
+                    Usage(*(a + b for a, b in zip(usage, child.usage()))),
+                    count + 1,
+                )
+            stack.append((child, above | {name}))
+    return totals
+
+
+def candidates(result, limit=20, key="churn", min_share=0.01):
+    """Rank exclude patterns by the bytes they would save.
+
+    The candidates are the directories, ``/<path>/*``, the names of
+    directories which are in several places, ``<name>/``, and file suffixes,
+    ``*<suffix>``, with at least ``min_share`` of the ranked usage of the
+    image. A directory isn't a candidate if one of its subdirectories has
+    almost all of its usage, the subdirectory is the better exclude.
+
+    :param excludes.Scan result:    Scan of the image.
+    :param int limit:               Number of candidates.
+    :param string key:              Usage to rank by, "churn" for the bytes
+                                    written every night or "bytes" for the
+                                    size.
+    :param float min_share:         Minimum share of the usage of the image.
+
+    :returns: The candidates, the most saving first.
+    :rtype: `list` of `excludes.Candidate`
+    """
+    total = getattr(result.tree.root.usage(), key)
+    threshold = max(total * min_share, 1)
+    found = []
+    for path, node in result.tree.directories():
+        usage = node.usage()
+        value = getattr(usage, key)
+        if not path or value < threshold:
+            continue
+        if any(
+            getattr(child, key) >= 0.9 * value
+            for child in (node.children or {}).values()
+        ):
+            continue
+        found.append(Candidate(path + "/*", usage))
+    for name, (usage, count) in names(result.tree).items():
+        if count >= MIN_OCCURRENCES and getattr(usage, key) >= threshold:
+            found.append(Candidate(name + "/", usage))
+    for suffix, usage in result.suffixes.items():
+        if getattr(usage, key) >= threshold:
+            found.append(Candidate("*" + suffix, usage))
+    found.sort(
+        key=lambda candidate: (
+            -getattr(candidate.usage, key),
+            -candidate.usage.bytes,
+            candidate.pattern,
+        )
+    )
+    return found[:limit]
+
+
+def latest_tree(vault_path):
+    """Find the tree of the newest successful image of a vault, or of the
+    newest image if none was successful.
+
+    :param string vault_path:   Vault directory.
+
+    :returns: The tree or None if the vault has no images.
+    :rtype: string
+    """
+    images = vault_images(vault_path)
+    successful = [image for image in images if image.status == "success"]
+    images = successful or images
+    if not images:
+        return None
+    return os.path.join(images[-1].path, "tree")
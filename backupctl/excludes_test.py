@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module excludes"""
+
+import os
+
+import pytest
+
+from backupctl import excludes
+
+# size of the file by path, files ending with "=" are hardlinks to the
+# previous image
+FILES = {
+    "etc/hosts=": 100,
+    "etc/passwd=": 200,
+    "srv/www/index.html=": 1000,
+    "srv/www/node_modules/a/index.js": 3000,
+    "srv/www/node_modules/a/node_modules/b.js": 500,
+    "srv/api/node_modules/c.js=": 4000,
+    "srv/api/node_modules/d.js": 1500,
+    "var/log/syslog": 20000,
+    "var/log/syslog.1=": 8000,
+    "var/log/app/debug.log": 10000,
+    "home/user/.cache/thumb.png": 2000,
+    "home/user/notes.txt~": 50,
+}
+
+
+def write_image(vault, name, status="success"):
+    os.makedirs(os.path.join(vault, name, "tree"))
+    with open(os.path.join(vault, name, "summary"), "w") as summary:
+        summary.write(
+            "Image: {0}\nImage-now: {0} 22:00:00\nStatus: {1}\n".format(name, status)
+        )
+    return os.path.join(vault, name, "tree")
+
+
+@pytest.fixture()
+def tree(tmp_path):
+    vault = str(tmp_path)
+    previous = write_image(vault, "2024-01-01")
+    latest = write_image(vault, "2024-01-02")
+    write_image(vault, "2024-01-03", status="error")
+    for name, size in FILES.items():
+        path = os.path.join(latest, name.rstrip("="))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if name.endswith("="):
+            old = os.path.join(previous, name.rstrip("="))
+            os.makedirs(os.path.dirname(old), exist_ok=True)
+            with open(old, "wb") as f:
+                f.write(b"x" * size)
+            os.link(old, path)
+        else:
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+    return latest
+
+
+def test_latest_tree(tree, tmp_path):
+    assert excludes.latest_tree(str(tmp_path)) == tree
+    assert excludes.latest_tree(str(tmp_path / "missing")) is None
+
+
+@pytest.mark.parametrize(
+    "pattern, path, directory, matched",
+    [
+        ("/var/cache/*", "/var/cache/apt", True, True),
+        ("/var/cache/*", "/var/cache/apt/archives", True, False),
+        ("/var/cache/*", "/srv/var/cache/apt", True, False),
+        ("*.bak", "/srv/db.bak", False, True),
+        ("*.bak", "/srv/db.bak/x", False, False),
+        ("*~", "/home/user/notes.txt~", False, True),
+        ("lost+found/", "/lost+found", True, True),
+        ("lost+found/", "/lost+found", False, False),
+        ("node_modules/", "/srv/www/node_modules", True, True),
+        ("www/node_modules", "/srv/www/node_modules", True, True),
+        ("www/node_modules", "/srv/awww/node_modules", True, False),
+        ("/srv/**.js", "/srv/www/a/index.js", False, True),
+        ("/srv/*.js", "/srv/www/index.js", False, False),
+        ("syslog.[0-9]", "/var/log/syslog.1", False, True),
+        ("syslog.?", "/var/log/syslog", False, False),
+    ],
+)
+def test_match(pattern, path, directory, matched):
+    rules = [excludes.compile_pattern(pattern)]
+    name = path.rsplit("/", 1)[1]
+    assert (excludes.match(rules, path, name, directory) == 0) == matched
+
+
+def test_scan(tree):
+    result = excludes.scan(tree, jobs=3)
+    total = sum(FILES.values())
+    churn = sum(size for name, size in FILES.items() if not name.endswith("="))
+    assert result.tree.root.usage() == excludes.Usage(total, 12, churn, 7)
+    assert result.tree.get("/srv/www").usage() == excludes.Usage(4500, 3, 3500, 2)
+    assert result.tree.get("/missing") is None
+    assert result.suffixes[".js"] == excludes.Usage(9000, 4, 5000, 3)
+    assert "~" not in result.suffixes
+    assert result.excluded == {}
+    paths = [path for path, node in result.tree.directories()]
+    assert paths[:3] == ["", "/etc", "/home"]
+    assert len(paths) == 15
+
+
+def test_scan_excludes(tree):
+    result = excludes.scan(
+        tree, ["node_modules/", "*.js", "/var/log/*", "/var/log/app/*"], jobs=2
+    )
+    assert list(result.excluded.items()) == [
+        ("node_modules/", excludes.Usage(9000, 4, 5000, 3)),
+        ("*.js", excludes.Usage(0, 0, 0, 0)),
+        ("/var/log/*", excludes.Usage(38000, 3, 30000, 2)),
+        ("/var/log/app/*", excludes.Usage(0, 0, 0, 0)),
+    ]
+    assert result.tree.root.bytes == sum(FILES.values()) - 47000
+    assert result.tree.get("/srv/www/node_modules") is None
+
+
+def test_names(tree):
+    totals = excludes.names(excludes.scan(tree).tree)
+    # the nested node_modules is counted once
+    assert totals["node_modules"] == (excludes.Usage(9000, 4, 5000, 3), 2)
+    assert totals["etc"] == (excludes.Usage(300, 2, 0, 0), 1)
+
+
+def test_candidates(tree):
+    result = excludes.scan(tree)
+    found = excludes.candidates(result, limit=5)
+    assert [candidate.pattern for candidate in found] == [
+        "/var/log/*",
+        "*.log",
+        "/var/log/app/*",
+        "/srv/*",
+        "*.js",
+    ]
+    assert found[0].usage == excludes.Usage(38000, 3, 30000, 2)
+    found = excludes.candidates(result, key="bytes", limit=3)
+    assert [candidate.pattern for candidate in found] == [
+        "/var/log/*",
+        "*.log",
+        "/srv/*",
+    ]
+    assert excludes.candidates(result, min_share=0.9) == []
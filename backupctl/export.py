@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import csv
+import json
+import logging
+from datetime import datetime
+
+import sqlalchemy
+
+from backupctl import database
+from backupctl.churn import ChurnEntry
+from backupctl.dirvish import DirvishEntry, MachineEntry, RunEntry
+from backupctl.history import HistoryEntry
+from backupctl.replicate import ReplicationEntry
+from backupctl.trash import TrashEntry
+
+logger = logging.getLogger(__name__)
+
+# Exportable tables and the column the --since filter applies to.
+TABLES = collections.OrderedDict(
+    [
+        ("history", (HistoryEntry, "datetime")),
+        ("machines", (MachineEntry, None)),
+        ("dirvish", (DirvishEntry, "datetime")),
+        ("trash", (TrashEntry, "datetime")),
+        ("replication", (ReplicationEntry, "replicated")),
+        ("runs", (RunEntry, "started")),
+        ("churn", (ChurnEntry, "measured")),
+    ]
+)
+
+FORMATS = ["jsonl", "csv"]
+
+
+def columns(table):
+    """Get the column names of an exportable table in their order.
+
+    :param string table:    Table name, one of `TABLES`.
+
+    :rtype: `list` of `string`
+
+    :raises KeyError: If the table can't be exported.
+    """
+    model, time_column = TABLES[table]
+    return [column.name for column in model.__table__.columns]
+
+
+def rows(engine, table, since=None, since_id=None, until=None, batch_size=1000):
+    """Read the rows of a table in the order of their ids.
+
+    The rows are fetched from the database cursor in batches of
+    ``batch_size`` while they are consumed, so the memory used doesn't depend
+    on the size of the table.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param string table:                        Table name, one of `TABLES`.
+    :param datetime since:                      Only rows at or after this
+                                                time.
+    :param int since_id:                        Only rows with a larger id,
+                                                e.g. the last id of the
+                                                previous export.
+    :param datetime until:                      Only rows before this time.
+    :param int batch_size:                      Rows fetched at once.
+
+    :returns: Generator of the rows as `dict` of column name and value.
+
+    :raises KeyError: If the table can't be exported.
+    :raises ValueError: If since or until is given for a table without a
+                        time.
+    """
+    model, time_column = TABLES[table]
+    names = columns(table)
+    if (since is not None or until is not None) and time_column is None:
+        raise ValueError("table {0} has no time to filter on".format(table))
+    if table not in sqlalchemy.inspect(engine).get_table_names():
+        # nothing was ever written to it
+        return
+
+    session = database.session_factory(engine)()
+    try:
+        query = session.query(*[getattr(model, name) for name in names])
+        if since is not None:
+            query = query.filter(getattr(model, time_column) >= since)
+        if until is not None:
+            query = query.filter(getattr(model, time_column) < until)
+        if since_id is not None:
+            query = query.filter(model.id > since_id)
+        query = query.order_by(model.id).yield_per(batch_size)
+        for row in query:
+            yield collections.OrderedDict(zip(names, row))
+    finally:
+        session.close()
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+    return value
+
+
+def to_json(record):
+    """Format a row as one line of JSON, without the newline.
+
+    :param dict record: Row as returned by `rows`.
+
+    :rtype: string
+    """
+    return json.dumps(
+        collections.OrderedDict((name, _value(value)) for name, value in record.items())
+    )
+
+
+def write(out, records, names, fmt="jsonl"):
+    """Write rows to a file one at a time.
+
+    :param out:             Text file object.
+    :param records:         Iterable of rows as returned by `rows`.
+    :param list names:      Column names, the header of a CSV file.
+    :param string fmt:      Output format, "jsonl" or "csv".
+
+    :returns: Number of written rows and id of the last row, None if no row
+              was written.
+    :rtype: `tuple` (int, int)
+
+    :raises ValueError: If the format is unknown.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unknown format {0}".format(fmt))
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(names)
+    count = 0
+    last_id = None
+    for record in records:
+        if fmt == "csv":
+            writer.writerow(
+                ["" if value is None else _value(value) for value in record.values()]
+            )
+        else:
+            out.write(to_json(record))
+            out.write("\n")
+        count += 1
+        last_id = record["id"]
+    return (count, last_id)
+
+
+def export(engine, table, out, fmt="jsonl", since=None, since_id=None):
+    """Export a table to a file with constant memory, see `rows`.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param string table:                        Table name, one of `TABLES`.
+    :param out:                                 Text file object.
+    :param string fmt:                          Output format, "jsonl" or
+                                                "csv".
+    :param datetime since:                      Only rows at or after this
+                                                time.
+    :param int since_id:                        Only rows with a larger id.
+
+    :returns: Number of written rows and id of the last row.
+    :rtype: `tuple` (int, int)
+
+    :raises KeyError: If the table can't be exported.
+    :raises ValueError: If the format is unknown or since is given for a
+                        table without a time.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unknown format {0}".format(fmt))
+    model, time_column = TABLES[table]
+    if since is not None and time_column is None:
+        raise ValueError("table {0} has no time to filter on".format(table))
+    records = rows(engine, table, since=since, since_id=since_id)
+    count, last_id = write(out, records, columns(table), fmt)
+    logger.info("exported {0} rows of {1}".format(count, table))
+    return (count, last_id)
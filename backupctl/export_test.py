@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module export"""
+
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytest
+import sqlalchemy
+
+from backupctl import export, history
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "export.db"))
+    hist = history.History(engine)
+    hist.add_many(
+        [
+            ("customer1", "create", None, "10G"),
+            ("customer1", "create", "www.example.com", "1G"),
+            ("customer2", "create", None, "20G"),
+        ]
+    )
+    hist.add("customer1", "autoscale", reason="used 95%")
+    return engine
+
+
+def test_export_jsonl(engine):
+    out = io.StringIO()
+    assert export.export(engine, "history", out) == (4, 4)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [line["id"] for line in lines] == [1, 2, 3, 4]
+    assert list(lines[0]) == export.columns("history")
+    assert lines[0]["vault"] is None
+    assert lines[3]["reason"] == "used 95%"
+    datetime.strptime(lines[0]["datetime"], "%Y-%m-%d %H:%M:%S.%f")
+
+
+def test_export_csv(engine):
+    out = io.StringIO()
+    assert export.export(engine, "history", out, fmt="csv", since_id=2) == (2, 4)
+    rows = list(csv.reader(io.StringIO(out.getvalue())))
+    assert rows[0] == export.columns("history")
+    assert [row[0] for row in rows[1:]] == ["3", "4"]
+    assert rows[1][rows[0].index("snapshot")] == ""
+
+
+def test_export_since(engine):
+    out = io.StringIO()
+    assert export.export(engine, "history", out, since=datetime(2999, 1, 1)) == (
+        0,
+        None,
+    )
+    assert out.getvalue() == ""
+    with pytest.raises(ValueError):
+        export.export(engine, "machines", out, since=datetime(2020, 1, 1))
+    with pytest.raises(ValueError):
+        export.export(engine, "history", out, fmt="xml")
+    with pytest.raises(KeyError):
+        export.export(engine, "schema_version", out)
+
+
+def test_export_missing_table(engine):
+    out = io.StringIO()
+    assert export.export(engine, "replication", out) == (0, None)
+
+
+def test_rows_are_streamed(engine):
+    rows = export.rows(engine, "history", batch_size=1)
+    assert next(rows)["id"] == 1
+    assert [row["id"] for row in rows] == [2, 3, 4]
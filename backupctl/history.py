@@ -4,9 +4,11 @@
 import logging
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, Integer, String
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+
+from backupctl import database
 
 logger = logging.getLogger(__name__)
 Base = declarative_base()
@@ -21,6 +23,14 @@ class HistoryEntry(Base):
     customer = Column(String)
     vault = Column(String)
     size = Column(String)
+    snapshot = Column(String)
+    reason = Column(String)
+
+    __table_args__ = (
+        Index("ix_history_datetime", "datetime"),
+        Index("ix_history_customer_vault_datetime", "customer", "vault", "datetime"),
+        Index("ix_history_customer_datetime", "customer", "datetime"),
+    )
 
     def __repr__(self):
         return "<Entry(id='{0}')>".format(self.id)
@@ -40,13 +50,33 @@ class History:
         self._engine = engine
         Base.metadata.create_all(engine)
 
-    def add(self, customer, command, vault=None, size=None):
+    def add(self, customer, command, vault=None, size=None, snapshot=None, reason=None):
         """Add an entry to the history.
 
         :param string customer: Customer name.
         :param string command:  Used subcommand, e.g. create or resize.
         :param string vault:    Vault name or server hostname.
         :param string size:     Quota size.
+        :param string snapshot: zfs snapshot of a dirvish image.
+        :param string reason:   Why the change was done, e.g. by autoscale.
+
+        :returns: True
+        :rtype: bool
+
+        :raises sqlalchemy.exc.ArgumentError: Raised when an invalid or
+                                              conflicting function argument is
+                                              supplied.
+        :raises sqlalchemy.exc.OperationalError: Wraps a DB-API
+                                                 OperationalError.
+        """
+        return self.add_many([(customer, command, vault, size, snapshot, reason)])
+
+    def add_many(self, entries):
+        """Add several entries to the history in one transaction.
+
+        :param list entries:    Tuples of (customer, command, vault, size),
+                                optionally followed by snapshot and reason,
+                                as described in `add`.
 
         :returns: True
         :rtype: bool
@@ -57,25 +87,89 @@ class History:
         :raises sqlalchemy.exc.OperationalError: Wraps a DB-API
                                                  OperationalError.
         """
-        new_entry = HistoryEntry(
-            datetime=datetime.now(),
-            command=str(command),
-            customer=str(customer),
-            vault=str(vault),
-            size=str(size),
-        )
-
-        db_session = sessionmaker(bind=self._engine)
-        session = db_session()
-
-        session.add(new_entry)
-        session.commit()
+        now = datetime.now()
+        new_entries = [
+            HistoryEntry(
+                datetime=now,
+                command=str(entry[1]),
+                customer=str(entry[0]),
+                vault=None if entry[2] is None else str(entry[2]),
+                size=None if entry[3] is None else str(entry[3]),
+                snapshot=entry[4] if len(entry) > 4 else None,
+                reason=entry[5] if len(entry) > 5 else None,
+            )
+            for entry in entries
+        ]
+        if not new_entries:
+            return True
+
+        with database.session_scope(self._engine) as session:
+            session.add_all(new_entries)
         return True
 
-    def show(self, count=20):
+    def entries(
+        self,
+        count=20,
+        customer=None,
+        vault=None,
+        command=None,
+        since=None,
+        until=None,
+        before=None,
+    ):
+        """Get the newest entries of the history matching all given filters.
+
+        The filters and the limit are applied by the database, which reads
+        the entries backwards from the newest one with the indexes on the
+        datetime, on customer and on customer and vault, no matter how big the
+        history is. Entries added at the same time are ordered by their id.
+
+        :param int count:           Maximum number of entries, None for all.
+        :param string customer:     Only entries of this customer.
+        :param string vault:        Only entries of this vault.
+        :param string command:      Only entries of this command.
+        :param datetime since:      Only entries at or after this time.
+        :param datetime until:      Only entries before this time.
+        :param tuple before:        Time and id of an entry, only entries
+                                    older than it, to page through the
+                                    history.
+
+        :returns: The entries, oldest first.
+        :rtype: `list` of `history.HistoryEntry`
+
+        :raises sqlalchemy.exc.OperationalError: Wraps a DB-API
+                                                 OperationalError.
+        """
+        with database.session_scope(self._engine) as session:
+            query = session.query(HistoryEntry)
+            if customer is not None:
+                query = query.filter(HistoryEntry.customer == str(customer))
+            if vault is not None:
+                query = query.filter(HistoryEntry.vault == str(vault))
+            if command is not None:
+                query = query.filter(HistoryEntry.command == str(command))
+            if since is not None:
+                query = query.filter(HistoryEntry.datetime >= since)
+            if until is not None:
+                query = query.filter(HistoryEntry.datetime < until)
+            if before is not None:
+                query = query.filter(
+                    sqlalchemy.tuple_(HistoryEntry.datetime, HistoryEntry.id)
+                    < sqlalchemy.tuple_(*before)
+                )
+            # the indexes end with the id, so the database doesn't sort
+            query = query.order_by(HistoryEntry.datetime.desc(), HistoryEntry.id.desc())
+            if count is not None:
+                query = query.limit(count)
+            entries = query.all()
+        entries.reverse()
+        return entries
+
+    def show(self, count=20, **filters):
         """Show the history.
 
-        :param int customer:    Number of entries to show.
+        :param int count:   Number of entries to show.
+        :param filters:     Filters of `entries`, e.g. customer or since.
 
         :returns: A list of entries.
         :rtype: `list` of `string`
@@ -86,28 +180,47 @@ class History:
         :raises sqlalchemy.exc.OperationalError: Wraps a DB-API
                                                  OperationalError.
         """
-        Base.metadata.bind = self._engine
-        db_session = sessionmaker()
-        db_session.bind = self._engine
-        session = db_session()
-
-        history_list = []
-        entries = session.query(HistoryEntry).order_by(HistoryEntry.datetime)[-count:]
-
-        for entry in entries:
-            dt = str(entry.datetime)
-            command = "{0}".format(entry.command)
-            customer = 'customer "{0}" '.format(entry.customer)
-            if entry.vault != "None":
-                vault = 'vault "{0}" '.format(entry.vault)
-            else:
-                vault = ""
-            if entry.size != "None":
-                size = "with size {0} ".format(entry.size)
-            else:
-                size = ""
-
-            history_list.append(
-                "{0} - {1} {2}{3}{4}".format(dt, command, customer, vault, size)
-            )
-        return history_list
+        return [format_entry(entry) for entry in self.entries(count, **filters)]
+
+
+def snapshot_entry(snapshot):
+    """Get the history entry of a snapshot taken of a dirvish image.
+
+    :param string snapshot: Snapshot name ``<pool>/<customer>/<vault>@<image>``.
+
+    :returns: Entry as expected by `History.add_many`.
+    :rtype: tuple
+    """
+    customer, vault = snapshot.split("@", 1)[0].split("/")[-2:]
+    return (customer, "snapshot", vault, None, snapshot)
+
+
+def format_entry(entry):
+    """Format a history entry for the output.
+
+    :param history.HistoryEntry entry:  History entry.
+
+    :rtype: string
+    """
+    dt = str(entry.datetime)
+    command = "{0}".format(entry.command)
+    customer = 'customer "{0}" '.format(entry.customer)
+    if entry.vault is not None:
+        vault = 'vault "{0}" '.format(entry.vault)
+    else:
+        vault = ""
+    if entry.size is not None:
+        size = "with size {0} ".format(entry.size)
+    else:
+        size = ""
+    if entry.snapshot:
+        snapshot = 'snapshot "{0}" '.format(entry.snapshot)
+    else:
+        snapshot = ""
+    if entry.reason:
+        reason = "({0}) ".format(entry.reason)
+    else:
+        reason = ""
+    return "{0} - {1} {2}{3}{4}{5}{6}".format(
+        dt, command, customer, vault, size, snapshot, reason
+    )
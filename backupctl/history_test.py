@@ -4,6 +4,7 @@
 """Test for class history"""
 
 import os
+from datetime import datetime
 
 import pytest
 import sqlalchemy
@@ -32,6 +33,16 @@ def test_add_vault(hist):
     )
 
 
+def test_add_many(hist):
+    assert hist.add_many(
+        [
+            ("customer1", "create", None, "10G"),
+            ("customer1", "create", "www.example.com", "1G"),
+        ]
+    )
+    assert hist.add_many([])
+
+
 def test_show_one(hist):
     hist.add(customer="customer1", size="10G", command="test")
     hist.add(customer="customer2", size="20G", command="test")
@@ -43,3 +54,78 @@ def test_show_one(hist):
 def test_show_default(hist):
     tdata = hist.show()
     assert type(tdata) == list
+
+
+@pytest.fixture()
+def fresh(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "history.db"))
+    return history.History(engine)
+
+
+def test_entries_filters(fresh):
+    fresh.add_many(
+        [
+            ("customer1", "create", None, "10G"),
+            ("customer1", "create", "www.example.com", "1G"),
+            ("customer2", "create", None, "20G"),
+            ("customer1", "resize", "www.example.com", "2G"),
+        ]
+    )
+    entries = fresh.entries()
+    assert [entry.id for entry in entries] == [1, 2, 3, 4]
+    assert [e.id for e in fresh.entries(customer="customer1")] == [1, 2, 4]
+    assert [
+        e.id for e in fresh.entries(customer="customer1", vault="www.example.com")
+    ] == [2, 4]
+    assert [e.id for e in fresh.entries(command="resize")] == [4]
+    now = entries[0].datetime
+    assert len(fresh.entries(since=now)) == 4
+    assert fresh.entries(until=now) == []
+
+
+def test_entries_pages(fresh):
+    fresh.add_many([("customer{0}".format(i), "create", None, "1G") for i in range(5)])
+    # entries added together have the same time
+    page = fresh.entries(count=2)
+    assert [entry.id for entry in page] == [4, 5]
+    page = fresh.entries(count=2, before=(page[0].datetime, page[0].id))
+    assert [entry.id for entry in page] == [2, 3]
+    page = fresh.entries(count=2, before=(page[0].datetime, page[0].id))
+    assert [entry.id for entry in page] == [1]
+    assert fresh.show(count=1) == [
+        '{0} - create customer "customer4" with size 1G '.format(page[0].datetime)
+    ]
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {},
+        {"customer": "customer1"},
+        {"customer": "customer1", "vault": "www.example.com"},
+        {"before": (datetime(2024, 1, 1), 10)},
+    ],
+)
+def test_entries_plan(fresh, filters):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    sqlalchemy.event.listen(fresh._engine, "before_cursor_execute", record)
+    try:
+        fresh.entries(**filters)
+    finally:
+        sqlalchemy.event.remove(fresh._engine, "before_cursor_execute", record)
+    ((statement, parameters),) = [
+        (statement, parameters)
+        for statement, parameters in statements
+        if statement.lstrip().startswith("SELECT")
+    ]
+    with fresh._engine.connect() as connection:
+        plan = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + statement, parameters
+        ).fetchall()
+    details = [row[-1] for row in plan]
+    assert not [detail for detail in details if "TEMP B-TREE" in detail], details
+    assert [detail for detail in details if "USING INDEX" in detail], details
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Entry points of the dirvish hooks backupctl-start and backupctl-stop.
+
+A hook sends its event to the daemon if the [hooks] section has a socket and
+the daemon listens on it. Otherwise, if the [hooks] section has a spool
+directory, it appends the event to the spool and `backupctl ingest` adds the
+events to the database later. The modules for the database are only imported
+if the hook writes directly to it, so a hook using the daemon or the spool
+starts and ends within milliseconds.
+"""
+
+import logging
+import os
+import sys
+
+from backupctl import protocol, spool
+from backupctl.settings import config
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.WARN)
+
+
+def spool_directory(cfg):
+    """Get the spool directory of the hooks.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :returns: The directory or None if the hooks don't spool.
+    :rtype: string
+    """
+    return cfg.get("hooks", "spool", fallback=None) or None
+
+
+def socket_path(cfg):
+    """Get the Unix socket of the daemon.
+
+    :param configparser.ConfigParser cfg:   Configuration object.
+
+    :returns: The path or None if the hooks don't use a daemon.
+    :rtype: string
+    """
+    return cfg.get("hooks", "socket", fallback=None) or None
+
+
+def backup_start():
+    """Record that a dirvish backup is started.
+
+    This function should be triggered by dirvish pre-server.
+    """
+    cfg = config()
+    if socket_path(cfg) is None and spool_directory(cfg) is None:
+        from backupctl import backupctl
+
+        return backupctl.backup_start()
+    _record(cfg, spool.event("start"))
+
+
+def backup_stop():
+    """Record that a dirvish backup is stopped, after a snapshot of a
+    successful image is taken if snapshots are enabled.
+
+    This function should be triggered by dirvish post-server.
+    """
+    cfg = config()
+    if socket_path(cfg) is None and spool_directory(cfg) is None:
+        from backupctl import backupctl
+
+        return backupctl.backup_stop()
+    snapshot = None
+    if (
+        cfg.getboolean("zfs", "snapshots", fallback=False)
+        and os.environ.get("DIRVISH_STATUS") == "success"
+    ):
+        snapshot = _snapshot(cfg)
+    _record(cfg, spool.event("end", snapshot=snapshot))
+
+
+def send(path, record, timeout=10):
+    """Send an event to the daemon and wait until it is committed.
+
+    :param string path:     Unix socket of the daemon.
+    :param dict record:     Event as created by `spool.event`.
+    :param float timeout:   Seconds to wait for the daemon.
+
+    :returns: True if the daemon committed the event.
+    :rtype: bool
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        answer = protocol.request(path, {"type": "event", "record": record}, timeout)
+    except (OSError, ValueError) as e:
+        LOG.warning("Couldn't send the event to the daemon: {0}".format(e))
+        return False
+    if not answer.get("ok"):
+        LOG.warning("The daemon failed: {0}".format(answer.get("error")))
+        return False
+    return True
+
+
+def _record(cfg, record):
+    path = socket_path(cfg)
+    if path is not None and send(path, record):
+        return
+    directory = spool_directory(cfg)
+    if directory is not None:
+        try:
+            spool.append(directory, record)
+        except OSError as e:
+            LOG.error("Couldn't spool the event to {0}: {1}".format(directory, e))
+            sys.exit(1)
+        return
+    # without the daemon, write the event like the daemon would
+    from backupctl import backupctl
+
+    backupctl.add_events([record])
+
+
+def _snapshot(cfg):
+    # zfs takes much longer than the import of the modules it needs
+    from backupctl import backupctl, dirvish
+
+    backupctl.zfs_backend(cfg)
+    return dirvish.snapshot_image(
+        cfg.get("zfs", "pool", fallback=None),
+        cfg.get("zfs", "root", fallback=None),
+        os.environ.get("DIRVISH_DEST", ""),
+    )
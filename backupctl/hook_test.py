@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module hook"""
+
+import configparser
+import subprocess
+import sys
+
+from backupctl import hook, spool
+
+
+def test_spool_hooks(tmp_path, mocker, monkeypatch):
+    cfg = configparser.ConfigParser()
+    cfg["hooks"] = {"spool": str(tmp_path / "spool")}
+    mocker.patch("backupctl.hook.config", lambda: cfg)
+    direct = mocker.patch("backupctl.backupctl.backup_start")
+    monkeypatch.setenv("DIRVISH_SERVER", "backup.example.com")
+    monkeypatch.setenv("DIRVISH_CLIENT", "www.example.com")
+    monkeypatch.setenv("DIRVISH_STATUS", "success")
+    hook.backup_start()
+    hook.backup_stop()
+    assert not direct.called
+    events = spool.read(cfg["hooks"]["spool"])
+    assert [event.record["trigger"] for event in events] == ["start", "end"]
+    assert events[1].record["snapshot"] is None
+
+
+def test_direct_hooks(mocker):
+    mocker.patch("backupctl.hook.config", configparser.ConfigParser)
+    direct = mocker.patch("backupctl.backupctl.backup_start")
+    hook.backup_start()
+    assert direct.called
+
+
+def test_spool_without_database():
+    # the hooks which only spool don't load the database modules
+    imported = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, backupctl.hook; print('sqlalchemy' in sys.modules)",
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    assert imported.stdout == "False\n"
+
+
+def test_daemon_not_running(tmp_path, mocker):
+    cfg = configparser.ConfigParser()
+    cfg["hooks"] = {"socket": str(tmp_path / "backupctl.sock")}
+    mocker.patch("backupctl.hook.config", lambda: cfg)
+    direct = mocker.patch("backupctl.backupctl.add_events")
+    hook.backup_start()
+    assert direct.call_args[0][0][0]["trigger"] == "start"
+
+    # the spool is preferred to the database
+    cfg["hooks"]["spool"] = str(tmp_path / "spool")
+    hook.backup_start()
+    assert direct.call_count == 1
+    assert len(spool.read(cfg["hooks"]["spool"])) == 1
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import csv
+import logging
+import os
+
+from backupctl import trash, zfs
+
+logger = logging.getLogger(__name__)
+
+Action = collections.namedtuple(
+    "Action", ["command", "customer", "vault", "size", "client"]
+)
+
+
+def load_manifest(path):
+    """Read a manifest with the desired customers and vaults.
+
+    A YAML manifest looks like::
+
+        customers:
+          customer1:
+            size: 10G
+            vaults:
+              www.example.com:
+                size: 500M
+                client: 192.0.2.1
+
+    A CSV manifest has the columns ``customer,vault,size,client``, rows
+    without a vault define the customer itself.
+
+    Every customer needs a size, like for the new command, ``none`` creates
+    it without a quota. Vaults without a size have no quota of their own.
+
+    :param string path: Path to a .yaml, .yml or .csv file.
+
+    :returns: Desired state as ``{customer: {"size": size, "vaults": {vault:
+              {"size": size, "client": client}}}}``.
+    :rtype: dict
+
+    :raises ValueError: If the manifest couldn't be interpreted.
+    :raises OSError: If the manifest couldn't be read.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".yaml", ".yml"):
+        customers = _load_yaml(path)
+    elif extension == ".csv":
+        customers = _load_csv(path)
+    else:
+        raise ValueError("unknown manifest format {0!r}".format(extension))
+    for customer, spec in sorted(customers.items()):
+        if spec["size"] is None:
+            raise ValueError(
+                'customer "{0}" needs a size, "none" for no quota'.format(customer)
+            )
+    return customers
+
+
+def _load_yaml(path):
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError("PyYAML is needed to read YAML manifests")
+    with open(path, "r") as manifest_file:
+        data = yaml.safe_load(manifest_file) or {}
+    if not isinstance(data, dict) or not isinstance(data.get("customers", {}), dict):
+        raise ValueError("manifest must contain a mapping of customers")
+    customers = {}
+    for customer, spec in (data.get("customers") or {}).items():
+        spec = spec or {}
+        vaults = {}
+        for vault, vault_spec in (spec.get("vaults") or {}).items():
+            vault_spec = vault_spec or {}
+            vaults[str(vault)] = {
+                "size": _size(vault_spec.get("size")),
+                "client": vault_spec.get("client"),
+            }
+        customers[str(customer)] = {
+            "size": _size(spec.get("size")),
+            "vaults": vaults,
+        }
+    return customers
+
+
+def _load_csv(path):
+    customers = {}
+    with open(path, "r", newline="") as manifest_file:
+        reader = csv.DictReader(manifest_file)
+        if reader.fieldnames is None or "customer" not in reader.fieldnames:
+            raise ValueError("manifest needs at least a customer column")
+        for line, row in enumerate(reader, start=2):
+            customer = (row.get("customer") or "").strip()
+            if not customer:
+                raise ValueError("line {0}: customer is needed".format(line))
+            entry = customers.setdefault(customer, {"size": None, "vaults": {}})
+            vault = (row.get("vault") or "").strip()
+            size = _size(row.get("size"))
+            if vault:
+                entry["vaults"][vault] = {
+                    "size": size,
+                    "client": (row.get("client") or "").strip() or None,
+                }
+            else:
+                entry["size"] = size
+    return customers
+
+
+def _size(size):
+    if size is None:
+        return None
+    size = str(size).strip()
+    if not size:
+        return None
+    if size.lower() != "none":
+        zfs.parse_size(size)
+    return size
+
+
+def _quota_differs(size, quota):
+    if size is None:
+        return False
+    if size.lower() == "none":
+        return quota is not None
+    return zfs.parse_size(size) != quota
+
+
+def plan(manifest, inventory, dirvish, root, prune=False):
+    """Compare the desired state with the pool and list the actions needed.
+
+    :param dict manifest:           Desired state, see `load_manifest`.
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param dirvish.Dirvish dirvish: Dirvish object.
+    :param string root:             Backup root path.
+    :param bool prune:              Remove customers and vaults which aren't
+                                    in the manifest, the trash is kept.
+
+    :returns: Actions in the order they have to be run.
+    :rtype: `list` of `manifest.Action`
+    """
+    actions = []
+    pool = inventory.pool
+    for customer, spec in sorted(manifest.items()):
+        fs = os.path.join(pool, customer)
+        if not inventory.exists(fs):
+            actions.append(Action("create", customer, None, spec["size"], None))
+        elif _quota_differs(spec["size"], inventory.quota(fs)):
+            actions.append(Action("resize", customer, None, spec["size"], None))
+        for vault, vault_spec in sorted(spec["vaults"].items()):
+            fs = os.path.join(pool, customer, vault)
+            client = vault_spec.get("client") or vault
+            if not inventory.exists(fs):
+                actions.append(
+                    Action("create", customer, vault, vault_spec.get("size"), client)
+                )
+                continue
+            if _quota_differs(vault_spec.get("size"), inventory.quota(fs)):
+                actions.append(
+                    Action("resize", customer, vault, vault_spec.get("size"), None)
+                )
+            if dirvish.config_client(root, customer, vault) != client:
+                actions.append(Action("config", customer, vault, None, client))
+    if prune:
+        for dataset in inventory.datasets():
+            if trash.is_trash(pool, dataset.name):
+                continue
+            parts = dataset.name.split("/")[1:]
+            if len(parts) == 1 and parts[0] not in manifest:
+                actions.append(Action("remove", parts[0], None, None, None))
+            elif (
+                len(parts) == 2
+                and parts[0] in manifest
+                and parts[1] not in manifest[parts[0]]["vaults"]
+            ):
+                actions.append(Action("remove", parts[0], parts[1], None, None))
+    return actions
+
+
+def format_action(action):
+    """Format an action for the plan output.
+
+    :param manifest.Action action:  Action.
+
+    :rtype: string
+    """
+    text = '{0} customer "{1}"'.format(action.command, action.customer)
+    if action.vault is not None:
+        text += ' vault "{0}"'.format(action.vault)
+    if action.size is not None:
+        text += " with size {0}".format(action.size)
+    if action.client is not None and action.client != action.vault:
+        text += " for client {0}".format(action.client)
+    return text
+
+
+def execute(actions, hist, dirvish, inventory, root, jobs=8, trash=None):
+    """Run the actions of a plan on a bounded thread pool.
+
+    Customers are created before everything else, then the quotas of each
+    customer and its vaults are changed in one batch, then the vaults are
+    created and configured and removals run last. The history entries of a
+    batch are written in one transaction as soon as it's done, so a crash
+    can't lose the entries of finished changes.
+
+    With a trash, removed customers and vaults are moved to it and destroyed
+    later by `trash.Trash.reap`, else they are destroyed immediately.
+
+    :param list actions:            Actions returned by `plan`.
+    :param history.History hist:    History database.
+    :param dirvish.Dirvish dirvish: Dirvish object.
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param string root:             Backup root path.
+    :param int jobs:                Number of parallel workers.
+    :param trash.Trash trash:       Trash to move removed file systems to.
+
+    :returns: Actions with a flag if they succeeded, in the input order.
+    :rtype: `list` of `tuple` (`manifest.Action`, bool)
+    """
+    removed = {
+        a.customer: a for a in actions if a.command == "remove" and a.vault is None
+    }
+    resizes = collections.OrderedDict()
+    for action in actions:
+        if action.command == "resize":
+            resizes.setdefault(action.customer, []).append(action)
+    phases = [
+        [[a] for a in actions if a.vault is None and a.command == "create"],
+        list(resizes.values()),
+        [
+            [a]
+            for a in actions
+            if a.vault is not None and a.command in ("create", "config")
+        ],
+        [[a] for a in actions if a.command == "remove" and a.vault is None],
+        [
+            [a]
+            for a in actions
+            if a.command == "remove"
+            and a.vault is not None
+            and a.customer not in removed
+        ],
+    ]
+    status = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for phase in phases:
+            futures = {
+                executor.submit(_run, batch, dirvish, inventory, root, trash): batch
+                for batch in phase
+            }
+            for future in concurrent.futures.as_completed(futures):
+                ok = future.result()
+                entries = []
+                for action in futures[future]:
+                    status[action] = ok
+                    if ok:
+                        entries += _history_entries(action, trash)
+                hist.add_many(entries)
+    results = []
+    for action in actions:
+        if action in status:
+            ok = status[action]
+        else:
+            # vault removed together with its customer
+            ok = status[removed[action.customer]]
+        results.append((action, ok))
+    return results
+
+
+def _history_entries(action, trash):
+    command = action.command
+    if command == "remove" and trash is not None:
+        command = "trash"
+    entries = [(action.customer, command, action.vault, action.size)]
+    if action.command == "create" and action.vault is not None:
+        entries.append((action.customer, "config", action.vault, None))
+    return entries
+
+
+def _filesystem(pool, action):
+    if action.vault is not None:
+        return os.path.join(pool, action.customer, action.vault)
+    return os.path.join(pool, action.customer)
+
+
+def _run(batch, dirvish, inventory, root, trash=None):
+    action = batch[0]
+    fs = _filesystem(inventory.pool, action)
+    try:
+        if action.command == "create":
+            path = None
+            if action.vault is not None:
+                path = os.path.join(root, action.customer, action.vault)
+            if not zfs.new_filesystem(fs, path, action.size, inventory=inventory):
+                return False
+            if action.vault is not None:
+                return dirvish.create_config(
+                    root, action.customer, action.vault, action.client, verbose=False
+                )
+            return True
+        elif action.command == "resize":
+            return zfs.set_quotas(
+                {_filesystem(inventory.pool, a): a.size for a in batch},
+                inventory=inventory,
+            )
+        elif action.command == "config":
+            return dirvish.create_config(
+                root, action.customer, action.vault, action.client, verbose=False
+            )
+        elif action.command == "remove":
+            if trash is not None:
+                return trash.move(inventory, action.customer, action.vault) is not None
+            return zfs.remove_filesystem(fs)
+    except Exception as e:
+        logger.error("{0} failed: {1}".format(format_action(action), e))
+    return False
+
+
+def format_throughput(count, seconds):
+    """Format the number of operations per second.
+
+    :param int count:       Number of operations done.
+    :param float seconds:   Elapsed time in seconds.
+
+    :rtype: string
+    """
+    rate = count / seconds if seconds > 0 else 0.0
+    return "{0} operations in {1:.2f}s, {2:.1f} operations/s".format(
+        count, seconds, rate
+    )
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module manifest"""
+
+import os
+
+import pytest
+import sqlalchemy
+
+from backupctl import dirvish, history, manifest, trash, zfs
+
+BACKUPCTL_DB = os.path.join(os.sep, "tmp", "backupctl", "backupctl.db")
+
+mock_data = {
+    "zfs-create": (0, "", ""),
+    "zfs-destroy": (0, "", ""),
+    "zfs-set": (0, "", ""),
+    "zfs-rename": (0, "", ""),
+    "zfs-program": (
+        1,
+        "",
+        "backupctl: backup/customer1: new quota 1024 is smaller than used size 2048",
+    ),
+    "zfs-list": (
+        0,
+        "backup\t3072\t1048576\t0\t1024\t/backup\t1.00x\n"
+        "backup/customer1\t2048\t1048576\t10485760\t1024\tnone\t1.50x\n"
+        "backup/customer1/www.example.com\t1024\t1048576\t0\t1024\t"
+        "/srv/backup/customer1/www.example.com\t1.00x\n"
+        "backup/customer1/old.example.com\t1024\t1048576\t0\t1024\t"
+        "/srv/backup/customer1/old.example.com\t1.00x\n"
+        "backup/backupctl-trash\t1024\t1048576\t0\t0\tnone\t1.00x\n"
+        "backup/backupctl-trash/1\t1024\t1048576\t0\t1024\tnone\t1.00x\n"
+        "backup/customer3\t2048\t1048576\t10485760\t1024\tnone\t1.50x\n"
+        "backup/customer3/mail.example.com\t1024\t1048576\t0\t1024\t"
+        "/srv/backup/customer3/mail.example.com\t1.00x\n",
+        "",
+    ),
+}
+
+
+@pytest.fixture()
+def mock_zfs(mocker):
+    commands = []
+
+    def mocked(cmd):
+        commands.append(cmd)
+        return mock_data["-".join(cmd[:2])]
+
+    mocker.patch("backupctl.zfs.execute_cmd", mocked)
+    mocker.patch("backupctl.zfs.stream_cmd", lambda cmd: zfs.Stream(*mocked(cmd)))
+    yield commands
+
+
+@pytest.fixture()
+def engine():
+    if not os.path.exists(os.path.dirname(BACKUPCTL_DB)):
+        os.makedirs(os.path.dirname(BACKUPCTL_DB))
+    return sqlalchemy.create_engine("sqlite:///{0}".format(BACKUPCTL_DB))
+
+
+DESIRED = {
+    "customer1": {
+        "size": "20M",
+        "vaults": {
+            "www.example.com": {"size": "500M", "client": None},
+            "new.example.com": {"size": None, "client": "192.0.2.1"},
+        },
+    },
+    "customer2": {"size": "1G", "vaults": {"db.example.com": {"size": None}}},
+}
+
+
+def test_load_yaml(tmp_path):
+    path = tmp_path / "manifest.yaml"
+    path.write_text(
+        "customers:\n"
+        "  customer1:\n"
+        "    size: 10G\n"
+        "    vaults:\n"
+        "      www.example.com:\n"
+        "        size: 500M\n"
+        "        client: 192.0.2.1\n"
+        "      mail.example.com:\n"
+    )
+    assert manifest.load_manifest(str(path)) == {
+        "customer1": {
+            "size": "10G",
+            "vaults": {
+                "www.example.com": {"size": "500M", "client": "192.0.2.1"},
+                "mail.example.com": {"size": None, "client": None},
+            },
+        }
+    }
+
+
+def test_load_csv(tmp_path):
+    path = tmp_path / "manifest.csv"
+    path.write_text(
+        "customer,vault,size,client\n"
+        "customer1,,10G,\n"
+        "customer1,www.example.com,500M,192.0.2.1\n"
+        "customer1,mail.example.com,,\n"
+    )
+    assert manifest.load_manifest(str(path)) == {
+        "customer1": {
+            "size": "10G",
+            "vaults": {
+                "www.example.com": {"size": "500M", "client": "192.0.2.1"},
+                "mail.example.com": {"size": None, "client": None},
+            },
+        }
+    }
+
+
+@pytest.mark.parametrize(
+    "name, content",
+    [
+        ("manifest.txt", ""),
+        ("manifest.csv", "vault\nwww.example.com\n"),
+        ("manifest.csv", "customer,size\ncustomer1,lots\n"),
+        ("manifest.yaml", "- customer1\n"),
+        # customers are only created with a size
+        ("manifest.csv", "customer,vault\ncustomer1,www.example.com\n"),
+        ("manifest.yaml", "customers:\n  customer1:\n"),
+    ],
+)
+def test_load_invalid(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_text(content)
+    with pytest.raises(ValueError):
+        manifest.load_manifest(str(path))
+
+
+def test_plan(mock_zfs, engine, tmp_path):
+    dirvish_obj = dirvish.Dirvish(engine)
+    dirvish_obj.create_config(
+        str(tmp_path), "customer1", "www.example.com", "www.example.com"
+    )
+    inventory = zfs.Inventory("backup")
+    actions = manifest.plan(DESIRED, inventory, dirvish_obj, str(tmp_path))
+    assert actions == [
+        manifest.Action("resize", "customer1", None, "20M", None),
+        manifest.Action("create", "customer1", "new.example.com", None, "192.0.2.1"),
+        manifest.Action("resize", "customer1", "www.example.com", "500M", None),
+        manifest.Action("create", "customer2", None, "1G", None),
+        manifest.Action(
+            "create", "customer2", "db.example.com", None, "db.example.com"
+        ),
+    ]
+    pruned = manifest.plan(DESIRED, inventory, dirvish_obj, str(tmp_path), True)
+    assert pruned[len(actions) :] == [
+        manifest.Action("remove", "customer1", "old.example.com", None, None),
+        manifest.Action("remove", "customer3", None, None, None),
+    ]
+    assert len(mock_zfs) == 1
+
+
+def test_execute(mock_zfs, engine, tmp_path):
+    dirvish_obj = dirvish.Dirvish(engine)
+    hist = history.History(engine)
+    inventory = zfs.Inventory("backup")
+    actions = [
+        manifest.Action("create", "customer2", "db.example.com", None, "192.0.2.1"),
+        manifest.Action("remove", "customer3", "mail.example.com", None, None),
+        manifest.Action("create", "customer2", None, "1G", None),
+        manifest.Action("remove", "customer3", None, None, None),
+        manifest.Action("resize", "customer1", None, "1K", None),
+    ]
+    results = manifest.execute(
+        actions, hist, dirvish_obj, inventory, str(tmp_path), jobs=2
+    )
+    assert results == [
+        (actions[0], True),
+        (actions[1], True),
+        (actions[2], True),
+        (actions[3], True),
+        (actions[4], False),
+    ]
+    assert (
+        dirvish_obj.config_client(str(tmp_path), "customer2", "db.example.com")
+        == "192.0.2.1"
+    )
+    commands = [cmd[:2] + cmd[-1:] for cmd in mock_zfs]
+    assert commands.index(["zfs", "create", "backup/customer2"]) < commands.index(
+        ["zfs", "create", "backup/customer2/db.example.com"]
+    )
+    assert ["zfs", "destroy", "backup/customer3/mail.example.com"] not in commands
+    assert ["zfs", "destroy", "backup/customer3"] in commands
+    assert ["zfs", "set", "backup/customer1"] not in commands
+    # the created file systems are added to the shared inventory
+    assert inventory.exists("backup/customer2/db.example.com")
+    assert inventory.quota("backup/customer2") == 1 << 30
+    assert commands.count(["zfs", "list", "backup"]) == 1
+    assert [cmd[:3] for cmd in mock_zfs].count(["zfs", "program", "backup"]) == 1
+
+
+def test_execute_trash(mock_zfs, engine, tmp_path):
+    hist = history.History(engine)
+    otrash = trash.Trash(engine)
+    actions = [
+        manifest.Action("remove", "customer1", "old.example.com", None, None),
+        manifest.Action("remove", "customer3", None, None, None),
+        manifest.Action("remove", "customer3", "mail.example.com", None, None),
+    ]
+    results = manifest.execute(
+        actions,
+        hist,
+        dirvish.Dirvish(engine),
+        zfs.Inventory("backup"),
+        str(tmp_path),
+        jobs=2,
+        trash=otrash,
+    )
+    assert [ok for action, ok in results] == [True, True, True]
+    commands = [cmd[:2] for cmd in mock_zfs]
+    assert ["zfs", "destroy"] not in commands
+    assert commands.count(["zfs", "rename"]) == 2
+    moved = otrash.entries()
+    assert sorted((entry.customer, entry.vault) for entry in moved[-2:]) == [
+        ("customer1", "old.example.com"),
+        ("customer3", None),
+    ]
+    assert [entry.command for entry in hist.entries()[-2:]] == ["trash", "trash"]
+
+
+def test_execute_history_per_batch(mock_zfs, tmp_path, mocker):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    hist = history.History(engine)
+    otrash = trash.Trash(engine)
+    mocker.patch.object(otrash, "move", side_effect=KeyboardInterrupt)
+    actions = [
+        manifest.Action("create", "customer2", None, "1G", None),
+        manifest.Action("remove", "customer3", None, None, None),
+    ]
+    with pytest.raises(KeyboardInterrupt):
+        manifest.execute(
+            actions,
+            hist,
+            dirvish.Dirvish(engine),
+            zfs.Inventory("backup"),
+            str(tmp_path),
+            trash=otrash,
+        )
+    # the customer created before the interruption is in the history
+    assert [(e.customer, e.command) for e in hist.entries()] == [
+        ("customer2", "create")
+    ]
+
+
+def test_format_action():
+    assert (
+        manifest.format_action(
+            manifest.Action("create", "customer1", "www", "10G", "192.0.2.1")
+        )
+        == 'create customer "customer1" vault "www" with size 10G for client 192.0.2.1'
+    )
+
+
+def test_format_throughput():
+    assert manifest.format_throughput(10, 2.0) == (
+        "10 operations in 2.00s, 5.0 operations/s"
+    )
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Versioned upgrades of the database schema.
+
+`create_all` creates missing tables with their current definition, but never
+changes existing tables. Changes of existing tables and their data are
+numbered migrations, which `upgrade` applies once each and records in the
+schema_version table. Every migration must also be correct on a database
+which was just created with the current definition. The statements are
+written for SQLite, the only database `database.open_engine` opens.
+"""
+
+import logging
+from datetime import datetime
+
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from backupctl import (churn, compact, database, dirvish, history, replicate,
+                       trash)
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+
+class SchemaVersionEntry(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied = Column(DateTime)
+
+    def __repr__(self):
+        return "<Entry(version='{0}')>".format(self.version)
+
+
+def _history_nulls(connection):
+    for column in ["vault", "size"]:
+        connection.exec_driver_sql(
+            "UPDATE history SET {0} = NULL WHERE {0} = 'None'".format(column)
+        )
+
+
+def _trash_nulls(connection):
+    connection.exec_driver_sql("UPDATE trash SET vault = NULL WHERE vault = 'None'")
+
+
+def _unique_machines(connection):
+    # point the backups of duplicated machines to the oldest entry
+    connection.exec_driver_sql(
+        "UPDATE dirvish SET machine = ("
+        "SELECT MIN(m2.id) FROM machines m1 JOIN machines m2"
+        " ON m1.dirvish_client IS m2.dirvish_client"
+        " AND m1.dirvish_server IS m2.dirvish_server"
+        " WHERE m1.id = dirvish.machine) "
+        "WHERE machine IN (SELECT id FROM machines)"
+    )
+    connection.exec_driver_sql(
+        "DELETE FROM machines WHERE id NOT IN ("
+        "SELECT MIN(id) FROM machines GROUP BY dirvish_client, dirvish_server)"
+    )
+    connection.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_machines_client_server"
+        " ON machines (dirvish_client, dirvish_server)"
+    )
+
+
+def _composite_indexes(connection):
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_dirvish_machine_datetime"
+        " ON dirvish (machine, datetime)"
+    )
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_history_customer_vault")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_history_customer_vault_datetime"
+        " ON history (customer, vault, datetime)"
+    )
+
+
+def _add_columns(connection, table, columns):
+    # tables created with the current definition already have the columns
+    existing = {
+        column["name"] for column in sqlalchemy.inspect(connection).get_columns(table)
+    }
+    for name, type_ in columns:
+        if name not in existing:
+            connection.exec_driver_sql(
+                "ALTER TABLE {0} ADD COLUMN {1} {2}".format(table, name, type_)
+            )
+
+
+def _dirvish_events(connection):
+    _add_columns(connection, "dirvish", [("event", "VARCHAR")])
+    connection.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_dirvish_event ON dirvish (event)"
+    )
+
+
+def _runs(connection):
+    # pair the events written before the runs were tracked, like
+    # dirvish.Dirvish.add_event does
+    connection.exec_driver_sql(
+        "INSERT INTO runs"
+        " (machine, start_id, end_id, started, ended, seconds, status) "
+        "SELECT machine,"
+        " CASE WHEN trigger = 'start' THEN id END,"
+        " CASE WHEN trigger = 'end' THEN id WHEN next_trigger = 'end' THEN next_id END,"
+        " CASE WHEN trigger = 'start' THEN datetime END,"
+        " CASE WHEN trigger = 'end' THEN datetime"
+        "  WHEN next_trigger = 'end' THEN next_datetime END,"
+        " CASE WHEN trigger = 'start' AND next_trigger = 'end'"
+        "  THEN ROUND((julianday(next_datetime) - julianday(datetime)) * 86400, 3)"
+        "  END,"
+        " CASE WHEN trigger = 'end' THEN COALESCE(status, 'unknown')"
+        "  WHEN next_trigger = 'end' THEN COALESCE(next_status, 'unknown')"
+        "  WHEN next_trigger = 'start' THEN 'missing' END "
+        "FROM (SELECT id, machine, trigger, datetime, status,"
+        " LAG(trigger) OVER w AS previous_trigger,"
+        " LEAD(trigger) OVER w AS next_trigger,"
+        " LEAD(id) OVER w AS next_id,"
+        " LEAD(datetime) OVER w AS next_datetime,"
+        " LEAD(status) OVER w AS next_status"
+        " FROM dirvish WINDOW w AS (PARTITION BY machine ORDER BY datetime, id)) "
+        "WHERE (trigger = 'start'"
+        " OR (trigger = 'end' AND COALESCE(previous_trigger, '') != 'start'))"
+        " AND NOT EXISTS (SELECT 1 FROM runs) "
+        "ORDER BY datetime, id"
+    )
+
+
+def _snapshots(connection):
+    _add_columns(connection, "dirvish", [("snapshot", "VARCHAR")])
+    _add_columns(
+        connection, "history", [("snapshot", "VARCHAR"), ("reason", "VARCHAR")]
+    )
+
+
+def _history_datetime(connection):
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_history_datetime ON history (datetime)"
+    )
+
+
+def _history_customer_datetime(connection):
+    # the index on customer, vault and datetime can't order the entries of a
+    # customer over all vaults by time
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_history_customer_datetime"
+        " ON history (customer, datetime)"
+    )
+
+
+MIGRATIONS = [
+    (1, "store missing vaults and sizes of the history as NULL", _history_nulls),
+    (2, "unique machines", _unique_machines),
+    (3, "indexes for machines and customers over time", _composite_indexes),
+    (4, "keys of spooled dirvish events", _dirvish_events),
+    (5, "runs of the existing dirvish events", _runs),
+    (6, "store missing vaults of the trash as NULL", _trash_nulls),
+    (7, "snapshots of dirvish images, reasons of the history", _snapshots),
+    (8, "index of the history over time", _history_datetime),
+    (9, "index of the history of customers over time", _history_customer_datetime),
+]
+
+
+def current_version(engine):
+    """Get the version of the database schema.
+
+    :param sqlalchemy.engine.base.Engine engine:    SQLAlchemy engine.
+
+    :returns: Number of the last applied migration, 0 if none was applied.
+    :rtype: int
+    """
+    if not sqlalchemy.inspect(engine).has_table(SchemaVersionEntry.__tablename__):
+        return 0
+    session = database.session_factory(engine)()
+    try:
+        version = session.query(sqlalchemy.func.max(SchemaVersionEntry.version))
+        return version.scalar() or 0
+    finally:
+        session.close()
+
+
+def upgrade(engine, migrations=None):
+    """Create missing tables and apply the pending migrations, each in its own
+    transaction. An up to date database is only read, so this is cheap enough
+    to run at every start. The write lock is taken before a migration checks
+    whether it is still pending, so processes starting at the same time apply
+    every migration only once.
+
+    :param sqlalchemy.engine.base.Engine engine:    SQLAlchemy engine.
+    :param list migrations:                         Tuples of version,
+                                                    description and function
+                                                    called with the
+                                                    connection, defaults to
+                                                    `MIGRATIONS`.
+
+    :returns: Versions of the applied migrations.
+    :rtype: `list` of `int`
+
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+    if migrations is None:
+        migrations = MIGRATIONS
+    latest = max([migration[0] for migration in migrations] or [0])
+    if latest and current_version(engine) >= latest:
+        return []
+
+    for base in [
+        history.Base,
+        dirvish.Base,
+        trash.Base,
+        replicate.Base,
+        compact.Base,
+        churn.Base,
+        Base,
+    ]:
+        base.metadata.create_all(engine)
+    applied = []
+    for version, description, migrate in sorted(migrations, key=lambda m: m[0]):
+        with database.session_scope(engine, immediate=True) as session:
+            if session.get(SchemaVersionEntry, version) is not None:
+                continue
+            migrate(session.connection())
+            session.add(
+                SchemaVersionEntry(
+                    version=version, description=description, applied=datetime.now()
+                )
+            )
+        logger.info("applied migration {0}: {1}".format(version, description))
+        applied.append(version)
+    return applied
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module migrations"""
+
+import pytest
+import sqlalchemy
+
+from backupctl import dirvish, history, migrations
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    """Database as written by older versions, without indexes and with
+    duplicated machines."""
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "old.db"))
+    with engine.begin() as connection:
+        for statement in [
+            "CREATE TABLE history (id INTEGER PRIMARY KEY, datetime DATETIME,"
+            " command VARCHAR, customer VARCHAR, vault VARCHAR, size VARCHAR)",
+            "CREATE TABLE machines (id INTEGER PRIMARY KEY,"
+            " dirvish_client VARCHAR, dirvish_server VARCHAR, enabled BOOLEAN)",
+            "CREATE TABLE dirvish (id INTEGER PRIMARY KEY, datetime DATETIME,"
+            " machine INTEGER REFERENCES machines (id), trigger VARCHAR,"
+            " status INTEGER)",
+            "INSERT INTO history VALUES"
+            " (1, '2020-01-01 00:00:00', 'create', 'customer1', 'None', '1G'),"
+            " (2, '2020-01-02 00:00:00', 'config', 'customer1', 'www', 'None')",
+            "CREATE TABLE trash (id INTEGER PRIMARY KEY, datetime DATETIME,"
+            " customer VARCHAR, vault VARCHAR, dataset VARCHAR,"
+            " trash_dataset VARCHAR, mountpoints VARCHAR, state VARCHAR,"
+            " reaped DATETIME)",
+            "INSERT INTO trash (id, customer, vault, state) VALUES"
+            " (1, 'customer1', 'None', 'trashed'), (2, 'customer1', 'www', 'trashed')",
+            "INSERT INTO machines VALUES (1, 'www', 'backup', 1),"
+            " (2, 'db', 'backup', 1), (3, 'www', 'backup', 1)",
+            "INSERT INTO dirvish VALUES (1, '2020-01-01 00:00:00', 1, 'start', NULL),"
+            " (2, '2020-01-01 00:00:00', 3, 'start', NULL),"
+            " (3, '2020-01-01 00:00:00', 2, 'start', NULL),"
+            " (4, '2020-01-01 01:00:00', 3, 'end', 'success')",
+        ]:
+            connection.exec_driver_sql(statement)
+    yield engine
+    engine.dispose()
+
+
+def test_upgrade(engine):
+    assert migrations.current_version(engine) == 0
+    assert migrations.upgrade(engine) == [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    assert migrations.current_version(engine) == 9
+
+    connection = engine.connect()
+    query = connection.exec_driver_sql
+    assert query("SELECT vault, size FROM history ORDER BY id").fetchall() == [
+        (None, "1G"),
+        ("www", None),
+    ]
+    assert query("SELECT vault FROM trash ORDER BY id").fetchall() == [
+        (None,),
+        ("www",),
+    ]
+    assert query("SELECT id FROM machines ORDER BY id").fetchall() == [(1,), (2,)]
+    assert query("SELECT machine FROM dirvish ORDER BY id").fetchall() == [
+        (1,),
+        (1,),
+        (2,),
+        (1,),
+    ]
+    assert query(
+        "SELECT machine, start_id, end_id, seconds, status FROM runs ORDER BY id"
+    ).fetchall() == [
+        (1, 1, None, None, "missing"),
+        (1, 2, 4, 3600.0, "success"),
+        (2, 3, None, None, None),
+    ]
+    connection.close()
+    inspector = sqlalchemy.inspect(engine)
+    assert {
+        index["name"]: index["unique"] for index in inspector.get_indexes("machines")
+    } == {"ix_machines_client_server": 1}
+    assert sorted(index["name"] for index in inspector.get_indexes("dirvish")) == [
+        "ix_dirvish_event",
+        "ix_dirvish_machine_datetime",
+    ]
+    assert sorted(index["name"] for index in inspector.get_indexes("history")) == [
+        "ix_history_customer_datetime",
+        "ix_history_customer_vault_datetime",
+        "ix_history_datetime",
+    ]
+    for table, columns in [
+        ("history", {"snapshot", "reason"}),
+        ("dirvish", {"snapshot"}),
+    ]:
+        assert columns <= {column["name"] for column in inspector.get_columns(table)}
+
+    # the old entries read like new ones
+    hist = history.History(engine)
+    assert hist.show()[0] == (
+        '2020-01-01 00:00:00 - create customer "customer1" with size 1G '
+    )
+    assert [entry.id for entry in hist.entries(customer="customer1", vault="www")] == [
+        2
+    ]
+
+
+def test_upgrade_once(engine):
+    migrations.upgrade(engine)
+    assert migrations.upgrade(engine) == []
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql(
+            "SELECT COUNT(*) FROM schema_version"
+        ).scalar() == len(migrations.MIGRATIONS)
+
+
+def test_upgrade_new_database(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "new.db"))
+    assert migrations.upgrade(engine) == [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    odirvish = dirvish.Dirvish(engine)
+    machine = odirvish.create_machine("backup", "www")
+    assert odirvish.create_machine("backup", "www").id == machine.id
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "INSERT INTO machines (dirvish_client, dirvish_server)"
+                " VALUES ('www', 'backup')"
+            )
+    engine.dispose()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Messages between the dirvish hooks and the backupctl daemon.
+
+A message is a JSON object framed by its length in bytes as a 4 byte
+unsigned integer in network byte order. Every request is answered by one
+message. Like `spool`, this module is imported by the hooks and doesn't use
+the database.
+"""
+
+import json
+import socket
+import struct
+
+HEADER = struct.Struct("!I")
+
+# Events are a few hundred bytes, anything bigger is an error.
+MAX_FRAME = 1 << 20
+
+
+def write_frame(sock, message):
+    """Send a message.
+
+    :param socket.socket sock:  Connected socket.
+    :param dict message:        Message, must be serializable as JSON.
+
+    :raises OSError: If the message can't be sent.
+    """
+    data = json.dumps(message).encode("utf8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def read_frame(sock):
+    """Receive a message.
+
+    :param socket.socket sock:  Connected socket.
+
+    :returns: The message or None if the connection was closed before it.
+    :rtype: dict
+
+    :raises OSError: If the connection fails or times out.
+    :raises ValueError: If the message is too big or isn't valid JSON.
+    """
+    header = _read(sock, HEADER.size)
+    if header is None:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError("frame of {0} bytes is too big".format(length))
+    data = _read(sock, length)
+    if data is None:
+        raise ValueError("connection closed within a frame")
+    return json.loads(data.decode("utf8"))
+
+
+def _read(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ValueError("connection closed within a frame")
+            return None
+        data += chunk
+    return data
+
+
+def request(path, message, timeout=10):
+    """Send a message to the daemon and wait for its answer.
+
+    :param string path:     Path of the Unix socket of the daemon.
+    :param dict message:    Message.
+    :param float timeout:   Seconds to wait for the connection and the answer.
+
+    :returns: The answer.
+    :rtype: dict
+
+    :raises OSError: If the daemon isn't running or doesn't answer in time.
+    :raises ValueError: If the answer is invalid.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        write_frame(sock, message)
+        answer = read_frame(sock)
+    if answer is None:
+        raise ConnectionError("daemon closed the connection")
+    return answer
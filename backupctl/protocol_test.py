@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module protocol"""
+
+import socket
+
+import pytest
+
+from backupctl import protocol
+
+
+def test_frames():
+    left, right = socket.socketpair()
+    with left, right:
+        protocol.write_frame(left, {"type": "stats"})
+        protocol.write_frame(left, {"type": "event", "record": {"id": "1"}})
+        assert protocol.read_frame(right) == {"type": "stats"}
+        assert protocol.read_frame(right)["record"] == {"id": "1"}
+        left.sendall(protocol.HEADER.pack(protocol.MAX_FRAME + 1))
+        with pytest.raises(ValueError):
+            protocol.read_frame(right)
+        left.sendall(protocol.HEADER.pack(10) + b"{}")
+        left.close()
+        with pytest.raises(ValueError):
+            protocol.read_frame(right)
+
+
+def test_closed():
+    left, right = socket.socketpair()
+    with right:
+        left.close()
+        assert protocol.read_frame(right) is None
+
+
+def test_request_no_daemon(tmp_path):
+    with pytest.raises(OSError):
+        protocol.request(str(tmp_path / "missing.sock"), {"type": "stats"})
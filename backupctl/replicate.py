@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Incremental replication of vaults to a secondary pool.
+
+Every run takes a snapshot of each vault and sends the difference to the last
+replicated snapshot with ``zfs send -i`` into ``zfs recv -s``. If a transfer
+is interrupted, the next run resumes it with the receive resume token of the
+target. The streams of all vaults share one bandwidth limit.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import shlex
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Float, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from backupctl import database, throttle, trash, zfs
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+SNAPSHOT_PREFIX = "backupctl-replicate"
+
+Transfer = collections.namedtuple(
+    "Transfer", ["returncode", "transferred", "seconds", "stderr"]
+)
+
+Result = collections.namedtuple(
+    "Result",
+    ["dataset", "mode", "snapshot", "pending", "transferred", "seconds", "error"],
+)
+
+
+class ReplicationEntry(Base):
+    __tablename__ = "replication"
+
+    id = Column(Integer, primary_key=True)
+    dataset = Column(String)
+    target = Column(String)
+    snapshot = Column(String)
+    snapshot_time = Column(DateTime)
+    pending = Column(String)
+    replicated = Column(DateTime)
+    bytes = Column(Integer)
+    seconds = Column(Float)
+    status = Column(String)
+    error = Column(String)
+
+    def __repr__(self):
+        return "<Entry(id='{0}')>".format(self.id)
+
+
+def transfer(send_command, recv_command, limiter=None, chunk_size=1 << 20):
+    """Pipe the output of a ``zfs send`` into a ``zfs recv`` with the zfs
+    backend, see `zfs.pipe_cmd`.
+
+    :param list send_command:           Send command.
+    :param list recv_command:           Receive command.
+    :param throttle.RateLimiter limiter: Bandwidth limit in bytes per second,
+                                        shared by all transfers.
+    :param int chunk_size:              Bytes read at once.
+
+    :returns: Result of the transfer, the return code is the one of the
+              failed command or 0.
+    :rtype: `replicate.Transfer`
+    """
+    started = time.monotonic()
+    returncode, transferred, stderr = zfs.pipe_cmd(
+        send_command, recv_command, limiter, chunk_size
+    )
+    return Transfer(returncode, transferred, time.monotonic() - started, stderr)
+
+
+class Replicator:
+    """Replicate the vaults of a pool to a target file system, on this host or
+    over ssh.
+
+    :ivar sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :ivar string target:    File system on the target the customers are
+                            received to, e.g. "backup2".
+    :ivar string ssh:       Host of the target for ssh, None if the target is
+                            local.
+    :ivar int jobs:         Number of vaults replicated in parallel.
+    :ivar float bandwidth:  Bytes per second of all transfers together, None
+                            for no limit.
+
+    :raises sqlalchemy.exc.ArgumentError: Raised when an invalid or conflicting
+                                          function argument is supplied.
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+
+    def __init__(self, engine, target, ssh=None, jobs=2, bandwidth=None):
+        self._engine = engine
+        self.target = target.rstrip("/")
+        self.ssh = ssh
+        self.jobs = jobs
+        self.bandwidth = bandwidth
+        self._limiter = throttle.RateLimiter(bandwidth)
+        Base.metadata.create_all(engine)
+
+    def target_fs(self, fs):
+        """Get the target file system of a source file system.
+
+        :param string fs:   Source file system, e.g. backup/customer/vault.
+
+        :rtype: string
+        """
+        return "/".join([self.target] + fs.split("/")[1:])
+
+    def _target_cmd(self, command):
+        if self.ssh is None:
+            return command
+        return ["ssh", self.ssh, " ".join(shlex.quote(arg) for arg in command)]
+
+    def datasets(self, inventory, customer=None, vault=None):
+        """List the vaults to replicate.
+
+        :param zfs.Inventory inventory: Inventory of the pool.
+        :param string customer:         Only vaults of this customer.
+        :param string vault:            Only this vault.
+
+        :rtype: `list` of `string`
+        """
+        pool = inventory.pool
+        fs = pool
+        if customer:
+            fs = os.path.join(pool, customer)
+            if vault:
+                fs = os.path.join(fs, vault)
+        return [
+            dataset.name
+            for dataset in inventory.datasets(fs)
+            if len(dataset.name.split("/")) == 3
+            and not trash.is_trash(pool, dataset.name)
+        ]
+
+    def state(self, datasets=None):
+        """Get the replication state of vaults.
+
+        :param list datasets:   Source file systems, None for all.
+
+        :returns: Replication entries by source file system.
+        :rtype: `dict` of `replicate.ReplicationEntry`
+        """
+        with database.session_scope(self._engine) as session:
+            query = session.query(ReplicationEntry).filter(
+                ReplicationEntry.target == self.target
+            )
+            entries = {entry.dataset: entry for entry in query}
+        if datasets is None:
+            return entries
+        return {fs: entries[fs] for fs in datasets if fs in entries}
+
+    def replicate(self, datasets, callback=None):
+        """Replicate vaults in parallel and save the new state.
+
+        :param list datasets:   Source file systems.
+        :param callback:        Called with each `replicate.Result`.
+
+        :returns: Results in the order of the datasets.
+        :rtype: `list` of `replicate.Result`
+        """
+        state = self.state(datasets)
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {
+                executor.submit(self._replicate_one, fs, state.get(fs)): fs
+                for fs in datasets
+            }
+            for future in concurrent.futures.as_completed(futures):
+                fs = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("replication of {0} failed: {1}".format(fs, e))
+                    entry = state.get(fs)
+                    pending = entry.pending if entry is not None else None
+                    result = Result(fs, None, None, pending, 0, 0.0, str(e))
+                # saved at once, so a resumable transfer isn't lost and the
+                # database isn't locked while the other vaults are sent
+                with database.session_scope(self._engine) as session:
+                    self._save(session, result, state.get(fs))
+                results[fs] = result
+                if callback is not None:
+                    callback(result)
+        return [results[fs] for fs in datasets]
+
+    def _save(self, session, result, entry):
+        if entry is None:
+            entry = ReplicationEntry(dataset=result.dataset, target=self.target)
+        else:
+            entry = session.merge(entry)
+        entry.pending = result.pending
+        entry.bytes = result.transferred
+        entry.seconds = result.seconds
+        entry.error = result.error
+        if result.error is None:
+            entry.status = "ok"
+            entry.snapshot = result.snapshot
+            entry.snapshot_time = _snapshot_time(result.snapshot)
+            entry.replicated = datetime.now()
+        else:
+            entry.status = "failed"
+        session.add(entry)
+
+    def _replicate_one(self, fs, entry):
+        target_fs = self.target_fs(fs)
+        base = entry.snapshot if entry is not None else None
+        pending = entry.pending if entry is not None else None
+        recv = self._target_cmd(["zfs", "recv", "-s", "-u", "-F", target_fs])
+
+        token, error = self._resume_token(target_fs)
+        if error is not None:
+            # the target may still hold the partial state of the pending
+            # snapshot, keep both until it can be checked
+            return Result(fs, None, None, pending, 0, 0.0, error)
+        if token and pending:
+            mode = "resume"
+            snapshot = pending
+            send = ["zfs", "send", "-t", token]
+        else:
+            parent = target_fs.rsplit("/", 1)[0]
+            returncode, stdout, stderr = zfs.execute_cmd(
+                self._target_cmd(
+                    ["zfs", "create", "-p", "-o", "mountpoint=none", parent]
+                )
+            )
+            if returncode != 0:
+                return Result(fs, None, None, pending, 0, 0.0, stderr.strip())
+            if token:
+                # a partial state without a known snapshot blocks every
+                # new receive
+                returncode, stdout, stderr = zfs.execute_cmd(
+                    self._target_cmd(["zfs", "recv", "-A", target_fs])
+                )
+                if returncode != 0:
+                    return Result(fs, None, None, pending, 0, 0.0, stderr.strip())
+            if pending:
+                # the partial state is gone, start the transfer again
+                zfs.destroy_snapshots(fs, [pending])
+                pending = None
+            snapshot = "{0}-{1}".format(
+                SNAPSHOT_PREFIX, datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+            )
+            if zfs.new_snapshot(fs, snapshot) is None:
+                return Result(fs, None, None, None, 0, 0.0, "couldn't take a snapshot")
+            send = ["zfs", "send"]
+            mode = "full"
+            if base:
+                send += ["-i", "{0}@{1}".format(fs, base)]
+                mode = "incremental"
+            send += ["{0}@{1}".format(fs, snapshot)]
+
+        result = transfer(send, recv, self._limiter)
+        if result.returncode != 0:
+            error = result.stderr.strip() or "exit code {0}".format(result.returncode)
+            logger.error("replication of {0} failed: {1}".format(fs, error))
+            token, lookup_error = self._resume_token(target_fs)
+            if token or lookup_error is not None:
+                pending = snapshot
+            else:
+                zfs.destroy_snapshots(fs, [snapshot])
+                pending = None
+            return Result(
+                fs, mode, None, pending, result.transferred, result.seconds, error
+            )
+
+        if base and base != snapshot and base.startswith(SNAPSHOT_PREFIX):
+            zfs.destroy_snapshots(fs, [base])
+            zfs.execute_cmd(
+                self._target_cmd(["zfs", "destroy", "{0}@{1}".format(target_fs, base)])
+            )
+        return Result(
+            fs, mode, snapshot, None, result.transferred, result.seconds, None
+        )
+
+    def _resume_token(self, target_fs):
+        # a lookup failing, e.g. while ssh is down, isn't the same as no token
+        returncode, stdout, stderr = zfs.execute_cmd(
+            self._target_cmd(
+                ["zfs", "get", "-H", "-o", "value", "receive_resume_token", target_fs]
+            )
+        )
+        if returncode != 0:
+            if "dataset does not exist" in stderr:
+                return ("", None)
+            error = stderr.strip() or "exit code {0}".format(returncode)
+            return (None, "couldn't get the resume token: {0}".format(error))
+        token = stdout.strip()
+        return ("" if token == "-" else token, None)
+
+
+def _snapshot_time(snapshot):
+    try:
+        return datetime.strptime(
+            snapshot[len(SNAPSHOT_PREFIX) + 1 :], "%Y%m%dT%H%M%S%fZ"
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def lag(entry, now=None):
+    """Get how far the target is behind the source.
+
+    :param replicate.ReplicationEntry entry:    Replication state of a vault.
+    :param datetime now:                        Current UTC time.
+
+    :returns: Seconds since the last replicated snapshot was taken or None if
+              nothing was replicated yet.
+    :rtype: float
+    """
+    if entry is None or entry.snapshot_time is None:
+        return None
+    if now is None:
+        now = datetime.utcnow()
+    return (now - entry.snapshot_time).total_seconds()
+
+
+def format_result(result):
+    """Format the result of a replication for the output.
+
+    :param replicate.Result result: Result.
+
+    :rtype: string
+    """
+    rate = result.transferred / result.seconds if result.seconds > 0 else 0
+    text = "{0}: {1} {2} in {3:.1f}s, {4}/s".format(
+        result.dataset,
+        result.mode or "-",
+        zfs.format_size(result.transferred),
+        result.seconds,
+        zfs.format_size(int(rate)),
+    )
+    if result.error is not None:
+        text += ", failed: {0}".format(result.error)
+        if result.pending:
+            text += " (resumable)"
+    return text
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for class replicate"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+import sqlalchemy
+
+from backupctl import replicate, simulator, throttle, zfs
+
+# Stub of the zfs command: snapshots are lines of a file, "zfs send" writes a
+# description of the stream and "zfs recv" appends it to a file per target
+# file system. If the file "fail" exists, "zfs recv" fails after reading and
+# leaves a resume token, a new stream is refused while a token is left. If the
+# file "down" exists, "zfs get" fails like an unreachable target.
+STUB = """\
+#!{python}
+import os
+import sys
+
+state = os.environ["ZFS_STUB"]
+args = sys.argv[1:]
+with open(os.path.join(state, "log"), "a") as f:
+    f.write(" ".join(args) + "\\n")
+
+
+def path(kind, fs):
+    return os.path.join(state, kind + "-" + fs.replace("/", "_"))
+
+
+def snapshots():
+    try:
+        with open(os.path.join(state, "snapshots")) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return []
+
+
+def save(names):
+    with open(os.path.join(state, "snapshots"), "w") as f:
+        f.write("".join(name + "\\n" for name in names))
+
+
+if args[0] == "snapshot":
+    save(snapshots() + [args[1]])
+elif args[0] == "destroy":
+    fs, names = args[1].split("@")
+    destroyed = ["{{0}}@{{1}}".format(fs, name) for name in names.split(",")]
+    save([name for name in snapshots() if name not in destroyed])
+elif args[0] == "create":
+    pass
+elif args[0] == "get":
+    if os.path.exists(os.path.join(state, "down")):
+        sys.stderr.write("ssh: connect to host backup2: Connection refused\\n")
+        sys.exit(255)
+    try:
+        with open(path("token", args[-1])) as f:
+            print(f.read())
+    except FileNotFoundError:
+        print("-")
+elif args[0] == "send":
+    if args[1] == "-t":
+        sys.stdout.write("resume {{0}}\\n".format(args[2]))
+    elif args[1] == "-i":
+        sys.stdout.write("incremental {{0}} {{1}}\\n".format(args[2], args[3]))
+    else:
+        sys.stdout.write("full {{0}}\\n".format(args[1]))
+    sys.stdout.write("x" * 4096)
+elif args[0] == "recv" and args[1] == "-A":
+    os.remove(path("token", args[-1]))
+elif args[0] == "recv":
+    stream = sys.stdin.read()
+    if os.path.exists(path("token", args[-1])) and not stream.startswith("resume"):
+        sys.stderr.write("destination contains partially-complete state\\n")
+        sys.exit(1)
+    if os.path.exists(os.path.join(state, "fail")):
+        with open(path("token", args[-1]), "w") as f:
+            f.write("token-" + stream.split()[1])
+        sys.stderr.write("cannot receive: connection reset\\n")
+        sys.exit(1)
+    if os.path.exists(path("token", args[-1])):
+        os.remove(path("token", args[-1]))
+    with open(path("recv", args[-1]), "a") as f:
+        f.write(stream.splitlines()[0] + "\\n")
+else:
+    sys.exit(2)
+"""
+
+
+@pytest.fixture()
+def stub(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    state = tmp_path / "state"
+    state.mkdir()
+    script = bin_dir / "zfs"
+    script.write_text(STUB.format(python=sys.executable))
+    script.chmod(0o755)
+    monkeypatch.setenv(
+        "PATH", "{0}{1}{2}".format(bin_dir, os.pathsep, os.environ["PATH"])
+    )
+    monkeypatch.setenv("ZFS_STUB", str(state))
+    previous = zfs.set_backend(zfs.CliBackend())
+    yield state
+    zfs.set_backend(previous)
+
+
+@pytest.fixture()
+def replicator(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "repl.db"))
+    return replicate.Replicator(engine, "backup2")
+
+
+def read(state, kind, fs):
+    with open(os.path.join(str(state), kind + "-" + fs.replace("/", "_"))) as f:
+        return f.read().splitlines()
+
+
+def snapshots(state):
+    with open(os.path.join(str(state), "snapshots")) as f:
+        return f.read().split()
+
+
+def test_target_fs(replicator):
+    assert replicator.target_fs("backup/customer1/vault1") == "backup2/customer1/vault1"
+    replicator.ssh = "backup2.example.com"
+    assert replicator._target_cmd(["zfs", "recv", "backup2/a b"]) == [
+        "ssh",
+        "backup2.example.com",
+        "zfs recv 'backup2/a b'",
+    ]
+
+
+def test_datasets(replicator):
+    pool = simulator.SimulatedPool("backup", size=1 << 40)
+    pool._create("backup/customer1")
+    pool._create("backup/customer1/www.example.com")
+    pool._create("backup/customer1/mail.example.com")
+    pool._create("backup/customer2")
+    pool._create("backup/customer2/db.example.com")
+    pool._create("backup/backupctl-trash")
+    pool._create("backup/backupctl-trash/1")
+    pool._create("backup/backupctl-trash/1/old.example.com")
+    previous = zfs.set_backend(pool)
+    try:
+        inventory = zfs.Inventory("backup")
+        assert replicator.datasets(inventory) == [
+            "backup/customer1/mail.example.com",
+            "backup/customer1/www.example.com",
+            "backup/customer2/db.example.com",
+        ]
+        assert replicator.datasets(inventory, "customer1", "www.example.com") == [
+            "backup/customer1/www.example.com"
+        ]
+    finally:
+        zfs.set_backend(previous)
+
+
+def test_full_then_incremental(stub, replicator):
+    fs = "backup/customer1/vault1"
+    (first,) = replicator.replicate([fs])
+    assert first.error is None
+    assert first.mode == "full"
+    assert first.transferred > 4096
+    assert snapshots(stub) == [fs + "@" + first.snapshot]
+
+    (second,) = replicator.replicate([fs])
+    assert second.error is None
+    assert second.mode == "incremental"
+    assert read(stub, "recv", "backup2/customer1/vault1") == [
+        "full {0}@{1}".format(fs, first.snapshot),
+        "incremental {0}@{1} {0}@{2}".format(fs, first.snapshot, second.snapshot),
+    ]
+    # the old base is destroyed on both sides
+    assert snapshots(stub) == [fs + "@" + second.snapshot]
+    with open(os.path.join(str(stub), "log")) as f:
+        log = f.read().splitlines()
+    assert "destroy backup2/customer1/vault1@{0}".format(first.snapshot) in log
+
+    entry = replicator.state()[fs]
+    assert entry.status == "ok"
+    assert entry.snapshot == second.snapshot
+    assert entry.bytes == second.transferred
+    assert replicate.lag(entry, entry.snapshot_time) == 0
+
+
+def test_resume(stub, replicator):
+    fs = "backup/customer1/vault1"
+    (stub / "fail").touch()
+    (failed,) = replicator.replicate([fs])
+    assert failed.error == "cannot receive: connection reset"
+    assert failed.pending is not None
+    entry = replicator.state()[fs]
+    assert entry.status == "failed"
+    assert entry.snapshot is None
+    assert entry.pending == failed.pending
+    # the snapshot is kept for the resume
+    assert snapshots(stub) == [fs + "@" + failed.pending]
+
+    (stub / "fail").unlink()
+    (resumed,) = replicator.replicate([fs])
+    assert resumed.error is None
+    assert resumed.mode == "resume"
+    assert resumed.snapshot == failed.pending
+    assert read(stub, "recv", "backup2/customer1/vault1") == [
+        "resume token-{0}@{1}".format(fs, failed.pending)
+    ]
+    entry = replicator.state()[fs]
+    assert entry.status == "ok"
+    assert entry.pending is None
+
+
+def test_token_lookup_failed(stub, replicator):
+    fs = "backup/customer1/vault1"
+    (stub / "fail").touch()
+    (failed,) = replicator.replicate([fs])
+    (stub / "fail").unlink()
+
+    # the target is unreachable, the pending snapshot and the partial state
+    # are kept
+    (stub / "down").touch()
+    (down,) = replicator.replicate([fs])
+    assert down.error.startswith("couldn't get the resume token: ssh:")
+    assert down.pending == failed.pending
+    assert replicator.state()[fs].pending == failed.pending
+    assert snapshots(stub) == [fs + "@" + failed.pending]
+
+    (stub / "down").unlink()
+    (resumed,) = replicator.replicate([fs])
+    assert resumed.error is None
+    assert resumed.mode == "resume"
+    assert resumed.snapshot == failed.pending
+
+
+def test_stale_token(stub, replicator):
+    fs = "backup/customer1/vault1"
+    # a partial state the database doesn't know the snapshot of
+    with open(os.path.join(str(stub), "token-backup2_customer1_vault1"), "w") as f:
+        f.write("token-unknown")
+    (result,) = replicator.replicate([fs])
+    assert result.error is None
+    assert result.mode == "full"
+    with open(os.path.join(str(stub), "log")) as f:
+        log = f.read().splitlines()
+    assert "recv -A backup2/customer1/vault1" in log
+    assert read(stub, "recv", "backup2/customer1/vault1") == [
+        "full {0}@{1}".format(fs, result.snapshot)
+    ]
+
+
+def test_failed_without_token(stub, replicator, monkeypatch):
+    fs = "backup/customer1/vault1"
+    monkeypatch.setattr(
+        replicate,
+        "transfer",
+        lambda send, recv, limiter: replicate.Transfer(1, 0, 0.1, ""),
+    )
+    (failed,) = replicator.replicate([fs])
+    assert failed.error == "exit code 1"
+    assert failed.pending is None
+    assert snapshots(stub) == []
+
+
+def test_transfer_bandwidth(stub):
+    now = [0.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        now[0] += seconds
+
+    limiter = throttle.RateLimiter(8192, burst=1024, clock=lambda: now[0], sleep=sleep)
+    result = replicate.transfer(
+        ["zfs", "send", "backup/a@s"],
+        ["zfs", "recv", "-s", "-u", "-F", "backup2/a"],
+        limiter,
+        chunk_size=1024,
+    )
+    assert result.returncode == 0
+    assert result.transferred == 4096 + len("full backup/a@s\n")
+    # the bytes beyond the burst are sent at the rate, however they were read
+    assert sum(waits) == pytest.approx((result.transferred - 1024) / 8192.0)
+
+
+def test_transfer_backend():
+    class Backend(zfs.Backend):
+        def __init__(self):
+            self.pipes = []
+
+        def pipe(self, send_command, recv_command, limiter=None, chunk_size=1 << 20):
+            self.pipes.append((send_command, recv_command))
+            return (0, 4096, "")
+
+    backend = Backend()
+    previous = zfs.set_backend(backend)
+    try:
+        result = replicate.transfer(["zfs", "send", "backup/a@s"], ["zfs", "recv"])
+    finally:
+        zfs.set_backend(previous)
+    assert (result.returncode, result.transferred) == (0, 4096)
+    assert backend.pipes == [(["zfs", "send", "backup/a@s"], ["zfs", "recv"])]
+
+
+def test_lag():
+    assert replicate.lag(None) is None
+    entry = replicate.ReplicationEntry(snapshot_time=datetime(2020, 1, 1, 12))
+    assert replicate.lag(entry, datetime(2020, 1, 1, 13)) == 3600
+    assert replicate._snapshot_time("backupctl-replicate-20200101T120000000000Z") == (
+        datetime(2020, 1, 1, 12)
+    )
+    assert replicate._snapshot_time("manual") is None
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Run the dirvish backups of many vaults with one worker pool.
+
+The vaults are queued by the time of their last successful backup, the
+oldest first, and started as long as the global and the per-customer
+concurrency allow. A failed backup is queued again after a backoff, which
+doubles for every further attempt, as long as it can start before the end of
+the backup window.
+"""
+
+import collections
+import concurrent.futures
+import heapq
+import logging
+import subprocess
+import time
+
+import sqlalchemy
+
+from backupctl import database, trash, zfs
+from backupctl.dirvish import DirvishEntry, MachineEntry
+
+logger = logging.getLogger(__name__)
+
+# A vault to back up, ``vault`` is "<customer>/<vault>" as dirvish expects it.
+Task = collections.namedtuple(
+    "Task", ["vault", "customer", "client", "last_success", "attempts"]
+)
+
+# The outcome of the last attempt of a vault, ``written`` is the growth of the
+# file system in bytes.
+Result = collections.namedtuple(
+    "Result", ["vault", "returncode", "attempts", "seconds", "written", "error"]
+)
+
+
+def last_success(engine):
+    """Get the time of the last successful backup of each client.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+
+    :returns: Datetime by backup client.
+    :rtype: dict
+    """
+    with database.session_scope(engine) as session:
+        query = (
+            session.query(
+                MachineEntry.dirvish_client, sqlalchemy.func.max(DirvishEntry.datetime)
+            )
+            .join(MachineEntry, MachineEntry.id == DirvishEntry.machine)
+            .filter(DirvishEntry.trigger == "end", DirvishEntry.status == "success")
+            .group_by(MachineEntry.dirvish_client)
+        )
+        return {client: when for client, when in query}
+
+
+def tasks(inventory, clients, successes, customer=None):
+    """Create the tasks of the vaults of a pool, vaults which never had a
+    successful backup first, then the vault with the oldest one.
+
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param dict clients:            Backup client by vault
+                                    ``<customer>/<vault>``, missing vaults are
+                                    their own client.
+    :param dict successes:          Time of the last successful backup by
+                                    client, see `last_success`.
+    :param string customer:         Only vaults of this customer.
+
+    :rtype: `list` of `runner.Task`
+    """
+    pool = inventory.pool
+    fs = pool if customer is None else "{0}/{1}".format(pool, customer)
+    result = []
+    for dataset in inventory.datasets(fs):
+        parts = dataset.name.split("/")
+        if len(parts) != 3 or trash.is_trash(pool, dataset.name):
+            continue
+        vault = "/".join(parts[1:])
+        client = clients.get(vault) or parts[2]
+        result.append(Task(vault, parts[1], client, successes.get(client), 0))
+    return sorted(
+        result,
+        key=lambda task: (
+            task.last_success is not None,
+            task.last_success or 0,
+            task.vault,
+        ),
+    )
+
+
+def execute(command):
+    """Run a backup command.
+
+    :param list command:    The command to execute.
+
+    :returns: A tuple of (returncode, stderr).
+    :rtype: tuple
+    """
+    try:
+        process = subprocess.run(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+    except OSError as e:
+        return (127, str(e))
+    return (process.returncode, process.stderr)
+
+
+class Runner:
+    """Run the backups of vaults in parallel.
+
+    :ivar int jobs:             Maximum number of backups at the same time.
+    :ivar dict customer_jobs:   Maximum number of backups of one customer at
+                                the same time by customer, the key None is the
+                                default.
+    :ivar int retries:          Number of retries of a failed backup.
+    :ivar float backoff:        Seconds before the first retry, doubled for
+                                every further retry.
+    :ivar float window:         Seconds after the start in which backups may
+                                be started, None for no limit.
+    :ivar list command:         Backup command, the vault is appended after
+                                ``--vault``.
+    :ivar string pool:          zfs pool the vaults are on, to measure the
+                                written bytes, None to not measure them.
+
+    :raises ValueError: If a maximum number of backups is less than 1.
+    """
+
+    def __init__(
+        self,
+        jobs=4,
+        customer_jobs=None,
+        retries=2,
+        backoff=300,
+        window=None,
+        command=None,
+        pool=None,
+        execute=execute,
+    ):
+        if jobs < 1 or min((customer_jobs or {}).values() or [1]) < 1:
+            raise ValueError("jobs must be at least 1")
+        self.jobs = jobs
+        self.customer_jobs = customer_jobs or {None: jobs}
+        self.retries = retries
+        self.backoff = backoff
+        self.window = window
+        self.command = command or ["dirvish"]
+        self.pool = pool
+        self._execute = execute
+        self._started = None
+        self._stats = {}
+
+    def limit(self, customer):
+        """Get the maximum number of backups of a customer at the same time.
+
+        :param string customer: Customer name.
+
+        :rtype: int
+        """
+        return self.customer_jobs.get(customer, self.customer_jobs.get(None, self.jobs))
+
+    def stats(self):
+        """Get the state of the current or the last run.
+
+        :returns: Number of queued, running, successful, failed and skipped
+                  backups, retries, written bytes, elapsed seconds and bytes
+                  per second.
+        :rtype: dict
+        """
+        stats = dict(self._stats)
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        stats["elapsed"] = elapsed
+        stats["throughput"] = stats.get("written", 0) / elapsed if elapsed else 0.0
+        return stats
+
+    def run(self, tasks, callback=None):
+        """Back up vaults until all succeeded, failed too often or the window
+        is over.
+
+        :param list tasks:  `runner.Task` in the order they should start.
+        :param callback:    Called with each `runner.Result` of an attempt.
+
+        :returns: The result of the last attempt of every vault which was
+                  started, in the order they finished.
+        :rtype: `list` of `runner.Result`
+        """
+        self._started = time.monotonic()
+        self._stats = {
+            "queued": len(tasks),
+            "running": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "retries": 0,
+            "skipped": 0,
+            "written": 0,
+        }
+        # (earliest start, position, task), a retry keeps its position
+        queue = [(0.0, position, task) for position, task in enumerate(tasks)]
+        heapq.heapify(queue)
+        running = {}
+        per_customer = collections.Counter()
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while queue or running:
+                now = time.monotonic() - self._started
+                if self.window is not None and now >= self.window:
+                    # nothing new starts after the window, the rest waits
+                    # for the next night
+                    self._stats["skipped"] += len(queue)
+                    self._stats["queued"] = 0
+                    queue = []
+                for ready, position, task in self._ready(queue, now, per_customer):
+                    running[executor.submit(self._backup, task)] = (position, task)
+                    per_customer[task.customer] += 1
+                    self._stats["queued"] -= 1
+                    self._stats["running"] += 1
+                if not running:
+                    if queue:
+                        # only retries are left, wait for the first one
+                        time.sleep(max(min(queue)[0] - now, 0))
+                    continue
+                timeout = None
+                if queue:
+                    timeout = max(min(queue)[0] - now, 0.1)
+                done, _ = concurrent.futures.wait(
+                    running,
+                    timeout=timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    position, task = running.pop(future)
+                    per_customer[task.customer] -= 1
+                    self._stats["running"] -= 1
+                    result = future.result()
+                    self._finish(queue, position, task, result, results)
+                    if callback is not None:
+                        callback(result)
+        return results
+
+    def _ready(self, queue, now, per_customer):
+        ready = []
+        waiting = []
+        slots = self.jobs - sum(per_customer.values())
+        while queue and len(ready) < slots:
+            item = heapq.heappop(queue)
+            start, position, task = item
+            if start > now:
+                waiting.append(item)
+                break
+            taken = per_customer[task.customer] + sum(
+                1 for other in ready if other[2].customer == task.customer
+            )
+            if taken >= self.limit(task.customer):
+                waiting.append(item)
+                continue
+            ready.append(item)
+        for item in waiting:
+            heapq.heappush(queue, item)
+        return ready
+
+    def _finish(self, queue, position, task, result, results):
+        if result.returncode == 0:
+            self._stats["succeeded"] += 1
+            self._stats["written"] += result.written or 0
+            results.append(result)
+            return
+        retry = time.monotonic() - self._started + self.backoff * 2**task.attempts
+        if task.attempts < self.retries and (
+            self.window is None or retry < self.window
+        ):
+            logger.warning(
+                "backup of {0} failed, retry in {1:.0f}s: {2}".format(
+                    task.vault, self.backoff * 2**task.attempts, result.error
+                )
+            )
+            self._stats["retries"] += 1
+            self._stats["queued"] += 1
+            heapq.heappush(
+                queue, (retry, position, task._replace(attempts=task.attempts + 1))
+            )
+            return
+        logger.error("backup of {0} failed: {1}".format(task.vault, result.error))
+        self._stats["failed"] += 1
+        results.append(result)
+
+    def _backup(self, task):
+        fs = "{0}/{1}".format(self.pool, task.vault) if self.pool else None
+        before = zfs.filesystem_usage(fs) if fs else None
+        started = time.monotonic()
+        returncode, stderr = self._execute(self.command + ["--vault", task.vault])
+        seconds = time.monotonic() - started
+        written = None
+        if fs and returncode == 0:
+            after = zfs.filesystem_usage(fs)
+            if before is not None and after is not None:
+                written = max(after - before, 0)
+        error = None
+        if returncode != 0:
+            error = stderr.strip() or "exit code {0}".format(returncode)
+        return Result(
+            task.vault, returncode, task.attempts + 1, seconds, written, error
+        )
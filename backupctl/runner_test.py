@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module runner"""
+
+import collections
+import threading
+import time
+from datetime import datetime
+
+import pytest
+import sqlalchemy
+
+from backupctl import runner, simulator, zfs
+from backupctl.dirvish import Dirvish
+
+
+@pytest.fixture()
+def pool():
+    pool = simulator.SimulatedPool("backup", size=1 << 50)
+    for fs in [
+        "backup/customer1",
+        "backup/customer1/www.example.com",
+        "backup/customer1/mail.example.com",
+        "backup/customer2",
+        "backup/customer2/db.example.com",
+        "backup/backupctl-trash",
+        "backup/backupctl-trash/1",
+    ]:
+        pool._create(fs)
+    previous = zfs.set_backend(pool)
+    yield pool
+    zfs.set_backend(previous)
+
+
+class Backups:
+    """Fake dirvish which records the concurrency and fails vaults a given
+    number of times."""
+
+    def __init__(self, seconds=0.02, failures=None):
+        self.seconds = seconds
+        self.failures = collections.Counter(failures or {})
+        self.calls = []
+        self.running = collections.Counter()
+        self.peak = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, command):
+        vault = command[command.index("--vault") + 1]
+        customer = vault.split("/")[0]
+        with self._lock:
+            self.calls.append(vault)
+            self.running[customer] += 1
+            self.running[None] += 1
+            for key in (customer, None):
+                self.peak[key] = max(self.peak[key], self.running[key])
+        time.sleep(self.seconds)
+        with self._lock:
+            self.running[customer] -= 1
+            self.running[None] -= 1
+            if self.failures[vault]:
+                self.failures[vault] -= 1
+                return (255, "rsync error\n")
+        return (0, "")
+
+
+def task(vault):
+    return runner.Task(vault, vault.split("/")[0], vault, None, 0)
+
+
+def test_last_success(tmp_path):
+    dirvish = Dirvish(sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db")))
+    for day, status in [(1, "success"), (2, "success"), (3, "error")]:
+        dirvish.add_event(
+            "end", "backup", "www.example.com", status, when=datetime(2024, 1, day)
+        )
+    dirvish.add_event("end", "backup", "db.example.com", "error")
+    dirvish.add_event("start", "backup", "mail.example.com", when=datetime(2024, 1, 5))
+    assert runner.last_success(dirvish._engine) == {
+        "www.example.com": datetime(2024, 1, 2)
+    }
+
+
+def test_tasks(pool):
+    inventory = zfs.Inventory("backup")
+    successes = {
+        "192.0.2.1": datetime(2024, 1, 2),
+        "db.example.com": datetime(2024, 1, 1),
+    }
+    tasks = runner.tasks(
+        inventory, {"customer1/www.example.com": "192.0.2.1"}, successes
+    )
+    assert [(t.vault, t.customer, t.client) for t in tasks] == [
+        ("customer1/mail.example.com", "customer1", "mail.example.com"),
+        ("customer2/db.example.com", "customer2", "db.example.com"),
+        ("customer1/www.example.com", "customer1", "192.0.2.1"),
+    ]
+    tasks = runner.tasks(inventory, {}, successes, customer="customer2")
+    assert [t.vault for t in tasks] == ["customer2/db.example.com"]
+
+
+def test_run_caps():
+    backups = Backups()
+    tasks = [task("customer1/{0}".format(i)) for i in range(6)]
+    tasks += [task("customer2/{0}".format(i)) for i in range(4)]
+    backup_runner = runner.Runner(
+        jobs=3, customer_jobs={None: 1, "customer1": 2}, execute=backups
+    )
+    results = backup_runner.run(tasks)
+    assert len(results) == 10
+    assert all(result.returncode == 0 for result in results)
+    assert backups.peak == {None: 3, "customer1": 2, "customer2": 1}
+    # the oldest vaults start first
+    assert backups.calls[:3] == ["customer1/0", "customer1/1", "customer2/0"]
+    stats = backup_runner.stats()
+    assert stats["succeeded"] == 10
+    assert stats["queued"] == stats["running"] == stats["failed"] == 0
+
+
+def test_run_retries():
+    backups = Backups(failures={"customer1/a": 1, "customer1/b": 5})
+    attempts = []
+    backup_runner = runner.Runner(jobs=2, retries=2, backoff=0.01, execute=backups)
+    results = backup_runner.run(
+        [task("customer1/a"), task("customer1/b"), task("customer2/c")],
+        callback=lambda result: attempts.append((result.vault, result.attempts)),
+    )
+    assert sorted((r.vault, r.returncode, r.attempts) for r in results) == [
+        ("customer1/a", 0, 2),
+        ("customer1/b", 255, 3),
+        ("customer2/c", 0, 1),
+    ]
+    assert [r.error for r in results if r.vault == "customer1/b"] == ["rsync error"]
+    assert len(attempts) == 6
+    stats = backup_runner.stats()
+    assert (stats["succeeded"], stats["failed"], stats["retries"]) == (2, 1, 3)
+
+
+def test_run_window():
+    backups = Backups(seconds=0.05, failures={"customer1/a": 1})
+    backup_runner = runner.Runner(jobs=1, backoff=60, window=0.08, execute=backups)
+    results = backup_runner.run(
+        [task("customer1/a"), task("customer1/b"), task("customer1/c")]
+    )
+    # no retry after the window, and nothing starts after it
+    assert [(r.vault, r.attempts) for r in results] == [
+        ("customer1/a", 1),
+        ("customer1/b", 1),
+    ]
+    stats = backup_runner.stats()
+    assert (stats["failed"], stats["skipped"], stats["queued"]) == (1, 1, 0)
+
+
+def test_run_written(pool):
+    def backup(command):
+        pool.write("backup/" + command[-1], 1 << 20)
+        return (0, "")
+
+    backup_runner = runner.Runner(pool="backup", execute=backup)
+    results = backup_runner.run([task("customer1/www.example.com")])
+    assert results[0].written == 1 << 20
+    assert backup_runner.stats()["written"] == 1 << 20
+
+
+def test_runner_invalid():
+    with pytest.raises(ValueError):
+        runner.Runner(jobs=0)
+    with pytest.raises(ValueError):
+        runner.Runner(customer_jobs={None: 0})
+
+
+def test_execute():
+    assert runner.execute(["true"]) == (0, "")
+    assert runner.execute(["sh", "-c", "echo failed >&2; exit 3"]) == (3, "failed\n")
+    assert runner.execute(["/nonexistent/dirvish"])[0] == 127
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+
+import sqlalchemy
+from sqlalchemy import DateTime
+
+logger = logging.getLogger(__name__)
+
+MachineRuns = collections.namedtuple(
+    "MachineRuns",
+    [
+        "client",
+        "server",
+        "runs",
+        "failures",
+        "p50",
+        "p95",
+        "max",
+        "average",
+        "recent",
+    ],
+)
+
+# Percentiles are the nearest rank of the durations ordered per machine, the
+# trend is the average of the newest runs against the average of all runs.
+REPORT = """
+WITH ranked AS (
+    SELECT machine, seconds, status,
+        ROW_NUMBER() OVER (
+            PARTITION BY machine ORDER BY seconds IS NULL, seconds
+        ) AS position,
+        COUNT(seconds) OVER (PARTITION BY machine) AS timed,
+        ROW_NUMBER() OVER (
+            PARTITION BY machine ORDER BY COALESCE(started, ended) DESC, id DESC
+        ) AS age
+    FROM runs
+    WHERE status IS NOT NULL
+        AND (:since IS NULL OR COALESCE(started, ended) >= :since)
+        AND (:until IS NULL OR COALESCE(started, ended) < :until)
+)
+SELECT machines.dirvish_client, machines.dirvish_server,
+    COUNT(*),
+    SUM(CASE WHEN status = 'success' THEN 0 ELSE 1 END),
+    MIN(CASE WHEN seconds IS NOT NULL AND position >= 0.50 * timed
+        THEN seconds END),
+    MIN(CASE WHEN seconds IS NOT NULL AND position >= 0.95 * timed
+        THEN seconds END),
+    MAX(seconds),
+    AVG(seconds),
+    AVG(CASE WHEN age <= :recent THEN seconds END)
+FROM ranked JOIN machines ON machines.id = ranked.machine
+WHERE (:client IS NULL OR machines.dirvish_client = :client)
+GROUP BY ranked.machine, machines.dirvish_client, machines.dirvish_server
+ORDER BY machines.dirvish_client, machines.dirvish_server
+"""
+
+
+def report(engine, client=None, since=None, until=None, recent=7):
+    """Get the statistics of the finished backup runs of each machine.
+
+    Runs which never ended count as failures. Everything is computed by the
+    database with window functions, only one row per machine is read.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param string client:   Only runs of this backup client.
+    :param datetime since:  Only runs started at or after this time.
+    :param datetime until:  Only runs started before this time.
+    :param int recent:      Number of newest runs of the trend.
+
+    :returns: The statistics per machine, durations in seconds.
+    :rtype: `list` of `runs.MachineRuns`
+
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+    query = sqlalchemy.text(REPORT).bindparams(
+        sqlalchemy.bindparam("since", type_=DateTime),
+        sqlalchemy.bindparam("until", type_=DateTime),
+    )
+    with engine.connect() as connection:
+        rows = connection.execute(
+            query,
+            {
+                "client": client,
+                "since": since,
+                "until": until,
+                "recent": recent,
+            },
+        )
+        return [MachineRuns(*row) for row in rows]
+
+
+def failure_rate(machine):
+    """Get the share of failed runs.
+
+    :param runs.MachineRuns machine:    Statistics of a machine.
+
+    :rtype: float
+    """
+    return machine.failures / machine.runs if machine.runs else 0.0
+
+
+def trend(machine):
+    """Get the change of the duration of the newest runs against all runs.
+
+    :param runs.MachineRuns machine:    Statistics of a machine.
+
+    :returns: The relative change, e.g. 0.1 if the newest runs took 10%
+              longer, None if the durations are unknown.
+    :rtype: float
+    """
+    if not machine.average or machine.recent is None:
+        return None
+    return machine.recent / machine.average - 1
+
+
+def format_duration(seconds):
+    """Format a duration as hours, minutes and seconds.
+
+    :param float seconds:   Duration, None if unknown.
+
+    :rtype: string
+    """
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{0}:{1:02d}:{2:02d}".format(hours, minutes, seconds)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module runs"""
+
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy
+
+from backupctl import runs
+from backupctl.dirvish import Dirvish, RunEntry
+
+START = datetime(2024, 1, 1)
+SERVER = "backup.example.com"
+
+
+@pytest.fixture()
+def dirvish(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    return Dirvish(engine)
+
+
+def backup(dirvish, client, day, seconds, status="success"):
+    started = START + timedelta(days=day)
+    dirvish.add_event("start", SERVER, client, when=started)
+    if seconds is not None:
+        dirvish.add_event(
+            "end", SERVER, client, status, when=started + timedelta(seconds=seconds)
+        )
+
+
+def test_runs(dirvish):
+    backup(dirvish, "www", 0, 100)
+    backup(dirvish, "www", 1, None)
+    backup(dirvish, "www", 2, 300, "fail")
+    backup(dirvish, "www", 3, None)
+    dirvish.add_event("end", SERVER, "db", "success", when=START)
+
+    session = sqlalchemy.orm.Session(dirvish._engine)
+    rows = [
+        (run.machine, run.started, run.seconds, run.status)
+        for run in session.query(RunEntry).order_by(RunEntry.id)
+    ]
+    session.close()
+    assert rows == [
+        (1, START, 100, "success"),
+        (1, START + timedelta(days=1), None, "missing"),
+        (1, START + timedelta(days=2), 300, "fail"),
+        (1, START + timedelta(days=3), None, None),
+        (2, None, None, "success"),
+    ]
+
+
+def test_report(dirvish):
+    for day in range(20):
+        backup(dirvish, "www", day, 100 * (day + 1), "fail" if day == 5 else "success")
+    backup(dirvish, "db", 0, None)
+    backup(dirvish, "db", 1, 60)
+    backup(dirvish, "mail", 0, None)
+
+    db, www = runs.report(dirvish._engine)
+    assert db == runs.MachineRuns("db", SERVER, 2, 1, 60, 60, 60, 60, 60)
+    assert www.runs == 20
+    assert www.failures == 1
+    assert (www.p50, www.p95, www.max) == (1000, 1900, 2000)
+    assert www.average == 1050
+    assert www.recent == 1700
+    assert runs.failure_rate(www) == 0.05
+    assert runs.trend(www) == pytest.approx(1700 / 1050 - 1)
+    assert runs.trend(db) == 0
+
+    (www,) = runs.report(
+        dirvish._engine, client="www", since=START + timedelta(days=10)
+    )
+    assert (www.runs, www.failures, www.p50, www.max) == (10, 0, 1500, 2000)
+    assert runs.report(dirvish._engine, until=START) == []
+
+
+def test_format_duration():
+    assert runs.format_duration(None) == "-"
+    assert runs.format_duration(59.6) == "0:01:00"
+    assert runs.format_duration(90061) == "25:01:01"
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import heapq
+import logging
+import math
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from backupctl import runs, trash
+
+logger = logging.getLogger(__name__)
+
+# A vault to back up, its expected duration in seconds and the I/O rate in
+# bytes per second it puts on the pool while it runs.
+Job = collections.namedtuple("Job", ["vault", "client", "seconds", "io", "measured"])
+
+# A scheduled job, start and end in minutes after the start of the window.
+Slot = collections.namedtuple("Slot", ["job", "start", "end"])
+
+
+def durations(engine, days=30, now=None):
+    """Get the expected durations of the backups of each client, the 95th
+    percentile of its runs of the last days, so the schedule holds on slow
+    nights too.
+
+    :param sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+    :param float days:                          Days of runs to consider.
+    :param datetime now:                        Current time.
+
+    :returns: Seconds by backup client.
+    :rtype: dict
+    """
+    since = (now or datetime.now()) - timedelta(days=days)
+    return {
+        machine.client: machine.p95
+        for machine in runs.report(engine, since=since)
+        if machine.p95 is not None
+    }
+
+
+def jobs(inventory, clients, durations, default_seconds=3600, throughput=None):
+    """Create the jobs of all vaults of a pool.
+
+    Vaults without runs are expected to read their whole size at
+    ``throughput`` bytes per second, or to take ``default_seconds`` if no
+    throughput is known. The I/O rate of a job is its size read over its
+    duration, rsync reads the whole tree of a vault to find the changes.
+
+    :param zfs.Inventory inventory: Inventory of the pool.
+    :param dict clients:            Backup client by vault
+                                    ``<customer>/<vault>``, missing vaults
+                                    are their own client.
+    :param dict durations:          Expected seconds by client, see
+                                    `durations`.
+    :param float default_seconds:   Duration of vaults without runs and
+                                    throughput.
+    :param float throughput:        Bytes per second of a new backup.
+
+    :returns: The jobs sorted by vault.
+    :rtype: `list` of `schedule.Job`
+    """
+    pool = inventory.pool
+    result = []
+    for dataset in inventory.datasets():
+        if len(dataset.name.split("/")) != 3 or trash.is_trash(pool, dataset.name):
+            continue
+        vault = dataset.name.split("/", 1)[1]
+        client = clients.get(vault) or vault.split("/")[1]
+        seconds = durations.get(client)
+        measured = seconds is not None
+        if not measured:
+            if throughput:
+                seconds = max(dataset.used / throughput, 60)
+            else:
+                seconds = default_seconds
+        seconds = max(seconds, 60)
+        result.append(Job(vault, client, seconds, dataset.used / seconds, measured))
+    return result
+
+
+def plan(jobs, concurrency, io_budget=None):
+    """Assign start times with list scheduling: the time advances from one
+    end of a backup to the next, and whenever backups end, the longest jobs
+    which fit beside the running ones without exceeding the concurrency and
+    the I/O budget are started.
+
+    A job which alone exceeds the I/O budget runs without other jobs.
+
+    :param list jobs:           Jobs to schedule.
+    :param int concurrency:     Maximum number of backups at the same time.
+    :param float io_budget:     Maximum I/O rate in bytes per second, None
+                                for no limit.
+
+    :returns: The slots sorted by start time.
+    :rtype: `list` of `schedule.Slot`
+
+    :raises ValueError: If the concurrency is less than 1.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    ordered = sorted(jobs, key=lambda job: (-job.seconds, job.vault))
+    if io_budget is None:
+        loads = [0] * len(ordered)
+        io_budget = 0
+    else:
+        loads = [min(job.io, io_budget) for job in ordered]
+    pending = _Pending(loads)
+    # (end, io) of the running jobs
+    running = []
+    load = 0
+    now = 0
+    slots = []
+    while pending:
+        while len(running) < concurrency:
+            index = pending.first(io_budget - load)
+            if index is None:
+                break
+            pending.remove(index)
+            job = ordered[index]
+            end = now + int(math.ceil(job.seconds / 60))
+            heapq.heappush(running, (end, loads[index]))
+            load += loads[index]
+            slots.append(Slot(job, now, end))
+        if not pending:
+            break
+        now = running[0][0]
+        while running and running[0][0] == now:
+            heapq.heappop(running)
+        # summed up again, so rounding errors don't add up over the night
+        load = sum(io for end, io in running)
+    return sorted(slots, key=lambda slot: (slot.start, slot.job.vault))
+
+
+class _Pending:
+    # jobs which aren't scheduled yet, in the order they should start, with a
+    # tree of the minimum load of each range to find the first job which
+    # fits in logarithmic time
+
+    def __init__(self, loads):
+        self._size = 1
+        while self._size < len(loads):
+            self._size *= 2
+        self._tree = [math.inf] * (2 * self._size)
+        self._tree[self._size : self._size + len(loads)] = loads
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = min(self._tree[2 * node], self._tree[2 * node + 1])
+        self._count = len(loads)
+
+    def __len__(self):
+        return self._count
+
+    def first(self, limit):
+        if self._tree[1] > limit:
+            return None
+        node = 1
+        while node < self._size:
+            node *= 2
+            if self._tree[node] > limit:
+                node += 1
+        return node - self._size
+
+    def remove(self, index):
+        node = index + self._size
+        self._tree[node] = math.inf
+        while node > 1:
+            node //= 2
+            self._tree[node] = min(self._tree[2 * node], self._tree[2 * node + 1])
+        self._count -= 1
+
+
+def peak(slots):
+    """Get the highest number of backups running at the same time.
+
+    :param list slots:  Scheduled slots.
+
+    :rtype: int
+    """
+    # a backup ending at a minute makes room for one starting at it
+    events = sorted(
+        [(slot.start, 1) for slot in slots] + [(slot.end, -1) for slot in slots]
+    )
+    running = highest = 0
+    for moment, change in events:
+        running += change
+        highest = max(highest, running)
+    return highest
+
+
+def makespan(slots):
+    """Get the minutes from the start of the window until the last backup
+    ends.
+
+    :param list slots:  Scheduled slots.
+
+    :rtype: int
+    """
+    return max([slot.end for slot in slots] or [0])
+
+
+def parse_time(value):
+    """Read a time of day.
+
+    :param string value:    Time, e.g. "22:00".
+
+    :returns: Minutes after midnight.
+    :rtype: int
+
+    :raises ValueError: If the time can't be interpreted.
+    """
+    hours, minutes = value.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError("invalid time {0}".format(value))
+    return hours * 60 + minutes
+
+
+def crontab(slots, window_start, user="root", header=None):
+    """Create the cron table of a schedule, one dirvish job per vault.
+
+    :param list slots:          Scheduled slots.
+    :param int window_start:    Start of the window in minutes after
+                                midnight.
+    :param string user:         User running dirvish.
+    :param list header:         Comment lines at the top.
+
+    :rtype: string
+    """
+    lines = ["# {0}".format(line) for line in header or []]
+    lines.append("SHELL=/bin/sh")
+    lines.append("PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin")
+    lines.append("")
+    for slot in slots:
+        hours, minutes = divmod((window_start + slot.start) % (24 * 60), 60)
+        lines.append(
+            "{0:<2d} {1:<2d} * * *  {2}  dirvish --vault {3}".format(
+                minutes, hours, user, slot.job.vault
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def write(path, content):
+    """Replace a file atomically, e.g. a file in /etc/cron.d which cron might
+    read at any time.
+
+    :param string path:     File path.
+    :param string content:  New content.
+
+    :raises OSError: If the file can't be written.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    # cron ignores files with a dot in their name, also the temporary one
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".backupctl-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        # cron ignores files which are writable by others
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
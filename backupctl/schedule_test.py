@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module schedule"""
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy
+
+from backupctl import schedule, simulator, zfs
+from backupctl.dirvish import Dirvish
+
+G = 1 << 30
+
+
+@pytest.fixture()
+def inventory():
+    pool = simulator.SimulatedPool("backup", size=1 << 50)
+    pool._create("backup/customer1")
+    pool._create("backup/customer1/www.example.com")
+    pool._create("backup/customer1/mail.example.com")
+    pool._create("backup/customer2")
+    pool._create("backup/customer2/db.example.com")
+    pool._create("backup/backupctl-trash")
+    pool._create("backup/backupctl-trash/1")
+    pool.write("backup/customer1/www.example.com", 36 * G)
+    pool.write("backup/customer1/mail.example.com", 18 * G)
+    pool.write("backup/customer2/db.example.com", 1 * G)
+    previous = zfs.set_backend(pool)
+    yield zfs.Inventory("backup")
+    zfs.set_backend(previous)
+
+
+def job(vault, minutes, io=0):
+    return schedule.Job(vault, vault, minutes * 60, io, True)
+
+
+def test_durations(tmp_path):
+    dirvish = Dirvish(sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db")))
+    now = datetime(2024, 2, 1)
+    for day, seconds in [(40, 9000), (3, 600), (2, 1200), (1, 1800)]:
+        started = now - timedelta(days=day)
+        dirvish.add_event("start", "backup", "www.example.com", when=started)
+        dirvish.add_event(
+            "end",
+            "backup",
+            "www.example.com",
+            "success",
+            when=started + timedelta(seconds=seconds),
+        )
+    assert schedule.durations(dirvish._engine, now=now) == {"www.example.com": 1800}
+
+
+def test_jobs(inventory):
+    jobs = schedule.jobs(
+        inventory,
+        {"customer1/mail.example.com": "192.0.2.1"},
+        {"www.example.com": 7200, "192.0.2.1": 30},
+        default_seconds=600,
+    )
+    assert [(j.vault, j.client, j.seconds, j.measured) for j in jobs] == [
+        ("customer1/mail.example.com", "192.0.2.1", 60, True),
+        ("customer1/www.example.com", "www.example.com", 7200, True),
+        ("customer2/db.example.com", "db.example.com", 600, False),
+    ]
+    assert jobs[1].io == 36 * G / 7200
+    jobs = schedule.jobs(inventory, {}, {}, throughput=G / 60)
+    assert [j.seconds for j in jobs] == [18 * 60, 36 * 60, 60]
+
+
+def test_plan():
+    jobs = [job("a", 60), job("b", 30), job("c", 30), job("d", 20), job("e", 10)]
+    slots = schedule.plan(jobs, 2)
+    assert [(s.job.vault, s.start, s.end) for s in slots] == [
+        ("a", 0, 60),
+        ("b", 0, 30),
+        ("c", 30, 60),
+        ("d", 60, 80),
+        ("e", 60, 70),
+    ]
+    assert schedule.peak(slots) == 2
+    assert schedule.makespan(slots) == 80
+    assert schedule.makespan(schedule.plan(jobs, 5)) == 60
+    assert schedule.peak(schedule.plan(jobs, 1)) == 1
+    assert schedule.makespan(schedule.plan(jobs, 1)) == 150
+    with pytest.raises(ValueError):
+        schedule.plan(jobs, 0)
+
+
+def test_plan_io_budget():
+    jobs = [job("a", 60, 80), job("b", 30, 50), job("c", 30, 20), job("d", 10, 500)]
+    slots = schedule.plan(jobs, 3, io_budget=100)
+    assert [(s.job.vault, s.start) for s in slots] == [
+        ("a", 0),
+        ("c", 0),
+        ("b", 60),
+        ("d", 90),
+    ]
+    # the load never exceeds the budget
+    for slot in slots:
+        running = [o for o in slots if o.start <= slot.start < o.end]
+        assert sum(min(o.job.io, 100) for o in running) <= 100
+
+
+def test_plan_scale():
+    jobs = [
+        job("customer{0}/vault{1}".format(i % 300, i), 5 + (i * 37) % 120, i % 7 * 10)
+        for i in range(5000)
+    ]
+    started = time.monotonic()
+    slots = schedule.plan(jobs, 40, io_budget=100)
+    assert time.monotonic() - started < 5
+    assert len(slots) == 5000
+    assert schedule.peak(slots) == 40
+    # the load never exceeds the budget, ends before starts at the same time
+    load = 0
+    events = sorted(
+        [(slot.start, 1, slot.job.io) for slot in slots]
+        + [(slot.end, -1, slot.job.io) for slot in slots]
+    )
+    for moment, change, io in events:
+        load += change * io
+        assert load <= 100
+
+
+def test_crontab():
+    slots = schedule.plan([job("customer1/www", 60), job("customer2/db", 150)], 1)
+    assert schedule.crontab(slots, schedule.parse_time("22:30"), header=["x"]) == (
+        "# x\n"
+        "SHELL=/bin/sh\n"
+        "PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin\n"
+        "\n"
+        "30 22 * * *  root  dirvish --vault customer2/db\n"
+        "0  1  * * *  root  dirvish --vault customer1/www\n"
+    )
+    with pytest.raises(ValueError):
+        schedule.parse_time("24:00")
+
+
+def test_write(tmp_path):
+    path = str(tmp_path / "backupctl")
+    schedule.write(path, "first\n")
+    schedule.write(path, "second\n")
+    assert open(path).read() == "second\n"
+    assert oct((tmp_path / "backupctl").stat().st_mode & 0o777) == "0o644"
+    assert [p.name for p in tmp_path.iterdir()] == ["backupctl"]
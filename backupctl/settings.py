@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import configparser
+import os
+
+from xdg import BaseDirectory
+
+
+def config():
+    """Read the configuration files. If no configuration exists, write the
+    default configuration to the directory ~/.config.
+
+    :returns: Configuration object.
+    :rtype: `configparser.ConfigParser`
+    """
+    cfg = configparser.ConfigParser()
+    cfg.read(os.path.join(os.sep, "etc", "backupctl.ini"))
+    cfg.read(os.path.join(BaseDirectory.xdg_config_home, "backupctl.ini"))
+    cfg.read("backupctl.ini")
+
+    if not cfg.has_section("database"):
+        cfg.add_section("database")
+    if not cfg.has_option("database", "type"):
+        cfg["database"]["type"] = "sqlite"
+    if not cfg.has_option("database", "path"):
+        cfg["database"]["path"] = os.path.join(
+            os.sep, "var", "lib", "backupctl", "backupctl.db"
+        )
+    if not cfg.has_option("database", "fullpath"):
+        cfg["database"]["fullpath"] = "{0}:///{1}".format(
+            cfg["database"].get("type"), cfg["database"].get("path")
+        )
+    return cfg
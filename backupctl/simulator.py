@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""In-memory zfs simulator.
+
+The simulator answers the zfs commands used by backupctl from an in-memory
+dataset tree, so backupctl can be run and profiled against pools with
+hundreds of thousands of datasets on any machine::
+
+    from backupctl import simulator, zfs
+
+    zfs.set_backend(simulator.SimulatedPool.synthetic("backup", 1000, 100))
+"""
+
+import getopt
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+from backupctl import zfs
+
+logger = logging.getLogger(__name__)
+
+PROGRAM_TABLE = re.compile(r"^local (\w+) = \{$")
+PROGRAM_LINE = re.compile(r'^\s*\["((?:[^"\\]|\\.)*)"\] = \{(.*)\},$')
+PROGRAM_VALUE = re.compile(r'\["((?:[^"\\]|\\.)*)"\] = "((?:[^"\\]|\\.)*)"')
+
+
+class SimulatorError(Exception):
+    """A zfs command failed in the simulator."""
+
+
+class SimulatedDataset:
+    """A file system of the simulated pool.
+
+    :ivar string name:          zfs file system.
+    :ivar int data:             Bytes written to this file system itself.
+    :ivar int used:             Bytes used by the file system and all its
+                                descendants.
+    :ivar int quota:            Quota in bytes or None.
+    :ivar string mountpoint:    Mountpoint or None.
+    :ivar dict properties:      Other properties.
+    :ivar set children:         Names of the direct children.
+    :ivar dict snapshots:       Creation time and referenced bytes by
+                                snapshot name.
+    """
+
+    __slots__ = (
+        "name",
+        "data",
+        "used",
+        "quota",
+        "mountpoint",
+        "properties",
+        "children",
+        "snapshots",
+    )
+
+    def __init__(self, name, quota=None, mountpoint=None, properties=None):
+        self.name = name
+        self.data = 0
+        self.used = 0
+        self.quota = quota
+        self.mountpoint = mountpoint
+        self.properties = properties or {}
+        self.children = set()
+        self.snapshots = {}
+
+
+class SimulatedPool(zfs.Backend):
+    """Backend simulating a zfs pool in memory.
+
+    Supported are ``zfs create``, ``set``, ``get``, ``list``, ``rename``,
+    ``snapshot``, ``destroy``, the channel programs generated by `zfs.channel_program`,
+    ``zfs send`` piped into ``zfs recv`` within the pool and ``zpool get``.
+    Commands other than zfs and zpool are run with the `zfs.CliBackend`.
+
+    :ivar string pool:      zfs pool name.
+    :ivar int size:         Size of the pool in bytes.
+    :ivar latency:          Seconds every zfs command takes, either a number
+                            or a dict by zfs subcommand.
+    :ivar dict calls:       Number of calls by zfs subcommand.
+    """
+
+    def __init__(self, pool="backup", size=1 << 50, latency=0):
+        self.pool = pool
+        self.size = size
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.RLock()
+        self._cli = zfs.CliBackend()
+        self._datasets = {pool: SimulatedDataset(pool, mountpoint="/" + pool)}
+
+    @classmethod
+    def synthetic(
+        cls,
+        pool,
+        customers,
+        vaults,
+        root=os.path.join(os.sep, "srv", "backup"),
+        used=1 << 30,
+        seed=0,
+        **kwargs
+    ):
+        """Create a pool with customers and vaults like backupctl does.
+
+        :param string pool:     zfs pool name.
+        :param int customers:   Number of customers.
+        :param int vaults:      Number of vaults per customer.
+        :param string root:     Backup root path for the vault mountpoints.
+        :param int used:        Maximum bytes used per vault.
+        :param int seed:        Seed for the random usage.
+
+        :returns: Simulated pool.
+        :rtype: `simulator.SimulatedPool`
+        """
+        sim = cls(pool, **kwargs)
+        rng = random.Random(seed)
+        for c in range(customers):
+            customer = "customer{0}".format(c)
+            fs = "{0}/{1}".format(pool, customer)
+            sim._create(fs, quota=used * vaults * 2)
+            for v in range(vaults):
+                vault = "vault{0}.example.com".format(v)
+                sim._create(
+                    "{0}/{1}".format(fs, vault),
+                    quota=used * 2,
+                    mountpoint=os.path.join(root, customer, vault),
+                )
+                sim.write("{0}/{1}".format(fs, vault), rng.randint(0, used))
+        return sim
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Load a pool saved with `save`.
+
+        :param string path: JSON file.
+
+        :returns: Simulated pool.
+        :rtype: `simulator.SimulatedPool`
+
+        :raises OSError: If the file couldn't be read.
+        :raises ValueError: If the file isn't a saved pool.
+        """
+        with open(path, "r") as state_file:
+            state = json.load(state_file)
+        sim = cls(state["pool"], size=state["size"], **kwargs)
+        for dataset in state["datasets"]:
+            name, data, quota, mountpoint, properties = dataset[:5]
+            if name != sim.pool:
+                sim._create(name, quota, mountpoint, properties)
+            sim._datasets[name].data = data
+            sim._add_used(name, data)
+            if len(dataset) > 5:
+                sim._datasets[name].snapshots = {
+                    snapshot: tuple(value) for snapshot, value in dataset[5].items()
+                }
+        return sim
+
+    def save(self, path):
+        """Save the pool to a JSON file.
+
+        :param string path: JSON file.
+        """
+        with self._lock:
+            datasets = [
+                [ds.name, ds.data, ds.quota, ds.mountpoint, ds.properties, ds.snapshots]
+                for ds in self._walk(self.pool)
+            ]
+        with open(path, "w") as state_file:
+            json.dump(
+                {"pool": self.pool, "size": self.size, "datasets": datasets}, state_file
+            )
+
+    def write(self, fs, size):
+        """Simulate writing (or with a negative size deleting) data.
+
+        :param string fs:   zfs file system.
+        :param int size:    Number of bytes.
+
+        :raises SimulatorError: If a quota would be exceeded.
+        """
+        with self._lock:
+            ds = self._get(fs)
+            for ancestor in self._ancestors(fs):
+                if ancestor.quota is not None and ancestor.used + size > ancestor.quota:
+                    raise SimulatorError(
+                        "cannot write to '{0}': Disk quota exceeded".format(fs)
+                    )
+            ds.data += size
+            self._add_used(fs, size)
+
+    def execute(self, command, stdin="", communicate=True):
+        if (
+            isinstance(command, str)
+            or not command
+            or command[0] not in ("zfs", "zpool")
+        ):
+            return self._cli.execute(command, stdin, communicate)
+        subcommand = command[1] if len(command) > 1 else ""
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(subcommand, 0)
+        if latency:
+            time.sleep(latency)
+        handler = getattr(self, "_{0}_{1}".format(command[0], subcommand), None)
+        if handler is None:
+            return (2, "", "unrecognized command '{0}'\n".format(subcommand))
+        with self._lock:
+            self.calls[subcommand] = self.calls.get(subcommand, 0) + 1
+            try:
+                return (0, handler(command[2:]), "")
+            except (SimulatorError, getopt.GetoptError, ValueError) as e:
+                return (1, "", "{0}\n".format(e))
+
+    def pipe(self, send_command, recv_command, limiter=None, chunk_size=1 << 20):
+        # zfs is never touched, only streams within the pool are simulated
+        if send_command[:2] != ["zfs", "send"] or recv_command[:2] != ["zfs", "recv"]:
+            return (2, 0, "only zfs send into zfs recv is simulated\n")
+        with self._lock:
+            self.calls["send"] = self.calls.get("send", 0) + 1
+            try:
+                transferred = self._receive(send_command[2:], recv_command[2:])
+            except (SimulatorError, getopt.GetoptError, ValueError) as e:
+                return (1, 0, "{0}\n".format(e))
+        if limiter is not None:
+            limiter.acquire(transferred)
+        return (0, transferred, "")
+
+    def _receive(self, send_args, recv_args):
+        opts, send_args = getopt.getopt(send_args, "i:t:")
+        flags = dict(opts)
+        if "-t" in flags:
+            raise SimulatorError("resuming a stream is not simulated")
+        fs, name = send_args[0].split("@", 1)
+        source = self._get(fs)
+        if name not in source.snapshots:
+            raise SimulatorError(
+                "cannot open '{0}': dataset does not exist".format(send_args[0])
+            )
+        creation, refer = source.snapshots[name]
+        opts, recv_args = getopt.getopt(recv_args, "suF")
+        force = ("-F", "") in opts
+        target_fs = recv_args[0]
+        target = self._datasets.get(target_fs)
+        if "-i" in flags:
+            base = flags["-i"].split("@", 1)[1]
+            if target is None or base not in target.snapshots:
+                raise SimulatorError(
+                    "cannot receive incremental stream: destination {0} has no "
+                    "snapshot {1}".format(target_fs, base)
+                )
+            transferred = abs(refer - source.snapshots[base][1])
+        else:
+            if target is not None and not force:
+                raise SimulatorError(
+                    "cannot receive new filesystem stream: destination '{0}' "
+                    "exists".format(target_fs)
+                )
+            if target is None:
+                self._create(target_fs)
+                target = self._datasets[target_fs]
+            transferred = refer
+        if name in target.snapshots:
+            raise SimulatorError(
+                "cannot receive: destination snapshot {0}@{1} exists".format(
+                    target_fs, name
+                )
+            )
+        self._add_used(target_fs, refer - target.data)
+        target.data = refer
+        target.snapshots[name] = (creation, refer)
+        return transferred
+
+    def _get(self, fs):
+        try:
+            return self._datasets[fs]
+        except KeyError:
+            raise SimulatorError("cannot open '{0}': dataset does not exist".format(fs))
+
+    def _ancestors(self, fs):
+        while True:
+            yield self._datasets[fs]
+            if "/" not in fs:
+                return
+            fs = fs.rsplit("/", 1)[0]
+
+    def _add_used(self, fs, size):
+        for ancestor in self._ancestors(fs):
+            ancestor.used += size
+
+    def _walk(self, fs, depth=None):
+        stack = [(fs, 0)]
+        while stack:
+            name, level = stack.pop()
+            ds = self._datasets[name]
+            yield ds
+            if depth is None or level < depth:
+                stack.extend(
+                    (child, level + 1) for child in sorted(ds.children, reverse=True)
+                )
+
+    def _create(self, fs, quota=None, mountpoint=None, properties=None):
+        if fs in self._datasets:
+            raise SimulatorError(
+                "cannot create '{0}': dataset already exists".format(fs)
+            )
+        parent = fs.rsplit("/", 1)[0] if "/" in fs else None
+        if parent not in self._datasets:
+            raise SimulatorError(
+                "cannot create '{0}': parent does not exist".format(fs)
+            )
+        self._datasets[fs] = SimulatedDataset(fs, quota, mountpoint, properties)
+        self._datasets[parent].children.add(fs)
+
+    def _set(self, ds, prop, value):
+        if prop == "quota":
+            quota = None if value in ("none", "0") else _parse_bytes(value)
+            if quota is not None and quota < ds.used:
+                raise SimulatorError(
+                    "cannot set property for '{0}': size is less than current used "
+                    "or reserved space".format(ds.name)
+                )
+            ds.quota = quota
+        elif prop == "mountpoint":
+            ds.mountpoint = None if value == "none" else value
+        else:
+            ds.properties[prop] = value
+
+    def _value(self, ds, prop, parsable):
+        if prop == "name":
+            return ds.name
+        elif prop == "type":
+            return "filesystem"
+        elif prop == "mountpoint":
+            return ds.mountpoint or "none"
+        elif prop == "compressratio":
+            return "1.00x"
+        elif prop == "used":
+            value = ds.used
+        elif prop in ("avail", "available"):
+            value = self.size - self._datasets[self.pool].used
+            for ancestor in self._ancestors(ds.name):
+                if ancestor.quota is not None:
+                    value = min(value, ancestor.quota - ancestor.used)
+            value = max(value, 0)
+        elif prop in ("refer", "referenced"):
+            value = ds.data
+        elif prop == "quota":
+            if ds.quota is None:
+                return "0" if parsable else "none"
+            value = ds.quota
+        else:
+            return ds.properties.get(prop, "-")
+        return str(value) if parsable else zfs.format_size(value)
+
+    def _zfs_create(self, args):
+        opts, args = getopt.getopt(args, "po:")
+        properties = dict(value.split("=", 1) for flag, value in opts if flag == "-o")
+        fs = args[0]
+        if ("-p", "") in opts:
+            if fs in self._datasets:
+                # like zfs, -p doesn't fail on an existing file system
+                return ""
+            parts = fs.split("/")
+            for i in range(2, len(parts)):
+                if "/".join(parts[:i]) not in self._datasets:
+                    self._create("/".join(parts[:i]))
+        self._create(fs)
+        ds = self._datasets[fs]
+        for prop, value in properties.items():
+            self._set(ds, prop, value)
+        return ""
+
+    def _zfs_set(self, args):
+        ds = self._get(args[-1])
+        for assignment in args[:-1]:
+            prop, value = assignment.split("=", 1)
+            self._set(ds, prop, value)
+        return ""
+
+    def _zfs_get(self, args):
+        opts, args = getopt.getopt(args, "Hpro:d:t:")
+        flags = dict(opts)
+        fields = flags.get("-o", "name,property,value,source").split(",")
+        depth = int(flags["-d"]) if "-d" in flags else None
+        if "-r" not in flags and depth is None:
+            depth = 0
+        lines = []
+        for fs in args[1:]:
+            for ds in self._walk(self._get(fs).name, depth):
+                for prop in args[0].split(","):
+                    row = {
+                        "name": ds.name,
+                        "property": prop,
+                        "value": self._value(ds, prop, "-p" in flags),
+                        "source": "local",
+                    }
+                    lines.append("\t".join(row[field] for field in fields))
+        return "".join(line + "\n" for line in lines)
+
+    def _zfs_list(self, args):
+        opts, args = getopt.getopt(args, "Hpro:d:t:s:")
+        flags = dict(opts)
+        fields = flags.get("-o", "name,used,avail,refer,mountpoint").split(",")
+        depth = int(flags["-d"]) if "-d" in flags else None
+        if "-r" not in flags and depth is None:
+            depth = 0
+        types = flags.get("-t", "filesystem").split(",")
+        lines = []
+        for fs in args or [self.pool]:
+            for ds in self._walk(self._get(fs).name, depth):
+                if "filesystem" in types or "all" in types:
+                    lines.append(
+                        "\t".join(
+                            self._value(ds, field, "-p" in flags) for field in fields
+                        )
+                    )
+                if "snapshot" in types or "all" in types:
+                    for snapshot, (creation, refer) in ds.snapshots.items():
+                        row = {
+                            "name": "{0}@{1}".format(ds.name, snapshot),
+                            "type": "snapshot",
+                            "used": "0",
+                            "refer": str(refer),
+                            "referenced": str(refer),
+                            "creation": str(creation),
+                        }
+                        lines.append("\t".join(row.get(f, "-") for f in fields))
+        return "".join(line + "\n" for line in lines)
+
+    def _zfs_snapshot(self, args):
+        opts, args = getopt.getopt(args, "ro:")
+        for snapshot in args:
+            fs, name = snapshot.split("@", 1)
+            ds = self._get(fs)
+            if name in ds.snapshots:
+                raise SimulatorError(
+                    "cannot create snapshot '{0}': dataset already exists".format(
+                        snapshot
+                    )
+                )
+            ds.snapshots[name] = (int(time.time()), ds.data)
+        return ""
+
+    def _zfs_destroy(self, args):
+        opts, args = getopt.getopt(args, "rRf")
+        flags = dict(opts)
+        if "@" in args[0]:
+            fs, names = args[0].split("@", 1)
+            ds = self._get(fs)
+            for name in names.split(","):
+                if name not in ds.snapshots:
+                    raise SimulatorError(
+                        "could not find any snapshots to destroy; check snapshot "
+                        "names."
+                    )
+            for name in names.split(","):
+                del ds.snapshots[name]
+            return ""
+        ds = self._get(args[0])
+        if ds.children and "-r" not in flags and "-R" not in flags:
+            raise SimulatorError(
+                "cannot destroy '{0}': filesystem has children".format(ds.name)
+            )
+        if ds.name == self.pool:
+            raise SimulatorError(
+                "cannot destroy '{0}': operation not applicable to datasets of "
+                "this type".format(ds.name)
+            )
+        self._add_used(ds.name, -ds.used)
+        for descendant in list(self._walk(ds.name)):
+            del self._datasets[descendant.name]
+        self._datasets[ds.name.rsplit("/", 1)[0]].children.discard(ds.name)
+        return ""
+
+    def _zfs_rename(self, args):
+        opts, args = getopt.getopt(args, "fpu")
+        ds = self._get(args[0])
+        new_fs = args[1]
+        if ds.name == self.pool or "/" not in new_fs:
+            raise SimulatorError(
+                "cannot rename '{0}': operation not applicable to datasets of "
+                "this type".format(ds.name)
+            )
+        if new_fs in self._datasets:
+            raise SimulatorError(
+                "cannot rename to '{0}': dataset already exists".format(new_fs)
+            )
+        if new_fs.startswith(ds.name + "/"):
+            raise SimulatorError(
+                "cannot rename to '{0}': New dataset name cannot be a "
+                "descendant of current dataset name".format(new_fs)
+            )
+        parent = new_fs.rsplit("/", 1)[0]
+        if parent not in self._datasets:
+            raise SimulatorError(
+                "cannot rename to '{0}': parent does not exist".format(new_fs)
+            )
+        used = ds.used
+        self._add_used(ds.name, -used)
+        self._datasets[ds.name.rsplit("/", 1)[0]].children.discard(ds.name)
+        for descendant in list(self._walk(ds.name)):
+            del self._datasets[descendant.name]
+            descendant.name = new_fs + descendant.name[len(args[0]) :]
+            descendant.children = {
+                new_fs + child[len(args[0]) :] for child in descendant.children
+            }
+            self._datasets[descendant.name] = descendant
+        self._datasets[parent].children.add(new_fs)
+        self._add_used(new_fs, used)
+        return ""
+
+    def _zpool_get(self, args):
+        opts, args = getopt.getopt(args, "Hpo:")
+        flags = dict(opts)
+        fields = flags.get("-o", "name,property,value,source").split(",")
+        if args[1] != self.pool:
+            raise SimulatorError("cannot open '{0}': no such pool".format(args[1]))
+        values = {"size": self.size, "allocated": self._datasets[self.pool].used}
+        values["free"] = values["size"] - values["allocated"]
+        # destroys are synchronous in the simulator
+        values["freeing"] = 0
+        lines = []
+        for prop in args[0].split(","):
+            value = values.get(prop)
+            row = {
+                "name": self.pool,
+                "property": prop,
+                "value": "-" if value is None else str(value),
+                "source": "-",
+            }
+            lines.append("\t".join(row[field] for field in fields))
+        return "".join(line + "\n" for line in lines)
+
+    def _zfs_program(self, args):
+        opts, args = getopt.getopt(args, "jnt:m:")
+        if args[0] != self.pool:
+            raise SimulatorError("cannot open '{0}': no such pool".format(args[0]))
+        with open(args[1], "r") as script_file:
+            script = script_file.read()
+        tables = {}
+        table = None
+        for line in script.splitlines():
+            match = PROGRAM_TABLE.match(line)
+            if match:
+                table = tables.setdefault(match.group(1), {})
+                continue
+            match = PROGRAM_LINE.match(line)
+            if match and table is not None:
+                table[_unescape(match.group(1))] = {
+                    _unescape(prop): _unescape(value)
+                    for prop, value in PROGRAM_VALUE.findall(match.group(2))
+                }
+        for fs, props in sorted(tables.get("quotas", {}).items()):
+            ds = self._get(fs)
+            quota = props.get("quota", "0")
+            if quota != "0" and int(quota) < ds.used:
+                raise SimulatorError(
+                    "{0} {1}: new quota {2} is smaller than used size {3}".format(
+                        zfs.CHANNEL_PROGRAM_ERROR, fs, quota, ds.used
+                    )
+                )
+        properties = tables.get("properties", {})
+        for fs, props in sorted(properties.items()):
+            self._get(fs)
+            for prop in props:
+                # like zfs.sync.set_prop, which only supports user properties
+                if not zfs.is_user_property(prop):
+                    raise SimulatorError(
+                        "Channel program execution failed:\n"
+                        "property '{0}' is not supported".format(prop)
+                    )
+        for fs, props in properties.items():
+            for prop, value in props.items():
+                self._set(self._datasets[fs], prop, value)
+        return ""
+
+
+def _parse_bytes(value):
+    if value.isdigit():
+        return int(value)
+    return zfs.parse_size(value)
+
+
+def _unescape(value):
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) == "n" else m.group(1), value)
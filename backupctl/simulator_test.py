@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module simulator"""
+
+import configparser
+import time
+
+import pytest
+import sqlalchemy
+
+from backupctl import backupctl, replicate, simulator, zfs
+
+
+@pytest.fixture()
+def sim():
+    pool = simulator.SimulatedPool("backup", size=1 << 40)
+    previous = zfs.set_backend(pool)
+    yield pool
+    zfs.set_backend(previous)
+
+
+def test_filesystem_lifecycle(sim):
+    assert zfs.new_filesystem("backup/customer1", size="1G")
+    assert zfs.new_filesystem(
+        "backup/customer1/www.example.com", "/srv/backup/customer1/www", "500M"
+    )
+    assert not zfs.new_filesystem("backup/customer1", size="1G")
+    assert not zfs.new_filesystem("backup/customer2/www.example.com")
+    sim.write("backup/customer1/www.example.com", 100 << 20)
+    assert zfs.filesystem_usage("backup/customer1") == 100 << 20
+    assert zfs.resize_filesystem("backup/customer1/www.example.com", "200M")
+    assert not zfs.resize_filesystem("backup/customer1/www.example.com", "50M")
+    inventory = zfs.Inventory("backup")
+    dataset = inventory.get("backup/customer1/www.example.com")
+    assert dataset.quota == 200 << 20
+    assert dataset.avail == 100 << 20
+    assert dataset.mountpoint == "/srv/backup/customer1/www"
+    assert inventory.get("backup/customer1").avail == (1 << 30) - (100 << 20)
+    assert zfs.remove_filesystem("backup/customer1")
+    assert zfs.filesystem_usage("backup") == 0
+    assert not zfs.Inventory("backup").exists("backup/customer1/www.example.com")
+
+
+def test_rename(sim):
+    zfs.new_filesystem("backup/customer1", size="1G")
+    zfs.new_filesystem("backup/customer1/www.example.com", "/srv/backup/www")
+    zfs.new_filesystem("backup/trash")
+    sim.write("backup/customer1/www.example.com", 1 << 20)
+    assert zfs.rename_filesystem("backup/customer1", "backup/trash/1")
+    inventory = zfs.Inventory("backup")
+    assert [d.name for d in inventory.datasets("backup/trash")] == [
+        "backup/trash",
+        "backup/trash/1",
+        "backup/trash/1/www.example.com",
+    ]
+    assert inventory.usage("backup/trash") == 1 << 20
+    assert inventory.get("backup/trash/1").quota == 1 << 30
+    assert not zfs.rename_filesystem("backup/trash/1", "backup/trash/1/x")
+    assert not zfs.rename_filesystem("backup/trash/1", "backup/customer2/x")
+    assert zfs.pool_freeing("backup") == 0
+
+
+def test_write_quota(sim):
+    assert zfs.new_filesystem("backup/customer1", size="1M")
+    assert zfs.new_filesystem("backup/customer1/www.example.com")
+    with pytest.raises(simulator.SimulatorError):
+        sim.write("backup/customer1/www.example.com", 2 << 20)
+    sim.write("backup/customer1/www.example.com", 1 << 20)
+
+
+def test_destroy_children(sim):
+    zfs.new_filesystem("backup/customer1")
+    zfs.new_filesystem("backup/customer1/www.example.com")
+    returncode, stdout, stderr = zfs.execute_cmd(["zfs", "destroy", "backup/customer1"])
+    assert returncode == 1
+    assert "filesystem has children" in stderr
+    assert zfs.execute_cmd(["zfs", "destroy", "-r", "backup/customer1"])[0] == 0
+    assert zfs.execute_cmd(["zfs", "destroy", "-r", "backup/customer1"])[0] == 1
+
+
+def test_channel_program(sim):
+    zfs.new_filesystem("backup/customer1")
+    zfs.new_filesystem("backup/customer1/www.example.com")
+    sim.write("backup/customer1/www.example.com", 10 << 20)
+    assert not zfs.set_quotas(
+        {"backup/customer1": "1G", "backup/customer1/www.example.com": "1M"}
+    )
+    assert zfs.Inventory("backup").quota("backup/customer1") is None
+    assert zfs.set_quotas(
+        {"backup/customer1": "1G", "backup/customer1/www.example.com": "20M"}
+    )
+    assert zfs.Inventory("backup").quota("backup/customer1") == 1 << 30
+    assert sim.calls["program"] == 2
+    # channel programs can't set quotas, they are only checked by it
+    assert sim.calls["set"] == 2
+
+
+def test_channel_program_user_properties(sim, tmp_path):
+    zfs.new_filesystem("backup/customer1")
+    assert zfs.set_properties(
+        {"backup/customer1": {"backupctl:owner": "ops", "compression": "off"}}
+    )
+    assert sim.calls["program"] == 1
+    assert sim.calls["set"] == 1
+    properties = sim._datasets["backup/customer1"].properties
+    assert properties["backupctl:owner"] == "ops"
+    assert properties["compression"] == "off"
+    # zfs refuses other properties in channel programs
+    script = tmp_path / "quota.lua"
+    script.write_text(
+        'local properties = {\n    ["backup/customer1"] = {["quota"] = "1024"},\n}\n'
+    )
+    returncode, stdout, stderr = zfs.execute_cmd(
+        ["zfs", "program", "backup", str(script)]
+    )
+    assert returncode != 0
+    assert "not supported" in stderr
+    assert zfs.CHANNEL_PROGRAM_ERROR not in stderr
+
+
+def test_latency(sim):
+    sim.latency = {"get": 0.1}
+    started = time.monotonic()
+    zfs.filesystem_usage("backup")
+    zfs.Inventory("backup").refresh()
+    assert 0.1 <= time.monotonic() - started < 0.2
+
+
+def test_other_commands(sim):
+    assert zfs.execute_cmd(["echo", "hello world"])[1] == "hello world\n"
+    assert zfs.execute_cmd(["zfs", "frobnicate"])[0] == 2
+
+
+def test_replicate(sim, tmp_path):
+    sim._create("backup/customer1")
+    sim._create("backup/customer1/www.example.com")
+    sim.write("backup/customer1/www.example.com", 1 << 20)
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "db"))
+    replicator = replicate.Replicator(engine, "backup/replica")
+    fs = "backup/customer1/www.example.com"
+    (first,) = replicator.replicate([fs])
+    assert (first.error, first.mode, first.transferred) == (None, "full", 1 << 20)
+    sim.write(fs, 1 << 10)
+    (second,) = replicator.replicate([fs])
+    assert (second.error, second.mode) == (None, "incremental")
+    assert second.transferred == 1 << 10
+    target = sim._datasets["backup/replica/customer1/www.example.com"]
+    assert target.data == (1 << 20) + (1 << 10)
+    assert list(target.snapshots) == [second.snapshot]
+    # nothing falls through to the real zfs
+    assert zfs.pipe_cmd(["zfs", "send", "-t", "1-abc"], ["zfs", "recv", "x"])[0] == 1
+    assert zfs.pipe_cmd(["zfs", "send", fs], ["ssh", "backup2", "zfs recv"])[0] == 2
+
+
+def test_save_load(tmp_path):
+    sim = simulator.SimulatedPool.synthetic("backup", 3, 4, used=1 << 20)
+    path = str(tmp_path / "pool.json")
+    sim.save(path)
+    loaded = simulator.SimulatedPool.load(path)
+    for command in (
+        ["zfs", "list", "-H", "-p", "-r", "backup"],
+        ["zfs", "get", "-H", "-p", "-r", "quota,used", "backup"],
+    ):
+        assert loaded.execute(command) == sim.execute(command)
+
+
+def test_synthetic_pool(sim):
+    pool = simulator.SimulatedPool.synthetic("backup", 100, 100, used=1 << 20)
+    zfs.set_backend(pool)
+    inventory = zfs.Inventory("backup")
+    assert len(inventory.datasets()) == 1 + 100 + 100 * 100
+    assert pool.calls == {"list": 1}
+    customer = inventory.get("backup/customer42")
+    assert customer.used == sum(
+        d.used for d in inventory.datasets("backup/customer42")[1:]
+    )
+
+
+def test_backupctl_commands(sim, mocker, tmp_path, capsys):
+    hist = mocker.Mock()
+    dirvish = mocker.Mock()
+    inventory = zfs.Inventory("backup")
+    root = str(tmp_path)
+    backupctl.new(
+        hist, dirvish, "backup", root, "customer1", size="1G", inventory=inventory
+    )
+    backupctl.new(
+        hist, dirvish, "backup", root, "customer1", "www", "10M", inventory=inventory
+    )
+    backupctl.resize(hist, "backup", "customer1", "www", "20M", inventory=inventory)
+    backupctl.status(inventory, "customer1")
+    backupctl.remove(hist, "backup", "customer1", "www")
+    assert sim.calls == {"list": 1, "create": 2, "set": 2, "destroy": 1}
+    assert "backup/customer1/www" in capsys.readouterr().out
+    assert not zfs.Inventory("backup").exists("backup/customer1/www")
+
+
+def test_zfs_backend(tmp_path):
+    cfg = configparser.ConfigParser()
+    cfg["zfs"] = {"pool": "backup", "root": str(tmp_path), "backend": "simulator"}
+    cfg["simulator"] = {"customers": "2", "vaults": "3"}
+    previous = zfs.get_backend()
+    try:
+        backend = backupctl.zfs_backend(cfg)
+        assert zfs.get_backend() is backend
+        assert len(zfs.Inventory("backup").datasets()) == 9
+    finally:
+        zfs.set_backend(previous)
+    cfg["zfs"]["backend"] = "cli"
+    assert backupctl.zfs_backend(cfg) is previous
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Spool directory of dirvish hook events.
+
+This module is imported by the hooks and must stay cheap to import, it
+doesn't use the database.
+"""
+
+import collections
+import json
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Environment of a dirvish hook which is kept in a spooled event.
+ENVIRONMENT = [
+    "DIRVISH_SERVER",
+    "DIRVISH_CLIENT",
+    "DIRVISH_IMAGE",
+    "DIRVISH_DEST",
+    "DIRVISH_STATUS",
+]
+
+SpoolEvent = collections.namedtuple("SpoolEvent", ["path", "record"])
+
+
+def event_key(record):
+    """Get the key a hook event is stored with, the same for every retry of
+    the hook for one image.
+
+    :param dict record: Spooled event.
+
+    :rtype: string
+    """
+    env = record["env"]
+    if not env.get("DIRVISH_IMAGE"):
+        # without an image only the event itself can be recognized again
+        return record["id"]
+    return "{0}:{1}:{2}:{3}".format(
+        record["trigger"],
+        env.get("DIRVISH_SERVER"),
+        env.get("DIRVISH_CLIENT"),
+        env.get("DIRVISH_IMAGE"),
+    )
+
+
+def event(trigger, environ=None, snapshot=None, now=None):
+    """Create the event of a dirvish hook.
+
+    :param string trigger:      "start" or "end".
+    :param dict environ:        Environment of the hook, defaults to
+                                `os.environ`.
+    :param string snapshot:     zfs snapshot taken of the image.
+    :param float now:           Time of the event, defaults to now.
+
+    :returns: The event, its id starts with the time in microseconds, so the
+              ids sort in the order the events were created.
+    :rtype: dict
+    """
+    if environ is None:
+        environ = os.environ
+    if now is None:
+        now = time.time()
+    return {
+        "id": "{0:017d}-{1}-{2}".format(int(now * 1e6), os.getpid(), uuid.uuid4().hex),
+        "trigger": trigger,
+        "time": now,
+        "pid": os.getpid(),
+        "env": {key: environ.get(key) for key in ENVIRONMENT},
+        "snapshot": snapshot,
+    }
+
+
+def write(directory, trigger, environ=None, snapshot=None):
+    """Append a new event of a dirvish hook to the spool, see `event` and
+    `append`.
+
+    :param string directory:    Spool directory.
+    :param string trigger:      "start" or "end".
+    :param dict environ:        Environment of the hook, defaults to
+                                `os.environ`.
+    :param string snapshot:     zfs snapshot taken of the image.
+
+    :returns: Path of the spooled event.
+    :rtype: string
+
+    :raises OSError: If the event can't be written.
+    """
+    return append(directory, event(trigger, environ, snapshot))
+
+
+def append(directory, record):
+    """Append an event to the spool.
+
+    The event is written to a temporary file and renamed into the spool, so
+    a reader never sees a partial event. Files are named by the event id and
+    sort in the order the events were created.
+
+    :param string directory:    Spool directory.
+    :param dict record:         Event as created by `event`.
+
+    :returns: Path of the spooled event.
+    :rtype: string
+
+    :raises OSError: If the event can't be written.
+    """
+    tmp = os.path.join(directory, "tmp")
+    os.makedirs(tmp, exist_ok=True)
+    partial = os.path.join(tmp, record["id"])
+    with open(partial, "w", encoding="utf8") as f:
+        json.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+    path = os.path.join(directory, "{0}.json".format(record["id"]))
+    os.rename(partial, path)
+    return path
+
+
+def read(directory):
+    """Read the spooled events in the order they were written. Files which
+    can't be read are logged and skipped, they stay in the spool.
+
+    :param string directory:    Spool directory.
+
+    :returns: The events.
+    :rtype: `list` of `spool.SpoolEvent`
+    """
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    except FileNotFoundError:
+        return []
+    events = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            with open(path, encoding="utf8") as f:
+                events.append(SpoolEvent(path, json.load(f)))
+        except (OSError, ValueError) as e:
+            logger.error("can't read spooled event {0}: {1}".format(path, e))
+    return events
+
+
+def remove(events):
+    """Remove ingested events from the spool.
+
+    :param list events: Events as returned by `read`.
+    """
+    for event in events:
+        try:
+            os.remove(event.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module spool"""
+
+import os
+
+from backupctl import spool
+
+ENV = {
+    "DIRVISH_SERVER": "backup.example.com",
+    "DIRVISH_CLIENT": "www.example.com",
+    "DIRVISH_IMAGE": "www.example.com:default:2024-01-01",
+    "HOME": "/root",
+}
+
+
+def test_write_read(tmp_path):
+    directory = str(tmp_path / "spool")
+    first = spool.write(directory, "start", ENV)
+    second = spool.write(directory, "end", dict(ENV, DIRVISH_STATUS="success"))
+    assert os.listdir(os.path.join(directory, "tmp")) == []
+    # written but not yet renamed into the spool
+    with open(os.path.join(directory, "tmp", "partial"), "w") as f:
+        f.write("{")
+    with open(os.path.join(directory, "broken.json"), "w") as f:
+        f.write("{")
+
+    events = spool.read(directory)
+    assert [event.path for event in events] == [first, second]
+    assert events[0].record["trigger"] == "start"
+    assert events[0].record["pid"] == os.getpid()
+    assert "HOME" not in events[0].record["env"]
+    assert events[1].record["env"]["DIRVISH_STATUS"] == "success"
+
+    spool.remove(events)
+    spool.remove(events)
+    assert [event.path for event in spool.read(directory)] == []
+    assert spool.read(str(tmp_path / "missing")) == []
+
+
+def test_event_key(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool.write(directory, "end", ENV)
+    spool.write(directory, "end", ENV)
+    spool.write(directory, "start", ENV)
+    spool.write(directory, "end", dict(ENV, DIRVISH_IMAGE=None))
+    keys = [spool.event_key(event.record) for event in spool.read(directory)]
+    assert keys[0] == keys[1]
+    assert keys[0] == "end:backup.example.com:www.example.com:{0}".format(
+        ENV["DIRVISH_IMAGE"]
+    )
+    assert keys[2] != keys[0]
+    assert keys[3] == os.path.basename(spool.read(directory)[3].path)[:-5]
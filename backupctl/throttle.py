@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket shared by several threads.
+
+    :ivar float rate:   Tokens added per second, None for no limit.
+    :ivar float burst:  Maximum number of tokens saved up.
+    :ivar clock:        Function returning the current time in seconds.
+    :ivar sleep:        Function waiting for a number of seconds.
+    """
+
+    def __init__(self, rate=None, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate or 0, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Take tokens from the bucket, wait until there are enough.
+
+        Amounts bigger than the burst size are allowed and leave the bucket
+        in debt, which later calls have to wait for.
+
+        :param float amount:    Number of tokens, e.g. operations or bytes.
+
+        :returns: Number of seconds waited.
+        :rtype: float
+        """
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module throttle"""
+
+import pytest
+
+from backupctl import throttle
+
+
+class Clock:
+    """Time which only passes while sleeping."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter_unlimited():
+    limiter = throttle.RateLimiter()
+    assert limiter.acquire(1000) == 0.0
+
+
+def test_rate_limiter_burst():
+    clock = Clock()
+    limiter = throttle.RateLimiter(rate=100, burst=2, clock=clock, sleep=clock.sleep)
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == pytest.approx(0.01)
+    assert clock.waits == [pytest.approx(0.01)]
+    # the bucket refills while the time passes
+    clock.now += 1
+    assert limiter.acquire(2) == 0.0
+
+
+def test_rate_limiter_debt():
+    clock = Clock()
+    limiter = throttle.RateLimiter(rate=100, burst=1, clock=clock, sleep=clock.sleep)
+    assert limiter.acquire(3) == pytest.approx(0.02)
+    assert limiter.acquire() == pytest.approx(0.01)
+    assert clock.waits == [pytest.approx(0.02), pytest.approx(0.01)]
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from backupctl import database, throttle, zfs
+
+logger = logging.getLogger(__name__)
+Base = declarative_base()
+
+NAMESPACE = "backupctl-trash"
+
+
+class TrashEntry(Base):
+    __tablename__ = "trash"
+
+    id = Column(Integer, primary_key=True)
+    datetime = Column(DateTime)
+    customer = Column(String)
+    vault = Column(String)
+    dataset = Column(String)
+    trash_dataset = Column(String)
+    mountpoints = Column(String)
+    state = Column(String)
+    reaped = Column(DateTime)
+
+    def __repr__(self):
+        return "<Entry(id='{0}')>".format(self.id)
+
+
+def namespace(pool):
+    """Get the file system holding the trashed file systems of a pool.
+
+    :param string pool: zfs pool name.
+
+    :rtype: string
+    """
+    return os.path.join(pool, NAMESPACE)
+
+
+def is_trash(pool, fs):
+    """Check if a file system is the trash namespace or inside of it.
+
+    :param string pool: zfs pool name.
+    :param string fs:   zfs file system.
+
+    :rtype: bool
+    """
+    trash = namespace(pool)
+    return fs == trash or fs.startswith(trash + "/")
+
+
+class Trash:
+    """Move removed file systems to a trash namespace and destroy them later.
+
+    Renaming a file system is done in constant time, while destroying a file
+    system with years of hardlinked dirvish images can block the pool for
+    minutes. Removed file systems are therefore unmounted and renamed to
+    ``<pool>/backupctl-trash/<id>``. They can be restored until they are
+    destroyed by `reap`.
+
+    :ivar sqlalchemy.engine.base.Engine engine: SQLAlchemy engine.
+
+    :raises sqlalchemy.exc.ArgumentError: Raised when an invalid or conflicting
+                                          function argument is supplied.
+    :raises sqlalchemy.exc.OperationalError: Wraps a DB-API OperationalError.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._lock = threading.Lock()
+        Base.metadata.create_all(engine)
+
+    def move(self, inventory, customer, vault=None):
+        """Move a customer or vault to the trash.
+
+        :param zfs.Inventory inventory: Inventory of the pool.
+        :param string customer:         Customer name.
+        :param string vault:            Vault name or server hostname.
+
+        :returns: The trash entry or None if the file system couldn't be
+                  moved.
+        :rtype: `trash.TrashEntry`
+        """
+        pool = inventory.pool
+        if vault:
+            fs = os.path.join(pool, customer, vault)
+        else:
+            fs = os.path.join(pool, customer)
+        if not inventory.exists(fs):
+            logger.error('zfs file system "{0}" does not exist'.format(fs))
+            return None
+        # several file systems can be moved at the same time
+        with self._lock:
+            if not inventory.exists(namespace(pool)) and not zfs.new_filesystem(
+                namespace(pool), inventory=inventory
+            ):
+                return None
+        mountpoints = {
+            dataset.name[len(fs) :]: dataset.mountpoint
+            for dataset in inventory.datasets(fs)
+            if dataset.mountpoint is not None
+        }
+
+        # the entry is committed before zfs is touched, so a renamed file
+        # system always has a row, even if the calling command rolls back or
+        # the process dies before the state is set (see recover), and no
+        # database lock is held while zfs renames
+        with database.session_scope(self._engine, separate=True) as session:
+            entry = TrashEntry(
+                datetime=datetime.now(),
+                customer=str(customer),
+                vault=str(vault) if vault else None,
+                dataset=fs,
+                mountpoints=json.dumps(mountpoints, sort_keys=True),
+                state="pending",
+            )
+            session.add(entry)
+            session.flush()
+            entry.trash_dataset = os.path.join(namespace(pool), str(entry.id))
+
+        if self._rename(inventory, entry, mountpoints):
+            state = "trashed"
+            logger.info('moved "{0}" to trash "{1}"'.format(fs, entry.trash_dataset))
+        else:
+            state = None
+        with database.session_scope(self._engine, separate=True) as session:
+            entry = session.merge(entry)
+            if state is None:
+                session.delete(entry)
+                return None
+            entry.state = state
+        return entry
+
+    def _rename(self, inventory, entry, mountpoints):
+        if inventory.exists(entry.trash_dataset):
+            logger.error(
+                'zfs file system "{0}" already exists'.format(entry.trash_dataset)
+            )
+            return False
+        # unmount first, otherwise the renamed file systems would keep their
+        # mountpoints and block a new customer or vault with the same name
+        unmounted = []
+        for suffix in sorted(mountpoints, reverse=True):
+            if not zfs.set_mountpoint(entry.dataset + suffix, inventory=inventory):
+                break
+            unmounted.append(suffix)
+        if len(unmounted) == len(mountpoints) and zfs.rename_filesystem(
+            entry.dataset, entry.trash_dataset, inventory=inventory
+        ):
+            return True
+        for suffix in unmounted:
+            zfs.set_mountpoint(
+                entry.dataset + suffix, mountpoints[suffix], inventory=inventory
+            )
+        return False
+
+    def recover(self, inventory, min_age=60):
+        """Finish the moves which were interrupted between the rename and
+        the commit of their state. Pending entries whose file system is in the
+        trash become trashed, the others are deleted.
+
+        :param zfs.Inventory inventory: Inventory of the pool.
+        :param float min_age:           Seconds a pending entry is left alone,
+                                        as it may belong to a running move.
+
+        :returns: Number of entries which became trashed.
+        :rtype: int
+        """
+        cutoff = datetime.now() - timedelta(seconds=min_age)
+        recovered = 0
+        with database.session_scope(self._engine, separate=True) as session:
+            query = self._query(session, "pending", None).filter(
+                TrashEntry.datetime <= cutoff
+            )
+            for entry in query:
+                if not entry.trash_dataset.startswith(namespace(inventory.pool) + "/"):
+                    continue
+                if inventory.exists(entry.trash_dataset):
+                    entry.state = "trashed"
+                    recovered += 1
+                    logger.info(
+                        'recovered "{0}" in trash "{1}"'.format(
+                            entry.dataset, entry.trash_dataset
+                        )
+                    )
+                else:
+                    session.delete(entry)
+        return recovered
+
+    def entries(self, state="trashed", customer=None, vault=None):
+        """List the trash entries.
+
+        :param string state:    Only entries in this state ("pending",
+                                "trashed", "restored" or "reaped"), None for
+                                all.
+        :param string customer: Only entries of this customer.
+        :param string vault:    Only entries of this vault.
+
+        :returns: Trash entries, oldest first.
+        :rtype: `list` of `trash.TrashEntry`
+        """
+        with database.session_scope(self._engine) as session:
+            query = self._query(session, state, customer)
+            if vault is not None:
+                query = query.filter(TrashEntry.vault == str(vault))
+            return query.order_by(TrashEntry.datetime, TrashEntry.id).all()
+
+    def _query(self, session, state, customer):
+        query = session.query(TrashEntry)
+        if state is not None:
+            query = query.filter(TrashEntry.state == state)
+        if customer is not None:
+            query = query.filter(TrashEntry.customer == str(customer))
+        return query
+
+    def restore(self, inventory, customer, vault=None):
+        """Restore the most recently trashed file system of a customer or
+        vault, including its mountpoints.
+
+        :param zfs.Inventory inventory: Inventory of the pool.
+        :param string customer:         Customer name.
+        :param string vault:            Vault name or server hostname.
+
+        :returns: The restored trash entry or None if nothing was restored.
+        :rtype: `trash.TrashEntry`
+        """
+        self.recover(inventory)
+        with database.session_scope(self._engine) as session:
+            query = self._query(session, "trashed", customer)
+            if vault:
+                query = query.filter(TrashEntry.vault == str(vault))
+            else:
+                # a whole customer is trashed without a vault
+                query = query.filter(TrashEntry.vault.is_(None))
+            entry = query.order_by(
+                TrashEntry.datetime.desc(), TrashEntry.id.desc()
+            ).first()
+            if entry is None:
+                logger.error(
+                    'nothing in trash for customer "{0}" vault "{1}"'.format(
+                        customer, vault
+                    )
+                )
+                return None
+            if inventory.exists(entry.dataset):
+                logger.error(
+                    'zfs file system "{0}" already exists'.format(entry.dataset)
+                )
+                return None
+            if not zfs.rename_filesystem(
+                entry.trash_dataset, entry.dataset, inventory=inventory
+            ):
+                return None
+            for suffix, mountpoint in sorted(json.loads(entry.mountpoints).items()):
+                zfs.set_mountpoint(
+                    entry.dataset + suffix, mountpoint, inventory=inventory
+                )
+            entry.state = "restored"
+        return entry
+
+    def reap(
+        self,
+        pool,
+        jobs=1,
+        rate=None,
+        max_freeing=None,
+        interval=10,
+        callback=None,
+    ):
+        """Destroy all trashed file systems.
+
+        :param string pool:         zfs pool name.
+        :param int jobs:            Number of file systems destroyed in
+                                    parallel.
+        :param float rate:          Maximum number of destroys started per
+                                    second, None for no limit.
+        :param int max_freeing:     Don't start a destroy while the pool has
+                                    more bytes than this left to free.
+        :param float interval:      Seconds between checks of the freeing
+                                    property.
+        :param callback:            Called with the trash entry and a success
+                                    flag after each destroy.
+
+        :returns: Number of destroyed and number of failed file systems.
+        :rtype: `tuple` (int, int)
+        """
+        entries = [
+            entry
+            for entry in self.entries()
+            if entry.trash_dataset.startswith(namespace(pool) + "/")
+        ]
+        limiter = throttle.RateLimiter(rate)
+
+        def destroy(entry):
+            limiter.acquire()
+            if max_freeing is not None:
+                self.wait_freeing(pool, max_freeing, interval)
+            return zfs.destroy_filesystem(entry.trash_dataset)
+
+        reaped = 0
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(destroy, entry): entry for entry in entries}
+            for future in concurrent.futures.as_completed(futures):
+                entry = futures[future]
+                ok = future.result()
+                # each destroy is recorded at once, together with what the
+                # callback writes, e.g. the history entry
+                with database.session_scope(self._engine) as session:
+                    if ok:
+                        entry = session.merge(entry)
+                        entry.state = "reaped"
+                        entry.reaped = datetime.now()
+                        reaped += 1
+                    else:
+                        failed += 1
+                    if callback is not None:
+                        callback(entry, ok)
+        return (reaped, failed)
+
+    def orphans(self, inventory):
+        """List the file systems in the trash namespace without a trashed
+        entry, which `reap` doesn't destroy. Interrupted moves are recovered
+        first, see `recover`.
+
+        :param zfs.Inventory inventory: Inventory of the pool.
+
+        :returns: Names of the file systems, sorted.
+        :rtype: `list` of string
+        """
+        trash = namespace(inventory.pool)
+        if not inventory.exists(trash):
+            return []
+        self.recover(inventory)
+        trashed = {entry.trash_dataset for entry in self.entries()}
+        return sorted(
+            dataset.name
+            for dataset in inventory.datasets(trash)
+            if dataset.name.count("/") == trash.count("/") + 1
+            and dataset.name not in trashed
+        )
+
+    def wait_freeing(self, pool, threshold=0, interval=10, callback=None):
+        """Wait until a zfs pool has freed the space of destroyed datasets.
+
+        :param string pool:         zfs pool name.
+        :param int threshold:       Stop waiting at or below this number of bytes.
+        :param float interval:      Seconds between checks.
+        :param callback:            Called with the bytes left to free after each
+                                    check.
+
+        :returns: Bytes left to free or None if the pool couldn't be checked.
+        :rtype: int
+        """
+        while True:
+            freeing = zfs.pool_freeing(pool)
+            if callback is not None and freeing is not None:
+                callback(freeing)
+            if freeing is None or freeing <= threshold:
+                return freeing
+            time.sleep(interval)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for class trash"""
+
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy
+
+from backupctl import database, history, simulator, trash, zfs
+
+
+@pytest.fixture()
+def sim():
+    pool = simulator.SimulatedPool("backup", size=1 << 40)
+    pool._create("backup/customer1", quota=1 << 30)
+    pool._create(
+        "backup/customer1/www.example.com",
+        mountpoint="/srv/backup/customer1/www.example.com",
+    )
+    pool._create(
+        "backup/customer1/mail.example.com",
+        mountpoint="/srv/backup/customer1/mail.example.com",
+    )
+    pool.write("backup/customer1/www.example.com", 1 << 20)
+    previous = zfs.set_backend(pool)
+    yield pool
+    zfs.set_backend(previous)
+
+
+@pytest.fixture()
+def otrash(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///{0}".format(tmp_path / "trash.db"))
+    return trash.Trash(engine)
+
+
+def test_move_and_restore(sim, otrash):
+    inventory = zfs.Inventory("backup")
+    entry = otrash.move(inventory, "customer1")
+    assert entry.state == "trashed"
+    assert entry.vault is None
+    assert entry.trash_dataset == "backup/backupctl-trash/{0}".format(entry.id)
+    assert not inventory.exists("backup/customer1")
+    fresh = zfs.Inventory("backup")
+    assert fresh.get(entry.trash_dataset + "/www.example.com").mountpoint is None
+    assert fresh.get("backup/backupctl-trash").mountpoint is None
+    assert fresh.usage("backup/backupctl-trash") == 1 << 20
+
+    assert otrash.restore(inventory, "customer1", "www.example.com") is None
+    restored = otrash.restore(inventory, "customer1")
+    assert restored.state == "restored"
+    fresh = zfs.Inventory("backup")
+    assert fresh.get("backup/customer1/www.example.com").mountpoint == (
+        "/srv/backup/customer1/www.example.com"
+    )
+    assert fresh.get("backup/customer1").quota == 1 << 30
+    assert otrash.entries() == []
+
+
+def test_move_missing(sim, otrash):
+    assert otrash.move(zfs.Inventory("backup"), "customer2") is None
+    assert otrash.entries(state=None) == []
+
+
+def test_move_vault_twice(sim, otrash):
+    inventory = zfs.Inventory("backup")
+    first = otrash.move(inventory, "customer1", "www.example.com")
+    zfs.new_filesystem(
+        "backup/customer1/www.example.com",
+        "/srv/backup/customer1/www.example.com",
+        inventory=inventory,
+    )
+    second = otrash.move(inventory, "customer1", "www.example.com")
+    assert first.id != second.id
+    assert otrash.restore(inventory, "customer1", "www.example.com").id == second.id
+    assert otrash.restore(inventory, "customer1", "www.example.com") is None
+
+
+def test_move_commits_entry(sim, otrash):
+    engine = otrash._engine
+    hist = history.History(engine)
+    with pytest.raises(RuntimeError):
+        with database.session_scope(engine):
+            otrash.move(zfs.Inventory("backup"), "customer1", "www.example.com")
+            hist.add("customer1", "trash", "www.example.com")
+            raise RuntimeError("history")
+    # the renamed file system keeps its trash entry, only the history entry
+    # is rolled back
+    [entry] = otrash.entries()
+    assert entry.trash_dataset == "backup/backupctl-trash/1"
+    assert sim._datasets["backup/backupctl-trash/1"]
+    assert hist.entries() == []
+
+    with database.session_scope(engine):
+        entry = otrash.move(zfs.Inventory("backup"), "customer1", "mail.example.com")
+        hist.add("customer1", "trash", "mail.example.com")
+    assert entry.trash_dataset == "backup/backupctl-trash/2"
+    assert len(otrash.entries()) == 2
+    assert len(hist.entries()) == 1
+
+
+def test_move_pending(sim, otrash, mocker):
+    states = []
+
+    def rename(fs, new_fs, inventory=None):
+        states.extend(entry.state for entry in otrash.entries(state=None))
+        return False
+
+    mocker.patch("backupctl.zfs.rename_filesystem", rename)
+    inventory = zfs.Inventory("backup")
+    assert otrash.move(inventory, "customer1", "www.example.com") is None
+    # the entry is committed while zfs renames and removed if it fails
+    assert states == ["pending"]
+    assert otrash.entries(state=None) == []
+    assert inventory.get("backup/customer1/www.example.com").mountpoint == (
+        "/srv/backup/customer1/www.example.com"
+    )
+
+
+def test_recover(sim, otrash):
+    # moves which died between the rename and the commit of their state
+    inventory = zfs.Inventory("backup")
+    zfs.new_filesystem("backup/backupctl-trash", inventory=inventory)
+    assert zfs.rename_filesystem(
+        "backup/customer1/www.example.com",
+        "backup/backupctl-trash/1",
+        inventory=inventory,
+    )
+    old = datetime.now() - timedelta(hours=1)
+    with database.session_scope(otrash._engine) as session:
+        for i, vault, when in [
+            (1, "www.example.com", old),
+            (2, "mail.example.com", old),
+            (3, "mail.example.com", datetime.now()),
+        ]:
+            session.add(
+                trash.TrashEntry(
+                    id=i,
+                    datetime=when,
+                    customer="customer1",
+                    vault=vault,
+                    dataset="backup/customer1/" + vault,
+                    trash_dataset="backup/backupctl-trash/{0}".format(i),
+                    mountpoints="{}",
+                    state="pending",
+                )
+            )
+    assert otrash.orphans(inventory) == []
+    assert [entry.id for entry in otrash.entries()] == [1]
+    # a recent entry may belong to a running move
+    assert [entry.id for entry in otrash.entries(state="pending")] == [3]
+    assert otrash.restore(inventory, "customer1", "www.example.com").id == 1
+    assert inventory.exists("backup/customer1/www.example.com")
+
+
+def test_orphans(sim, otrash):
+    inventory = zfs.Inventory("backup")
+    assert otrash.orphans(inventory) == []
+    entry = otrash.move(inventory, "customer1", "www.example.com")
+    sim._create("backup/backupctl-trash/99")
+    sim._create("backup/backupctl-trash/99/child")
+    inventory = zfs.Inventory("backup")
+    assert otrash.orphans(inventory) == ["backup/backupctl-trash/99"]
+    assert otrash.reap("backup") == (1, 0)
+    assert not zfs.Inventory("backup").exists(entry.trash_dataset)
+    assert zfs.Inventory("backup").exists("backup/backupctl-trash/99")
+
+
+def test_reap(sim, otrash):
+    inventory = zfs.Inventory("backup")
+    otrash.move(inventory, "customer1", "www.example.com")
+    otrash.move(inventory, "customer1", "mail.example.com")
+    reaped = []
+    assert otrash.reap(
+        "backup",
+        jobs=2,
+        rate=1000,
+        max_freeing=0,
+        interval=0,
+        callback=lambda entry, ok: reaped.append((entry.vault, ok)),
+    ) == (2, 0)
+    assert sorted(reaped) == [("mail.example.com", True), ("www.example.com", True)]
+    assert sim.calls["destroy"] == 2
+    assert zfs.Inventory("backup").datasets("backup/backupctl-trash") == [
+        zfs.Inventory("backup").get("backup/backupctl-trash")
+    ]
+    assert zfs.filesystem_usage("backup") == 0
+    assert otrash.entries() == []
+    assert len(otrash.entries(state="reaped")) == 2
+    assert otrash.reap("backup") == (0, 0)
+
+
+def test_wait_freeing(mocker, otrash):
+    freeing = iter([2048, 1024, 0])
+    mocker.patch("backupctl.zfs.pool_freeing", lambda pool: next(freeing))
+    progress = []
+    assert otrash.wait_freeing("backup", interval=0, callback=progress.append) == 0
+    assert progress == [2048, 1024, 0]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Parallel removal of directory trees.
+
+Dirvish images are trees in which almost every file is a hardlink to the
+previous image, so removing them costs one unlink per inode and hardly any
+data. `Remover` spreads the directories over a pool of threads: every thread
+works depth-first on its own deque and steals the oldest (highest up)
+directories of other threads when it runs out of work, which keeps all
+threads busy even when the trees are very unbalanced.
+"""
+
+import collections
+import logging
+import os
+import random
+import stat
+import threading
+import time
+
+from backupctl import throttle
+
+logger = logging.getLogger(__name__)
+
+RemoveStats = collections.namedtuple(
+    "RemoveStats", ["files", "directories", "freed", "errors", "seconds"]
+)
+
+
+class _Directory:
+    __slots__ = ("path", "parent", "pending")
+
+    def __init__(self, path, parent):
+        self.path = path
+        self.parent = parent
+        # the scan of the directory itself plus its unfinished subdirectories
+        self.pending = 1
+
+
+class Remover:
+    """Remove directory trees with a work-stealing pool of threads.
+
+    :ivar int jobs:         Number of threads.
+    :ivar float rate:       Maximum number of unlinks per second, None for no
+                            limit.
+    :ivar float interval:   Seconds between calls of the progress callback.
+    """
+
+    def __init__(self, jobs=8, rate=None, interval=10):
+        self.jobs = max(int(jobs), 1)
+        self.rate = rate
+        self.interval = interval
+        self._limiter = throttle.RateLimiter(rate)
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+
+    def remove(self, paths, progress=None):
+        """Remove directory trees and everything in them.
+
+        Files of which this was the last link are counted as freed, with the
+        space allocated for them. Links to the same file removed at the same
+        time by two threads may not be counted.
+
+        :param list paths:  Directories to remove.
+        :param progress:    Called with the `walk.RemoveStats` so far every
+                            ``interval`` seconds.
+
+        :returns: Statistics of the removal.
+        :rtype: `walk.RemoveStats`
+        """
+        started = time.monotonic()
+        self._deques = [collections.deque() for i in range(self.jobs)]
+        self._outstanding = 0
+        self._counts = [[0, 0, 0, 0] for i in range(self.jobs)]
+        for i, path in enumerate(paths):
+            self._deques[i % self.jobs].append(_Directory(path, None))
+            self._outstanding += 1
+        threads = [
+            threading.Thread(target=self._worker, args=(i,), daemon=True)
+            for i in range(self.jobs)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.interval)
+                if progress is not None and thread.is_alive():
+                    progress(self._stats(started))
+        return self._stats(started)
+
+    def _stats(self, started):
+        files, directories, freed, errors = (sum(c) for c in zip(*self._counts))
+        return RemoveStats(
+            files, directories, freed, errors, time.monotonic() - started
+        )
+
+    def _next(self, index):
+        with self._work:
+            while True:
+                if self._deques[index]:
+                    return self._deques[index].pop()
+                victims = [d for d in self._deques if d]
+                if victims:
+                    return random.choice(victims).popleft()
+                if self._outstanding == 0:
+                    self._work.notify_all()
+                    return None
+                self._work.wait()
+
+    def _worker(self, index):
+        counts = self._counts[index]
+        while True:
+            directory = self._next(index)
+            if directory is None:
+                return
+            subdirectories = self._scan(directory, counts)
+            with self._work:
+                directory.pending += len(subdirectories)
+                self._deques[index].extend(subdirectories)
+                self._outstanding += len(subdirectories)
+                if subdirectories:
+                    self._work.notify_all()
+            self._finish(directory, counts)
+
+    def _scan(self, directory, counts):
+        subdirectories = []
+        try:
+            entries = list(os.scandir(directory.path))
+        except OSError as e:
+            logger.error("couldn't read {0}: {1}".format(directory.path, e))
+            counts[3] += 1
+            return subdirectories
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(_Directory(entry.path, directory))
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                self._limiter.acquire()
+                os.unlink(entry.path)
+            except OSError as e:
+                logger.error("couldn't remove {0}: {1}".format(entry.path, e))
+                counts[3] += 1
+                continue
+            counts[0] += 1
+            if st.st_nlink == 1 and not stat.S_ISLNK(st.st_mode):
+                counts[2] += st.st_blocks * 512
+        # the thread goes on with the first subdirectory, the others are left
+        # at the stealing end of its deque
+        subdirectories.reverse()
+        return subdirectories
+
+    def _finish(self, directory, counts):
+        while directory is not None:
+            with self._work:
+                directory.pending -= 1
+                if directory.pending > 0:
+                    return
+                self._outstanding -= 1
+                if self._outstanding == 0:
+                    self._work.notify_all()
+            try:
+                os.rmdir(directory.path)
+                counts[1] += 1
+            except OSError as e:
+                logger.error("couldn't remove {0}: {1}".format(directory.path, e))
+                counts[3] += 1
+            directory = directory.parent
+
+
+def remove_trees(paths, jobs=8, rate=None, interval=10, progress=None):
+    """Remove directory trees in parallel, see `Remover`.
+
+    :param list paths:      Directories to remove.
+    :param int jobs:        Number of threads.
+    :param float rate:      Maximum number of unlinks per second.
+    :param float interval:  Seconds between calls of the progress callback.
+    :param progress:        Called with the `walk.RemoveStats` so far.
+
+    :rtype: `walk.RemoveStats`
+    """
+    return Remover(jobs, rate, interval).remove(paths, progress)
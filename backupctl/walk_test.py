@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""Test for module walk"""
+
+import os
+
+import pytest
+
+from backupctl import walk
+
+
+def make_images(path, images=3, directories=5, files=4):
+    first = os.path.join(path, "image0")
+    for d in range(directories):
+        sub = os.path.join(first, "dir{0}".format(d), "sub")
+        os.makedirs(sub)
+        for f in range(files):
+            with open(os.path.join(sub, "file{0}".format(f)), "wb") as out:
+                out.write(b"x" * 4096)
+        os.symlink("sub/file0", os.path.join(first, "dir{0}".format(d), "link"))
+    for i in range(1, images):
+        for dirpath, dirnames, filenames in os.walk(first):
+            target = os.path.join(path, "image{0}".format(i))
+            target = os.path.join(target, os.path.relpath(dirpath, first))
+            os.makedirs(target, exist_ok=True)
+            for filename in filenames:
+                src = os.path.join(dirpath, filename)
+                dst = os.path.join(target, filename)
+                if os.path.islink(src):
+                    os.symlink(os.readlink(src), dst)
+                else:
+                    os.link(src, dst)
+    return [os.path.join(path, "image{0}".format(i)) for i in range(images)]
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_remove_trees(tmp_path, jobs):
+    paths = make_images(str(tmp_path))
+    stats = walk.remove_trees(paths, jobs=jobs)
+    assert os.listdir(str(tmp_path)) == []
+    # 5 directories with 4 files and a symlink in each image
+    assert stats.files == 3 * 5 * 5
+    # image, 5 directories and 5 subdirectories
+    assert stats.directories == 3 * 11
+    assert stats.errors == 0
+    assert stats.freed >= 5 * 4 * 4096
+
+
+def test_remove_trees_keeps_shared_files(tmp_path):
+    paths = make_images(str(tmp_path))
+    stats = walk.remove_trees(paths[:2], jobs=2)
+    assert stats.freed == 0
+    assert os.listdir(str(tmp_path)) == ["image2"]
+
+
+def test_remove_trees_missing(tmp_path):
+    stats = walk.remove_trees([str(tmp_path / "missing")])
+    assert stats.errors == 2
+
+
+def test_remove_trees_progress(tmp_path):
+    # 142 unlinks with a burst of 100 and 100 unlinks/s take 0.42s
+    paths = make_images(str(tmp_path), images=1, directories=2, files=70)
+    reports = []
+    stats = walk.Remover(jobs=2, rate=100, interval=0.05).remove(
+        paths, progress=reports.append
+    )
+    assert stats.seconds >= 0.3
+    assert reports
+    assert reports[-1].files <= stats.files
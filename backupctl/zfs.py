@@ -1,13 +1,77 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import collections
 import logging
+import os
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Prefix of errors raised by our channel programs, used to tell a refused
+# change apart from a zfs without channel program support.
+CHANNEL_PROGRAM_ERROR = "backupctl:"
 
-def new_filesystem(fs, path=None, size=None, compression=True):
+CHANNEL_PROGRAM = """\
+-- generated by backupctl, all checks see the same transaction group
+local quotas = {{
+{quotas}
+}}
+local properties = {{
+{properties}
+}}
+for fs, props in pairs(quotas) do
+    local quota = props["quota"]
+    if quota ~= "0" then
+        local used = zfs.get_prop(fs, "used")
+        if tonumber(quota) < used then
+            error(string.format(
+                "{error} %s: new quota %s is smaller than used size %d",
+                fs, quota, used))
+        end
+    end
+end
+for fs, props in pairs(properties) do
+    for prop, value in pairs(props) do
+        local err = zfs.check.set_prop(fs, prop, value)
+        if err ~= 0 then
+            error(string.format(
+                "{error} %s: can't set %s=%s (error %d)", fs, prop, value, err))
+        end
+    end
+end
+for fs, props in pairs(properties) do
+    for prop, value in pairs(props) do
+        zfs.sync.set_prop(fs, prop, value)
+    end
+end
+"""
+
+INVENTORY_PROPERTIES = [
+    "name",
+    "used",
+    "avail",
+    "quota",
+    "refer",
+    "mountpoint",
+    "compressratio",
+]
+
+Dataset = collections.namedtuple("Dataset", INVENTORY_PROPERTIES)
+
+Property = collections.namedtuple("Property", ["name", "property", "value"])
+
+SNAPSHOT_PROPERTIES = ["name", "used", "refer", "creation"]
+
+Snapshot = collections.namedtuple("Snapshot", SNAPSHOT_PROPERTIES)
+
+
+def new_filesystem(fs, path=None, size=None, compression=True, inventory=None):
     """Create a new zfs file system. The file system is automatically mounted
     according to the path property.
 
@@ -16,10 +80,26 @@ def new_filesystem(fs, path=None, size=None, compression=True):
     :param string size:         Size in a human readable format.
     :param bool compression:    Option to enable or disable the zfs internal
                                 compression.
+    :param Inventory inventory: Optional inventory used to check if the file
+                                system already exists.
 
     :returns: True if the file system was created correctly, else False.
     :rtype: bool
     """
+    if inventory is not None and inventory.exists(fs):
+        logger.error('zfs file system "{0}" already exists'.format(fs))
+        return False
+    returncode, stdout, stderr = execute_cmd(
+        _new_filesystem_cmd(fs, path, size, compression)
+    )
+    if not _new_filesystem_done(fs, returncode, stderr):
+        return False
+    if inventory is not None:
+        inventory.add(fs, quota=size, mountpoint=path)
+    return True
+
+
+def _new_filesystem_cmd(fs, path, size, compression):
     if compression:
         compression = "compression=on"
     else:
@@ -30,12 +110,14 @@ def new_filesystem(fs, path=None, size=None, compression=True):
         size = []
     if path is None:
         path = "none"
-
-    returncode, stdout, stderr = execute_cmd(
+    return (
         ["zfs", "create", "-o", compression, "-o", "dedup=off"]
         + size
         + ["-o", "mountpoint={0}".format(path), "{0}".format(fs)]
     )
+
+
+def _new_filesystem_done(fs, returncode, stderr):
     if returncode == 0:
         logger.info('created zfs file system "{0}" successfully'.format(fs))
         return True
@@ -44,25 +126,43 @@ def new_filesystem(fs, path=None, size=None, compression=True):
         return False
 
 
-def resize_filesystem(fs, size):
+def resize_filesystem(fs, size, inventory=None):
     """Set a new zfs file system quota to a present zfs file system.
 
     :param string fs:           zfs file system.
     :param string size:         Size in a human readable format.
+    :param Inventory inventory: Optional inventory to look up the usage in.
 
     :returns: True if the quota was set correctly, else False.
     :rtype: bool
     """
     if size.lower() != "none":
-        usage = filesystem_usage(fs)
-        if usage > parse_size(size):
-            logger.warn(
-                "new size ({0}) is smaller than used size ({1})".format(size, usage)
-            )
+        if not _resize_allowed(size, filesystem_usage(fs, inventory)):
             return False
-    returncode, stdout, stderr = execute_cmd(
-        ["zfs", "set", "quota={0}".format(size), "{0}".format(fs)]
-    )
+    returncode, stdout, stderr = execute_cmd(_resize_filesystem_cmd(fs, size))
+    if not _resize_filesystem_done(fs, size, returncode, stderr):
+        return False
+    if inventory is not None:
+        inventory.update(fs, quota=size)
+    return True
+
+
+def _resize_allowed(size, usage):
+    if usage is None:
+        return False
+    if usage > parse_size(size):
+        logger.warn(
+            "new size ({0}) is smaller than used size ({1})".format(size, usage)
+        )
+        return False
+    return True
+
+
+def _resize_filesystem_cmd(fs, size):
+    return ["zfs", "set", "quota={0}".format(size), "{0}".format(fs)]
+
+
+def _resize_filesystem_done(fs, size, returncode, stderr):
     if returncode == 0:
         logger.info(
             'set zfs file system quota for "{0}" to {1} successfully'.format(fs, size)
@@ -75,19 +175,35 @@ def resize_filesystem(fs, size):
         return False
 
 
-def remove_filesystem(fs):
+def remove_filesystem(fs, inventory=None):
     """Remove an existing zfs file system. The file system is automatically
     unmounted.
 
-    :param string fs:   zfs file system.
+    :param string fs:           zfs file system.
+    :param Inventory inventory: Optional inventory to remove the file system
+                                from.
 
     :returns: True if the file system was removed correctly, else False.
     :rtype: bool
     """
-    execute_cmd(["zfs", "set", "mountpoint=none", "{0}".format(fs)])
-    returncode, stdout, stderr = execute_cmd(
-        ["zfs", "destroy", "-r", "-f", "{0}".format(fs)]
+    unmount_cmd, destroy_cmd = _remove_filesystem_cmds(fs)
+    execute_cmd(unmount_cmd)
+    returncode, stdout, stderr = execute_cmd(destroy_cmd)
+    if not _remove_filesystem_done(fs, returncode, stderr):
+        return False
+    if inventory is not None:
+        inventory.discard(fs)
+    return True
+
+
+def _remove_filesystem_cmds(fs):
+    return (
+        ["zfs", "set", "mountpoint=none", "{0}".format(fs)],
+        ["zfs", "destroy", "-r", "-f", "{0}".format(fs)],
     )
+
+
+def _remove_filesystem_done(fs, returncode, stderr):
     if returncode == 0:
         logger.info('destroyed zfs file system "{0}" successfully'.format(fs))
         return True
@@ -96,17 +212,31 @@ def remove_filesystem(fs):
         return False
 
 
-def filesystem_usage(fs):
+def filesystem_usage(fs, inventory=None):
     """Get the usage of a filesystem.
 
-    :param string fs:   zfs file system.
+    :param string fs:           zfs file system.
+    :param Inventory inventory: Optional inventory to look up the usage in,
+                                instead of asking zfs.
 
     :returns: Number of used bytes or None if an error occured.
     :rtype: int
     """
-    returncode, stdout, stderr = execute_cmd(
-        ["zfs", "get", "-H", "-o", "value", "-p", "used", "{0}".format(fs)]
-    )
+    if inventory is not None:
+        usage = inventory.usage(fs)
+        if usage is None:
+            logger.error('zfs file system "{0}" does not exist'.format(fs))
+        return usage
+    stream = stream_cmd(_filesystem_usage_cmd(fs))
+    stdout = "\n".join(stream)
+    return _filesystem_usage_done(fs, stream.returncode, stdout, stream.stderr)
+
+
+def _filesystem_usage_cmd(fs):
+    return ["zfs", "get", "-H", "-o", "value", "-p", "used", "{0}".format(fs)]
+
+
+def _filesystem_usage_done(fs, returncode, stdout, stderr):
     try:
         usage = int(stdout)
     except ValueError as e:
@@ -116,17 +246,834 @@ def filesystem_usage(fs):
         logger.info('file system "{0}" use {1}B data'.format(fs, usage))
         return usage
     else:
-        logger.error('destroy zfs file system "{0}" failed: {1}'.format(fs, stderr))
+        logger.error(
+            'get usage of zfs file system "{0}" failed: {1}'.format(fs, stderr)
+        )
+        return None
+
+
+def rename_filesystem(fs, new_fs, inventory=None):
+    """Rename a zfs file system, together with all its descendants. This
+    doesn't touch the data and is done in constant time.
+
+    :param string fs:           zfs file system.
+    :param string new_fs:       New name of the zfs file system.
+    :param Inventory inventory: Optional inventory to update.
+
+    :returns: True if the file system was renamed correctly, else False.
+    :rtype: bool
+    """
+    returncode, stdout, stderr = execute_cmd(
+        ["zfs", "rename", "{0}".format(fs), "{0}".format(new_fs)]
+    )
+    if returncode == 0:
+        logger.info('renamed zfs file system "{0}" to "{1}"'.format(fs, new_fs))
+        if inventory is not None:
+            inventory.rename(fs, new_fs)
+        return True
+    else:
+        logger.error('rename zfs file system "{0}" failed: {1}'.format(fs, stderr))
+        return False
+
+
+def set_mountpoint(fs, path=None, inventory=None):
+    """Set the mountpoint of a zfs file system, which mounts or unmounts it.
+
+    :param string fs:           zfs file system.
+    :param string path:         Mountpoint, None to unmount.
+    :param Inventory inventory: Optional inventory to update.
+
+    :returns: True if the mountpoint was set correctly, else False.
+    :rtype: bool
+    """
+    if path is None:
+        path = "none"
+    returncode, stdout, stderr = execute_cmd(
+        ["zfs", "set", "mountpoint={0}".format(path), "{0}".format(fs)]
+    )
+    if returncode == 0:
+        if inventory is not None:
+            inventory.update(fs, mountpoint=path)
+        return True
+    else:
+        logger.error(
+            'set mountpoint of zfs file system "{0}" failed: {1}'.format(fs, stderr)
+        )
+        return False
+
+
+def destroy_filesystem(fs, inventory=None):
+    """Destroy a zfs file system and all its descendants, without unmounting
+    it first like `remove_filesystem` does.
+
+    :param string fs:           zfs file system.
+    :param Inventory inventory: Optional inventory to update.
+
+    :returns: True if the file system was destroyed correctly, else False.
+    :rtype: bool
+    """
+    returncode, stdout, stderr = execute_cmd(_remove_filesystem_cmds(fs)[1])
+    if not _remove_filesystem_done(fs, returncode, stderr):
+        return False
+    if inventory is not None:
+        inventory.discard(fs)
+    return True
+
+
+def pool_freeing(pool):
+    """Get the number of bytes a zfs pool still has to free from destroyed
+    datasets in the background.
+
+    :param string pool: zfs pool name.
+
+    :returns: Number of bytes or None if an error occured.
+    :rtype: int
+    """
+    returncode, stdout, stderr = execute_cmd(
+        ["zpool", "get", "-H", "-p", "-o", "value", "freeing", "{0}".format(pool)]
+    )
+    try:
+        freeing = int(stdout)
+    except ValueError as e:
+        logger.error('zpool get freeing of "{0}" failed: {1}'.format(pool, stderr))
+        return None
+    return freeing
+
+
+def new_snapshot(fs, name):
+    """Take a snapshot of a zfs file system.
+
+    :param string fs:   zfs file system.
+    :param string name: Snapshot name, e.g. the dirvish image.
+
+    :returns: The full snapshot name ``fs@name`` or None if an error occured.
+    :rtype: string
+    """
+    snapshot = "{0}@{1}".format(fs, name)
+    returncode, stdout, stderr = execute_cmd(["zfs", "snapshot", snapshot])
+    if returncode == 0:
+        logger.info('created zfs snapshot "{0}"'.format(snapshot))
+        return snapshot
+    else:
+        logger.error('create zfs snapshot "{0}" failed: {1}'.format(snapshot, stderr))
         return None
 
 
+def list_snapshots(fs):
+    """List the snapshots of a zfs file system, oldest first.
+
+    :param string fs:   zfs file system.
+
+    :rtype: `list` of `zfs.Snapshot`
+    """
+    snapshots = []
+    for row in list_records(fs, SNAPSHOT_PROPERTIES, types="snapshot", depth=1):
+        try:
+            name, used, refer, creation = row
+            snapshots.append(Snapshot(name, int(used), int(refer), int(creation)))
+        except ValueError as e:
+            logger.warning("ignored zfs snapshot {0!r}: {1}".format(row, e))
+    return sorted(snapshots, key=lambda snapshot: (snapshot.creation, snapshot.name))
+
+
+def destroy_snapshots(fs, names):
+    """Destroy snapshots of a zfs file system with one ``zfs destroy`` call.
+    Destroying a snapshot doesn't depend on the number of files in it.
+
+    :param string fs:   zfs file system.
+    :param list names:  Snapshot names without the file system.
+
+    :returns: True if the snapshots were destroyed correctly, else False.
+    :rtype: bool
+    """
+    if not names:
+        return True
+    snapshots = "{0}@{1}".format(fs, ",".join(names))
+    returncode, stdout, stderr = execute_cmd(["zfs", "destroy", snapshots])
+    if returncode == 0:
+        logger.info('destroyed zfs snapshots "{0}"'.format(snapshots))
+        return True
+    else:
+        logger.error(
+            'destroy zfs snapshots "{0}" failed: {1}'.format(snapshots, stderr)
+        )
+        return False
+
+
+def mount_snapshot(snapshot, path):
+    """Mount a zfs snapshot read-only.
+
+    :param string snapshot: Full snapshot name ``fs@name``.
+    :param string path:     Mountpoint, created if it doesn't exist.
+
+    :returns: True if the snapshot was mounted correctly, else False.
+    :rtype: bool
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+    except OSError as e:
+        logger.error("couldn't create mountpoint {0}: {1}".format(path, e))
+        return False
+    returncode, stdout, stderr = execute_cmd(
+        ["mount", "-t", "zfs", "-o", "ro", "{0}".format(snapshot), path]
+    )
+    if returncode == 0:
+        return True
+    else:
+        logger.error('mount zfs snapshot "{0}" failed: {1}'.format(snapshot, stderr))
+        return False
+
+
+def umount_snapshot(path):
+    """Unmount a zfs snapshot mounted with `mount_snapshot`.
+
+    :param string path: Mountpoint.
+
+    :returns: True if the snapshot was unmounted correctly, else False.
+    :rtype: bool
+    """
+    returncode, stdout, stderr = execute_cmd(["umount", path])
+    if returncode == 0:
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+        return True
+    else:
+        logger.error("unmount {0} failed: {1}".format(path, stderr))
+        return False
+
+
+async def async_new_filesystem(
+    fs, path=None, size=None, compression=True, executor=None
+):
+    """Create a new zfs file system with an `AsyncExecutor`. See
+    `new_filesystem`.
+
+    :param string fs:               zfs file system.
+    :param string path:             Mountpoint to mount the new file system.
+    :param string size:             Size in a human readable format.
+    :param bool compression:        Option to enable or disable the zfs
+                                    internal compression.
+    :param AsyncExecutor executor:  Executor, defaults to `EXECUTOR`.
+
+    :returns: True if the file system was created correctly, else False.
+    :rtype: bool
+    """
+    returncode, stdout, stderr = await (executor or EXECUTOR).run(
+        _new_filesystem_cmd(fs, path, size, compression)
+    )
+    return _new_filesystem_done(fs, returncode, stderr)
+
+
+async def async_resize_filesystem(fs, size, executor=None):
+    """Set a new quota with an `AsyncExecutor`. See `resize_filesystem`.
+
+    :param string fs:               zfs file system.
+    :param string size:             Size in a human readable format.
+    :param AsyncExecutor executor:  Executor, defaults to `EXECUTOR`.
+
+    :returns: True if the quota was set correctly, else False.
+    :rtype: bool
+    """
+    if size.lower() != "none":
+        usage = await async_filesystem_usage(fs, executor)
+        if not _resize_allowed(size, usage):
+            return False
+    returncode, stdout, stderr = await (executor or EXECUTOR).run(
+        _resize_filesystem_cmd(fs, size)
+    )
+    return _resize_filesystem_done(fs, size, returncode, stderr)
+
+
+async def async_remove_filesystem(fs, executor=None):
+    """Remove a zfs file system with an `AsyncExecutor`. See
+    `remove_filesystem`.
+
+    :param string fs:               zfs file system.
+    :param AsyncExecutor executor:  Executor, defaults to `EXECUTOR`.
+
+    :returns: True if the file system was removed correctly, else False.
+    :rtype: bool
+    """
+    executor = executor or EXECUTOR
+    unmount_cmd, destroy_cmd = _remove_filesystem_cmds(fs)
+    await executor.run(unmount_cmd)
+    returncode, stdout, stderr = await executor.run(destroy_cmd)
+    return _remove_filesystem_done(fs, returncode, stderr)
+
+
+async def async_filesystem_usage(fs, executor=None):
+    """Get the usage of a file system with an `AsyncExecutor`. See
+    `filesystem_usage`.
+
+    :param string fs:               zfs file system.
+    :param AsyncExecutor executor:  Executor, defaults to `EXECUTOR`.
+
+    :returns: Number of used bytes or None if an error occured.
+    :rtype: int
+    """
+    returncode, stdout, stderr = await (executor or EXECUTOR).run(
+        _filesystem_usage_cmd(fs)
+    )
+    return _filesystem_usage_done(fs, returncode, stdout, stderr)
+
+
+def set_quotas(quotas, inventory=None, fallback=True):
+    """Set the quotas of several file systems at once. See `set_properties`.
+
+    :param dict quotas:         Sizes in a human readable format or "none" by
+                                zfs file system.
+    :param Inventory inventory: Optional inventory to look up the usage in
+                                for the fallback and to update.
+    :param bool fallback:       Set the quotas one by one if channel programs
+                                are not available.
+
+    :returns: True if all quotas were set, else False.
+    :rtype: bool
+    """
+    properties = {}
+    for fs, size in quotas.items():
+        quota = _parse_quota(size)
+        properties[fs] = {"quota": "0" if quota is None else str(quota)}
+    if not set_properties(properties, inventory=inventory, fallback=fallback):
+        return False
+    if inventory is not None:
+        for fs, size in quotas.items():
+            inventory.update(fs, quota=size)
+    return True
+
+
+def set_properties(properties, inventory=None, fallback=True):
+    """Set properties of several file systems with one zfs channel program
+    per pool. All new quotas are checked against the used size first and the
+    user properties are set in a single transaction group, or nothing is
+    changed. Channel programs can only set user properties, so the other
+    properties, like quotas, are set with one ``zfs set`` per file system
+    after the check, which isn't atomic: their old values are read first and
+    the ones already set are restored if a ``zfs set`` fails.
+
+    If the channel program can't be run, the quotas are checked and all
+    properties are set and restored the same way with ``zfs set`` instead.
+
+    :param dict properties:     Property values by property name by zfs file
+                                system, quotas in bytes.
+    :param Inventory inventory: Optional inventory to look up the usage in
+                                for the fallback.
+    :param bool fallback:       Set the properties one by one if channel
+                                programs are not available.
+
+    :returns: True if all properties were set, else False.
+    :rtype: bool
+    """
+    pools = collections.OrderedDict()
+    for fs in sorted(properties):
+        pools.setdefault(fs.split("/")[0], {})[fs] = properties[fs]
+    success = True
+    for pool, pool_properties in pools.items():
+        native = {}
+        for fs, props in pool_properties.items():
+            values = {
+                prop: value
+                for prop, value in props.items()
+                if not is_user_property(prop)
+            }
+            if values:
+                native[fs] = values
+        if not any(
+            "quota" in props or len(props) > len(native.get(fs, {}))
+            for fs, props in pool_properties.items()
+        ):
+            # nothing to check or to set atomically
+            success = _set_properties_each(native, check=False) and success
+            continue
+        returncode, stdout, stderr = run_channel_program(
+            pool, channel_program(pool_properties)
+        )
+        if returncode == 0:
+            if _set_properties_each(native, check=False):
+                logger.info(
+                    'set properties of {0} file systems in "{1}" '
+                    "successfully".format(len(pool_properties), pool)
+                )
+            else:
+                success = False
+        elif CHANNEL_PROGRAM_ERROR in stderr or not fallback:
+            logger.error(
+                'set properties in "{0}" failed, nothing changed: {1}'.format(
+                    pool, stderr
+                )
+            )
+            success = False
+        else:
+            logger.warning(
+                'channel program in "{0}" failed, set properties one by one: '
+                "{1}".format(pool, stderr)
+            )
+            success = _set_properties_each(pool_properties, inventory) and success
+    return success
+
+
+def is_user_property(prop):
+    """Check if a property is a user property, which zfs channel programs
+    can set.
+
+    :param string prop: Property name.
+
+    :rtype: bool
+    """
+    return ":" in prop
+
+
+def _set_properties_each(properties, inventory=None, check=True):
+    for fs, props in sorted(properties.items()):
+        quota = props.get("quota", "0")
+        if check and quota != "0":
+            usage = filesystem_usage(fs, inventory)
+            if usage is None or usage > int(quota):
+                logger.warning(
+                    "new quota of {0} ({1}) is smaller than used size ({2})".format(
+                        fs, quota, usage
+                    )
+                )
+                return False
+    if not properties:
+        return True
+    old = _current_properties(properties)
+    if old is None:
+        return False
+    applied = []
+    for fs, props in sorted(properties.items()):
+        returncode, stdout, stderr = execute_cmd(
+            ["zfs", "set"]
+            + ["{0}={1}".format(prop, value) for prop, value in sorted(props.items())]
+            + ["{0}".format(fs)]
+        )
+        if returncode != 0:
+            logger.error(
+                'set zfs file system properties for "{0}" failed: {1}'.format(
+                    fs, stderr
+                )
+            )
+            _restore_properties(applied, old)
+            return False
+        applied.append(fs)
+    return True
+
+
+def _current_properties(properties):
+    names = sorted({prop for props in properties.values() for prop in props})
+    returncode, stdout, stderr = execute_cmd(
+        ["zfs", "get", "-H", "-p", "-o", "name,property,value", ",".join(names)]
+        + sorted(properties)
+    )
+    if returncode != 0:
+        logger.error("get zfs properties to restore failed: {0}".format(stderr))
+        return None
+    current = {}
+    for line in stdout.splitlines():
+        try:
+            name, prop, value = line.split("\t", 2)
+        except ValueError:
+            logger.error("ignore zfs get line {0!r}".format(line))
+            continue
+        current.setdefault(name, {})[prop] = value
+    return current
+
+
+def _restore_properties(applied, old):
+    for fs in reversed(applied):
+        for prop, value in sorted(old.get(fs, {}).items()):
+            if value == "-" and is_user_property(prop):
+                command = ["zfs", "inherit", prop, "{0}".format(fs)]
+            else:
+                command = [
+                    "zfs",
+                    "set",
+                    "{0}={1}".format(prop, value),
+                    "{0}".format(fs),
+                ]
+            returncode, stdout, stderr = execute_cmd(command)
+            if returncode == 0:
+                logger.info('restored {0}={1} of "{2}"'.format(prop, value, fs))
+            else:
+                logger.error(
+                    'restore {0}={1} of "{2}" failed: {3}'.format(
+                        prop, value, fs, stderr
+                    )
+                )
+
+
+def channel_program(properties):
+    """Generate a zfs channel program (Lua) which checks the new quotas
+    against the used sizes and sets the user properties atomically. The other
+    properties are left to ``zfs set``.
+
+    :param dict properties: Property values by property name by zfs file
+                            system.
+
+    :returns: Lua script.
+    :rtype: string
+    """
+    quotas = {
+        fs: {"quota": props["quota"]}
+        for fs, props in properties.items()
+        if "quota" in props
+    }
+    user = {}
+    for fs, props in properties.items():
+        values = {
+            prop: value for prop, value in props.items() if is_user_property(prop)
+        }
+        if values:
+            user[fs] = values
+    return CHANNEL_PROGRAM.format(
+        quotas=_lua_table(quotas),
+        properties=_lua_table(user),
+        error=CHANNEL_PROGRAM_ERROR,
+    )
+
+
+def _lua_table(properties):
+    lines = []
+    for fs, props in sorted(properties.items()):
+        values = ", ".join(
+            "[{0}] = {1}".format(_lua_string(prop), _lua_string(value))
+            for prop, value in sorted(props.items())
+        )
+        lines.append("    [{0}] = {{{1}}},".format(_lua_string(fs), values))
+    return "\n".join(lines)
+
+
+def _lua_string(value):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return '"{0}"'.format(value.replace("\n", "\\n"))
+
+
+def run_channel_program(pool, script):
+    """Run a zfs channel program.
+
+    :param string pool:     zfs pool name.
+    :param string script:   Lua script.
+
+    :returns: A tuple of (returncode, stdout, stderr).
+    :rtype: tuple
+    """
+    fd, path = tempfile.mkstemp(prefix="backupctl-", suffix=".lua")
+    try:
+        with os.fdopen(fd, "w") as script_file:
+            script_file.write(script)
+        return execute_cmd(["zfs", "program", "{0}".format(pool), path])
+    finally:
+        os.unlink(path)
+
+
+def list_cmd(fs, properties, types="filesystem", recursive=True, depth=None):
+    """Build a parsable ``zfs list`` command.
+
+    :param string fs:           zfs file system.
+    :param list properties:     Columns to list.
+    :param string types:        Comma separated dataset types, e.g. "all".
+    :param bool recursive:      List all descendants too.
+    :param int depth:           Limit the recursion to this depth.
+
+    :rtype: list
+    """
+    command = ["zfs", "list", "-H", "-p", "-o", ",".join(properties), "-t", types]
+    if depth is not None:
+        command += ["-d", "{0}".format(depth)]
+    elif recursive:
+        command += ["-r"]
+    return command + ["{0}".format(fs)]
+
+
+def list_records(fs, properties, types="filesystem", recursive=True, depth=None):
+    """Yield the rows of ``zfs list`` while zfs is still listing.
+
+    Only one row is held in memory at a time, so even listings with millions
+    of snapshots can be processed. Stopping the iteration early stops zfs.
+
+    :param string fs:           zfs file system.
+    :param list properties:     Columns to list.
+    :param string types:        Comma separated dataset types, e.g. "all".
+    :param bool recursive:      List all descendants too.
+    :param int depth:           Limit the recursion to this depth.
+
+    :returns: Generator of rows with one string per property.
+    :rtype: generator
+    """
+    with stream_cmd(list_cmd(fs, properties, types, recursive, depth)) as stream:
+        for line in stream:
+            yield line.split("\t")
+    if stream.returncode not in (0, None):
+        logger.error('list zfs datasets of "{0}" failed: {1}'.format(fs, stream.stderr))
+
+
+def get_properties(fs, properties, recursive=False, depth=None, types=None):
+    """Yield properties of datasets while ``zfs get`` is still running.
+
+    :param string fs:           zfs dataset.
+    :param list properties:     Property names.
+    :param bool recursive:      Get the properties of all descendants too.
+    :param int depth:           Limit the recursion to this depth.
+    :param string types:        Comma separated dataset types, e.g. "snapshot".
+
+    :returns: Generator of `zfs.Property` with parsable values.
+    :rtype: generator
+    """
+    command = ["zfs", "get", "-H", "-p", "-o", "name,property,value"]
+    if types is not None:
+        command += ["-t", types]
+    if depth is not None:
+        command += ["-d", "{0}".format(depth)]
+    elif recursive:
+        command += ["-r"]
+    command += [",".join(properties), "{0}".format(fs)]
+    with stream_cmd(command) as stream:
+        for line in stream:
+            try:
+                name, prop, value = line.split("\t", 2)
+            except ValueError:
+                logger.error("ignore zfs get line {0!r}".format(line))
+                continue
+            yield Property(name, prop, value)
+    if stream.returncode not in (0, None):
+        logger.error(
+            'get zfs properties of "{0}" failed: {1}'.format(fs, stream.stderr)
+        )
+
+
+class Inventory:
+    """In-memory table of all file systems of a zfs pool.
+
+    The table is read with a single ``zfs list`` call and served from memory
+    until it's older than ``ttl`` seconds. Changes done through the functions
+    of this module are written back to the table, so it stays valid without
+    forking zfs again. The table can be shared by threads.
+
+    :ivar string pool:  zfs pool name.
+    :ivar float ttl:    Number of seconds the table is valid.
+    """
+
+    def __init__(self, pool, ttl=30):
+        self.pool = pool
+        self.ttl = ttl
+        self._datasets = {}
+        self._loaded = None
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        """Read all file systems of the pool into the table.
+
+        :returns: True if the table was read correctly, else False.
+        :rtype: bool
+        """
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        stream = stream_cmd(
+            list_cmd(self.pool, INVENTORY_PROPERTIES, types="filesystem")
+        )
+        datasets = {}
+        for line in stream:
+            try:
+                dataset = parse_dataset(line)
+            except ValueError as e:
+                logger.warning("ignore zfs list line {0!r}: {1}".format(line, e))
+                continue
+            datasets[dataset.name] = dataset
+        if stream.returncode != 0:
+            logger.error(
+                'list zfs file systems of "{0}" failed: {1}'.format(
+                    self.pool, stream.stderr
+                )
+            )
+            return False
+        self._datasets = datasets
+        self._loaded = time.monotonic()
+        logger.info(
+            'read {0} zfs file systems of "{1}"'.format(len(datasets), self.pool)
+        )
+        return True
+
+    def invalidate(self):
+        """Force a refresh on the next lookup."""
+        self._loaded = None
+
+    def _table(self):
+        # callers hold the lock while they use the table
+        if self._loaded is None or time.monotonic() - self._loaded > self.ttl:
+            self._refresh()
+        return self._datasets
+
+    def get(self, fs):
+        """Get a file system.
+
+        :param string fs:   zfs file system.
+
+        :returns: The file system or None if it doesn't exist.
+        :rtype: `zfs.Dataset`
+        """
+        with self._lock:
+            return self._table().get(fs)
+
+    def exists(self, fs):
+        """Check if a file system exists.
+
+        :param string fs:   zfs file system.
+
+        :rtype: bool
+        """
+        with self._lock:
+            return fs in self._table()
+
+    def usage(self, fs):
+        """Get the number of used bytes of a file system.
+
+        :param string fs:   zfs file system.
+
+        :returns: Number of used bytes or None if the file system doesn't
+                  exist.
+        :rtype: int
+        """
+        dataset = self.get(fs)
+        if dataset is None:
+            return None
+        return dataset.used
+
+    def quota(self, fs):
+        """Get the quota of a file system.
+
+        :param string fs:   zfs file system.
+
+        :returns: Quota in bytes or None if no quota is set or the file system
+                  doesn't exist.
+        :rtype: int
+        """
+        dataset = self.get(fs)
+        if dataset is None:
+            return None
+        return dataset.quota
+
+    def datasets(self, fs=None):
+        """List a file system and all its descendants, sorted by name.
+
+        :param string fs:   zfs file system, defaults to the whole pool.
+
+        :rtype: `list` of `zfs.Dataset`
+        """
+        if fs is None:
+            fs = self.pool
+        with self._lock:
+            return [
+                dataset
+                for name, dataset in sorted(self._table().items())
+                if name == fs or name.startswith(fs + "/")
+            ]
+
+    def add(self, fs, quota=None, mountpoint=None):
+        """Add a newly created file system to the table.
+
+        :param string fs:           zfs file system.
+        :param string quota:        Quota in a human readable format.
+        :param string mountpoint:   Mountpoint of the file system.
+        """
+        with self._lock:
+            if self._loaded is None:
+                return
+            self._datasets[fs] = Dataset(
+                name=fs,
+                used=0,
+                avail=None,
+                quota=_parse_quota(quota),
+                refer=0,
+                mountpoint=None if mountpoint in (None, "none") else mountpoint,
+                compressratio=1.0,
+            )
+
+    def update(self, fs, quota=False, mountpoint=False):
+        """Update the quota or mountpoint of a file system in the table.
+
+        :param string fs:           zfs file system.
+        :param string quota:        Quota in a human readable format.
+        :param string mountpoint:   Mountpoint or "none".
+        """
+        with self._lock:
+            dataset = self._datasets.get(fs)
+            if dataset is None:
+                return
+            if quota is not False:
+                dataset = dataset._replace(quota=_parse_quota(quota))
+            if mountpoint is not False:
+                dataset = dataset._replace(
+                    mountpoint=None if mountpoint in (None, "none") else mountpoint
+                )
+            self._datasets[fs] = dataset
+
+    def rename(self, fs, new_fs):
+        """Rename a file system and all its descendants in the table.
+
+        :param string fs:       zfs file system.
+        :param string new_fs:   New name of the zfs file system.
+        """
+        with self._lock:
+            for name in list(self._datasets):
+                if name == fs or name.startswith(fs + "/"):
+                    dataset = self._datasets.pop(name)
+                    new_name = new_fs + name[len(fs) :]
+                    self._datasets[new_name] = dataset._replace(name=new_name)
+
+    def discard(self, fs):
+        """Remove a file system and all its descendants from the table.
+
+        :param string fs:   zfs file system.
+        """
+        with self._lock:
+            for name in list(self._datasets):
+                if name == fs or name.startswith(fs + "/"):
+                    del self._datasets[name]
+
+
+def parse_dataset(line):
+    """Parse a line of ``zfs list -H -p -o`` output with the columns of
+    `INVENTORY_PROPERTIES`.
+
+    :param string line: Tab separated line.
+
+    :returns: Parsed file system.
+    :rtype: `zfs.Dataset`
+
+    :raises ValueError: If the line couldn't be interpreted.
+    """
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) != len(INVENTORY_PROPERTIES):
+        raise ValueError("expected {0} columns".format(len(INVENTORY_PROPERTIES)))
+    name, used, avail, quota, refer, mountpoint, compressratio = fields
+    return Dataset(
+        name=name,
+        used=int(used),
+        avail=int(avail),
+        quota=int(quota) or None,
+        refer=int(refer),
+        mountpoint=None if mountpoint in ("-", "none", "legacy") else mountpoint,
+        compressratio=float(compressratio.rstrip("x")),
+    )
+
+
+def _parse_quota(quota):
+    if quota is None or str(quota).lower() == "none":
+        return None
+    return parse_size(str(quota))
+
+
 def parse_size(size):
     """Convert a human readable file system size ("B", "K", "M", "G", "T")
     into a number of bytes.
 
     :param string size: Human readable size.
 
-    :returns: Number of bytes or None if an error occured.
+    :returns: Number of bytes.
     :rtype: int
 
     :raises ValueError: If size couldn't be interpreted.
@@ -155,6 +1102,394 @@ def parse_size(size):
     return int(num * prefix[letter])
 
 
+def format_size(size):
+    """Convert a number of bytes into a human readable size, the way zfs
+    shows it.
+
+    :param int size:    Number of bytes.
+
+    :returns: Human readable size or "-" if size is None.
+    :rtype: string
+    """
+    if size is None:
+        return "-"
+    for symbol in ("B", "K", "M", "G", "T", "P", "E", "Z"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        symbol = "Y"
+    if symbol == "B":
+        return "{0}B".format(int(size))
+    return "{0:.{1}f}{2}".format(size, 1 if size < 100 else 0, symbol)
+
+
+CommandTiming = collections.namedtuple(
+    "CommandTiming", ["command", "seconds", "returncode", "attempt"]
+)
+
+
+class AsyncExecutor:
+    """Run commands in parallel with asyncio.
+
+    The number of commands running at the same time is limited globally and
+    per zfs pool. Commands running longer than the timeout are killed.
+    Commands failing because a dataset is busy are retried with an
+    exponential backoff. The wall times of all commands are summed up and
+    the most recent ones are kept.
+
+    :ivar int max_concurrency:  Maximum number of commands running at once.
+    :ivar int pool_concurrency: Maximum number of commands running at once on
+                                the same pool.
+    :ivar float timeout:        Seconds after which a command is killed, None
+                                to wait forever.
+    :ivar int retries:          Number of retries for busy datasets.
+    :ivar float backoff:        Seconds to wait before the first retry, doubled
+                                for every further retry.
+    :ivar collections.deque timings:    `zfs.CommandTiming` of the last
+                                        ``max_timings`` finished commands.
+    """
+
+    BUSY = "dataset is busy"
+
+    def __init__(
+        self,
+        max_concurrency=8,
+        pool_concurrency=4,
+        timeout=600,
+        retries=3,
+        backoff=1.0,
+        max_timings=1000,
+    ):
+        self.max_concurrency = max_concurrency
+        self.pool_concurrency = pool_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # long running processes share EXECUTOR, only the totals grow
+        self.timings = collections.deque(maxlen=max_timings)
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._loop = None
+        self._semaphore = None
+        self._pool_semaphores = {}
+
+    def _semaphores(self, pool):
+        # asyncio primitives belong to the loop they are first used in
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._pool_semaphores = {}
+        if pool not in self._pool_semaphores:
+            self._pool_semaphores[pool] = asyncio.Semaphore(self.pool_concurrency)
+        return self._semaphore, self._pool_semaphores[pool]
+
+    async def run(self, command):
+        """Run a command.
+
+        :param list command:    The command to execute, the zfs pool is taken
+                                from the last argument.
+
+        :returns: A tuple of (returncode, stdout, stderr). The returncode is
+                  negative if the command was killed.
+        :rtype: tuple
+        """
+        semaphore, pool_semaphore = self._semaphores(command[-1].split("/")[0])
+        attempt = 0
+        while True:
+            # wait for the pool first, so commands queued on a busy pool
+            # don't take the slots of the other pools
+            async with pool_semaphore:
+                async with semaphore:
+                    result = await self._execute(command, attempt)
+            if result[0] == 0 or self.BUSY not in result[2] or attempt >= self.retries:
+                return result
+            delay = self.backoff * 2**attempt
+            logger.info(
+                "{0} is busy, retry in {1:.1f}s".format(" ".join(command), delay)
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _execute(self, command, attempt):
+        started = time.monotonic()
+        returncode, stdout, stderr = await _backend.execute_async(command, self.timeout)
+        if returncode is not None and returncode < 0:
+            logger.error("{0}: {1}".format(" ".join(command), stderr))
+        seconds = time.monotonic() - started
+        self.timings.append(CommandTiming(command, seconds, returncode, attempt))
+        self._count += 1
+        self._total += seconds
+        self._max = max(self._max, seconds)
+        return (returncode, stdout, stderr)
+
+    def stats(self):
+        """Summarize the wall times of all finished commands.
+
+        :returns: Number of commands, total, mean and maximum seconds.
+        :rtype: dict
+        """
+        return {
+            "count": self._count,
+            "total": self._total,
+            "mean": self._total / self._count if self._count else 0.0,
+            "max": self._max,
+        }
+
+
+EXECUTOR = AsyncExecutor()
+
+
+class Stream:
+    """Output lines of a finished command.
+
+    Iterating yields the lines of stdout without line breaks. Once the
+    iteration is done, returncode and stderr are set.
+
+    :ivar int returncode:   Return code of the command, None while running.
+    :ivar string stderr:    Error output of the command, None while running.
+    """
+
+    def __init__(self, returncode, stdout, stderr):
+        self.returncode = returncode
+        self.stderr = stderr
+        self._stdout = stdout or ""
+
+    def __iter__(self):
+        return iter(self._stdout.splitlines())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the command if it's still running."""
+
+
+class ProcessStream(Stream):
+    """Output lines of a running command, read directly from the pipe.
+
+    Error output goes to a temporary file, so the command can't block on a
+    full stderr pipe while stdout is read. Closing the stream before all
+    lines were read kills the command.
+    """
+
+    def __init__(self, command):
+        super().__init__(None, None, None)
+        self._done = False
+        self._stderr_file = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=self._stderr_file
+        )
+
+    def __iter__(self):
+        try:
+            for line in self._proc.stdout:
+                yield line.decode("utf8").rstrip("\n")
+            self._done = True
+        finally:
+            self.close()
+
+    def close(self):
+        if self.returncode is not None:
+            return
+        if not self._done and self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.stdout.close()
+        self.returncode = self._proc.wait()
+        self._stderr_file.seek(0)
+        self.stderr = self._stderr_file.read().decode("utf8")
+        self._stderr_file.close()
+
+
+class Backend:
+    """Storage backend which executes the zfs commands.
+
+    All zfs commands of this module go through the backend set with
+    `set_backend`, by default the `CliBackend`.
+    """
+
+    def execute(self, command, stdin="", communicate=True):
+        """Execute a command, see `execute_cmd`.
+
+        :returns: A tuple of (returncode, stdout, stderr).
+        :rtype: tuple
+        """
+        raise NotImplementedError()
+
+    def stream(self, command):
+        """Execute a command and iterate over its output lines.
+
+        :param list command:    The command to execute.
+
+        :rtype: `zfs.Stream`
+        """
+        return Stream(*self.execute(command))
+
+    def pipe(self, send_command, recv_command, limiter=None, chunk_size=1 << 20):
+        """Pipe the output of a command into another one, e.g. ``zfs send``
+        into ``zfs recv``, see `pipe_cmd`.
+
+        :returns: A tuple of (returncode, transferred bytes, stderr), the
+                  returncode is the one of the failed command or 0.
+        :rtype: tuple
+        """
+        raise NotImplementedError()
+
+    async def execute_async(self, command, timeout=None):
+        """Execute a command without blocking the event loop.
+
+        :param list command:    The command to execute.
+        :param float timeout:   Seconds after which the command is killed.
+
+        :returns: A tuple of (returncode, stdout, stderr). The returncode is
+                  negative if the command was killed or, if the backend can't
+                  kill it, isn't waited for after the timeout.
+        :rtype: tuple
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(None, self.execute, command), timeout
+            )
+        except asyncio.TimeoutError:
+            return (
+                -signal.SIGKILL,
+                "",
+                "not waited for after a timeout of {0}s".format(timeout),
+            )
+
+
+class CliBackend(Backend):
+    """Backend running the real zfs command line tools."""
+
+    def execute(self, command, stdin="", communicate=True):
+        returncode = 0
+        is_shell = isinstance(command, str)
+        proc = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=is_shell
+        )
+        if communicate:
+            (stdout, stderr) = proc.communicate(stdin)
+            returncode = proc.wait()
+            return (returncode, stdout.decode("utf8"), stderr.decode("utf8"))
+        return (None, None, None)
+
+    def stream(self, command):
+        return ProcessStream(command)
+
+    def pipe(self, send_command, recv_command, limiter=None, chunk_size=1 << 20):
+        transferred = 0
+        with tempfile.TemporaryFile() as send_err, tempfile.TemporaryFile() as recv_err:
+            send = subprocess.Popen(
+                send_command, stdout=subprocess.PIPE, stderr=send_err
+            )
+            recv = subprocess.Popen(
+                recv_command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=recv_err,
+            )
+            try:
+                while True:
+                    chunk = send.stdout.read(chunk_size)
+                    if not chunk:
+                        break
+                    if limiter is not None:
+                        limiter.acquire(len(chunk))
+                    recv.stdin.write(chunk)
+                    transferred += len(chunk)
+            except BrokenPipeError:
+                send.kill()
+            finally:
+                send.stdout.close()
+                try:
+                    recv.stdin.close()
+                except BrokenPipeError:
+                    pass
+            send_returncode = send.wait()
+            recv_returncode = recv.wait()
+            send_err.seek(0)
+            recv_err.seek(0)
+            stderr = (send_err.read() + recv_err.read()).decode("utf8", "replace")
+        return (recv_returncode or send_returncode, transferred, stderr)
+
+    async def execute_async(self, command, timeout=None):
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return (
+                proc.returncode,
+                "",
+                "killed after a timeout of {0}s".format(timeout),
+            )
+        return (proc.returncode, stdout.decode("utf8"), stderr.decode("utf8"))
+
+
+_backend = CliBackend()
+
+
+def set_backend(backend):
+    """Set the storage backend used for all zfs commands.
+
+    :param Backend backend: Backend, e.g. `CliBackend` or
+                            `simulator.SimulatedPool`.
+
+    :returns: The previous backend.
+    :rtype: `zfs.Backend`
+    """
+    global _backend
+    previous = _backend
+    _backend = backend
+    return previous
+
+
+def get_backend():
+    """Get the storage backend used for all zfs commands.
+
+    :rtype: `zfs.Backend`
+    """
+    return _backend
+
+
+def stream_cmd(command):
+    """Execute the given command and read its output line by line while it
+    runs, instead of buffering all of it like `execute_cmd`.
+
+    :param list command:    The command to execute.
+
+    :returns: Iterable over the output lines, with the returncode and stderr
+              set once all lines are read or the stream is closed.
+    :rtype: `zfs.Stream`
+    """
+    return _backend.stream(command)
+
+
+def pipe_cmd(send_command, recv_command, limiter=None, chunk_size=1 << 20):
+    """Pipe the output of a command into another one while both run, e.g.
+    ``zfs send`` into ``zfs recv``.
+
+    :param list send_command:           Command writing the stream.
+    :param list recv_command:           Command reading the stream.
+    :param throttle.RateLimiter limiter: Bandwidth limit in bytes per second.
+    :param int chunk_size:              Bytes read at once.
+
+    :returns: A tuple of (returncode, transferred bytes, stderr), the
+              returncode is the one of the failed command or 0.
+    :rtype: tuple
+    """
+    return _backend.pipe(send_command, recv_command, limiter, chunk_size)
+
+
 def execute_cmd(command, stdin="", communicate=True):
     """Executes the given command (which should be a list).
 
@@ -170,14 +1505,4 @@ def execute_cmd(command, stdin="", communicate=True):
 
     Returns a tuple of (returncode, stdout, stderr) upon completion.
     """
-
-    returncode = 0
-    is_shell = isinstance(command, str)
-    proc = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=is_shell
-    )
-    if communicate:
-        (stdout, stderr) = proc.communicate(stdin)
-        returncode = proc.wait()
-        return (returncode, stdout.decode("utf8"), stderr.decode("utf8"))
-    return (None, None, None)
+    return _backend.execute(command, stdin, communicate)
@@ -3,11 +3,17 @@
 
 """Test for class zfs"""
 
+import asyncio
+import collections
+import itertools
 import os
+import stat
+import time
+import tracemalloc
 
 import pytest
 
-from backupctl import zfs
+from backupctl import simulator, zfs
 
 mock_data = {
     "zfs-create": (0, "", ""),
@@ -15,6 +21,17 @@ mock_data = {
     "zfs-destroy": (0, "", ""),
     "zfs-get": (0, "0", ""),
     "zfs-set": (0, "", ""),
+    "zfs-rename": (0, "", ""),
+    "zfs-snapshot": (0, "", ""),
+    "zpool-get": (0, "1048576\n", ""),
+    "zfs-list": (
+        0,
+        "backup\t3072\t1048576\t0\t1024\t/backup\t1.00x\n"
+        "backup/customer1\t2048\t1048576\t10485760\t1024\tnone\t1.50x\n"
+        "backup/customer1/www.example.com\t1024\t1048576\t0\t1024\t"
+        "/srv/backup/customer1/www.example.com\t2.00x\n",
+        "",
+    ),
 }
 
 
@@ -27,6 +44,7 @@ def mock_zfs(mocker):
         return mock_data["-".join(cmd[:2])]
 
     mocker.patch("backupctl.zfs.execute_cmd", mocked)
+    mocker.patch("backupctl.zfs.stream_cmd", lambda cmd: zfs.Stream(*mocked(cmd)))
     yield commands
 
 
@@ -114,6 +132,443 @@ def test_remove_zfs_filesystem(mock_zfs):
     ]
 
 
+def test_rename_zfs_filesystem(mock_zfs):
+    inventory = zfs.Inventory("backup")
+    assert inventory.exists("backup/customer1")
+    assert zfs.rename_filesystem(
+        "backup/customer1", "backup/backupctl-trash/1", inventory=inventory
+    )
+    assert not inventory.exists("backup/customer1/www.example.com")
+    dataset = inventory.get("backup/backupctl-trash/1/www.example.com")
+    assert dataset.name == "backup/backupctl-trash/1/www.example.com"
+    assert zfs.set_mountpoint(
+        "backup/backupctl-trash/1/www.example.com", None, inventory
+    )
+    assert inventory.get("backup/backupctl-trash/1/www.example.com").mountpoint is None
+    assert zfs.destroy_filesystem("backup/backupctl-trash/1", inventory)
+    assert not inventory.exists("backup/backupctl-trash/1")
+    assert mock_zfs[1:] == [
+        ["zfs", "rename", "backup/customer1", "backup/backupctl-trash/1"],
+        ["zfs", "set", "mountpoint=none", "backup/backupctl-trash/1/www.example.com"],
+        ["zfs", "destroy", "-r", "-f", "backup/backupctl-trash/1"],
+    ]
+
+
+def test_snapshots(mock_zfs, mocker):
+    fs = "backup/customer1/www.example.com"
+    assert zfs.new_snapshot(fs, "2024-01-02") == fs + "@2024-01-02"
+    assert zfs.destroy_snapshots(fs, [])
+    assert zfs.destroy_snapshots(fs, ["2024-01-01", "2024-01-02"])
+    assert mock_zfs == [
+        ["zfs", "snapshot", fs + "@2024-01-02"],
+        ["zfs", "destroy", fs + "@2024-01-01,2024-01-02"],
+    ]
+    mocker.patch(
+        "backupctl.zfs.stream_cmd",
+        lambda cmd: zfs.Stream(
+            0,
+            "{0}@2024-01-02\t0\t2048\t1704153600\n"
+            "{0}@2024-01-01\t1024\t1024\t1704067200\n".format(fs),
+            "",
+        ),
+    )
+    assert zfs.list_snapshots(fs) == [
+        zfs.Snapshot(fs + "@2024-01-01", 1024, 1024, 1704067200),
+        zfs.Snapshot(fs + "@2024-01-02", 0, 2048, 1704153600),
+    ]
+
+
+def test_pool_freeing(mock_zfs):
+    assert zfs.pool_freeing("backup") == 1048576
+    assert mock_zfs == [
+        ["zpool", "get", "-H", "-p", "-o", "value", "freeing", "backup"]
+    ]
+
+
+def test_inventory(mock_zfs):
+    inventory = zfs.Inventory("backup")
+    assert inventory.exists("backup/customer1")
+    assert not inventory.exists("backup/customer2")
+    assert inventory.usage("backup/customer1") == 2048
+    assert inventory.quota("backup/customer1") == 10485760
+    assert inventory.quota("backup/customer1/www.example.com") is None
+    dataset = inventory.get("backup/customer1/www.example.com")
+    assert dataset.mountpoint == "/srv/backup/customer1/www.example.com"
+    assert dataset.compressratio == 2.0
+    assert inventory.get("backup/customer1").mountpoint is None
+    assert [d.name for d in inventory.datasets("backup/customer1")] == [
+        "backup/customer1",
+        "backup/customer1/www.example.com",
+    ]
+    assert len(mock_zfs) == 1
+    assert mock_zfs[0][:2] == ["zfs", "list"]
+
+
+def test_inventory_ttl(mock_zfs):
+    inventory = zfs.Inventory("backup", ttl=0)
+    inventory.exists("backup/customer1")
+    inventory.exists("backup/customer1")
+    assert len(mock_zfs) == 2
+
+
+def test_inventory_serves_filesystem_operations(mock_zfs):
+    inventory = zfs.Inventory("backup")
+    assert zfs.filesystem_usage("backup/customer1", inventory) == 2048
+    assert zfs.filesystem_usage("backup/customer2", inventory) is None
+    assert not zfs.new_filesystem("backup/customer1", size="1G", inventory=inventory)
+    assert zfs.new_filesystem("backup/customer2", size="1G", inventory=inventory)
+    assert inventory.quota("backup/customer2") == 1073741824
+    assert zfs.resize_filesystem("backup/customer1", "20M", inventory=inventory)
+    assert inventory.quota("backup/customer1") == 20971520
+    assert not zfs.resize_filesystem("backup/customer1", "1K", inventory=inventory)
+    assert zfs.remove_filesystem("backup/customer1", inventory=inventory)
+    assert not inventory.exists("backup/customer1/www.example.com")
+    assert [cmd[:2] for cmd in mock_zfs] == [
+        ["zfs", "list"],
+        ["zfs", "create"],
+        ["zfs", "set"],
+        ["zfs", "set"],
+        ["zfs", "destroy"],
+    ]
+
+
+STUB_ZFS = """#!/bin/sh
+echo "$@" >> "{log}"
+case "$1" in
+program)
+    cp "$3" "{script}"
+    # like zfs, only user properties can be set by a channel program
+    if sed -n '/^local properties/,/^}}/p' "$3" | grep -q '"quota"'; then
+        echo "Channel program execution failed: property 'quota' is not supported" >&2
+        exit 1
+    fi
+    echo "$STUB_PROGRAM_ERROR" >&2
+    exit $STUB_PROGRAM_EXIT
+    ;;
+get)
+    if [ "$5" = "name,property,value" ]; then
+        props="$6"
+        shift 6
+        for fs in "$@"; do
+            echo "$props" | tr , '\\n' | while read -r prop; do
+                printf '%s\\t%s\\t%s\\n' "$fs" "$prop" 0
+            done
+        done
+    else
+        echo 1024
+    fi
+    ;;
+set)
+    if [ -n "$STUB_SET_FAIL" ] && [ "$3" = "$STUB_SET_FAIL" ]; then
+        echo "cannot set property for '$3': permission denied" >&2
+        exit 1
+    fi
+    ;;
+esac
+"""
+
+
+@pytest.fixture()
+def stub_zfs(tmp_path, monkeypatch):
+    log = tmp_path / "zfs.log"
+    script = tmp_path / "received.lua"
+    executable = tmp_path / "zfs"
+    executable.write_text(STUB_ZFS.format(log=log, script=script))
+    executable.chmod(executable.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv(
+        "PATH", "{0}{1}{2}".format(tmp_path, os.pathsep, os.environ["PATH"])
+    )
+    monkeypatch.setenv("STUB_PROGRAM_EXIT", "0")
+    monkeypatch.setenv("STUB_PROGRAM_ERROR", "")
+    monkeypatch.setenv("STUB_SET_FAIL", "")
+
+    def calls():
+        return log.read_text().splitlines() if log.exists() else []
+
+    yield calls, script, monkeypatch
+
+
+def test_set_quotas_channel_program(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    assert zfs.set_quotas(
+        {
+            "backup/customer1": "1G",
+            "backup/customer1/www.example.com": "500M",
+            "backup/customer1/mail.example.com": "none",
+        }
+    )
+    assert calls()[0].startswith("program backup ")
+    # zfs can't set quotas in a channel program, it only checks them
+    assert calls()[1:] == [
+        "get -H -p -o name,property,value quota backup/customer1 "
+        "backup/customer1/mail.example.com backup/customer1/www.example.com",
+        "set quota=1073741824 backup/customer1",
+        "set quota=0 backup/customer1/mail.example.com",
+        "set quota=524288000 backup/customer1/www.example.com",
+    ]
+    lua = script.read_text()
+    quotas = lua[lua.index("local quotas") : lua.index("local properties")]
+    assert '["backup/customer1"] = {["quota"] = "1073741824"},' in quotas
+    assert '["backup/customer1/www.example.com"] = {["quota"] = "524288000"},' in quotas
+    assert '["backup/customer1/mail.example.com"] = {["quota"] = "0"},' in quotas
+    assert lua.index("zfs.check.set_prop") < lua.index("zfs.sync.set_prop")
+
+
+def test_set_properties_user_properties(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    assert zfs.set_properties(
+        {"backup/customer1": {"backupctl:owner": "ops", "compression": "off"}}
+    )
+    assert calls()[1:] == [
+        "get -H -p -o name,property,value compression backup/customer1",
+        "set compression=off backup/customer1",
+    ]
+    lua = script.read_text()
+    properties = lua[lua.index("local properties") :]
+    assert '["backup/customer1"] = {["backupctl:owner"] = "ops"},' in properties
+    # without quotas or user properties, there's nothing for a channel program
+    assert zfs.set_properties({"backup/customer2": {"compression": "off"}})
+    assert calls()[3:] == [
+        "get -H -p -o name,property,value compression backup/customer2",
+        "set compression=off backup/customer2",
+    ]
+
+
+def test_set_properties_quota_not_supported(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    # a script setting a quota is refused by zfs without our error prefix
+    script_path = script.parent / "quota.lua"
+    script_path.write_text(
+        'local properties = {\n    ["backup/customer1"] = {["quota"] = "1024"},\n}\n'
+    )
+    returncode, stdout, stderr = zfs.run_channel_program(
+        "backup", script_path.read_text()
+    )
+    assert returncode == 1
+    assert zfs.CHANNEL_PROGRAM_ERROR not in stderr
+
+
+def test_set_quotas_refused(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    monkeypatch.setenv("STUB_PROGRAM_EXIT", "1")
+    monkeypatch.setenv(
+        "STUB_PROGRAM_ERROR",
+        "backupctl: backup/customer1: new quota 1 is smaller than used size 1024",
+    )
+    assert not zfs.set_quotas({"backup/customer1": "1K", "backup/customer2": "1G"})
+    assert len(calls()) == 1
+
+
+def test_set_quotas_fallback(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    monkeypatch.setenv("STUB_PROGRAM_EXIT", "1")
+    monkeypatch.setenv("STUB_PROGRAM_ERROR", "unrecognized command 'program'")
+    assert zfs.set_quotas({"backup/customer1": "1G", "backup/customer2": "none"})
+    assert calls()[1:] == [
+        "get -H -o value -p used backup/customer1",
+        "get -H -p -o name,property,value quota backup/customer1 backup/customer2",
+        "set quota=1073741824 backup/customer1",
+        "set quota=0 backup/customer2",
+    ]
+    assert not zfs.set_quotas({"backup/customer1": "1G"}, fallback=False)
+
+
+def test_set_quotas_restored(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    monkeypatch.setenv("STUB_SET_FAIL", "backup/customer3")
+    assert not zfs.set_quotas(
+        {"backup/customer1": "1G", "backup/customer2": "2G", "backup/customer3": "3G"}
+    )
+    # the quotas set before the failure are set back to their old values
+    assert calls()[2:] == [
+        "set quota=1073741824 backup/customer1",
+        "set quota=2147483648 backup/customer2",
+        "set quota=3221225472 backup/customer3",
+        "set quota=0 backup/customer2",
+        "set quota=0 backup/customer1",
+    ]
+
+
+def test_set_quotas_fallback_too_small(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    monkeypatch.setenv("STUB_PROGRAM_EXIT", "1")
+    monkeypatch.setenv("STUB_PROGRAM_ERROR", "unrecognized command 'program'")
+    assert not zfs.set_quotas({"backup/customer1": "1G", "backup/customer2": "512B"})
+    assert [call.split()[0] for call in calls()] == ["program", "get", "get"]
+
+
+def test_async_filesystem_operations(stub_zfs):
+    calls, script, monkeypatch = stub_zfs
+    executor = zfs.AsyncExecutor()
+
+    async def operations():
+        return await asyncio.gather(
+            zfs.async_new_filesystem("backup/customer1", size="1G", executor=executor),
+            zfs.async_resize_filesystem("backup/customer2", "1G", executor=executor),
+            zfs.async_resize_filesystem("backup/customer3", "1B", executor=executor),
+            zfs.async_filesystem_usage("backup/customer4", executor=executor),
+            zfs.async_remove_filesystem("backup/customer5", executor=executor),
+        )
+
+    assert asyncio.run(operations()) == [True, True, False, 1024, True]
+    assert sorted(calls()) == [
+        "create -o compression=on -o dedup=off -o quota=1G -o mountpoint=none "
+        "backup/customer1",
+        "destroy -r -f backup/customer5",
+        "get -H -o value -p used backup/customer2",
+        "get -H -o value -p used backup/customer3",
+        "get -H -o value -p used backup/customer4",
+        "set mountpoint=none backup/customer5",
+        "set quota=1G backup/customer2",
+    ]
+    assert executor.stats()["count"] == 7
+
+
+def test_async_executor_timeout():
+    executor = zfs.AsyncExecutor(timeout=0.2)
+    started = time.monotonic()
+    returncode, stdout, stderr = asyncio.run(executor.run(["sleep", "10"]))
+    assert time.monotonic() - started < 5
+    assert returncode < 0
+    assert "timeout" in stderr
+    assert executor.timings[0].returncode == returncode
+
+
+def test_async_executor_backend_timeout():
+    # the backend runs the command in a thread, which can't be killed
+    pool = simulator.SimulatedPool("backup", latency=0.3)
+    previous = zfs.set_backend(pool)
+    try:
+        executor = zfs.AsyncExecutor(timeout=0.05)
+        returncode, stdout, stderr = asyncio.run(
+            executor.run(["zfs", "list", "backup"])
+        )
+    finally:
+        zfs.set_backend(previous)
+    assert returncode < 0
+    assert "timeout" in stderr
+
+
+def test_async_executor_concurrency():
+    class Backend(zfs.Backend):
+        def __init__(self):
+            self.running = collections.Counter()
+            self.max = collections.Counter()
+
+        async def execute_async(self, command, timeout=None):
+            pool = command[-1].split("/")[0]
+            for key in [pool, None]:
+                self.running[key] += 1
+                self.max[key] = max(self.max[key], self.running[key])
+            await asyncio.sleep(0.01)
+            for key in [pool, None]:
+                self.running[key] -= 1
+            return (0, "", "")
+
+    backend = Backend()
+    executor = zfs.AsyncExecutor(max_concurrency=3, pool_concurrency=2)
+
+    async def pools():
+        await asyncio.gather(
+            *[
+                executor.run(["zfs", "list", "{0}/{1}".format(pool, i)])
+                for pool in ["pool1", "pool2", "pool3"]
+                for i in range(4)
+            ]
+        )
+
+    previous = zfs.set_backend(backend)
+    try:
+        asyncio.run(pools())
+    finally:
+        zfs.set_backend(previous)
+    assert backend.max[None] == 3
+    assert max(backend.max[pool] for pool in ["pool1", "pool2", "pool3"]) == 2
+    assert executor.stats()["count"] == 12
+
+
+def test_async_executor_busy_pool():
+    class Backend(zfs.Backend):
+        def __init__(self):
+            self.events = []
+
+        async def execute_async(self, command, timeout=None):
+            self.events.append(("start", command[-1]))
+            await asyncio.sleep(0.01)
+            self.events.append(("end", command[-1]))
+            return (0, "", "")
+
+    backend = Backend()
+    executor = zfs.AsyncExecutor(max_concurrency=2, pool_concurrency=1)
+
+    async def pools():
+        await asyncio.gather(
+            *[executor.run(["zfs", "list", "pool1/{0}".format(i)]) for i in range(4)],
+            executor.run(["zfs", "list", "pool2/0"]),
+        )
+
+    previous = zfs.set_backend(backend)
+    try:
+        asyncio.run(pools())
+    finally:
+        zfs.set_backend(previous)
+    # the commands waiting for pool1 don't hold the slot pool2 can use
+    assert backend.events[:2] == [("start", "pool1/0"), ("start", "pool2/0")]
+
+
+def test_async_executor_timings():
+    class Backend(zfs.Backend):
+        async def execute_async(self, command, timeout=None):
+            return (0, "", "")
+
+    executor = zfs.AsyncExecutor(max_timings=2)
+
+    async def commands():
+        for i in range(5):
+            await executor.run(["zfs", "list", "backup/{0}".format(i)])
+
+    previous = zfs.set_backend(Backend())
+    try:
+        asyncio.run(commands())
+    finally:
+        zfs.set_backend(previous)
+    assert [timing.command[-1] for timing in executor.timings] == [
+        "backup/3",
+        "backup/4",
+    ]
+    assert executor.stats()["count"] == 5
+
+
+def test_async_executor_busy_retry(tmp_path):
+    counter = tmp_path / "attempts"
+    executor = zfs.AsyncExecutor(retries=2, backoff=0.01)
+    command = [
+        "sh",
+        "-c",
+        'echo x >> "$0"; '
+        'if [ $(wc -l < "$0") -lt 3 ]; then echo "dataset is busy" >&2; exit 1; fi',
+        str(counter),
+    ]
+    assert asyncio.run(executor.run(command))[0] == 0
+    assert [timing.attempt for timing in executor.timings] == [0, 1, 2]
+    counter.unlink()
+    executor = zfs.AsyncExecutor(retries=1, backoff=0.01)
+    assert asyncio.run(executor.run(command))[0] == 1
+
+
+def test_parse_dataset_invalid():
+    with pytest.raises(ValueError):
+        zfs.parse_dataset("backup\t0")
+
+
+@pytest.mark.parametrize(
+    "size, human_size",
+    [(None, "-"), (512, "512B"), (10240, "10.0K"), (11811160064, "11.0G")],
+)
+def test_format_size(size, human_size):
+    assert zfs.format_size(size) == human_size
+
+
 @pytest.mark.parametrize(
     "human_size, parsed_bytes",
     [
@@ -128,6 +583,73 @@ def test_parse_size(human_size, parsed_bytes):
     assert zfs.parse_size(human_size) == parsed_bytes
 
 
+def test_stream_cmd():
+    stream = zfs.stream_cmd(["sh", "-c", "echo one; echo two; echo error >&2; exit 3"])
+    assert stream.returncode is None
+    assert list(stream) == ["one", "two"]
+    assert stream.returncode == 3
+    assert stream.stderr == "error\n"
+
+
+def test_stream_cmd_early_termination():
+    started = time.monotonic()
+    with zfs.stream_cmd(["yes"]) as stream:
+        assert list(itertools.islice(stream, 3)) == ["y", "y", "y"]
+    assert stream.returncode < 0
+    assert time.monotonic() - started < 5
+
+
+def test_stream_cmd_bounded_memory():
+    tracemalloc.start()
+    count = sum(1 for line in zfs.stream_cmd(["seq", "1", "500000"]))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert count == 500000
+    assert peak < 1 << 20
+
+
+def test_list_records(mock_zfs):
+    records = list(zfs.list_records("backup", ["name", "used"], depth=1))
+    assert records[1][:2] == ["backup/customer1", "2048"]
+    assert mock_zfs == [
+        ["zfs", "list", "-H", "-p", "-o", "name,used", "-t", "filesystem"]
+        + ["-d", "1", "backup"]
+    ]
+
+
+def test_get_properties(mocker):
+    mocker.patch(
+        "backupctl.zfs.stream_cmd",
+        lambda cmd: zfs.Stream(
+            0,
+            "backup/customer1\tused\t2048\n"
+            "backup/customer1@2018-01-01\tused\t1024\n",
+            "",
+        ),
+    )
+    assert list(
+        zfs.get_properties("backup/customer1", ["used"], recursive=True, types="all")
+    ) == [
+        zfs.Property("backup/customer1", "used", "2048"),
+        zfs.Property("backup/customer1@2018-01-01", "used", "1024"),
+    ]
+
+
+def test_get_properties_short_line(mocker, caplog):
+    mocker.patch(
+        "backupctl.zfs.stream_cmd",
+        lambda cmd: zfs.Stream(
+            1,
+            "backup/customer1\tused\t2048\nbackup/customer1@2018\n",
+            "cannot open 'backup/customer1@2018-01-01': dataset does not exist",
+        ),
+    )
+    assert list(zfs.get_properties("backup/customer1", ["used"], recursive=True)) == [
+        zfs.Property("backup/customer1", "used", "2048")
+    ]
+    assert "ignore zfs get line 'backup/customer1@2018'" in caplog.text
+
+
 def test_execute_cmd():
     zfs.execute_cmd(["echo", "hello world"], communicate=False)
     returncode, stdout, stderr = zfs.execute_cmd(["echo", "hello world"])
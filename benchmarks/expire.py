@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark the removal of hardlinked dirvish image trees.
+
+Builds a synthetic vault in which every image is a hardlink copy of the first
+one, then removes the images with ``rm -rf`` and with `walk.Remover` at
+different numbers of threads. Run it from the repository root::
+
+    python3 -m benchmarks.expire --images 4 --directories 200 --files 100 \\
+        --jobs 1,4,16 --path /srv/backup/benchmark
+
+Use a path on the pool the vaults are on, the results on a tmpfs don't say
+much about zfs.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from backupctl import walk
+
+
+def build(path, images, directories, files, size):
+    """Create a vault with hardlinked images.
+
+    :param string path:         Vault directory.
+    :param int images:          Number of images.
+    :param int directories:     Number of directories per image.
+    :param int files:           Number of files per directory.
+    :param int size:            Size of each file in bytes.
+
+    :returns: Image directories.
+    :rtype: `list` of `string`
+    """
+    data = b"x" * size
+    paths = [os.path.join(path, "image{0}".format(i)) for i in range(images)]
+    for d in range(directories):
+        # a few levels deep, like a real file system
+        relative = os.path.join(
+            "d{0}".format(d % 10), "d{0}".format(d % 7), "d{0}".format(d)
+        )
+        first = os.path.join(paths[0], relative)
+        os.makedirs(first)
+        for f in range(files):
+            with open(os.path.join(first, "f{0}".format(f)), "wb") as out:
+                out.write(data)
+        for image in paths[1:]:
+            target = os.path.join(image, relative)
+            os.makedirs(target)
+            for f in range(files):
+                name = "f{0}".format(f)
+                os.link(os.path.join(first, name), os.path.join(target, name))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--directories", type=int, default=200)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--size", type=int, default=0)
+    parser.add_argument("--jobs", default="1,2,4,8,16")
+    parser.add_argument("--path", default=None)
+    args = parser.parse_args()
+
+    runs = [("rm -rf", None)] + [
+        ("remover -j {0}".format(jobs), int(jobs)) for jobs in args.jobs.split(",")
+    ]
+    inodes = args.images * args.directories * args.files
+    print("{0} links in {1} images".format(inodes, args.images))
+    print("{0:<16} {1:>10} {2:>12}".format("METHOD", "SECONDS", "UNLINKS/S"))
+    for name, jobs in runs:
+        path = tempfile.mkdtemp(prefix="backupctl-benchmark-", dir=args.path)
+        try:
+            paths = build(path, args.images, args.directories, args.files, args.size)
+            started = time.monotonic()
+            if jobs is None:
+                subprocess.check_call(["rm", "-rf"] + paths)
+            else:
+                walk.remove_trees(paths, jobs=jobs)
+            seconds = time.monotonic() - started
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+        print("{0:<16} {1:>10.2f} {2:>12.0f}".format(name, seconds, inodes / seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,9 @@ setup(
         'jinja2',
         'SQLAlchemy',
     ),
+    extras_require={
+        'yaml': ['PyYAML'],
+    },
     keywords='dirvish, zfs',
     url='https://www.adfinis-sygroup.ch/',
     packages=find_packages(),
@@ -50,7 +53,7 @@ setup(
     entry_points="""
     [console_scripts]
     backupctl=backupctl.backupctl:main
-    backupctl-start=backupctl.backupctl:backup_start
-    backupctl-stop=backupctl.backupctl:backup_stop
+    backupctl-start=backupctl.hook:backup_start
+    backupctl-stop=backupctl.hook:backup_stop
     """
 )